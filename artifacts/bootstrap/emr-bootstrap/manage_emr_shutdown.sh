@@ -53,6 +53,10 @@ do
 		aws s3 rm ${LOCK_FILE}
 	fi
     STEPS=$(aws emr list-steps --cluster-id ${CLUSTER_ID} --step-states PENDING RUNNING | jq .Steps[].Status.State | wc -l)
+    # The resident job server (start_job_server.sh) runs outside of the steps and exits when the queue is idle
+    if pgrep -f job_server.py > /dev/null; then
+        STEPS=$((STEPS + 1))
+    fi
     echo "There are ${STEPS} in the queue"
     if [ "$STEPS" -ne "0" ]; then
         MESSAGE="$(date): Found ${STEPS} running or pending. Sleeping for ${SLEEP}..."
@@ -0,0 +1,32 @@
+#!/bin/bash -x
+#
+# Starts the resident Spark job server (job_server.py) in background on the master node
+# Added as a step by the odl_create_emr_cluster function, and by odl_spark_submit when it queues jobs (the server
+# stops after some idle minutes while the cluster keeps running):
+#   start_job_server.sh s3://bucket-programs/spark_programs/ queue_url stage_table control_table
+
+PROGRAMS=$1
+QUEUE_URL=$2
+STAGE_TABLE=$3
+CONTROL_TABLE=$4
+# The driver memory is fixed when the driver JVM starts
+DRIVER_MEMORY=${DRIVER_MEMORY:-4g}
+
+if pgrep -f job_server.py > /dev/null; then
+    echo "The job server is already running"
+    exit 0
+fi
+
+sudo mkdir -p /home/hadoop/code
+sudo aws s3 sync ${PROGRAMS} /home/hadoop/code/
+python /home/hadoop/code/schema_registry.py sync || echo "Unable to sync the schema registry"
+
+# One JVM thread per Python thread (Spark 3, ignored by Spark 2): the scheduler pool of each job is a local property
+# of its thread, the job server only sets it with pinned threads
+export PYSPARK_PIN_THREAD=true
+cd /home/hadoop/code
+nohup /usr/bin/spark-submit --driver-memory ${DRIVER_MEMORY} \
+    --conf spark.yarn.appMasterEnv.PYTHONIOENCODING=utf8 \
+    job_server.py --queue-url ${QUEUE_URL} --stage-table ${STAGE_TABLE} --control-table ${CONTROL_TABLE} \
+    >> /var/log/job_server.log 2>&1 &
+echo "Job server started"
@@ -14,8 +14,13 @@
 from __future__ import print_function
 
 
+import calendar
+import hashlib
+import json
 import logging
 import os
+from multiprocessing.pool import ThreadPool
+from threading import Lock
 
 import boto3
 
@@ -24,6 +29,18 @@ from awsglue.context import GlueContext
 from hive_metastore_migration import *
 
 CONNECTION_TYPE_NAME = 'com.amazonaws.services.glue.connections.DataCatalogConnection'
+
+# Incremental export: fingerprints of the previous export, compacted base (the import input) and latest copy of it
+FINGERPRINTS_FILE = 'fingerprints.json'
+BASE_DIR = 'base'
+LATEST_DIR = 'latest'
+
+# Tables of a database read from the Glue API in parallel
+CATALOG_READ_CONCURRENCY = 8
+
+# Glue API names of the export fields that are not the capitalized field name
+API_FIELD_NAMES = {'namespaceName': 'DatabaseName', 'order': 'SortOrder'}
+
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 logger.setLevel(getattr(logging, os.getenv('LOG_LEVEL', 'INFO')))
@@ -50,6 +67,246 @@ def change_schemas(sql_context, databases, tables, partitions):
     return databases, tables, partitions
 
 
+def split_s3_path(path):
+    """
+    Bucket and key prefix (ending in /) of an S3 path
+    :param path: s3://, s3a:// or s3n:// path
+    :return: tuple (bucket, prefix)
+    """
+    if not re.match(r'^s3[an]?://', path):
+        raise AssertionError('Path %s is not an S3 path' % path)
+    (bucket, _, prefix) = path.split('://', 1)[1].partition('/')
+    return bucket, prefix if not prefix or prefix.endswith('/') else prefix + '/'
+
+
+def list_objects(s3, bucket, prefix):
+    """
+    ETags of the objects of a prefix
+    :return: dict of key (relative to the prefix) to ETag
+    """
+    objects = dict()
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            objects[obj['Key'][len(prefix):]] = obj['ETag']
+    return objects
+
+
+def sync_s3_prefix(s3, bucket, source, target):
+    """
+    Server-side copy of the objects of the source prefix to the target prefix (only the missing or changed ones), and
+    delete the other objects of the target prefix
+    :return: None
+    """
+    source_objects = list_objects(s3, bucket, source)
+    target_objects = list_objects(s3, bucket, target)
+    copied = 0
+    for (name, etag) in source_objects.items():
+        if target_objects.get(name) != etag:
+            s3.copy_object(Bucket=bucket, Key=target + name, CopySource={'Bucket': bucket, 'Key': source + name})
+            copied += 1
+    stale = [target + name for name in target_objects if name not in source_objects]
+    for i in range(0, len(stale), 1000):
+        s3.delete_objects(Bucket=bucket, Delete={'Objects': [{'Key': key} for key in stale[i:i + 1000]]})
+    logger.info('Synced s3://{}/{} to s3://{}/{}: {} copied, {} deleted'.format(
+        bucket, source, bucket, target, copied, len(stale)))
+
+
+def api_to_catalog_item(value, data_type):
+    """
+    Convert a Glue API value to the DataCatalogConnection export format of the data type: camelCase fields (only the
+    fields of the schema) and times as milliseconds strings
+    :param value: boto3 response value
+    :param data_type: DATACATALOG_*_ITEM_SCHEMA or one of its field types
+    :return: JSON value
+    """
+    if value is None:
+        return None
+    if isinstance(data_type, StructType):
+        item = dict()
+        for field in data_type.fields:
+            name = API_FIELD_NAMES.get(field.name, field.name[0].upper() + field.name[1:])
+            if name in value:
+                item[field.name] = api_to_catalog_item(value[name], field.dataType)
+        return item
+    if isinstance(data_type, ArrayType):
+        return [api_to_catalog_item(element, data_type.elementType) for element in value]
+    if isinstance(value, datetime):
+        return str(calendar.timegm(value.utctimetuple()) * 1000 + value.microsecond // 1000)
+    return value
+
+
+def fingerprint(row):
+    return hashlib.md5(json.dumps(row, sort_keys=True)).hexdigest()
+
+
+def file_name(*names):
+    # one file per database or table, names starting with _ or . would be hidden files for spark
+    return 'part-%s.json' % hashlib.md5(json.dumps(names)).hexdigest()
+
+
+def put_rows(s3, bucket, key, rows):
+    """
+    Write the rows as JSON lines, delete the object if there are no rows
+    :return: None
+    """
+    if rows:
+        s3.put_object(Bucket=bucket, Key=key, Body='\n'.join(json.dumps(row) for row in rows) + '\n')
+    else:
+        s3.delete_object(Bucket=bucket, Key=key)
+
+
+class IncrementalExport:
+    """
+    Export of the changes of the DataCatalog since the previous export, read from the Glue API instead of the
+    DataCatalogConnection:
+
+    - fingerprints.json: per database, table (UpdateTime and hash) and partition (hash) fingerprints of the export
+    - base/: compacted export, in the import format (databases, tables and partitions folders), one file per database
+      for databases and tables and one file per table for partitions, so only the files of the changes are rewritten
+    - <timestamp>/: delta, the changed databases, tables and partitions and the deleted ones (deleted folder)
+    """
+
+    def __init__(self, client, s3, output_path):
+        self.client = client
+        self.s3 = s3
+        (self.bucket, self.prefix) = split_s3_path(output_path)
+        self.base = self.prefix + BASE_DIR + '/'
+        self.delta = split_s3_path(get_output_dir(output_path))[1]
+        self.changes = 0
+        self.lock = Lock()
+
+    def load_fingerprints(self):
+        try:
+            body = self.s3.get_object(Bucket=self.bucket, Key=self.prefix + FINGERPRINTS_FILE)['Body'].read()
+        except self.s3.exceptions.NoSuchKey:
+            return dict()
+        return json.loads(body)['databases']
+
+    def save_fingerprints(self, fingerprints):
+        self.s3.put_object(Bucket=self.bucket, Key=self.prefix + FINGERPRINTS_FILE, Body=json.dumps({
+            'exported_at': strftime('%Y-%m-%d %H:%M:%S', localtime()),
+            'databases': fingerprints
+        }))
+
+    def write_delta(self, folder, name, rows):
+        if rows:
+            put_rows(self.s3, self.bucket, '%s%s/%s' % (self.delta, folder, name), rows)
+            with self.lock:
+                self.changes += len(rows)
+
+    def export_table(self, database, table, previous):
+        """
+        Export the partitions of a table changed since the previous export
+        :param previous: fingerprint of the table in the previous export, or empty
+        :return: dict of partition values to hashes
+        """
+        rows = []
+        hashes = dict()
+        for page in self.client.get_paginator('get_partitions').paginate(DatabaseName=database, TableName=table):
+            for partition in page['Partitions']:
+                row = {'database': database, 'table': table, 'type': 'partition',
+                       'item': api_to_catalog_item(partition, DATACATALOG_PARTITION_ITEM_SCHEMA)}
+                values = json.dumps(partition['Values'])
+                hashes[values] = fingerprint(row)
+                rows.append((values, row))
+        previous_hashes = previous.get('partitions', dict())
+        if hashes == previous_hashes:
+            return hashes
+        name = file_name(database, table)
+        put_rows(self.s3, self.bucket, '%spartitions/%s' % (self.base, name), [row for (_, row) in rows])
+        self.write_delta('partitions', name, [row for (values, row) in rows
+                                              if previous_hashes.get(values) != hashes[values]])
+        self.write_delta('deleted', name, [{'type': 'partition', 'database': database, 'table': table,
+                                            'values': json.loads(values)}
+                                           for values in previous_hashes if values not in hashes])
+        return hashes
+
+    def delete_database(self, database, previous):
+        name = file_name(database)
+        self.s3.delete_object(Bucket=self.bucket, Key='%sdatabases/%s' % (self.base, name))
+        self.s3.delete_object(Bucket=self.bucket, Key='%stables/%s' % (self.base, name))
+        for table in previous.get('tables', dict()):
+            self.s3.delete_object(Bucket=self.bucket, Key='%spartitions/%s' % (self.base, file_name(database, table)))
+        self.write_delta('deleted', name, [{'type': 'database', 'database': database}])
+
+    def export_database(self, database, previous):
+        """
+        Export the changes of a database since the previous export
+        :param previous: fingerprint of the database in the previous export, or empty
+        :return: dict fingerprint of the database, None if the database does not exist
+        """
+        try:
+            response = self.client.get_database(Name=database)
+        except self.client.exceptions.EntityNotFoundException:
+            if previous:
+                self.delete_database(database, previous)
+            return None
+        name = file_name(database)
+        row = {'type': 'database', 'item': api_to_catalog_item(response['Database'], DATACATALOG_DATABASE_ITEM_SCHEMA)}
+        fingerprints = {'hash': fingerprint(row), 'tables': dict()}
+        if fingerprints['hash'] != previous.get('hash'):
+            put_rows(self.s3, self.bucket, '%sdatabases/%s' % (self.base, name), [row])
+            self.write_delta('databases', name, [row])
+
+        tables = []
+        for page in self.client.get_paginator('get_tables').paginate(DatabaseName=database):
+            tables.extend(page['TableList'])
+        previous_tables = previous.get('tables', dict())
+        rows = []
+        changed = []
+        for table in tables:
+            row = {'database': database, 'type': 'table',
+                   'item': api_to_catalog_item(table, DATACATALOG_TABLE_ITEM_SCHEMA)}
+            rows.append(row)
+            fingerprints['tables'][table['Name']] = {'update_time': str(table.get('UpdateTime')),
+                                                     'hash': fingerprint(row)}
+            if previous_tables.get(table['Name'], dict()).get('hash') != fingerprints['tables'][table['Name']]['hash']:
+                changed.append(row)
+        deleted = [table for table in previous_tables if table not in fingerprints['tables']]
+        if changed or deleted:
+            put_rows(self.s3, self.bucket, '%stables/%s' % (self.base, name), rows)
+            self.write_delta('tables', name, changed)
+            self.write_delta('deleted', name, [{'type': 'table', 'database': database, 'table': table}
+                                               for table in deleted])
+        for table in deleted:
+            self.s3.delete_object(Bucket=self.bucket, Key='%spartitions/%s' % (self.base, file_name(database, table)))
+
+        pool = ThreadPool(CATALOG_READ_CONCURRENCY)
+        try:
+            partitions = pool.map(lambda table: self.export_table(database, table['Name'],
+                                                                  previous_tables.get(table['Name'], dict())), tables)
+        finally:
+            pool.close()
+        for (table, hashes) in zip(tables, partitions):
+            fingerprints['tables'][table['Name']]['partitions'] = hashes
+        return fingerprints
+
+    def export(self, database_arr, latest=False):
+        """
+        Export the changes of the databases since the previous export (everything on the first one), and save the
+        fingerprints
+        :param database_arr: database names, or None for all the databases (the previous ones not found are deleted)
+        :param latest: server-side copy of the base to the latest folder
+        :return: number of changed or deleted items
+        """
+        previous = self.load_fingerprints()
+        fingerprints = dict(previous)
+        if database_arr is None:
+            database_arr = set(previous)
+            for page in self.client.get_paginator('get_databases').paginate():
+                database_arr.update(database['Name'] for database in page['DatabaseList'])
+        for database in sorted(database_arr):
+            fingerprints[database] = self.export_database(database, previous.get(database, dict()))
+            if fingerprints[database] is None:
+                del fingerprints[database]
+        # the base files are written before the fingerprints, a failed export is exported again by the next one
+        self.save_fingerprints(fingerprints)
+        logger.info('Exported {} changes to s3://{}/{}'.format(self.changes, self.bucket, self.delta))
+        if latest:
+            sync_s3_prefix(self.s3, self.bucket, self.base, self.prefix + LATEST_DIR + '/')
+        return self.changes
+
+
 def datacatalog_migrate_to_hive_metastore(sc, sql_context, databases, tables, partitions, connection):
 
     hive_metastore = HiveMetastore(connection, sql_context)
@@ -107,6 +364,9 @@ def main():
                         help='AWS region of source Glue DataCatalog, default to "us-east-1"')
     parser.add_argument('-l', '--latest', required=False, action='store_true',
                         help='Copy the export folder to a latest/ folder (overwriting)')
+    parser.add_argument('-I', '--incremental', required=False, action='store_true',
+                        help='Export only the changes since the previous export (S3 output path) to a timestamped '
+                             'folder, and update the base/ folder with the whole DataCatalog')
 
     options = get_options(parser, sys.argv)
     if options['mode'] == to_s3:
@@ -124,13 +384,25 @@ def main():
     else:
         raise AssertionError('unknown mode ' + options['mode'])
 
+    if options['incremental'] and options['mode'] != to_s3:
+        raise AssertionError('Option incremental is only allowed for mode ' + to_s3)
+
     validate_aws_regions(options['region'])
     client = boto3.client('glue', region_name=options['region'])
+    s3 = boto3.client('s3')
+    database_arr = options['database_names'].split(',')
+    if options['incremental']:
+        # the changes are read from the Glue API, no spark read of the whole DataCatalog
+        IncrementalExport(client, s3, options['output_path']).export(
+            database_arr=None if database_arr[0] == 'ALL' else database_arr,
+            latest=options['latest']
+        )
+        return
+
     # spark env
     (conf, sc, sql_context) = get_spark_env()
     glue_context = GlueContext(sc)
     # extract from datacatalog reader
-    database_arr = options['database_names'].split(',')
     if database_arr[0] == 'ALL':
         # get the database names from glue
         resp = client.get_databases()
@@ -156,8 +428,12 @@ def main():
             partitions=partitions,
             output_path=output_path
         )
-        if options['latest']:
-            output_path = get_output_dir(options['output_path'], 'latest')
+        if options['latest'] and re.match(r'^s3[an]?://', output_path):
+            # server-side copy of the export instead of a second spark write
+            (bucket, prefix) = split_s3_path(output_path)
+            sync_s3_prefix(s3, bucket, prefix, split_s3_path(get_output_dir(options['output_path'], LATEST_DIR))[1])
+        elif options['latest']:
+            output_path = get_output_dir(options['output_path'], LATEST_DIR)
             datacatalog_migrate_to_s3(
                 databases=databases,
                 tables=tables,
@@ -14,12 +14,19 @@
 # except for python 2.7 standard library and Spark 2.1
 import sys
 import argparse
+import heapq
+import json
+import math
 import re
 import logging
-from time import localtime, strftime
+import zlib
+from multiprocessing.pool import ThreadPool
+from operator import add
+from time import localtime, strftime, time
 from types import MethodType
 from datetime import tzinfo, datetime, timedelta
 
+from pyspark import StorageLevel
 from pyspark.context import SparkContext, SparkConf
 from pyspark.sql import SQLContext, DataFrame, Row
 from pyspark.sql.functions import lit, struct, array, col, UserDefinedFunction, concat, monotonically_increasing_id, \
@@ -29,6 +36,92 @@ from pyspark.sql.types import StringType, StructField, StructType, LongType, Arr
 
 MYSQL_DRIVER_CLASS = 'com.mysql.jdbc.Driver'
 
+# Glue BatchCreatePartition limit of partitions per request, and JSON bytes of the partitions of a request (below the
+# request size limit of the API)
+GLUE_BATCH_MAX_ITEMS = 100
+GLUE_BATCH_MAX_BYTES = 1024 * 1024
+
+# Partitions of the same table moved together to a spark partition by the batching (the last batch of each slot may
+# not be full)
+BATCH_ITEMS_PER_SLOT = 10000
+
+# Hive Metastore tables extracted, with the HiveMetastore field of each one
+METASTORE_TABLES = [
+    ('ms_dbs', 'DBS'),
+    ('ms_database_params', 'DATABASE_PARAMS'),
+    ('ms_tbls', 'TBLS'),
+    ('ms_table_params', 'TABLE_PARAMS'),
+    ('ms_columns', 'COLUMNS_V2'),
+    ('ms_bucketing_cols', 'BUCKETING_COLS'),
+    ('ms_sds', 'SDS'),
+    ('ms_sd_params', 'SD_PARAMS'),
+    ('ms_serdes', 'SERDES'),
+    ('ms_serde_params', 'SERDE_PARAMS'),
+    ('ms_skewed_col_names', 'SKEWED_COL_NAMES'),
+    ('ms_skewed_string_list', 'SKEWED_STRING_LIST'),
+    ('ms_skewed_string_list_values', 'SKEWED_STRING_LIST_VALUES'),
+    ('ms_skewed_col_value_loc_map', 'SKEWED_COL_VALUE_LOC_MAP'),
+    ('ms_sort_cols', 'SORT_COLS'),
+    ('ms_partitions', 'PARTITIONS'),
+    ('ms_partition_params', 'PARTITION_PARAMS'),
+    ('ms_partition_keys', 'PARTITION_KEYS'),
+    ('ms_partition_key_vals', 'PARTITION_KEY_VALS')
+]
+
+# Numeric id column of the tables that grow with the tables and partitions, read with parallel JDBC range partitions
+JDBC_PARTITION_COLUMNS = {
+    'TBLS': 'TBL_ID',
+    'TABLE_PARAMS': 'TBL_ID',
+    'PARTITION_KEYS': 'TBL_ID',
+    'COLUMNS_V2': 'CD_ID',
+    'SDS': 'SD_ID',
+    'SD_PARAMS': 'SD_ID',
+    'BUCKETING_COLS': 'SD_ID',
+    'SORT_COLS': 'SD_ID',
+    'SERDES': 'SERDE_ID',
+    'SERDE_PARAMS': 'SERDE_ID',
+    'PARTITIONS': 'PART_ID',
+    'PARTITION_PARAMS': 'PART_ID',
+    'PARTITION_KEY_VALS': 'PART_ID'
+}
+
+# Rows fetched per round trip (MySQL cursor fetch) and rows per JDBC partition
+JDBC_FETCH_SIZE = 10000
+JDBC_ROWS_PER_PARTITION = 200000
+JDBC_MAX_PARTITIONS = 64
+
+# Metastore tables extracted at the same time
+EXTRACT_CONCURRENCY = 8
+
+# Hive Metastore tables written, with the HiveMetastore field and the tables referenced by the foreign keys of each one
+EXPORT_TABLES = [
+    ('DBS', 'ms_dbs', []),
+    ('DATABASE_PARAMS', 'ms_database_params', ['DBS']),
+    ('CDS', 'ms_cds', []),
+    ('SERDES', 'ms_serdes', []),
+    ('SERDE_PARAMS', 'ms_serde_params', ['SERDES']),
+    ('COLUMNS_V2', 'ms_columns', ['CDS']),
+    ('SDS', 'ms_sds', ['CDS', 'SERDES']),
+    ('SD_PARAMS', 'ms_sd_params', ['SDS']),
+    ('SKEWED_COL_NAMES', 'ms_skewed_col_names', ['SDS']),
+    ('SKEWED_STRING_LIST', 'ms_skewed_string_list', []),
+    ('SKEWED_STRING_LIST_VALUES', 'ms_skewed_string_list_values', ['SKEWED_STRING_LIST']),
+    ('SKEWED_COL_VALUE_LOC_MAP', 'ms_skewed_col_value_loc_map', ['SDS', 'SKEWED_STRING_LIST']),
+    ('SORT_COLS', 'ms_sort_cols', ['SDS']),
+    ('TBLS', 'ms_tbls', ['DBS', 'SDS']),
+    ('TABLE_PARAMS', 'ms_table_params', ['TBLS']),
+    ('PARTITION_KEYS', 'ms_partition_keys', ['TBLS']),
+    ('PARTITIONS', 'ms_partitions', ['TBLS', 'SDS']),
+    ('PARTITION_PARAMS', 'ms_partition_params', ['PARTITIONS']),
+    ('PARTITION_KEY_VALS', 'ms_partition_key_vals', ['PARTITIONS'])
+]
+
+# Rows per JDBC batch insert (one multi-row INSERT with rewriteBatchedStatements)
+JDBC_BATCH_SIZE = 5000
+
+# Metastore tables written at the same time
+EXPORT_CONCURRENCY = 8
+
 # flags for migration direction
 FROM_METASTORE = 'from-metastore'
 TO_METASTORE = 'to-metastore'
@@ -225,34 +318,70 @@ def join_other_to_single_column(df, other, on, how, new_column_name):
     return df.join(other=other_combined, on=on, how=how)
 
 
-def batch_items_within_partition(sql_context, df, key_col, value_col, values_col):
+def batch_items_by_key(sql_context, df, key_col, value_col, values_col, max_items=GLUE_BATCH_MAX_ITEMS,
+                       max_bytes=GLUE_BATCH_MAX_BYTES, items_per_slot=BATCH_ITEMS_PER_SLOT):
     """
-    Group a DataFrame of key, value pairs, create a list of values for the same key in each spark partition, but there
-    is no cross-partition data interaction, so the same key may be shown multiple times in the output dataframe
+    Group a DataFrame of key, value pairs in batches of values of the same key, with at most max_items values and
+    max_bytes of JSON values per batch. The values of each key are split in slots of up to items_per_slot values,
+    spread over the spark partitions by their size (largest first, to the partition with less values), and the
+    values of the same key in a partition are batched together: full batches, balanced between the executors
     :param sql_context: spark sqlContext
     :param df: DataFrame with only two columns, a key_col and a value_col
     :param key_col: name of key column
     :param value_col: name of value column
     :param values_col: name of values column, which is an array of value_col
+    :param max_items: maximum values per batch
+    :param max_bytes: maximum JSON bytes of the values of a batch (a single bigger value is a batch alone)
+    :param items_per_slot: values of the same key moved together to a spark partition
     :type df: DataFrame
     :type key_col: str
     :type value_col: str
-    :return: DataFrame of values grouped by key within each partition
+    :return: DataFrame of batches of values grouped by key
     """
-
-    def group_by_key(it):
+    sc = df.rdd.context
+    pairs = df.rdd.map(lambda row: (row[key_col], row[value_col])).persist(StorageLevel.MEMORY_AND_DISK)
+    counts = pairs.map(lambda kv: (kv[0], 1)).reduceByKey(add).collect()
+
+    num_partitions = max(1, sc.defaultParallelism)
+    splits = dict()
+    slots = []
+    for (key, count) in counts:
+        splits[key] = int(math.ceil(float(count) / items_per_slot))
+        slots.extend(((key, split), float(count) / splits[key]) for split in range(splits[key]))
+    loads = [(0, partition) for partition in range(num_partitions)]
+    slot_partitions = dict()
+    for (slot, size) in sorted(slots, key=lambda item: -item[1]):
+        (load, partition) = heapq.heappop(loads)
+        slot_partitions[slot] = partition
+        heapq.heappush(loads, (load + size, partition))
+    splits = sc.broadcast(splits)
+    slot_partitions = sc.broadcast(slot_partitions)
+
+    def to_slot(kv):
+        (k, v) = kv
+        payload = json.dumps(v.asDict(recursive=True) if isinstance(v, Row) else v, default=str)
+        return ((k, zlib.crc32(payload) % splits.value[k]), (v, len(payload)))
+
+    def batch_by_key(it):
         grouped = dict()
-        for row in it:
-            (k, v) = (row[key_col], row[value_col])
-            if k in grouped:
-                grouped[k].append(v)
-            else:
-                grouped[k] = [v]
+        for ((k, _), value) in it:
+            grouped.setdefault(k, []).append(value)
         row = Row(key_col, values_col)
         for k in grouped:
-            yield row(k, grouped[k])
-
-    return sql_context.createDataFrame(data=df.rdd.mapPartitions(group_by_key), schema=StructType([
+            (batch, batch_bytes) = ([], 0)
+            for (v, size) in grouped[k]:
+                if batch and (len(batch) >= max_items or batch_bytes + size > max_bytes):
+                    yield row(k, batch)
+                    (batch, batch_bytes) = ([], 0)
+                batch.append(v)
+                batch_bytes += size
+            if batch:
+                yield row(k, batch)
+
+    batches = pairs.map(to_slot) \
+        .partitionBy(num_partitions, partitionFunc=lambda slot: slot_partitions.value[slot]) \
+        .mapPartitions(batch_by_key)
+    return sql_context.createDataFrame(data=batches, schema=StructType([
         StructField(key_col, get_schema_type(df, key_col), True),
         StructField(values_col, ArrayType(get_schema_type(df, value_col)), True)
     ]))
@@ -264,10 +393,10 @@ def batch_metastore_partitions(sql_context, df_parts):
     :param df_parts: the dataframe of partitions with the schema of DATACATALOG_PARTITION_SCHEMA
     :type df_parts: DataFrame
     :return: a dataframe partition in which each row contains a list of catalog partitions
-    belonging to the same database and table.
+    belonging to the same database and table, at most one Glue BatchCreatePartition request.
     """
     df_kv = df_parts.select(struct(['database', 'table', 'type']).alias('key'), 'item')
-    batched_kv = batch_items_within_partition(sql_context, df_kv, key_col='key', value_col='item', values_col='items')
+    batched_kv = batch_items_by_key(sql_context, df_kv, key_col='key', value_col='item', values_col='items')
     batched_parts = batched_kv.select(
         batched_kv.key.database.alias('database'),
         batched_kv.key.table.alias('table'),
@@ -1259,87 +1388,148 @@ class HiveMetastore:
     As a convention, the fields are prefixed by ms_ to show that it is raw Hive Metastore data
     """
 
-    def read_table(self, connection, db_name='hive', table_name=None):
+    @staticmethod
+    def jdbc_url(url, properties):
+        """
+        MySQL url with the driver properties that are not in the url yet
+        """
+        for name in sorted(properties):
+            if '%s=' % name not in url:
+                url = '%s%s%s=%s' % (url, '&' if '?' in url else '?', name, properties[name])
+        return url
+
+    def read_bounds(self, connection, db_name='hive', table_name=None, column=None):
         """
-        Load a JDBC table into Spark Dataframe
+        Min, max and count of the id column of a JDBC table, in one query
         """
-        return self.sql_context.read.format('jdbc').options(
+        bounds = self.sql_context.read.format('jdbc').options(
             url=connection['url'],
-            dbtable='%s.%s' % (db_name, table_name),
+            dbtable='(SELECT MIN(%s) AS lower_bound, MAX(%s) AS upper_bound, COUNT(*) AS row_count FROM %s.%s) bounds'
+                    % (column, column, db_name, table_name),
             user=connection['user'],
             password=connection['password'],
             driver=MYSQL_DRIVER_CLASS
-        ).load()
+        ).load().collect()[0]
+        return bounds.lower_bound, bounds.upper_bound, bounds.row_count
+
+    def read_table(self, connection, db_name='hive', table_name=None, partition_column=None):
+        """
+        Load a JDBC table into Spark Dataframe. With a numeric partition column the table is read by ranges of the
+        column in parallel, one partition per JDBC_ROWS_PER_PARTITION rows
+        """
+        options = {
+            # Server side cursors: the driver ignores the fetchsize without them and reads the whole result in memory
+            'url': self.jdbc_url(connection['url'], {'useCursorFetch': 'true'}),
+            'dbtable': '%s.%s' % (db_name, table_name),
+            'user': connection['user'],
+            'password': connection['password'],
+            'driver': MYSQL_DRIVER_CLASS,
+            'fetchsize': str(JDBC_FETCH_SIZE)
+        }
+        if partition_column:
+            (lower_bound, upper_bound, row_count) = self.read_bounds(connection, db_name, table_name,
+                                                                     partition_column)
+            num_partitions = min(JDBC_MAX_PARTITIONS, int(math.ceil(float(row_count) / JDBC_ROWS_PER_PARTITION)))
+            if num_partitions > 1 and upper_bound > lower_bound:
+                # The bounds only define the ranges, the rows out of them are read by the first and last partitions
+                options.update({
+                    'partitionColumn': partition_column,
+                    'lowerBound': str(lower_bound),
+                    'upperBound': str(upper_bound),
+                    'numPartitions': str(num_partitions)
+                })
+            logging.info('Reading %s.%s: %s rows in %s partitions' % (db_name, table_name, row_count,
+                                                                       max(num_partitions, 1)))
+        return self.sql_context.read.format('jdbc').options(**options).load()
 
     def write_table(self, connection, db_name='hive', table_name=None, df=None):
         """
-        Write from Spark Dataframe into a JDBC table
+        Write from Spark Dataframe into a JDBC table, in batches of JDBC_BATCH_SIZE rows rewritten by the driver as
+        multi-row inserts
         """
         return df.write.jdbc(
-            url=connection['url'],
+            url=self.jdbc_url(connection['url'], {'rewriteBatchedStatements': 'true'}),
             table='%s.%s' % (db_name, table_name),
             mode='append',
             properties={
                 'user': connection['user'],
                 'password': connection['password'],
-                'driver': MYSQL_DRIVER_CLASS
+                'driver': MYSQL_DRIVER_CLASS,
+                'batchsize': str(JDBC_BATCH_SIZE)
             }
         )
 
+    def extract_table(self, table):
+        """
+        Read and cache a metastore table, the transformations join the tables many times
+        """
+        (field, table_name) = table
+        df = self.read_table(connection=self.connection, table_name=table_name,
+                             partition_column=JDBC_PARTITION_COLUMNS.get(table_name))
+        df = df.persist(StorageLevel.MEMORY_AND_DISK)
+        logging.info('Extracted %s: %s rows' % (table_name, df.count()))
+        return (field, df)
+
     def extract_metastore(self):
-        self.ms_dbs = self.read_table(connection=self.connection, table_name='DBS')
-        self.ms_database_params = self.read_table(connection=self.connection, table_name='DATABASE_PARAMS')
-        self.ms_tbls = self.read_table(connection=self.connection, table_name='TBLS')
-        self.ms_table_params = self.read_table(connection=self.connection, table_name='TABLE_PARAMS')
-        self.ms_columns = self.read_table(connection=self.connection, table_name='COLUMNS_V2')
-        self.ms_bucketing_cols = self.read_table(connection=self.connection, table_name='BUCKETING_COLS')
-        self.ms_sds = self.read_table(connection=self.connection, table_name='SDS')
-        self.ms_sd_params = self.read_table(connection=self.connection, table_name='SD_PARAMS')
-        self.ms_serdes = self.read_table(connection=self.connection, table_name='SERDES')
-        self.ms_serde_params = self.read_table(connection=self.connection, table_name='SERDE_PARAMS')
-        self.ms_skewed_col_names = self.read_table(connection=self.connection, table_name='SKEWED_COL_NAMES')
-        self.ms_skewed_string_list = self.read_table(connection=self.connection, table_name='SKEWED_STRING_LIST')
-        self.ms_skewed_string_list_values = self.read_table(connection=self.connection,
-                                                            table_name='SKEWED_STRING_LIST_VALUES')
-        self.ms_skewed_col_value_loc_map = self.read_table(connection=self.connection,
-                                                           table_name='SKEWED_COL_VALUE_LOC_MAP')
-        self.ms_sort_cols = self.read_table(connection=self.connection, table_name='SORT_COLS')
-        self.ms_partitions = self.read_table(connection=self.connection, table_name='PARTITIONS')
-        self.ms_partition_params = self.read_table(connection=self.connection, table_name='PARTITION_PARAMS')
-        self.ms_partition_keys = self.read_table(connection=self.connection, table_name='PARTITION_KEYS')
-        self.ms_partition_key_vals = self.read_table(connection=self.connection, table_name='PARTITION_KEY_VALS')
-
-    # order of write matters here
+        # The tables are independent, their JDBC reads run at the same time
+        pool = ThreadPool(EXTRACT_CONCURRENCY)
+        try:
+            for (field, df) in pool.map(self.extract_table, METASTORE_TABLES):
+                setattr(self, field, df)
+        finally:
+            pool.close()
+            pool.join()
+
+    @staticmethod
+    def export_waves():
+        """
+        Tables to write in order of the foreign keys: each wave only references the tables of the previous waves
+        """
+        written = set()
+        pending = list(EXPORT_TABLES)
+        waves = []
+        while pending:
+            wave = [table for table in pending if set(table[2]) <= written]
+            if not wave:
+                raise AssertionError('circular foreign keys between %s' % ', '.join(table[0] for table in pending))
+            waves.append(wave)
+            written.update(table[0] for table in wave)
+            pending = [table for table in pending if table not in wave]
+        return waves
+
+    def export_table(self, table):
+        """
+        Write a table and return its row count and duration
+        """
+        (table_name, field, _) = table
+        df = getattr(self, field).persist(StorageLevel.MEMORY_AND_DISK)
+        start = time()
+        rows = df.count()
+        self.write_table(connection=self.connection, table_name=table_name, df=df)
+        df.unpersist()
+        seconds = time() - start
+        print('Loaded %s: %s rows in %.1f seconds' % (table_name, rows, seconds))
+        return (table_name, {'rows': rows, 'seconds': seconds})
+
+    # order of write matters here: the tables of a wave are written at the same time after the previous waves
     def export_to_metastore(self):
-        self.ms_dbs.show()
-        self.write_table(connection=self.connection, table_name='DBS', df=self.ms_dbs)
-        self.write_table(connection=self.connection, table_name='DATABASE_PARAMS', df=self.ms_database_params)
-        self.write_table(connection=self.connection, table_name='CDS', df=self.ms_cds)
-        self.write_table(connection=self.connection, table_name='SERDES', df=self.ms_serdes)
-        self.write_table(connection=self.connection, table_name='SERDE_PARAMS', df=self.ms_serde_params)
-        self.write_table(connection=self.connection, table_name='COLUMNS_V2', df=self.ms_columns)
-        self.write_table(connection=self.connection, table_name='SDS', df=self.ms_sds)
-        self.write_table(connection=self.connection, table_name='SD_PARAMS', df=self.ms_sd_params)
-        self.write_table(connection=self.connection, table_name='SKEWED_COL_NAMES', df=self.ms_skewed_col_names)
-        self.write_table(connection=self.connection, table_name='SKEWED_STRING_LIST', df=self.ms_skewed_string_list)
-        self.write_table(connection=self.connection, table_name='SKEWED_STRING_LIST_VALUES',
-                         df=self.ms_skewed_string_list_values)
-        self.write_table(connection=self.connection, table_name='SKEWED_COL_VALUE_LOC_MAP',
-                         df=self.ms_skewed_col_value_loc_map)
-        self.write_table(connection=self.connection, table_name='SORT_COLS',
-                         df=self.ms_sort_cols)
-        self.write_table(connection=self.connection, table_name='TBLS', df=self.ms_tbls)
-        self.write_table(connection=self.connection, table_name='TABLE_PARAMS', df=self.ms_table_params)
-        self.write_table(connection=self.connection, table_name='PARTITION_KEYS', df=self.ms_partition_keys)
-        self.write_table(connection=self.connection, table_name='PARTITIONS', df=self.ms_partitions)
-        self.write_table(connection=self.connection, table_name='PARTITION_PARAMS', df=self.ms_partition_params)
-        self.write_table(connection=self.connection, table_name='PARTITION_KEY_VALS', df=self.ms_partition_key_vals)
+        pool = ThreadPool(EXPORT_CONCURRENCY)
+        try:
+            for wave in self.export_waves():
+                self.export_stats.update(pool.map(self.export_table, wave))
+        finally:
+            pool.close()
+            pool.join()
+        return self.export_stats
 
     def __init__(self, connection, sql_context):
         self.connection = connection
         self.sql_context = sql_context
+        # table name: rows and seconds of the export_to_metastore writes
+        self.export_stats = dict()
         self.ms_dbs = None
         self.ms_database_params = None
+        self.ms_cds = None
         self.ms_tbls = None
         self.ms_table_params = None
         self.ms_columns = None
@@ -15,51 +15,43 @@
 # Sample Athena Query
 # Author: Rafael M. Koike
 # Date: 2018-07-06
-import time
-import boto3
+from __future__ import print_function
+
+import os
+import sys
 
+import boto3
 
-def query_waiter(execution_id, timeout=60):
-    """
-    query_waiter receives an Athena execution id and pool the Athena API till you have a SUCCEEDED/FAILED/CANCELLED
-    reply or the timeout reached (default is 60 seconds)
-    The return is the string: SUCCEEDED/FAILED/CANCELLED/TIMEOUT
+# The AthenaQueryExecutor is shared with the Lambda functions
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../../lambda')))
+from common import AthenaQueryExecutor  # noqa: E402
 
-    :param execution_id: string
-    :param timeout: integer
-    :return: string
-    """
-    start = time.time()
-    while True:
-        stats = athena_client.get_query_execution(QueryExecutionId=execution_id)
-        status = stats['QueryExecution']['Status']['State']
-        if status in ['SUCCEEDED', 'FAILED', 'CANCELLED']:
-            if status == 'SUCCEEDED':
-                status = athena_client.get_query_results(
-                    QueryExecutionId=execution_id)
-            return status
-        time.sleep(0.2)  # 200ms
-        # Exit if the time waiting exceed the timeout seconds
-        if time.time() > start + timeout:
-            return 'TIMEOUT'
+# Max number of Athena queries running at the same time (match the account Athena concurrency limit)
+MAX_CONCURRENCY = 5
 
 
 if __name__ == '__main__':
     athena_client = boto3.client('athena')
-    s3_client = boto3.client('s3')
+    executor = AthenaQueryExecutor(output_location='s3://aws-athena-query-results-109881088269-us-east-2',
+                                   max_concurrency=MAX_CONCURRENCY,
+                                   athena_client=athena_client)
     # SQL QUERY
     query = 'SHOW DATABASES;'
-    query_id_databases = athena_client.start_query_execution(QueryString=query,
-                                                             ResultConfiguration={
-                                                                 'OutputLocation': 's3://aws-athena-query-results-109881088269-us-east-2'
-                                                             })
-    resp = query_waiter(query_id_databases['QueryExecutionId'])
+    resp, execution_id = executor.execute(query)
     if resp in ['TIMEOUT', 'FAILED', 'CANCELLED']:
         print('Query result: {}'.format(resp))
         raise Exception('Unable to complete the Athena Query')
 
-    # The result is inside the ResultSet but need to extract the values
+    # All the result pages, one tuple of values per row
     print('Query executed successfully!')
-    print('Query result: {}'.format(resp.get('ResultSet')))
-    for row in resp.get('ResultSet').get('Rows'):
-        print(row.get('Data'))
+    databases = [row[0] for row in executor.iter_rows(execution_id)]
+    print('Databases: {}'.format(databases))
+
+    # Run one query per database concurrently and print each result as soon as the query finishes
+    queries = [(database, 'SHOW TABLES;', database) for database in databases]
+    for database, state, execution_id in executor.run(queries):
+        if state != 'SUCCEEDED':
+            print('Database {}: {}'.format(database, state))
+            continue
+        for row in executor.iter_rows(execution_id):
+            print(database, row)
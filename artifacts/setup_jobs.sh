@@ -2,6 +2,9 @@
 sudo mkdir /home/hadoop/code
 sudo aws s3 sync $1 /home/hadoop/code/
 
+# Cache the schema registry on the cluster (the programs read the schemas from /home/hadoop/schemas)
+python /home/hadoop/code/schema_registry.py sync || echo "Unable to sync the schema registry"
+
 jobId=`cat /mnt/var/lib/info/job-flow.json | jq -r ".jobFlowId"`
 
 finished=1
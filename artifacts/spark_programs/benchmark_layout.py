@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+#
+# Benchmark of the Parquet layouts (writer.py): bytes scanned by typical filters
+#
+# spark-submit --master 'local[*]' benchmark_layout.py --rows 20000000 --output /mnt/tmp/benchmark_layout
+#
+# The same synthetic data (status, customer, date_time, amount, description) is written with each layout in a local
+# directory (pyarrow reads the footers of the files, so the job runs in local mode). For each filter the row groups
+# whose min/max statistics can't exclude the filter are scanned: the report shows the MB and the % of the table
+# scanned, like Athena and the Spark predicate pushdown skip the row groups. The string statistics are written by
+# Parquet 1.10+ (Spark 2.4+).
+
+from __future__ import division
+from __future__ import print_function
+
+import glob
+import logging
+import os
+import shutil
+from datetime import datetime
+
+import click
+import pyarrow.parquet as pq
+
+from pyspark import SparkContext
+from pyspark.sql import SparkSession
+from pyspark.sql.functions import col, concat, floor, format_string, from_unixtime, lit, pow, rand, sha2, when
+
+from writer import layout_writer
+
+logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+logger = logging.getLogger(__name__)
+logger.setLevel(getattr(logging, os.getenv('LOG_LEVEL', 'INFO')))
+
+# 2018-01-01 00:00:00 UTC
+BASE_TIMESTAMP = 1514764800
+DAYS = 90
+CUSTOMERS = 10000
+STATUS = ['OPEN', 'ASSIGNED', 'PENDING', 'RESOLVED', 'CLOSED', 'CANCELLED']
+
+# The default layout is written first, the Parquet settings of the other layouts stay in the session
+LAYOUTS = [
+    ('default', {}),
+    ('sort status, customer, date_time', {
+        'sort_by': ['status', 'customer', 'date_time'], 'row_group_mb': 32, 'timestamp_micros': True}),
+    ('zorder customer, date_time', {
+        'zorder_by': ['customer', 'date_time'], 'row_group_mb': 32, 'timestamp_micros': True}),
+]
+
+# Filters: column -> (min, max) accepted values
+FILTERS = [
+    ("status = 'PENDING'", {'status': ('PENDING', 'PENDING')}),
+    ("customer = 'C00042'", {'customer': ('C00042', 'C00042')}),
+    ("date_time in 2018-02-01", {'date_time': (datetime(2018, 2, 1), datetime(2018, 2, 1, 23, 59, 59))}),
+    ("customer = 'C00042' and date_time in 2018-02", {
+        'customer': ('C00042', 'C00042'), 'date_time': (datetime(2018, 2, 1), datetime(2018, 2, 28, 23, 59, 59))}),
+]
+
+
+def generate(spark, rows):
+    # Skewed customers (some customers have most of the rows) and random order
+    customer = floor(pow(rand(seed=1), 3) * CUSTOMERS).cast('int')
+    status = floor(rand(seed=2) * len(STATUS)).cast('int')
+    status_name = lit(STATUS[-1])
+    for position, value in enumerate(STATUS[:-1]):
+        status_name = when(status == position, lit(value)).otherwise(status_name)
+    return spark.range(rows)\
+        .select(
+            status_name.alias('status'),
+            format_string('C%05d', customer).alias('customer'),
+            from_unixtime(lit(BASE_TIMESTAMP) + floor(rand(seed=3) * DAYS * 86400)).cast('timestamp')
+            .alias('date_time'),
+            (rand(seed=4) * 1000).cast('decimal(12,2)').alias('amount'),
+            concat(lit('description '), sha2(col('id').cast('string'), 256)).alias('description'))
+
+
+def _raw(value):
+    # Physical value of the statistics (strings as bytes, timestamps as microseconds)
+    if isinstance(value, datetime):
+        return int((value - datetime(1970, 1, 1)).total_seconds() * 1000000)
+    if not isinstance(value, bytes) and hasattr(value, 'encode'):
+        return value.encode('utf-8')
+    return value
+
+
+def scanned(path, conditions):
+    """
+    Bytes of the row groups that can have rows of the filter
+    :param path: string local directory of the Parquet files
+    :param conditions: dict column: (min, max)
+    :return: tuple (scanned bytes, total bytes, scanned row groups, total row groups)
+    """
+    scanned_bytes = total_bytes = scanned_groups = total_groups = 0
+    for name in glob.glob(os.path.join(path, '*.parquet')):
+        metadata = pq.ParquetFile(name).metadata
+        columns = dict((metadata.schema.column(index).name, index) for index in range(metadata.num_columns))
+        for group in range(metadata.num_row_groups):
+            row_group = metadata.row_group(group)
+            size = sum(row_group.column(index).total_compressed_size for index in range(row_group.num_columns))
+            total_bytes += size
+            total_groups += 1
+            match = True
+            for column, (low, high) in conditions.items():
+                statistics = row_group.column(columns[column]).statistics
+                if statistics is None or not statistics.has_min_max:
+                    continue
+                if _raw(high) < statistics.min_raw or _raw(low) > statistics.max_raw:
+                    match = False
+                    break
+            if match:
+                scanned_bytes += size
+                scanned_groups += 1
+    return scanned_bytes, total_bytes, scanned_groups, total_groups
+
+
+@click.command()
+@click.option('--rows', default=10000000, help='Number of rows')
+@click.option('--files', default=8, help='Number of files of each layout')
+@click.option('--output', default='/mnt/tmp/benchmark_layout', help='Local directory of the Parquet files')
+def run(rows, files, output):
+    sc = SparkContext()
+    # The timestamps of the filters are UTC
+    spark = SparkSession.builder.appName('Benchmark layout').config('spark.sql.session.timeZone', 'UTC').getOrCreate()
+
+    df = generate(spark, rows).cache()
+    df.count()
+
+    results = []
+    for name, layout in LAYOUTS:
+        path = os.path.join(output, name.split(' ')[0])
+        shutil.rmtree(path, ignore_errors=True)
+        layout = dict(layout, files=files)
+        if name == 'default':
+            layout_writer(df.repartition(files), layout={}).parquet('file://' + path)
+        else:
+            layout_writer(df, layout=layout).parquet('file://' + path)
+        for description, conditions in FILTERS:
+            results.append((name, description) + scanned(path, conditions))
+
+    print('{:<36} {:<46} {:>10} {:>8} {:>12}'.format('layout', 'filter', 'MB', '%', 'row groups'))
+    for name, description, scanned_bytes, total_bytes, scanned_groups, total_groups in results:
+        print('{:<36} {:<46} {:>10.1f} {:>7.1f}% {:>5}/{:<6}'.format(
+            name, description, scanned_bytes / 1024 / 1024, 100 * scanned_bytes / total_bytes, scanned_groups,
+            total_groups))
+    df.unpersist()
+    sc.stop()
+
+
+if __name__ == '__main__':
+    run()
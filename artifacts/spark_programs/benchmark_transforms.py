@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+#
+# Benchmark of the date parsing: Python UDF (datetime.strptime) x native expressions (transforms.parse_timestamp)
+#
+# spark-submit benchmark_transforms.py --rows 20000000 --format '%d.%m.%Y %H:%M:%S.%f'
+#
+# The input is generated and cached before the measures, each parser runs --runs times and the best run is reported
+# in rows/sec. The results of both parsers are compared on the same rows before the measures.
+
+from __future__ import print_function
+
+import logging
+import os
+import time
+from datetime import datetime
+
+import click
+
+from pyspark import SparkContext
+from pyspark.sql import SparkSession
+from pyspark.sql.functions import col, concat, count, date_format, from_unixtime, lit, lpad, udf
+from pyspark.sql.functions import max as max_
+from pyspark.sql.types import TimestampType
+
+from transforms import native_pattern, parse_timestamp
+
+logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+logger = logging.getLogger(__name__)
+logger.setLevel(getattr(logging, os.getenv('LOG_LEVEL', 'INFO')))
+
+# 2018-01-01 00:00:00 UTC
+BASE_TIMESTAMP = 1514764800
+
+
+def generate(spark, rows, python_format):
+    """
+    Cached DataFrame with the column value formatted with the format (values spread over one year)
+    """
+    pattern, _, fraction = native_pattern(python_format)
+    seconds = from_unixtime(lit(BASE_TIMESTAMP) + (col('id') * 7919) % (365 * 86400))
+    value = date_format(seconds, pattern)
+    if fraction:
+        value = concat(value, lpad((col('id') % 1000).cast('string'), 3, '0'))
+    df = spark.range(rows).select(value.alias('value')).cache()
+    df.count()
+    return df
+
+
+def strptime_udf(python_format):
+    # Same UDF of the Spark programs before transforms.py
+    def parse_date(argument):
+        try:
+            return datetime.strptime(argument, python_format)
+        except (TypeError, ValueError):
+            return None
+    return udf(parse_date, TimestampType())
+
+
+def measure(df, parsed, runs):
+    best = None
+    for _ in range(runs):
+        start = time.time()
+        df.select(parsed.alias('parsed')).agg(count('parsed'), max_('parsed')).collect()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+@click.command()
+@click.option('--rows', default=10000000, help='Number of rows')
+@click.option('--format', 'python_format', default='%d.%m.%Y %H:%M:%S.%f', help='strptime format')
+@click.option('--runs', default=3, help='Runs of each parser (best run reported)')
+def run(rows, python_format, runs):
+    if not native_pattern(python_format):
+        raise click.UsageError('The format {} has no native expression'.format(python_format))
+    sc = SparkContext()
+    spark = SparkSession.builder.appName('Benchmark transforms').getOrCreate()
+
+    df = generate(spark, rows, python_format)
+    python_udf = strptime_udf(python_format)
+    native = parse_timestamp('value', python_format)
+
+    sample = df.limit(100000).select(python_udf('value').alias('udf'), native.alias('native'))
+    mismatches = sample.filter(~col('udf').eqNullSafe(col('native'))).count()
+    if mismatches:
+        sample.filter(~col('udf').eqNullSafe(col('native'))).show(10, False)
+        raise Exception('{} rows parsed differently by the UDF and the native expression'.format(mismatches))
+
+    udf_time = measure(df, python_udf('value'), runs)
+    native_time = measure(df, native, runs)
+    print('Format: {} Rows: {}'.format(python_format, rows))
+    print('Python UDF:         {:>14,.0f} rows/sec ({:.1f}s)'.format(rows / udf_time, udf_time))
+    print('Native expressions: {:>14,.0f} rows/sec ({:.1f}s)'.format(rows / native_time, native_time))
+    print('Speedup: {:.1f}x'.format(udf_time / native_time))
+    sc.stop()
+
+
+if __name__ == '__main__':
+    run()
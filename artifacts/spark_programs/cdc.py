@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+#
+# Change data capture between successive full dumps (latest/ files, Sqoop full imports)
+#
+# The analytics table is bucketed by the primary key (cdc_bucket=pmod(hash(key), buckets)) and a snapshot with the
+# primary key and the hash of the other columns of every row is kept next to the table ({analytics}_cdc_snapshot/).
+# Each run:
+#
+#   1. joins (full outer) the new dump with the snapshot by primary key and compares the row hashes:
+#      I (new key), U (different hash), D (key missing in the dump). Unchanged rows are dropped
+#   2. writes the changes with the cdc_op column to a change partition ({analytics}_changes/cdc_date=...)
+#   3. rewrites only the buckets with changes (dynamic partition overwrite)
+#   4. writes a new snapshot version (previous snapshot + changes) and removes the older versions
+#
+# The first run (no snapshot) is a full load. A rerun after a failure finds the same changes (the snapshot is
+# replaced last) and the merge is idempotent: the changed keys are removed from the buckets before the new rows are
+# added. The primary key must be unique and not null in the dumps.
+#
+#   from cdc import capture
+#   stats = capture(spark, df, ['id'], 's3://bucket-analytics/servicedesk/customer/ca_sdm/tb_call_req/')
+
+from __future__ import print_function
+
+import logging
+import os
+from datetime import datetime
+
+from pyspark.sql.functions import coalesce, col, concat_ws, hash, lit, pmod, sha2, when
+
+logger = logging.getLogger(__name__)
+logger.setLevel(getattr(logging, os.getenv('LOG_LEVEL', 'INFO')))
+
+OP_COLUMN = 'cdc_op'
+HASH_COLUMN = 'cdc_row_hash'
+BUCKET_COLUMN = 'cdc_bucket'
+PREVIOUS_HASH_COLUMN = 'cdc_previous_hash'
+INSERT = 'I'
+UPDATE = 'U'
+DELETE = 'D'
+
+# Null and empty string must have different hashes
+NULL_MARKER = u'\u0000'
+SEPARATOR = u'\u0001'
+
+DEFAULT_BUCKETS = 64
+
+
+def row_hash(columns):
+    """
+    SHA-256 of the column values of the row
+    :param columns: list of column names
+    :return: Column
+    """
+    values = [coalesce(col(column).cast('string'), lit(NULL_MARKER)) for column in columns]
+    return sha2(concat_ws(SEPARATOR, *values), 256)
+
+
+def key_bucket(keys, buckets):
+    """
+    Bucket of the primary key (murmur3 hash, the same value in every run)
+    :param keys: list of primary key column names
+    :param buckets: integer
+    :return: Column
+    """
+    return pmod(hash(*[col(key) for key in keys]), lit(buckets))
+
+
+def _path(spark, path):
+    jvm = spark.sparkContext._jvm
+    hadoop_path = jvm.org.apache.hadoop.fs.Path(path)
+    return hadoop_path.getFileSystem(spark.sparkContext._jsc.hadoopConfiguration()), hadoop_path
+
+
+def _exists(spark, path):
+    fs, hadoop_path = _path(spark, path)
+    return fs.exists(hadoop_path)
+
+
+def _delete(spark, path):
+    fs, hadoop_path = _path(spark, path)
+    if fs.exists(hadoop_path):
+        logger.info('Deleting {}'.format(path))
+        fs.delete(hadoop_path, True)
+
+
+def snapshot_versions(spark, snapshot_path):
+    """
+    Complete snapshot versions (with the _SUCCESS file), oldest first
+    :param spark: SparkSession
+    :param snapshot_path: string
+    :return: list of paths
+    """
+    if not _exists(spark, snapshot_path):
+        return []
+    fs, hadoop_path = _path(spark, snapshot_path)
+    versions = []
+    for status in fs.listStatus(hadoop_path):
+        version = status.getPath().toString()
+        if status.isDirectory() and _exists(spark, '{}/_SUCCESS'.format(version)):
+            versions.append(version)
+    return sorted(versions)
+
+
+def detect_changes(new, previous, keys, buckets):
+    """
+    Inserted, updated and deleted rows of the new dump. The deleted rows have only the primary key
+    :param new: DataFrame with the new dump
+    :param previous: DataFrame with the snapshot (keys and cdc_row_hash)
+    :param keys: list of primary key column names
+    :param buckets: integer
+    :return: DataFrame with the columns of the dump, cdc_row_hash, cdc_op and cdc_bucket
+    """
+    columns = [column for column in new.columns if column not in keys]
+    hashed = new.withColumn(HASH_COLUMN, row_hash(columns))
+    previous = previous.select(*(keys + [col(HASH_COLUMN).alias(PREVIOUS_HASH_COLUMN)]))
+    op = when(col(HASH_COLUMN).isNull(), lit(DELETE))\
+        .when(col(PREVIOUS_HASH_COLUMN).isNull(), lit(INSERT))\
+        .when(col(HASH_COLUMN) != col(PREVIOUS_HASH_COLUMN), lit(UPDATE))
+    return hashed.join(previous, on=keys, how='full_outer')\
+        .withColumn(OP_COLUMN, op)\
+        .where(col(OP_COLUMN).isNotNull())\
+        .withColumn(BUCKET_COLUMN, key_bucket(keys, buckets))\
+        .select(*(new.columns + [HASH_COLUMN, OP_COLUMN, BUCKET_COLUMN]))
+
+
+def merge_changes(spark, changes, path, keys, touched):
+    """
+    Rewrite the buckets with changes of the table. The other buckets are not read or written
+    :param spark: SparkSession
+    :param changes: DataFrame from detect_changes
+    :param path: string table location
+    :param keys: list of primary key column names
+    :param touched: list of buckets with changes
+    :return: None
+    """
+    current = spark.read.parquet(path).where(col(BUCKET_COLUMN).isin(touched))
+    kept = current.join(changes.select(*keys), on=keys, how='left_anti').select(*current.columns)
+    upserts = changes.where(col(OP_COLUMN) != DELETE).select(*current.columns)
+    # Dynamic overwrite: the output goes to a staging directory and only the written buckets are replaced when the
+    # job commits, after the current files of the buckets were read
+    spark.conf.set('spark.sql.sources.partitionOverwriteMode', 'dynamic')
+    kept.union(upserts).write\
+        .mode('overwrite')\
+        .partitionBy(BUCKET_COLUMN)\
+        .parquet(path)
+
+
+def next_snapshot(previous, changes, keys):
+    """
+    Snapshot after the changes: the previous snapshot without the changed keys plus the inserted and updated rows
+    :param previous: DataFrame with the snapshot (keys and cdc_row_hash)
+    :param changes: DataFrame from detect_changes
+    :param keys: list of primary key column names
+    :return: DataFrame with the keys and cdc_row_hash
+    """
+    columns = keys + [HASH_COLUMN]
+    upserts = changes.where(col(OP_COLUMN) != DELETE).select(*columns)
+    return previous.join(changes.select(*keys), on=keys, how='left_anti').select(*columns).union(upserts)
+
+
+def capture(spark, new, keys, path, buckets=DEFAULT_BUCKETS, changes_path=None, snapshot_path=None):
+    """
+    Apply the new full dump to the table bucketed by the primary key, writing only the changes
+    :param spark: SparkSession (Spark 2.3+, the merge sets spark.sql.sources.partitionOverwriteMode=dynamic)
+    :param new: DataFrame with the new dump (same columns of the table, without cdc_bucket)
+    :param keys: list of primary key column names
+    :param path: string table location
+    :param buckets: integer number of buckets of the table (fixed after the first load)
+    :param changes_path: string location of the change partitions (default: {path}_changes)
+    :param snapshot_path: string location of the snapshots (default: {path}_cdc_snapshot)
+    :return: dict with the mode (full or incremental), the number of inserts, updates and deletes and the buckets
+    """
+    path = path.rstrip('/')
+    changes_path = (changes_path or path + '_changes').rstrip('/')
+    snapshot_path = (snapshot_path or path + '_cdc_snapshot').rstrip('/')
+    cdc_date = datetime.utcnow().strftime('%Y-%m-%d-%H-%M-%S')
+    snapshot = '{}/version={}'.format(snapshot_path, cdc_date)
+    columns = [column for column in new.columns if column not in keys]
+    versions = snapshot_versions(spark, snapshot_path)
+
+    if not versions:
+        logger.info('No snapshot in {}, full load of {}'.format(snapshot_path, path))
+        # Remove the files of the previous layout (the dynamic overwrite would keep them)
+        _delete(spark, path)
+        new.withColumn(BUCKET_COLUMN, key_bucket(keys, buckets)).write\
+            .mode('overwrite')\
+            .partitionBy(BUCKET_COLUMN)\
+            .parquet(path)
+        # The snapshot is read from the table just written (the dump is read only once)
+        spark.read.parquet(path).select(*(keys + [row_hash(columns).alias(HASH_COLUMN)])).write\
+            .mode('overwrite')\
+            .parquet(snapshot)
+        return {'mode': 'full', 'cdc_date': cdc_date, 'buckets': list(range(buckets))}
+
+    previous = spark.read.parquet(versions[-1])
+    logger.info('Comparing the dump with the snapshot {}'.format(versions[-1]))
+    changes = detect_changes(new, previous, keys, buckets).persist()
+    counts = dict((row[OP_COLUMN], row['count']) for row in changes.groupBy(OP_COLUMN).count().collect())
+    stats = {
+        'mode': 'incremental',
+        'cdc_date': cdc_date,
+        'inserts': counts.get(INSERT, 0),
+        'updates': counts.get(UPDATE, 0),
+        'deletes': counts.get(DELETE, 0),
+        'buckets': []
+    }
+    logger.info('Changes: {inserts} inserts, {updates} updates, {deletes} deletes'.format(**stats))
+    if not counts:
+        changes.unpersist()
+        return stats
+
+    stats['buckets'] = sorted(row[BUCKET_COLUMN] for row in changes.select(BUCKET_COLUMN).distinct().collect())
+    changes.drop(BUCKET_COLUMN).write.mode('overwrite').parquet('{}/cdc_date={}'.format(changes_path, cdc_date))
+    merge_changes(spark, changes, path, keys, stats['buckets'])
+    next_snapshot(previous, changes, keys).write.mode('overwrite').parquet(snapshot)
+
+    # The buckets left without rows (only deletes) are not written by the dynamic overwrite, remove their old files
+    filled = spark.read.parquet(snapshot).select(key_bucket(keys, buckets).alias(BUCKET_COLUMN)).distinct().collect()
+    for bucket in set(stats['buckets']) - set(row[BUCKET_COLUMN] for row in filled):
+        _delete(spark, '{}/{}={}'.format(path, BUCKET_COLUMN, bucket))
+
+    changes.unpersist()
+    for version in versions:
+        _delete(spark, version)
+    return stats
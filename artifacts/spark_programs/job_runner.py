@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+#
+# Generic Spark job (read, transforms, write) described by a JSON job spec
+#
+#   spark-submit job_runner.py --spec /home/hadoop/code/jobs/tb_table1.json --var s3_dir_stage=s3://... \
+#       --partition dt=2018-07-06
+#
+# Job spec (jobs/*.json):
+#
+#   {
+#     "name": "tb_table1",
+#     "profile": "medium",                            resource profile (PROFILES)
+#     "conf": {"spark.sql.shuffle.partitions": "64"}, Spark conf over the profile
+#     "source": {
+#       "format": "csv",                              csv, json, parquet, orc, text or table (Hive table)
+#       "path": "{s3_dir_stage}",                     files of the formats, or "table": "{hive_database_raw}.{...}"
+#       "options": {"sep": ";", "header": "true"},
+#       "schema": {"s3_data_source": "{s3_dir_stage}", "database": "{hive_database_raw}", "table": "..."}
+#     },
+#     "transforms": [                                 TRANSFORMS, applied in order
+#       {"type": "parse_date", "column": "date_time", "formats": ["%Y.%m.%d"], "output": "year"},
+#       {"type": "with_column", "column": "year", "expr": "year(year)"}
+#     ],
+#     "target": {
+#       "table": "{hive_database_analytics}.{hive_table_analytics}",   or "path"
+#       "mode": "append",                             append, overwrite, overwrite_partitions or cdc
+#       "partition_by": ["year"],
+#       "primary_key": ["id"], "buckets": 64,         cdc mode (cdc.py)
+#       "layout": {"sort_by": ["status"]}             writer.py layout (default: the job catalog layout)
+#     },
+#     "delete_source": false                          delete the files read after the write (stage files)
+#   }
+#
+# The strings of the spec are formatted with the variables ({name}): the --var options and the arguments sent by
+# odl_spark_submit (params_type job_spec). --partition name=value sets the partition_name and partition variables and
+# reads only this partition of a source table.
+#
+# --manifest (manifest.py) replaces the source path by the exact files of the manifest (no listing) and, with
+# delete_source, only these files are deleted.
+#
+# The spark.datalake.profile conf (odl_spark_submit, profile of the job catalog) profiles the DataFrame and checks
+# its quality rules before the write (profiling.py).
+#
+# The spark.datalake.rollups conf (rollups of the job catalog) updates the rollup tables of a partitioned target table
+# with the partition processed (rollup.py).
+#
+# The profile and the conf of the spec are set in the SparkConf of the SparkContext: the executors are started with
+# them (spark.conf.set after the start has no effect on the executors, the serializer, etc). The driver memory is
+# fixed when spark-submit starts the driver JVM and must be a spark-submit argument.
+
+from __future__ import print_function
+
+import json
+import logging
+import os
+import re
+
+import click
+
+from pyspark import SparkConf
+from pyspark import SparkContext
+from pyspark.sql import SparkSession
+from pyspark.sql.functions import col, expr
+
+from cdc import BUCKET_COLUMN, DEFAULT_BUCKETS, capture
+from manifest import delete_files as delete_manifest_files
+from manifest import manifest_files, plan_input, read_manifest
+from profiling import profiled
+from rollup import update_rollups
+from schema_registry import get_struct_type
+from transforms import parse_date, parse_timestamp
+from writer import layout_writer
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(getattr(logging, os.getenv('LOG_LEVEL', 'INFO')))
+logger.info('Loading Job module.')
+
+# Settings of every job
+COMMON_CONF = {
+    'spark.serializer': 'org.apache.spark.serializer.KryoSerializer',
+    # Must be lower than 2048m
+    'spark.kryoserializer.buffer.max': '1024m',
+    'spark.rdd.compress': 'true',
+    'spark.speculation': 'false',
+    'spark.debug.maxToStringFields': '100',
+    'spark.hadoop.mapreduce.fileoutputcommitter.algorithm.version': '2',
+    # 512 MBs per partition (RDD and DataFrame readers)
+    'spark.hadoop.mapreduce.input.fileinputformat.split.minsize': '536870912',
+    'spark.hadoop.mapreduce.input.fileinputformat.split.maxsize': '536870912',
+    'spark.sql.files.maxPartitionBytes': '536870912',
+    'hive.exec.dynamic.partition': 'true',
+    'hive.exec.dynamic.partition.mode': 'nonstrict',
+}
+
+# Executor resources and shuffle parallelism
+PROFILES = {
+    'small': {
+        'spark.executor.memory': '4g',
+        'spark.executor.cores': '2',
+        'spark.sql.shuffle.partitions': '32',
+    },
+    'medium': {
+        'spark.executor.memory': '10g',
+        'spark.executor.cores': '4',
+        'spark.sql.shuffle.partitions': '200',
+    },
+    'large': {
+        'spark.executor.memory': '18g',
+        'spark.executor.cores': '5',
+        'spark.executor.memoryOverhead': '3g',
+        'spark.sql.shuffle.partitions': '800',
+    },
+}
+
+DEFAULT_PROFILE = 'medium'
+
+SOURCE_FORMATS = ('csv', 'json', 'parquet', 'orc', 'text', 'table')
+
+TARGET_MODES = ('append', 'overwrite', 'overwrite_partitions', 'cdc')
+
+# Variable of the spec strings: {name} (the regex quantifiers like {4} are not variables)
+VARIABLE = re.compile(r'\{([A-Za-z_]\w*)\}')
+
+
+def build_session(app_name, profile=DEFAULT_PROFILE, conf=None):
+    """
+    SparkSession with Hive support started with the common settings, the resource profile and the conf
+    :param app_name: string
+    :param profile: string PROFILES key
+    :param conf: dict Spark conf over the profile, optional
+    :return: SparkSession
+    """
+    if profile not in PROFILES:
+        raise ValueError('Unknown profile {} ({})'.format(profile, ', '.join(sorted(PROFILES))))
+    settings = dict(COMMON_CONF)
+    settings.update(PROFILES[profile])
+    settings.update(conf or {})
+    if SparkContext._active_spark_context:
+        logger.warning('The SparkContext is already started, the profile {} is not applied'.format(profile))
+    spark_conf = SparkConf().setAll([(key, str(value)) for key, value in settings.items()])
+    logger.info('Spark conf: {}'.format(sorted(settings.items())))
+    return SparkSession.builder.appName(app_name).config(conf=spark_conf).enableHiveSupport().getOrCreate()
+
+
+def format_spec(value, variables):
+    """
+    Strings of the spec formatted with the variables
+    :param value: spec value (dict, list, string)
+    :param variables: dict
+    :return: the value with the strings formatted
+    """
+    if isinstance(value, dict):
+        return dict((key, format_spec(item, variables)) for key, item in value.items())
+    if isinstance(value, list):
+        return [format_spec(item, variables) for item in value]
+    if isinstance(value, type(u'')) or isinstance(value, str):
+        return VARIABLE.sub(lambda match: _variable(match.group(1), variables, value), value)
+    return value
+
+
+def _variable(name, variables, value):
+    if name not in variables:
+        raise ValueError('Missing variable {} in "{}"'.format(name, value))
+    return variables[name]
+
+
+def load_spec(spec_path, variables):
+    """
+    Job spec (local file) formatted with the variables and validated
+    :param spec_path: string
+    :param variables: dict
+    :return: dict
+    """
+    try:
+        spec = json.load(open(spec_path))
+    except ValueError:
+        raise ValueError('Invalid JSON job spec: {}'.format(spec_path))
+    spec = format_spec(spec, variables)
+    source = spec.get('source', {})
+    target = spec.get('target', {})
+    if source.get('format') not in SOURCE_FORMATS:
+        raise ValueError('The source format must be one of {}'.format(', '.join(SOURCE_FORMATS)))
+    if not source.get('table' if source['format'] == 'table' else 'path'):
+        raise ValueError('Missing the source {}'.format('table' if source['format'] == 'table' else 'path'))
+    if target.get('mode', 'append') not in TARGET_MODES:
+        raise ValueError('The target mode must be one of {}'.format(', '.join(TARGET_MODES)))
+    if not target.get('table') and not target.get('path'):
+        raise ValueError('Missing the target table or path')
+    if target.get('mode') == 'cdc' and not (target.get('primary_key') and target.get('path')):
+        raise ValueError('The cdc mode needs the primary_key and the path of the target')
+    for step in spec.get('transforms', []):
+        if step.get('type') not in TRANSFORMS:
+            raise ValueError('Unknown transform {} ({})'.format(step.get('type'), ', '.join(sorted(TRANSFORMS))))
+    return spec
+
+
+def read_source(spark, source, partition=None, files=None):
+    """
+    DataFrame of the source
+    :param spark: SparkSession
+    :param source: dict
+    :param partition: tuple (name, value) read only this partition of a source table, optional
+    :param files: list of the files to read instead of the source path (manifest), optional
+    :return: DataFrame
+    """
+    if source['format'] == 'table':
+        df = spark.table(source['table'])
+        if partition:
+            # The stage files of the partition were just copied, register the partition in the metastore
+            spark.sql("ALTER TABLE {} ADD IF NOT EXISTS PARTITION ({}='{}')".format(source['table'], *partition))
+            df = df.where(col(partition[0]) == partition[1])
+        return df
+    reader = spark.read.format(source['format']).options(**source.get('options', {}))
+    if source.get('schema'):
+        schema = source['schema']
+        reader = reader.schema(get_struct_type(schema.get('s3_data_source'), schema['database'], schema['table']))
+    return reader.load(files or source['path'])
+
+
+def _parse(parser):
+    def transform(df, step):
+        return df.withColumn(step.get('output', step['column']), parser(step['column'], *step['formats']))
+    return transform
+
+
+# Built-in transforms: function(DataFrame, step) -> DataFrame
+TRANSFORMS = {
+    'select': lambda df, step: df.selectExpr(*step['columns']),
+    'drop': lambda df, step: df.drop(*step['columns']),
+    'rename': lambda df, step: df.select(*[col(name).alias(step['columns'].get(name, name)) for name in df.columns]),
+    'cast': lambda df, step: df.select(*[col(name).cast(step['columns'][name]).alias(name)
+                                         if name in step['columns'] else col(name) for name in df.columns]),
+    'with_column': lambda df, step: df.withColumn(step['column'], expr(step['expr'])),
+    'filter': lambda df, step: df.where(expr(step['condition'])),
+    'deduplicate': lambda df, step: df.dropDuplicates(step.get('columns')),
+    'repartition': lambda df, step: df.repartition(step['partitions'], *step.get('columns', [])),
+    'parse_timestamp': _parse(parse_timestamp),
+    'parse_date': _parse(parse_date),
+}
+
+
+def write_target(spark, df, target):
+    """
+    Write the DataFrame in the target table or path
+    :param spark: SparkSession
+    :param df: DataFrame
+    :param target: dict
+    :return: None
+    """
+    mode = target.get('mode', 'append')
+    partition_by = target.get('partition_by', [])
+    if mode == 'cdc':
+        stats = capture(spark, df, target['primary_key'], target['path'],
+                        buckets=int(target.get('buckets', DEFAULT_BUCKETS)))
+        logger.info('CDC {}: {}'.format(target['path'], stats))
+        if target.get('table') and stats['mode'] == 'full':
+            spark.sql("MSCK REPAIR TABLE {}".format(target['table']))
+        elif target.get('table') and stats['buckets']:
+            spark.sql("ALTER TABLE {} ADD IF NOT EXISTS {}".format(target['table'], ' '.join(
+                "PARTITION ({}={})".format(BUCKET_COLUMN, bucket) for bucket in stats['buckets'])))
+        return
+
+    if mode == 'overwrite_partitions':
+        spark.conf.set('spark.sql.sources.partitionOverwriteMode', 'dynamic')
+    if target.get('table'):
+        # insertInto is by position: the columns in the order of the table (partition columns last)
+        df = df.select(*spark.table(target['table']).columns)
+        writer = layout_writer(df, target.get('layout'), partition_by)
+        writer.insertInto(target['table'], overwrite=mode != 'append')
+    else:
+        writer = layout_writer(df, target.get('layout'), partition_by)
+        if partition_by:
+            writer = writer.partitionBy(*partition_by)
+        writer.mode('append' if mode == 'append' else 'overwrite').parquet(target['path'])
+
+
+def delete_files(spark, files):
+    jvm = spark.sparkContext._jvm
+    for name in files:
+        path = jvm.org.apache.hadoop.fs.Path(name)
+        path.getFileSystem(spark.sparkContext._jsc.hadoopConfiguration()).delete(path, False)
+    logger.info('Deleted {} source files'.format(len(files)))
+
+
+def execute(spark, spec, partition=None, manifest=None):
+    """
+    Read, transform and write the job spec in the session
+    :param spark: SparkSession
+    :param spec: dict from load_spec
+    :param partition: tuple (name, value), optional
+    :param manifest: dict manifest of the source files, optional
+    :return: dict profile (profiling.py) or None
+    """
+    if manifest:
+        files = manifest_files(manifest)
+        if not files:
+            logger.info('Empty manifest, nothing to process')
+            return None
+        plan_input(spark, manifest)
+        df = read_source(spark, spec['source'], partition, files)
+    else:
+        df = read_source(spark, spec['source'], partition)
+        files = df.inputFiles() if spec.get('delete_source') else []
+        if spec.get('delete_source') and not files:
+            logger.info('No files in the source, probably a previous job has already processed them')
+            return None
+    for step in spec.get('transforms', []):
+        logger.debug('Transform: {}'.format(step))
+        df = TRANSFORMS[step['type']](df, step)
+
+    # Profile and quality rules (profiling.py) before the write, the write reads the persisted rows
+    df, profile = profiled(df, spec['target'].get('table') or spec['target'].get('path'))
+    write_target(spark, df, spec['target'])
+    if profile:
+        df.unpersist()
+    if spec['target'].get('table') and spec['target'].get('partition_by'):
+        # Rollups of the job catalog (rollup.py), from the partition loaded (all the partitions if the source partition
+        # is not the target partition)
+        loaded = '='.join(partition) if partition and [partition[0]] == spec['target']['partition_by'] else None
+        update_rollups(spark, spec['target']['table'], loaded)
+    if spec.get('delete_source') and manifest:
+        delete_manifest_files(files)
+    elif spec.get('delete_source'):
+        delete_files(spark, files)
+    return profile
+
+
+def run_job(spec, partition=None, conf=None, manifest=None):
+    """
+    Run the job spec in a new SparkContext
+    :param spec: dict from load_spec
+    :param partition: tuple (name, value), optional
+    :param conf: dict Spark conf over the spec conf, optional
+    :param manifest: dict manifest of the source files, optional
+    :return: None
+    """
+    settings = dict(spec.get('conf', {}))
+    settings.update(conf or {})
+    spark = build_session(spec.get('name', 'job_runner'), spec.get('profile', DEFAULT_PROFILE), settings)
+    execute(spark, spec, partition, manifest)
+    spark.stop()
+
+
+def _pairs(values, option):
+    pairs = {}
+    for value in values:
+        if '=' not in value:
+            raise click.BadParameter('{} must be name=value'.format(value), param_hint=option)
+        name, value = value.split('=', 1)
+        pairs[name] = value
+    return pairs
+
+
+@click.command()
+@click.option('--spec', 'spec_path', envvar='JOB_SPEC', required=True, help='Job spec JSON file')
+@click.option('--var', 'variables', multiple=True, help='Variable of the spec (name=value)')
+@click.option('--partition', envvar='PARTITION', help='Partition to process (name=value)')
+@click.option('--conf', 'conf', multiple=True, help='Spark conf over the profile and the spec (key=value)')
+@click.option('--manifest', 'manifest_path', envvar='MANIFEST', help='Manifest of the source files, optional')
+@click.option('--debug', envvar='LOG_LEVEL', is_flag=True, default=False, help='Enable debug logs')
+def run(spec_path, variables, partition, conf, manifest_path, debug):
+    if debug:
+        logger.setLevel(getattr(logging, 'DEBUG'))
+    variables = _pairs(variables, '--var')
+    if partition:
+        partition = tuple(_pairs([partition], '--partition').items())[0]
+        variables['partition_name'], variables['partition'] = partition
+    spec = load_spec(spec_path, variables)
+    logger.debug('Job spec: {}'.format(spec))
+    manifest = read_manifest(manifest_path) if manifest_path else None
+    run_job(spec, partition, _pairs(conf, '--conf'), manifest)
+
+
+if __name__ == '__main__':
+    run()
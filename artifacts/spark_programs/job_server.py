@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+#
+# Resident Spark job server: one warm SparkSession running the job specs (job_runner.py) received from a SQS queue
+#
+# Each spark-submit step starts a driver JVM, a SparkContext, the metastore client and a YARN application, for small
+# files the startup takes longer than the job. The job server is started by the cluster (start_job_server.sh, again
+# by odl_spark_submit with the messages if it stopped idle) and odl_spark_submit sends the job_spec items of the job
+# catalog to the queue instead of adding steps:
+#
+#   {
+#     "s3_object_name_stage": "s3://bucket-stage/.../file.csv",
+#     "spec": "tb_table1.json",                       job spec file (jobs/)
+#     "variables": {"s3_dir_stage": "s3://...", ...}, variables of the job spec
+#     "partition": "dt=2018-07-06",                   optional
+#     "layout": {"sort_by": ["status"]},              optional, Parquet layout of the job catalog
+#     "conf": {"spark.datalake.profile": "{}", ...}   optional, profiling.py confs of the job catalog profile
+#   }
+#
+# Up to --concurrency jobs run at the same time, each one in a new session of the SparkContext (own SQL conf and temp
+# views, shared executors and metastore client), sharing the executors with the FAIR scheduler. The jobs of the same
+# table run one at a time (the messages wait in the queue). With Spark 3 (pinned thread mode, PYSPARK_PIN_THREAD) each
+# job also runs in the FAIR scheduler pool of its analytics table; before Spark 3 py4j runs the calls of a Python thread
+# in any JVM thread, so the thread local properties (pool and job description) are not set and the jobs share the
+# default pool. At the end of a job the control tables are updated
+# like odl_validate_job_submit does for the steps: LOADED in the control table and stage item and file removed, or
+# FAILED in the stage table. The server exits after --idle-minutes without messages, the cluster shutdown cron
+# (manage_emr_shutdown.sh) waits for it.
+#
+# spark-submit job_server.py --queue-url https://sqs.us-east-1.amazonaws.com/111111111111/datalake-jobs \
+#     --stage-table datalake-OdlStageControl --control-table datalake-OdlControl
+
+from __future__ import print_function
+
+import json
+import logging
+import os
+import threading
+import time
+from decimal import Decimal
+from multiprocessing.pool import ThreadPool
+
+import boto3
+import click
+
+from job_runner import build_session, execute, load_spec
+
+logging.basicConfig(format='%(asctime)s %(threadName)s %(levelname)s %(message)s')
+logger = logging.getLogger(__name__)
+logger.setLevel(getattr(logging, os.getenv('LOG_LEVEL', 'INFO')))
+logger.info('Loading Job module.')
+
+# REGION NAME
+REGION = os.getenv('AWS_DEFAULT_REGION', 'us-east-1')
+
+# Code location on the EMR master node
+CODE_PATH = '/home/hadoop/code/'
+
+# File status of the control tables (common.DatalakeStatus of the lambda functions)
+LOADED = 'LOADED'
+FAILED = 'FAILED'
+
+# Seconds before a message of a table with a running job is received again
+RETRY_DELAY = 30
+
+sqs_client = boto3.client('sqs', region_name=REGION)
+s3_client = boto3.client('s3', region_name=REGION)
+dynamodb_resource = boto3.resource('dynamodb', region_name=REGION)
+
+
+def pinned_threads(spark):
+    # The JVM thread of each Python thread is fixed with the pinned thread mode (Spark 3, default from Spark 3.2)
+    version = tuple(int(part) for part in spark.version.split('.')[:2])
+    return version >= (3, 0) and os.getenv('PYSPARK_PIN_THREAD', 'true' if version >= (3, 2) else 'false') == 'true'
+
+
+def job_pool(message):
+    # FAIR scheduler pool (and lock) of the job: its analytics table
+    variables = message.get('variables', {})
+    return '{}.{}'.format(variables.get('hive_database_analytics'), variables.get('hive_table_analytics'))
+
+
+def run_message(spark, message):
+    """
+    Run the job spec of the message in a new session
+    :param spark: SparkSession of the server
+    :param message: dict
+    :return: dict profile of the job or None
+    """
+    variables = dict(message.get('variables', {}))
+    partition = None
+    if message.get('partition'):
+        partition = tuple(message['partition'].split('=', 1))
+        variables['partition_name'], variables['partition'] = partition
+    spec = load_spec(CODE_PATH + 'jobs/' + message['spec'], variables)
+    if message.get('layout') and not spec['target'].get('layout'):
+        spec['target']['layout'] = message['layout']
+
+    session = spark.newSession()
+    # The resources of the SparkContext are fixed, only the SQL settings of the spec apply to the job
+    for key, value in spec.get('conf', {}).items():
+        if key.startswith('spark.sql.'):
+            session.conf.set(key, str(value))
+        else:
+            logger.warning('{} ignored by the job server: {}'.format(key, spec['name']))
+    for key, value in message.get('conf', {}).items():
+        session.conf.set(key, value)
+    if pinned_threads(spark):
+        spark.sparkContext.setLocalProperty('spark.scheduler.pool', job_pool(message))
+        spark.sparkContext.setJobDescription(message['s3_object_name_stage'])
+    return execute(session, spec, partition)
+
+
+def update_control(stage_table, control_table, s3_object_name_stage, succeeded, profile=None):
+    """
+    Update the control tables with the job result
+    :param stage_table: string DynamoDB stage control table
+    :param control_table: string DynamoDB control table
+    :param s3_object_name_stage: string
+    :param succeeded: boolean
+    :param profile: dict profile of the data loaded (profiling.py), optional
+    :return: None
+    """
+    timestamp = time.strftime("%Y-%m-%dT%H:%M:%S-%Z")
+    table_stage = dynamodb_resource.Table(stage_table)
+    if not succeeded:
+        table_stage.update_item(
+            Key={'s3_object_name_stage': s3_object_name_stage},
+            UpdateExpression="set file_status = :file_status, timestamp_step_finished = :timestamp_step_finished",
+            ExpressionAttributeValues={':file_status': FAILED, ':timestamp_step_finished': timestamp}
+        )
+        return
+
+    item = table_stage.get_item(Key={'s3_object_name_stage': s3_object_name_stage}).get('Item')
+    if not item:
+        logger.warning('No stage item for {}'.format(s3_object_name_stage))
+        return
+    dynamodb_resource.Table(control_table).update_item(
+        Key={'s3_object_name': item['s3_object_name_raw']},
+        UpdateExpression="set file_status = :file_status, "
+                         "timestamp_step_finished = :timestamp_step_finished, "
+                         "hive_table_analytics = :hive_table_analytics, "
+                         "hive_database_analytics = :hive_database_analytics, "
+                         "s3_target = :s3_target, "
+                         "data_profile = :data_profile",
+        ExpressionAttributeValues={
+            ':file_status': LOADED,
+            ':timestamp_step_finished': timestamp,
+            ':hive_table_analytics': item['hive_table_analytics'],
+            ':hive_database_analytics': item['hive_database_analytics'],
+            ':s3_target': item['s3_target'],
+            # DynamoDB numbers are Decimal
+            ':data_profile': json.loads(json.dumps(profile), parse_float=Decimal) if profile else None}
+    )
+    table_stage.delete_item(Key={'s3_object_name_stage': s3_object_name_stage})
+    bucket, key = s3_object_name_stage.split('/', 3)[2:]
+    s3_client.delete_object(Bucket=bucket, Key=key)
+
+
+class JobServer(object):
+    """
+    Receive the messages of the queue and run them in the thread pool
+    """
+
+    def __init__(self, spark, queue_url, stage_table, control_table, concurrency, visibility_timeout):
+        self.spark = spark
+        self.queue_url = queue_url
+        self.stage_table = stage_table
+        self.control_table = control_table
+        self.concurrency = concurrency
+        self.visibility_timeout = visibility_timeout
+        self.pool = ThreadPool(concurrency)
+        self.lock = threading.Lock()
+        # receipt handle: (pool, time of the last visibility extension)
+        self.running = {}
+
+    def busy_pools(self):
+        with self.lock:
+            return set(pool for pool, _ in self.running.values())
+
+    def finished(self, receipt_handle):
+        with self.lock:
+            del self.running[receipt_handle]
+
+    def process(self, receipt_handle, message):
+        name = message['s3_object_name_stage']
+        succeeded = False
+        profile = None
+        try:
+            logger.info('Running {} ({})'.format(name, message['spec']))
+            start = time.time()
+            profile = run_message(self.spark, message)
+            succeeded = True
+            logger.info('Finished {} in {:.1f}s'.format(name, time.time() - start))
+        except Exception as e:
+            logger.exception('Job failed {}: {}'.format(name, e))
+        try:
+            update_control(self.stage_table, self.control_table, name, succeeded, profile)
+            sqs_client.delete_message(QueueUrl=self.queue_url, ReceiptHandle=receipt_handle)
+        except Exception as e:
+            logger.exception('Unable to update the control tables of {}: {}'.format(name, e))
+        finally:
+            self.finished(receipt_handle)
+
+    def extend_visibility(self):
+        # Long jobs keep their messages hidden from the other receivers
+        now = time.time()
+        with self.lock:
+            expiring = [receipt_handle for receipt_handle, (_, extended) in self.running.items()
+                        if now - extended > self.visibility_timeout / 2]
+            for receipt_handle in expiring:
+                self.running[receipt_handle] = (self.running[receipt_handle][0], now)
+        for receipt_handle in expiring:
+            sqs_client.change_message_visibility(QueueUrl=self.queue_url, ReceiptHandle=receipt_handle,
+                                                 VisibilityTimeout=self.visibility_timeout)
+
+    def receive(self):
+        """
+        Receive messages for the free threads of the pool
+        :return: integer number of messages received
+        """
+        free = self.concurrency - len(self.running)
+        if free <= 0:
+            time.sleep(1)
+            return 0
+        response = sqs_client.receive_message(QueueUrl=self.queue_url, MaxNumberOfMessages=min(free, 10),
+                                              WaitTimeSeconds=20, VisibilityTimeout=self.visibility_timeout)
+        messages = response.get('Messages', [])
+        for received in messages:
+            receipt_handle = received['ReceiptHandle']
+            try:
+                message = json.loads(received['Body'])
+                pool = job_pool(message)
+            except (ValueError, AttributeError) as e:
+                logger.error('Invalid message {}: {}'.format(received['Body'], e))
+                sqs_client.delete_message(QueueUrl=self.queue_url, ReceiptHandle=receipt_handle)
+                continue
+            if pool in self.busy_pools():
+                sqs_client.change_message_visibility(QueueUrl=self.queue_url, ReceiptHandle=receipt_handle,
+                                                     VisibilityTimeout=RETRY_DELAY)
+                continue
+            with self.lock:
+                self.running[receipt_handle] = (pool, time.time())
+            self.pool.apply_async(self.process, (receipt_handle, message))
+        return len(messages)
+
+    def serve(self, idle_minutes):
+        idle_since = time.time()
+        while True:
+            self.extend_visibility()
+            if self.receive() or self.running:
+                idle_since = time.time()
+            elif time.time() - idle_since > idle_minutes * 60:
+                logger.info('No messages for {} minutes, stopping the job server'.format(idle_minutes))
+                break
+        self.pool.close()
+        self.pool.join()
+
+
+@click.command()
+@click.option('--queue-url', envvar='JOB_SERVER_QUEUE_URL', required=True, help='SQS queue of the jobs')
+@click.option('--stage-table', envvar='DYNAMO_DB_STAGE_TABLE', required=True, help='DynamoDB stage control table')
+@click.option('--control-table', envvar='DYNAMO_DB_CONTROL', required=True, help='DynamoDB control table')
+@click.option('--concurrency', envvar='JOB_SERVER_CONCURRENCY', type=int, default=4, help='Jobs at the same time')
+@click.option('--idle-minutes', envvar='JOB_SERVER_IDLE_MINUTES', type=int, default=15,
+              help='Stop after these minutes without messages')
+@click.option('--visibility-timeout', type=int, default=600, help='SQS visibility timeout of the running jobs')
+@click.option('--profile', default='large', help='Resource profile of the session (job_runner.PROFILES)')
+@click.option('--debug', envvar='LOG_LEVEL', is_flag=True, default=False, help='Enable debug logs')
+def run(queue_url, stage_table, control_table, concurrency, idle_minutes, visibility_timeout, profile, debug):
+    if debug:
+        logger.setLevel(getattr(logging, 'DEBUG'))
+    # FAIR: the jobs of the pools share the executors instead of waiting for the first job submitted
+    spark = build_session('Job server', profile, {'spark.scheduler.mode': 'FAIR'})
+    if not pinned_threads(spark):
+        logger.warning('Spark {} without pinned threads: the jobs run in the default scheduler pool'.format(
+            spark.version))
+    server = JobServer(spark, queue_url, stage_table, control_table, concurrency, visibility_timeout)
+    server.serve(idle_minutes)
+    spark.stop()
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+#
+# Input manifests of the Spark programs
+#
+# odl_spark_submit writes a manifest with the stage files of the job (the stage table items) and sends it to the
+# program with --manifest:
+#
+#   {
+#     "s3_data_source": "s3://customer-stage-dev/iba/br/laminacao",
+#     "partition": "dt=2018-07-06",
+#     "created": "2018-07-06T10:00:00",
+#     "files": [
+#       {"path": "s3://customer-stage-dev/iba/br/laminacao/dt=2018-07-06/file1.txt", "size": 1048576},
+#       ...
+#     ]
+#   }
+#
+# The programs read exactly these files (no listing of the stage prefix) and delete only them at the end: the files
+# that arrive during the job stay for the next job.
+#
+#   from manifest import delete_files, manifest_files, plan_input, read_manifest
+#   manifest = read_manifest(path)
+#   plan_input(spark, manifest)
+#   df = spark.read.csv(manifest_files(manifest))
+#   ...
+#   delete_files(manifest_files(manifest))
+
+from __future__ import division
+
+import json
+import logging
+import os
+
+import boto3
+
+logger = logging.getLogger(__name__)
+logger.setLevel(getattr(logging, os.getenv('LOG_LEVEL', 'INFO')))
+
+# Bytes per input partition of the DataFrame readers (spark.sql.files.maxPartitionBytes)
+MIN_PARTITION_BYTES = 32 * 1024 * 1024
+MAX_PARTITION_BYTES = 512 * 1024 * 1024
+
+# Keys per S3 DeleteObjects request
+DELETE_BATCH = 1000
+
+
+def _split(path):
+    # s3://bucket/key -> (bucket, key)
+    bucket, key = path.split('/', 3)[2:]
+    return bucket, key
+
+
+def read_manifest(path):
+    """
+    Manifest of the job (S3 object or local file)
+    :param path: string
+    :return: dict
+    """
+    if path.startswith('s3://'):
+        bucket, key = _split(path)
+        body = boto3.client('s3').get_object(Bucket=bucket, Key=key)['Body'].read()
+        manifest = json.loads(body.decode('utf-8'))
+    else:
+        manifest = json.load(open(path))
+    if not isinstance(manifest.get('files'), list):
+        raise ValueError('Invalid manifest {}: missing the files'.format(path))
+    logger.info('Manifest {}: {} files, {} bytes'.format(path, len(manifest['files']), manifest_bytes(manifest)))
+    return manifest
+
+
+def manifest_files(manifest):
+    """
+    Paths of the files of the manifest
+    :param manifest: dict
+    :return: list of strings
+    """
+    return [item['path'] for item in manifest['files']]
+
+
+def manifest_bytes(manifest):
+    """
+    Total size of the files of the manifest
+    :param manifest: dict
+    :return: integer (the files without size are ignored)
+    """
+    return sum(int(item.get('size') or 0) for item in manifest['files'])
+
+
+def plan_input(spark, manifest):
+    """
+    Split the input in partitions by the known sizes: the bytes of the manifest over the default parallelism, between
+    32 MB (small inputs still use all the executors) and 512 MB
+    :param spark: SparkSession
+    :param manifest: dict
+    :return: integer bytes per partition
+    """
+    parallelism = max(1, spark.sparkContext.defaultParallelism)
+    partition_bytes = int(min(MAX_PARTITION_BYTES, max(MIN_PARTITION_BYTES, manifest_bytes(manifest) / parallelism)))
+    spark.conf.set('spark.sql.files.maxPartitionBytes', str(partition_bytes))
+    return partition_bytes
+
+
+def delete_files(paths):
+    """
+    Delete the S3 objects (DeleteObjects requests of up to 1000 keys per bucket)
+    :param paths: list of s3:// paths
+    :return: integer number of objects deleted
+    """
+    buckets = {}
+    for path in paths:
+        bucket, key = _split(path)
+        buckets.setdefault(bucket, []).append(key)
+    s3_client = boto3.client('s3')
+    deleted = 0
+    for bucket, keys in buckets.items():
+        for start in range(0, len(keys), DELETE_BATCH):
+            response = s3_client.delete_objects(Bucket=bucket, Delete={
+                'Objects': [{'Key': key} for key in keys[start:start + DELETE_BATCH]],
+                'Quiet': True
+            })
+            for error in response.get('Errors', []):
+                logger.error('Unable to delete s3://{}/{}: {}'.format(bucket, error['Key'], error['Message']))
+            deleted += len(keys[start:start + DELETE_BATCH]) - len(response.get('Errors', []))
+    logger.info('Deleted {} files'.format(deleted))
+    return deleted
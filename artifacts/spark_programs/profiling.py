@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+#
+# Data profile and quality checks of the DataFrames written by the Spark programs
+#
+# The profile is computed by one aggregation (one scan) of the persisted DataFrame before the write, the write reads
+# the cached rows. For each column: nulls, approximate distinct values (HyperLogLog), min and max (as strings) and
+# the approximate quantiles of the numeric columns. odl_spark_submit enables it with the "profile" attribute of the
+# job catalog item (the rules, {} for no rules), sent as the spark.datalake.profile conf with the location of the
+# profile (spark.datalake.profile.path). odl_validate_job_submit (or the job server) stores the profile in the
+# data_profile attribute of the control table, streamed to the ES catalog by odl_ddb_update_es.
+#
+# Rules of the job catalog profile:
+#
+#   {
+#     "min_rows": 1,                                  minimum number of rows
+#     "max_null_ratio": {"*": 0.5, "id": 0},          maximum nulls / rows per column ("*": every column)
+#     "min_distinct": {"id": 100},                    minimum approximate distinct values
+#     "min": {"amount": 0},                           minimum value of the numeric columns
+#     "max": {"amount": 1000000}                      maximum value of the numeric columns
+#   }
+#
+# A breached rule fails the program (ProfileError) before the write, with the violations in the profile.
+#
+#   from profiling import profiled
+#   df, profile = profiled(df, 'db.table')
+#   layout_writer(df).insertInto('db.table')
+
+from __future__ import division
+
+import json
+import logging
+import math
+import os
+from datetime import date, datetime
+
+from pyspark import StorageLevel
+from pyspark.sql.functions import approx_count_distinct, col, count, expr, lit
+from pyspark.sql.functions import max as max_
+from pyspark.sql.functions import min as min_
+from pyspark.sql.types import ArrayType, BinaryType, MapType, NumericType, StructType
+
+logger = logging.getLogger(__name__)
+logger.setLevel(getattr(logging, os.getenv('LOG_LEVEL', 'INFO')))
+
+PROFILE_CONF = 'spark.datalake.profile'
+PROFILE_PATH_CONF = 'spark.datalake.profile.path'
+
+RULE_KEYS = ('min_rows', 'max_null_ratio', 'min_distinct', 'min', 'max')
+
+QUANTILES = (0.01, 0.25, 0.5, 0.75, 0.99)
+
+# Relative standard deviation of approx_count_distinct
+DISTINCT_RSD = 0.05
+
+# percentile_approx accuracy (relative error 1 / accuracy)
+QUANTILE_ACCURACY = 1000
+
+# Characters of the min and max strings
+MAX_VALUE_LENGTH = 128
+
+
+class ProfileError(ValueError):
+    pass
+
+
+def get_rules(spark):
+    """
+    Rules of the profile: the spark.datalake.profile conf (None if the profile is not enabled)
+    :param spark: SparkSession
+    :return: dict or None
+    """
+    rules = spark.conf.get(PROFILE_CONF, None)
+    if rules is None:
+        return None
+    rules = json.loads(rules) if rules else {}
+    unknown = set(rules) - set(RULE_KEYS)
+    if unknown:
+        raise ValueError('Unknown profile rules: {}'.format(', '.join(sorted(unknown))))
+    return rules
+
+
+def _number(value):
+    # JSON number (NaN and infinity are not valid JSON)
+    if value is None or isinstance(value, float) and (math.isnan(value) or math.isinf(value)):
+        return None
+    return value
+
+
+def _string(value):
+    # Hive format of the timestamps and dates, the min and max are keywords in the ES catalog (template
+    # datalake-odlcontrol of odl_es_index_manager) whatever the column type
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(value, date):
+        return value.strftime('%Y-%m-%d')
+    return u'{}'.format(value)[:MAX_VALUE_LENGTH]
+
+
+def compute_profile(df, quantiles=QUANTILES):
+    """
+    Profile of the DataFrame in one aggregation
+    :param df: DataFrame
+    :param quantiles: tuple of probabilities of the quantiles of the numeric columns
+    :return: dict with rows and columns (list of dict)
+    """
+    aggregations = [count(lit(1)).alias('rows')]
+    fields = []
+    for position, field in enumerate(df.schema.fields):
+        name = '`{}`'.format(field.name.replace('`', '``'))
+        column = col(name)
+        aggregations.append(count(column).alias('c{}_count'.format(position)))
+        # The complex and binary values have no order (only nulls)
+        if isinstance(field.dataType, (ArrayType, MapType, StructType, BinaryType)):
+            fields.append((position, field, False, False))
+            continue
+        aggregations.append(approx_count_distinct(column, DISTINCT_RSD).alias('c{}_distinct'.format(position)))
+        aggregations.append(min_(column).alias('c{}_min'.format(position)))
+        aggregations.append(max_(column).alias('c{}_max'.format(position)))
+        numeric = isinstance(field.dataType, NumericType)
+        if numeric:
+            aggregations.append(expr('percentile_approx(cast({} as double), array({}), {})'.format(
+                name, ', '.join(str(q) for q in quantiles), QUANTILE_ACCURACY)).alias('c{}_q'.format(position)))
+        fields.append((position, field, True, numeric))
+
+    row = df.agg(*aggregations).collect()[0].asDict()
+    rows = row['rows']
+    columns = []
+    for position, field, ordered, numeric in fields:
+        nulls = rows - row['c{}_count'.format(position)]
+        column = {
+            'name': field.name,
+            'type': field.dataType.simpleString(),
+            'nulls': nulls,
+            'null_ratio': round(nulls / rows, 6) if rows else 0.0,
+        }
+        if ordered:
+            column['distinct'] = row['c{}_distinct'.format(position)]
+            column['min'] = _string(row['c{}_min'.format(position)])
+            column['max'] = _string(row['c{}_max'.format(position)])
+        if numeric:
+            column['quantiles'] = [_number(value) for value in row['c{}_q'.format(position)] or []]
+        columns.append(column)
+    return {'rows': rows, 'quantiles': list(quantiles), 'columns': columns}
+
+
+def check(profile, rules):
+    """
+    Violations of the rules
+    :param profile: dict from compute_profile
+    :param rules: dict
+    :return: list of strings
+    """
+    violations = []
+    if rules.get('min_rows') is not None and profile['rows'] < rules['min_rows']:
+        violations.append('rows: {} < {}'.format(profile['rows'], rules['min_rows']))
+    columns = dict((column['name'], column) for column in profile['columns'])
+    null_ratios = dict(rules.get('max_null_ratio', {}))
+    default_ratio = null_ratios.pop('*', None)
+    for name, column in columns.items():
+        limit = null_ratios.get(name, default_ratio)
+        if limit is not None and column['null_ratio'] > limit:
+            violations.append('{}: null ratio {} > {}'.format(name, column['null_ratio'], limit))
+    for rule, compare in (('min_distinct', lambda value, limit: value < limit),
+                          ('min', lambda value, limit: float(value) < limit),
+                          ('max', lambda value, limit: float(value) > limit)):
+        for name, limit in rules.get(rule, {}).items():
+            if name not in columns:
+                violations.append('{}: missing column for the rule {}'.format(name, rule))
+                continue
+            if rule != 'min_distinct' and 'quantiles' not in columns[name]:
+                violations.append('{}: the rule {} needs a numeric column'.format(name, rule))
+                continue
+            value = columns[name].get('distinct' if rule == 'min_distinct' else rule)
+            if value is not None and compare(value, limit):
+                violations.append('{}: {} {} breaches the limit {}'.format(name, rule, value, limit))
+    return violations
+
+
+def write_profile(spark, profile, path):
+    """
+    Write the profile JSON (Hadoop FS, s3:// with EMRFS)
+    :param spark: SparkSession
+    :param profile: dict
+    :param path: string
+    :return: None
+    """
+    jvm = spark.sparkContext._jvm
+    hadoop_path = jvm.org.apache.hadoop.fs.Path(path)
+    fs = hadoop_path.getFileSystem(spark.sparkContext._jsc.hadoopConfiguration())
+    output = fs.create(hadoop_path, True)
+    try:
+        output.write(bytearray(json.dumps(profile, indent=2).encode('utf-8')))
+    finally:
+        output.close()
+
+
+def profiled(df, table=None):
+    """
+    Profile the DataFrame if the profile is enabled (spark.datalake.profile) and check the rules
+    :param df: DataFrame to write
+    :param table: string table name of the profile, optional
+    :return: tuple (DataFrame persisted when profiled, dict profile or None)
+    """
+    spark = df.sql_ctx.sparkSession
+    rules = get_rules(spark)
+    if rules is None:
+        return df, None
+    df = df.persist(StorageLevel.MEMORY_AND_DISK)
+    profile = compute_profile(df)
+    profile.update({
+        'table': table,
+        'profiled_at': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+        'violations': check(profile, rules)
+    })
+    profile['status'] = 'FAILED' if profile['violations'] else 'OK'
+    logger.info('Profile of {}: {} rows, {} violations'.format(table, profile['rows'], len(profile['violations'])))
+    path = spark.conf.get(PROFILE_PATH_CONF, None)
+    if path:
+        write_profile(spark, profile, path)
+    if profile['violations']:
+        df.unpersist()
+        raise ProfileError('Data quality rules breached by {}: {}'.format(table, '; '.join(profile['violations'])))
+    return df, profile
@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+#
+# Rollup tables: aggregates of an analytics table maintained partition by partition
+#
+# The "rollups" attribute of the job catalog item declares the aggregates of its analytics table, odl_spark_submit
+# sends them to the program as the Spark conf spark.datalake.rollups:
+#
+#   [
+#     {
+#       "table": "db_ads.tb_impressions_hourly",            rollup table (created by the first update)
+#       "path": "s3://datalake-analytics/ads/tb_impressions_hourly/",
+#       "time": {"column": "dt", "format": "yyyy-MM-dd-HH-mm", "grain": "hour", "output": "hour_start"},   optional
+#       "keys": ["adid", "referrer"],                       group by columns
+#       "measures": [
+#         {"name": "impressions", "agg": "count"},          count (rows, or the not null values of "column"), sum,
+#         {"name": "max_begin", "agg": "max", "column": "requestbegintime"}   min, max or avg
+#       ]
+#     }
+#   ]
+#
+# The rollup table has the partial aggregates of each partition of the analytics table, in the partition with the
+# same name and value (the time bucket of an hour has the rows of its dt=YYYY-MM-DD-HH-MM partitions). After the load
+# of a partition, update_rollups aggregates only this partition and overwrites its rollup partition, so the reruns
+# don't count the rows twice. The readers merge the partials (sum of the counts and sums, min of the mins, max of the
+# maxs, avg as sum / count), a group by of kilobytes:
+#
+#   from rollup import update_rollups
+#   layout_writer(df, partition_by=['dt']).insertInto('db.table', overwrite=True)
+#   update_rollups(spark, 'db.table', 'dt=2009-04-13-15-15')
+#
+# The distinct counts are not mergeable (no HyperLogLog sketches in the Spark SQL functions), use them in the keys.
+#
+# Commands (the rollups of the job catalog item of the data source):
+#   spark-submit rollup.py rebuild -s s3://bucket/data_source --start 2009-04-13 --end 2009-04-14 [--table db.rollup]
+#   spark-submit rollup.py sql -s s3://bucket/data_source        # merge query of the rollups (dashboards, Athena)
+
+from __future__ import print_function
+
+import json
+import logging
+import os
+
+import boto3
+import click
+
+from pyspark.sql.functions import col, count, date_trunc, lit, to_timestamp
+from pyspark.sql.functions import max as max_
+from pyspark.sql.functions import min as min_
+from pyspark.sql.functions import sum as sum_
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(getattr(logging, os.getenv('LOG_LEVEL', 'INFO')))
+
+# REGION NAME
+REGION = os.getenv('AWS_DEFAULT_REGION', 'us-east-1')
+
+# DynamoDB table for Job Catalog (commands)
+DYNAMO_DB_JOB_CATALOG = os.getenv('DYNAMO_DB_JOB_CATALOG')
+
+ROLLUPS_CONF = 'spark.datalake.rollups'
+
+ROLLUP_KEYS = ('table', 'path', 'time', 'keys', 'measures')
+
+# Aggregation of the partials and merge of the partials by the readers
+AGGREGATIONS = ('count', 'sum', 'min', 'max', 'avg')
+MERGE = {'count': 'SUM', 'sum': 'SUM', 'min': 'MIN', 'max': 'MAX'}
+
+# date_trunc units of the time bucket
+GRAINS = ('year', 'month', 'week', 'day', 'hour', 'minute')
+
+
+def get_rollups(spark, rollups=None):
+    """
+    Rollups of the table: the argument or the spark.datalake.rollups conf
+    :param spark: SparkSession
+    :param rollups: list or JSON string, optional
+    :return: list of dict
+    """
+    if rollups is None:
+        rollups = spark.conf.get(ROLLUPS_CONF, None)
+    if not rollups:
+        return []
+    if not isinstance(rollups, list):
+        rollups = json.loads(rollups)
+    for rollup in rollups:
+        unknown = set(rollup) - set(ROLLUP_KEYS)
+        if unknown:
+            raise ValueError('Unknown rollup settings: {}'.format(', '.join(sorted(unknown))))
+        if not rollup.get('table') or not rollup.get('measures'):
+            raise ValueError('The rollup needs the table and the measures: {}'.format(rollup))
+        if rollup.get('time', {}).get('grain', 'hour') not in GRAINS:
+            raise ValueError('Invalid grain {} of {}, use one of {}'.format(
+                rollup['time']['grain'], rollup['table'], ', '.join(GRAINS)))
+        for measure in rollup['measures']:
+            if measure.get('agg') not in AGGREGATIONS:
+                raise ValueError('Invalid aggregation {} of {}, use one of {}'.format(
+                    measure.get('agg'), rollup['table'], ', '.join(AGGREGATIONS)))
+            if measure['agg'] != 'count' and not measure.get('column'):
+                raise ValueError('The {} measure {} needs a column'.format(measure['agg'], measure['name']))
+    return rollups
+
+
+def _time_column(rollup):
+    time = rollup.get('time')
+    if not time:
+        return None
+    return time.get('output', 'period')
+
+
+def group_columns(rollup):
+    """
+    Group by columns of the rollup: the time bucket and the keys
+    :param rollup: dict
+    :return: list of strings
+    """
+    return ([_time_column(rollup)] if rollup.get('time') else []) + list(rollup.get('keys', []))
+
+
+def partial_aggregations(rollup):
+    """
+    Aggregations of the partials stored in the rollup table
+    :param rollup: dict
+    :return: list of tuples (column name, Column)
+    """
+    aggregations = []
+    for measure in rollup['measures']:
+        name, agg = measure['name'], measure['agg']
+        column = col(measure['column']) if measure.get('column') else None
+        if agg == 'count':
+            aggregations.append((name, count(column if column is not None else lit(1))))
+        elif agg == 'avg':
+            # The averages are not mergeable, the sum and the count are
+            aggregations.append((name + '_sum', sum_(column.cast('double'))))
+            aggregations.append((name + '_count', count(column)))
+        else:
+            function = {'sum': sum_, 'min': min_, 'max': max_}[agg]
+            aggregations.append((name, function(column)))
+    return aggregations
+
+
+def aggregate(df, rollup, partition_name):
+    """
+    Partial aggregates of the rows by partition
+    :param df: DataFrame of the analytics table (one or more partitions)
+    :param rollup: dict
+    :param partition_name: string partition column of the analytics table
+    :return: DataFrame with the group columns, the partials and the partition column (last)
+    """
+    time = rollup.get('time')
+    if time:
+        column = col(time['column'])
+        if time.get('format'):
+            column = to_timestamp(column, time['format'])
+        df = df.withColumn(_time_column(rollup), date_trunc(time.get('grain', 'hour'), column))
+    groups = group_columns(rollup)
+    aggregations = partial_aggregations(rollup)
+    return df.groupBy(*(groups + [partition_name])).agg(*[column.alias(name) for name, column in aggregations]).select(
+        *(groups + [name for name, _ in aggregations] + [partition_name]))
+
+
+def merge_sql(rollup, where=None):
+    """
+    Query of the rollup with the partials merged
+    :param rollup: dict
+    :param where: string SQL condition, optional
+    :return: string
+    """
+    # No quotes: the same query runs in Spark SQL and Athena
+    groups = ', '.join(group_columns(rollup))
+    measures = []
+    for measure in rollup['measures']:
+        if measure['agg'] == 'avg':
+            measures.append('SUM({0}_sum) / SUM({0}_count) AS {0}'.format(measure['name']))
+        else:
+            measures.append('{}({}) AS {}'.format(MERGE[measure['agg']], measure['name'], measure['name']))
+    sql = 'SELECT {} FROM {}'.format(', '.join(([groups] if groups else []) + measures), rollup['table'])
+    if where:
+        sql += ' WHERE {}'.format(where)
+    if groups:
+        sql += ' GROUP BY {}'.format(groups)
+    return sql
+
+
+def _table_exists(spark, table):
+    database, name = table.split('.', 1)
+    return name.lower() in [item.name.lower() for item in spark.catalog.listTables(database)]
+
+
+def _partition_name(spark, table):
+    database, name = table.split('.', 1)
+    partition_columns = [column.name for column in spark.catalog.listColumns(name, database) if column.isPartition]
+    if len(partition_columns) != 1:
+        raise ValueError('The rollups need a table with one partition column, {} has {}'.format(
+            table, partition_columns))
+    return partition_columns[0]
+
+
+def _partition_values(spark, table):
+    return set(row[0].split('=', 1)[1] for row in spark.sql('SHOW PARTITIONS {}'.format(table)).collect())
+
+
+def write_rollup(spark, partials, rollup, partition_name):
+    """
+    Overwrite the rollup partitions of the partials (the table is created by the first write)
+    :param spark: SparkSession
+    :param partials: DataFrame from aggregate
+    :param rollup: dict
+    :param partition_name: string
+    :return: None
+    """
+    # One small file per partition
+    partials = partials.repartition(col(partition_name))
+    if not _table_exists(spark, rollup['table']):
+        logger.info('Creating the rollup table {}'.format(rollup['table']))
+        writer = partials.write.format('parquet').partitionBy(partition_name)
+        if rollup.get('path'):
+            writer = writer.option('path', rollup['path'])
+        writer.saveAsTable(rollup['table'])
+        return
+    previous = spark.conf.get('spark.sql.sources.partitionOverwriteMode', 'static')
+    spark.conf.set('spark.sql.sources.partitionOverwriteMode', 'dynamic')
+    try:
+        partials.select(*spark.table(rollup['table']).columns).write.insertInto(rollup['table'], overwrite=True)
+    finally:
+        spark.conf.set('spark.sql.sources.partitionOverwriteMode', previous)
+
+
+def update_rollups(spark, table, partition=None, rollups=None):
+    """
+    Update the rollups of the table with the partition loaded
+    :param spark: SparkSession
+    :param table: string analytics table (<database>.<table>)
+    :param partition: string name=value of the partition loaded (None for all the partitions)
+    :param rollups: list, default spark.datalake.rollups conf
+    :return: None
+    """
+    rollups = get_rollups(spark, rollups)
+    if not rollups or not table:
+        return
+    partition_name = _partition_name(spark, table)
+    df = spark.table(table)
+    if partition:
+        name, value = partition.split('=', 1)
+        if name != partition_name:
+            raise ValueError('The table {} is partitioned by {}, not {}'.format(table, partition_name, name))
+        df = df.where(col(partition_name) == value)
+    else:
+        logger.warning('No partition loaded, rebuilding the rollups of all the partitions of {}'.format(table))
+    for rollup in rollups:
+        logger.info('Updating the rollup {} with {}'.format(rollup['table'], partition or 'all the partitions'))
+        write_rollup(spark, aggregate(df, rollup, partition_name), rollup, partition_name)
+
+
+def rebuild(spark, table, rollup, start, end):
+    """
+    Rebuild the rollup partitions of a range of partitions (the string values between start and end, the prefixes
+    included: 2009-04-13 to 2009-04-14 has all the hours of both days)
+    :param spark: SparkSession
+    :param table: string analytics table
+    :param rollup: dict
+    :param start: string first partition value (or prefix)
+    :param end: string last partition value (or prefix)
+    :return: integer number of partitions rebuilt
+    """
+    partition_name = _partition_name(spark, table)
+    values = sorted(value for value in _partition_values(spark, table) if start <= value and value[:len(end)] <= end)
+    # Partition pruning: only the partitions of the range are read
+    df = spark.table(table).where(col(partition_name).isin(*values)) if values else None
+    if df is not None:
+        write_rollup(spark, aggregate(df, rollup, partition_name), rollup, partition_name)
+    if _table_exists(spark, rollup['table']):
+        # Rollup partitions of the range without data in the table anymore
+        for value in sorted(_partition_values(spark, rollup['table']) - set(values)):
+            if start <= value and value[:len(end)] <= end:
+                spark.sql("ALTER TABLE {} DROP IF EXISTS PARTITION ({}='{}')".format(
+                    rollup['table'], partition_name, value))
+    logger.info('Rebuilt {} partitions of {}'.format(len(values), rollup['table']))
+    return len(values)
+
+
+def catalog_rollups(s3_data_source):
+    """
+    Analytics table and rollups of the job catalog item
+    :param s3_data_source: string
+    :return: tuple (string table, list of dict)
+    """
+    table_job = boto3.resource('dynamodb', region_name=REGION).Table(DYNAMO_DB_JOB_CATALOG)
+    item = table_job.get_item(Key={'s3_data_source': s3_data_source}).get('Item')
+    if not item:
+        raise click.ClickException('There is no job catalog item for {}'.format(s3_data_source))
+    rollups = item.get('rollups')
+    if rollups and not isinstance(rollups, list):
+        rollups = json.loads(rollups)
+    return '{}.{}'.format(item['hive_database_analytics'], item['hive_table_analytics']), rollups or []
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command('rebuild')
+@click.option('-s', '--s3-data-source', required=True, help='Job catalog s3_data_source')
+@click.option('--start', required=True, help='First partition value or prefix (ex: 2009-04-13)')
+@click.option('--end', required=True, help='Last partition value or prefix (ex: 2009-04-14)')
+@click.option('--table', 'rollup_table', help='Rebuild only this rollup table')
+def rebuild_command(s3_data_source, start, end, rollup_table):
+    """Rebuild the rollups of a range of partitions"""
+    # job_runner imports this module
+    from job_runner import build_session
+    table, rollups = catalog_rollups(s3_data_source)
+    spark = build_session('Rollup rebuild', profile='medium')
+    for rollup in get_rollups(spark, rollups):
+        if not rollup_table or rollup['table'] == rollup_table:
+            click.echo('{}: {} partitions'.format(rollup['table'], rebuild(spark, table, rollup, start, end)))
+    spark.stop()
+
+
+@cli.command('sql')
+@click.option('-s', '--s3-data-source', required=True, help='Job catalog s3_data_source')
+def sql_command(s3_data_source):
+    """Print the merge query of each rollup"""
+    _, rollups = catalog_rollups(s3_data_source)
+    for rollup in rollups:
+        click.echo('{};'.format(merge_sql(rollup)))
+
+
+if __name__ == '__main__':
+    cli()
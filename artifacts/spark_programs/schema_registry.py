@@ -0,0 +1,453 @@
+# -*- coding: utf-8 -*-
+#
+# Schema registry for the Spark programs
+#
+# Stores the versioned Spark schema (StructType JSON) of each job catalog data source (s3_data_source) in a DynamoDB
+# table, so the programs don't need to probe the Hive table (SELECT * ... LIMIT 1) to read the raw files.
+#
+# DynamoDB table (SCHEMA_REGISTRY_TABLE): s3_data_source (HASH, string), version (RANGE, number)
+# Item attributes: schema (StructType JSON), fingerprint (md5 of the schema), source (glue:<db>.<table> or
+# hql:<file>), registered (timestamp)
+#
+# The latest version of each data source is cached in SCHEMA_CACHE_DIR on the cluster (setup_jobs.sh runs the sync
+# command after copying the programs), so the programs read the schema from a local file:
+#
+#   from schema_registry import get_struct_type
+#   schema = get_struct_type(s3_data_source, hive_database_raw, hive_table_raw)
+#
+# Commands:
+#   python schema_registry.py register -s s3://bucket/data_source --glue db.table  # from the Glue Data Catalog
+#   python schema_registry.py register -s s3://bucket/data_source --hql tb_call_req-raw.hql
+#   python schema_registry.py refresh  # register the raw table of every job catalog item (new versions on change)
+#   python schema_registry.py sync     # download the latest versions to the local cache
+#   python schema_registry.py show -s s3://bucket/data_source [--version N]
+
+from __future__ import print_function
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+
+import boto3
+import click
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(getattr(logging, os.getenv('LOG_LEVEL', 'INFO')))
+
+# REGION NAME
+REGION = os.getenv('AWS_DEFAULT_REGION', 'us-east-1')
+
+# DynamoDB table for the Schema Registry
+SCHEMA_REGISTRY_TABLE = os.getenv('SCHEMA_REGISTRY_TABLE', 'OdlSchemaRegistry')
+
+# DynamoDB table for Job Catalog (refresh command)
+DYNAMO_DB_JOB_CATALOG = os.getenv('DYNAMO_DB_JOB_CATALOG')
+
+# Local cache of the latest schema versions
+SCHEMA_CACHE_DIR = os.getenv('SCHEMA_CACHE_DIR', '/home/hadoop/schemas')
+
+# Seconds before checking the registry for a new version of a cached schema
+SCHEMA_CACHE_TTL = int(os.getenv('SCHEMA_CACHE_TTL', 3600))
+
+# Hive primitive types to Spark types (char/varchar are strings in Spark)
+HIVE_TYPES = {
+    'string': 'string',
+    'varchar': 'string',
+    'char': 'string',
+    'tinyint': 'byte',
+    'smallint': 'short',
+    'int': 'integer',
+    'integer': 'integer',
+    'bigint': 'long',
+    'float': 'float',
+    'double': 'double',
+    'boolean': 'boolean',
+    'binary': 'binary',
+    'date': 'date',
+    'timestamp': 'timestamp',
+}
+
+CREATE_TABLE = re.compile(r'CREATE\s+(?:EXTERNAL\s+)?TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?([\w.`]+)\s*\(', re.IGNORECASE)
+PARTITIONED_BY = re.compile(r'\)\s*(?:COMMENT\s+\'[^\']*\'\s*)?PARTITIONED\s+BY\s*\(', re.IGNORECASE)
+
+
+def split_top_level(text, separator=','):
+    """
+    Split the text by the separator outside of <>, () and quoted comments
+    :param text: string
+    :param separator: string
+    :return: list of strings
+    """
+    parts = []
+    depth = 0
+    quote = None
+    current = ''
+    for char in text:
+        if quote:
+            quote = None if char == quote else quote
+        elif char in '\'"':
+            quote = char
+        elif char in '<(':
+            depth += 1
+        elif char in '>)':
+            depth -= 1
+        if char == separator and depth == 0 and not quote:
+            parts.append(current.strip())
+            current = ''
+        else:
+            current += char
+    if current.strip():
+        parts.append(current.strip())
+    return parts
+
+
+def hive_to_spark(hive_type):
+    """
+    Spark JSON type of a Hive type
+    :param hive_type: string (ex: int, varchar(30), decimal(10,2), array<string>, struct<a:int,b:string>)
+    :return: string or dict (StructType JSON format)
+    """
+    hive_type = hive_type.strip()
+    lower = hive_type.lower()
+    if lower.startswith('array<'):
+        return {'type': 'array', 'elementType': hive_to_spark(hive_type[6:-1]), 'containsNull': True}
+    if lower.startswith('map<'):
+        key_type, value_type = split_top_level(hive_type[4:-1])
+        return {'type': 'map', 'keyType': hive_to_spark(key_type), 'valueType': hive_to_spark(value_type),
+                'valueContainsNull': True}
+    if lower.startswith('struct<'):
+        fields = [field.split(':', 1) for field in split_top_level(hive_type[7:-1])]
+        return struct_json(fields)
+    if lower.startswith('decimal'):
+        return re.sub(r'\s', '', lower) if '(' in lower else 'decimal(10,0)'
+    base_type = lower.split('(')[0].strip()
+    if base_type not in HIVE_TYPES:
+        raise ValueError('Unsupported Hive type: {}'.format(hive_type))
+    return HIVE_TYPES[base_type]
+
+
+def struct_json(columns):
+    """
+    StructType JSON of the Hive columns (same schema returned by Spark for the Hive table)
+    :param columns: list of (name, hive type)
+    :return: dict
+    """
+    return {
+        'type': 'struct',
+        'fields': [{'name': name.strip().strip('`'), 'type': hive_to_spark(hive_type), 'nullable': True,
+                    'metadata': {}} for name, hive_type in columns]
+    }
+
+
+def fingerprint(schema):
+    """
+    Fingerprint of the schema to detect changes
+    :param schema: dict StructType JSON
+    :return: string
+    """
+    return hashlib.md5(json.dumps(schema, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def glue_columns(database, table, glue_client=None):
+    """
+    Columns of the table in the Glue Data Catalog (the partition keys are the last columns, like in Spark)
+    :param database: string
+    :param table: string
+    :param glue_client: boto3 Glue client
+    :return: list of (name, hive type)
+    """
+    glue_client = glue_client or boto3.client('glue', region_name=REGION)
+    glue_table = glue_client.get_table(DatabaseName=database, Name=table)['Table']
+    columns = glue_table['StorageDescriptor']['Columns'] + glue_table.get('PartitionKeys', [])
+    return [(column['Name'], column['Type']) for column in columns]
+
+
+def _column_definitions(text):
+    columns = []
+    for definition in split_top_level(text):
+        # name type [COMMENT '...']
+        definition = re.split(r'\s+COMMENT\s+', definition, flags=re.IGNORECASE)[0]
+        name, hive_type = definition.split(None, 1)
+        columns.append((name, hive_type))
+    return columns
+
+
+def _block(text, start):
+    """
+    Content of the parenthesis opened before the start position
+    """
+    depth = 1
+    quote = None
+    for position in range(start, len(text)):
+        if quote:
+            quote = None if text[position] == quote else quote
+        elif text[position] in '\'"':
+            quote = text[position]
+        elif text[position] == '(':
+            depth += 1
+        elif text[position] == ')':
+            depth -= 1
+            if depth == 0:
+                return text[start:position], position
+    raise ValueError('Unbalanced parenthesis in the DDL')
+
+
+def hql_columns(hql):
+    """
+    Columns of the CREATE TABLE statement (partition columns last)
+    :param hql: string DDL (ex: artifacts/hive_create_table/tb_call_req-raw.hql)
+    :return: list of (name, hive type)
+    """
+    hql = '\n'.join(line.split('--')[0] for line in hql.splitlines())
+    create = CREATE_TABLE.search(hql)
+    if not create:
+        raise ValueError('There is no CREATE TABLE statement in the DDL')
+    columns_text, end = _block(hql, create.end())
+    columns = _column_definitions(columns_text)
+    partitioned = PARTITIONED_BY.match(hql, end)
+    if partitioned:
+        columns += _column_definitions(_block(hql, partitioned.end())[0])
+    return columns
+
+
+class SchemaRegistry(object):
+    def __init__(self, table_name=SCHEMA_REGISTRY_TABLE, cache_dir=SCHEMA_CACHE_DIR, cache_ttl=SCHEMA_CACHE_TTL,
+                 dynamodb_resource=None):
+        """
+        Versioned schemas of the data sources
+        :param table_name: string DynamoDB table
+        :param cache_dir: string local directory (None to disable the cache)
+        :param cache_ttl: integer seconds
+        :param dynamodb_resource: boto3 DynamoDB resource
+        """
+        dynamodb_resource = dynamodb_resource or boto3.resource('dynamodb', region_name=REGION)
+        self._table = dynamodb_resource.Table(table_name)
+        self._cache_dir = cache_dir
+        self._cache_ttl = cache_ttl
+
+    def latest(self, s3_data_source):
+        """
+        Latest version registered in DynamoDB
+        :param s3_data_source: string
+        :return: dict item or None
+        """
+        resp = self._table.query(KeyConditionExpression=Key('s3_data_source').eq(s3_data_source),
+                                 ScanIndexForward=False, Limit=1, ConsistentRead=True)
+        items = resp.get('Items', [])
+        return self._decode(items[0]) if items else None
+
+    def get(self, s3_data_source, version=None):
+        """
+        Version of the schema (latest if version is None)
+        :param s3_data_source: string
+        :param version: integer
+        :return: dict item or None
+        """
+        if version is None:
+            return self.latest(s3_data_source)
+        item = self._table.get_item(Key={'s3_data_source': s3_data_source, 'version': int(version)}).get('Item')
+        return self._decode(item) if item else None
+
+    def load(self, s3_data_source):
+        """
+        Latest schema from the local cache or DynamoDB (the cache is updated)
+        :param s3_data_source: string
+        :return: dict item or None
+        """
+        item = self._read_cache(s3_data_source)
+        if item:
+            return item
+        item = self.latest(s3_data_source)
+        if item:
+            self._write_cache(item)
+        return item
+
+    def register(self, s3_data_source, schema, source):
+        """
+        Register the schema as a new version if it is different from the latest version
+        :param s3_data_source: string
+        :param schema: dict StructType JSON
+        :param source: string origin of the schema (glue:<db>.<table> or hql:<file>)
+        :return: tuple (item, True if a new version was registered)
+        """
+        latest = self.latest(s3_data_source)
+        schema_fingerprint = fingerprint(schema)
+        if latest and latest['fingerprint'] == schema_fingerprint:
+            self._write_cache(latest)
+            return latest, False
+        item = {
+            's3_data_source': s3_data_source,
+            'version': latest['version'] + 1 if latest else 1,
+            'schema': json.dumps(schema, sort_keys=True),
+            'fingerprint': schema_fingerprint,
+            'source': source,
+            'registered': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S')
+        }
+        try:
+            # Concurrent registrations of the same version fail instead of overwriting each other
+            self._table.put_item(Item=item, ConditionExpression='attribute_not_exists(version)')
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            logger.info('Version {} of {} registered concurrently, retrying'.format(item['version'], s3_data_source))
+            return self.register(s3_data_source, schema, source)
+        if latest:
+            logger.info('Schema of {} changed (version {} -> {})'.format(s3_data_source, latest['version'],
+                                                                         item['version']))
+        item = self._decode(item)
+        self._write_cache(item)
+        return item, True
+
+    @staticmethod
+    def _decode(item):
+        item = dict(item)
+        item['version'] = int(item['version'])
+        item['schema'] = json.loads(item['schema'])
+        return item
+
+    def _cache_path(self, s3_data_source):
+        return os.path.join(self._cache_dir, hashlib.md5(s3_data_source.encode('utf-8')).hexdigest() + '.json')
+
+    def _read_cache(self, s3_data_source):
+        if not self._cache_dir:
+            return None
+        path = self._cache_path(s3_data_source)
+        if not os.path.isfile(path) or time.time() - os.path.getmtime(path) > self._cache_ttl:
+            return None
+        try:
+            with open(path) as cache:
+                return json.load(cache)
+        except ValueError:
+            logger.warning('Invalid schema cache file {}, ignoring'.format(path))
+            return None
+
+    def _write_cache(self, item):
+        if not self._cache_dir:
+            return
+        try:
+            if not os.path.isdir(self._cache_dir):
+                os.makedirs(self._cache_dir)
+            path = self._cache_path(item['s3_data_source'])
+            # Atomic replace: the programs running at the same time never read a partial file
+            with open(path + '.tmp', 'w') as cache:
+                json.dump(item, cache)
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError) as e:
+            logger.warning('Unable to write the schema cache: {}'.format(e))
+
+
+def get_struct_type(s3_data_source, database=None, table=None, registry=None):
+    """
+    Spark schema of the data source from the registry. If there is no version registered yet the schema is read from
+    the Glue Data Catalog (database.table) and registered
+    :param s3_data_source: string job catalog key (None to read from Glue without the registry)
+    :param database: string raw Hive database
+    :param table: string raw Hive table
+    :param registry: SchemaRegistry
+    :return: pyspark.sql.types.StructType
+    """
+    from pyspark.sql.types import StructType
+
+    if not s3_data_source:
+        logger.info('There is no s3_data_source, reading the schema of {}.{} from Glue'.format(database, table))
+        return StructType.fromJson(struct_json(glue_columns(database, table)))
+    registry = registry or SchemaRegistry()
+    item = registry.load(s3_data_source)
+    if not item:
+        if not (database and table):
+            raise ValueError('There is no schema registered for {}'.format(s3_data_source))
+        logger.info('There is no schema registered for {}, reading {}.{} from Glue'.format(
+            s3_data_source, database, table))
+        schema = struct_json(glue_columns(database, table))
+        item, _ = registry.register(s3_data_source, schema, 'glue:{}.{}'.format(database, table))
+    logger.info('Using schema version {} of {}'.format(item['version'], s3_data_source))
+    return StructType.fromJson(item['schema'])
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option('-s', '--s3-data-source', required=True, help='Job catalog s3_data_source')
+@click.option('--glue', 'glue_table', help='Glue Data Catalog table (<database>.<table>)')
+@click.option('--hql', 'hql_file', type=click.Path(exists=True), help='CREATE TABLE DDL file')
+def register(s3_data_source, glue_table, hql_file):
+    """Register the schema of a data source"""
+    if bool(glue_table) == bool(hql_file):
+        raise click.UsageError('Use one of --glue or --hql')
+    if glue_table:
+        database, table = glue_table.split('.', 1)
+        schema, source = struct_json(glue_columns(database, table)), 'glue:{}'.format(glue_table)
+    else:
+        with open(hql_file) as ddl:
+            schema, source = struct_json(hql_columns(ddl.read())), 'hql:{}'.format(os.path.basename(hql_file))
+    item, changed = SchemaRegistry().register(s3_data_source, schema, source)
+    click.echo('{} version {} ({})'.format(s3_data_source, item['version'], 'new' if changed else 'unchanged'))
+
+
+@cli.command()
+def refresh():
+    """Register the raw table schema of every job catalog item"""
+    table_job = boto3.resource('dynamodb', region_name=REGION).Table(DYNAMO_DB_JOB_CATALOG)
+    registry = SchemaRegistry()
+    kwargs = {}
+    while True:
+        resp = table_job.scan(**kwargs)
+        for job in resp.get('Items', []):
+            source = 'glue:{}.{}'.format(job['hive_database_raw'], job['hive_table_raw'])
+            try:
+                schema = struct_json(glue_columns(job['hive_database_raw'], job['hive_table_raw']))
+            except (ClientError, ValueError) as e:
+                logger.error('Unable to read the schema of {}: {}'.format(source, e))
+                continue
+            item, changed = registry.register(job['s3_data_source'], schema, source)
+            click.echo('{} version {} ({})'.format(job['s3_data_source'], item['version'],
+                                                   'new' if changed else 'unchanged'))
+        if not resp.get('LastEvaluatedKey'):
+            break
+        kwargs['ExclusiveStartKey'] = resp['LastEvaluatedKey']
+
+
+@cli.command()
+def sync():
+    """Download the latest schema versions to the local cache"""
+    dynamodb_resource = boto3.resource('dynamodb', region_name=REGION)
+    registry = SchemaRegistry(dynamodb_resource=dynamodb_resource)
+    table = dynamodb_resource.Table(SCHEMA_REGISTRY_TABLE)
+    latest = {}
+    kwargs = {}
+    while True:
+        resp = table.scan(**kwargs)
+        for item in resp.get('Items', []):
+            if item['version'] > latest.get(item['s3_data_source'], {}).get('version', 0):
+                latest[item['s3_data_source']] = item
+        if not resp.get('LastEvaluatedKey'):
+            break
+        kwargs['ExclusiveStartKey'] = resp['LastEvaluatedKey']
+    for item in latest.values():
+        registry._write_cache(registry._decode(item))
+    click.echo('Cached {} schemas in {}'.format(len(latest), SCHEMA_CACHE_DIR))
+
+
+@cli.command()
+@click.option('-s', '--s3-data-source', required=True, help='Job catalog s3_data_source')
+@click.option('--version', type=int, help='Schema version (default latest)')
+def show(s3_data_source, version):
+    """Print a schema version"""
+    item = SchemaRegistry(cache_dir=None).get(s3_data_source, version)
+    if not item:
+        raise click.ClickException('There is no schema registered for {}'.format(s3_data_source))
+    click.echo(json.dumps(item, indent=2, sort_keys=True, default=str))
+
+
+if __name__ == '__main__':
+    cli()
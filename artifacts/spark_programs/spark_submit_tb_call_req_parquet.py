@@ -17,6 +17,11 @@ from pyspark.sql import SparkSession
 from pyspark.sql.functions import col, udf, to_timestamp, year, month, dayofmonth, concat, lit
 from pyspark.sql.types import *
 
+from cdc import BUCKET_COLUMN, DEFAULT_BUCKETS, capture
+from job_runner import build_session
+from schema_registry import get_struct_type
+from writer import layout_writer
+
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 logger.setLevel(getattr(logging, os.getenv('LOG_LEVEL', 'INFO')))
@@ -31,6 +36,11 @@ logger.info('Loading Job module.')
               help='Hive Analytics database name')
 @click.option('-hta', '--hive-table-analytics', envvar='HIVE_DATABASE_ANALYTICS', help='Hive Analytics table name')
 @click.option('-s3a', '--s3-object-analytics', envvar='S3_OBJECT_ANALYTICS', help='S3 path for Analytics objects')
+@click.option('-s3d', '--s3-data-source', envvar='S3_DATA_SOURCE',
+              help='Job catalog data source (schema registry key), optional')
+@click.option('-pk', '--cdc-primary-key', envvar='CDC_PRIMARY_KEY',
+              help='Primary key columns (comma separated), enables the change data capture mode')
+@click.option('--cdc-buckets', envvar='CDC_BUCKETS', type=int, help='Buckets of the analytics table in CDC mode')
 @click.option('--debug', envvar='LOG_LEVEL', is_flag=True, default=False, help='Enable debug logs')
 def run(**kwargs):
     # Sample parameter values
@@ -43,6 +53,10 @@ def run(**kwargs):
 
     # Check for all options. This program need all of them to run.
     param = dict()
+    # The schema registry key and the CDC options are optional
+    s3_data_source = kwargs.pop('s3_data_source')
+    cdc_primary_key = kwargs.pop('cdc_primary_key')
+    cdc_buckets = kwargs.pop('cdc_buckets')
     params = kwargs
     path, filename = os.path.split(__file__)
     name, ext = os.path.splitext(filename)
@@ -56,6 +70,10 @@ def run(**kwargs):
         except ValueError:
             raise ValueError('Invalid JSON configuration file: {}'.format(config_file))
 
+    s3_data_source = s3_data_source or params.get('s3_data_source')
+    cdc_primary_key = cdc_primary_key or params.get('cdc_primary_key')
+    cdc_buckets = cdc_buckets or params.get('cdc_buckets') or DEFAULT_BUCKETS
+
     for arg in kwargs:
         if kwargs.get(arg):
             logger.debug('Parsing parameter from command line {} : {}'.format(arg, kwargs.get(arg)))
@@ -77,31 +95,13 @@ def run(**kwargs):
     logger.debug("hive_table_analytics: {}".format(param['hive_table_analytics']))
     logger.debug("s3_object_analytics: {}".format(param['s3_object_analytics']))
 
-    sc = SparkContext()
-
-    spark = SparkSession.builder.appName("Spark and Hive")\
-                                .config("spark.hadoop.mapreduce.fileoutputcommitter.algorithm.version", "2")\
-                                .config("spark.speculation", "false").config("hive.exec.dynamic.partition", "true")\
-                                .config("hive.exec.dynamic.partition.mode", "nonstrict")\
-                                .enableHiveSupport()\
-                                .getOrCreate()
-
-    # 512 MBs per partition
-    sc._jsc.hadoopConfiguration().set("mapreduce.input.fileinputformat.split.minsize", "536870912")
-    sc._jsc.hadoopConfiguration().set("mapreduce.input.fileinputformat.split.maxsize", "536870912")
-    spark.conf.set("park.kryoserializer.buffer.max", "4096m")
-    spark.conf.set("spark.serializer", "org.apache.spark.serializer.KryoSerializer")
-    spark.conf.set("spark.rdd.compress", "true")
-    spark.conf.set("spark.executor.memory", "10g")
-    spark.conf.set("spark.debug.maxToStringFields", "100")
-
-    # Read the RAW table schema
-    source = "{}.{}".format(param['hive_database_raw'], param['hive_table_raw'])
-    df = spark.sql("SELECT * FROM {} LIMIT 1".format(source))
-    df.printSchema()
-    logger.debug('Showing SOURCE schema')
+    # Settings applied when the SparkContext starts (job_runner.PROFILES)
+    spark = build_session("Spark and Hive", profile='medium')
+    sc = spark.sparkContext
 
-    schema = df.schema
+    # Read the RAW table schema from the schema registry (no metastore query)
+    schema = get_struct_type(s3_data_source, param['hive_database_raw'], param['hive_table_raw'])
+    logger.debug('SOURCE schema: {}'.format(schema.simpleString()))
 
     # Open RAW file to process
     df2 = spark.read\
@@ -118,9 +118,20 @@ def run(**kwargs):
     # Save the transformed output
     destination = param['hive_database_analytics'] + "." + param['hive_table_analytics']  # <database>.<table>
     logger.debug('Saving DESTINATION table: {}'.format(destination))
-    df2.write.\
-        mode("overwrite").\
-        parquet(param['s3_object_analytics'])
+    if cdc_primary_key:
+        # Write only the rows inserted, updated or deleted since the previous dump
+        keys = [key.strip() for key in cdc_primary_key.split(',')]
+        stats = capture(spark, df2, keys, param['s3_object_analytics'], buckets=int(cdc_buckets))
+        logger.info('CDC {}: {}'.format(destination, stats))
+        if stats['mode'] == 'full':
+            spark.sql("MSCK REPAIR TABLE {}".format(destination))
+        elif stats['buckets']:
+            spark.sql("ALTER TABLE {} ADD IF NOT EXISTS {}".format(destination, ' '.join(
+                "PARTITION ({}={})".format(BUCKET_COLUMN, bucket) for bucket in stats['buckets'])))
+    else:
+        layout_writer(df2).\
+            mode("overwrite").\
+            parquet(param['s3_object_analytics'])
     logger.debug('Stopping Spark Context')
     sc.stop()
 
@@ -15,11 +15,18 @@ from pyspark.sql import SparkSession
 from pyspark.sql.functions import col, udf, to_timestamp, year, month, dayofmonth, concat, lit
 from pyspark.sql.types import *
 
+from job_runner import build_session
+from rollup import update_rollups
+from writer import layout_writer
+
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 logger.setLevel(getattr(logging, os.getenv('LOG_LEVEL', 'INFO')))
 logger.info('Loading Job module.')
 
+POSITIONAL_ARGS = ['hive_database_raw', 'hive_table_raw', 's3_object_raw', 'hive_database_analytics',
+                   'hive_table_analytics', 's3_object_analytics', 'partition']
+
 
 @click.command()
 @click.option('-hdr', '--hive-database-raw', envvar='HIVE_DATABASE_RAW', help='Hive RAW database name')
@@ -29,6 +36,8 @@ logger.info('Loading Job module.')
               help='Hive Analytics database name')
 @click.option('-hta', '--hive-table-analytics', envvar='HIVE_DATABASE_ANALYTICS', help='Hive Analytics table name')
 @click.option('-s3a', '--s3-object-analytics', envvar='S3_OBJECT_ANALYTICS', help='S3 path for Analytics objects')
+@click.option('-p', '--partition', envvar='PARTITION', help='Raw partition to process (ex: dt=2009-04-13-15-15)')
+@click.argument('positional', nargs=-1)
 def run(**kwargs):
     # Sample parameter values
     # params['hive_database_raw'] ='db_sap_ge2_raw_dev'
@@ -38,6 +47,14 @@ def run(**kwargs):
     # params['hive_table_analytics'] = 'tb_global_bkpf_parquet'
     # params['s3_object_analytics'] ='s3://datalake-analytics-dev/global/financial/tb_global_bkpf_parquet/'
 
+    # odl_spark_submit (positional params_type) sends: hive_database_raw hive_table_raw s3_object_raw
+    # hive_database_analytics hive_table_analytics s3_object_analytics [partition_name_stage=partition]
+    positional = kwargs.pop('positional')
+    for arg, value in zip(POSITIONAL_ARGS, positional):
+        kwargs[arg] = kwargs.get(arg) or value
+    # The partition is optional, without it all the raw partitions are processed
+    partition = kwargs.pop('partition')
+
     # Check for all options. This program need all of them to run.
     param = dict()
     params = kwargs
@@ -70,32 +87,42 @@ def run(**kwargs):
     logger.debug("hive_database_analytics: {}".format(param['hive_database_analytics']))
     logger.debug("hive_table_analytics: {}".format(param['hive_table_analytics']))
     logger.debug("s3_object_analytics: {}".format(param['s3_object_analytics']))
-
-    sc = SparkContext()
-
-    spark = SparkSession.builder.appName("Spark and Hive") \
-        .config("spark.hadoop.mapreduce.fileoutputcommitter.algorithm.version", "2") \
-        .config("spark.speculation", "false").config("hive.exec.dynamic.partition", "true") \
-        .config("hive.exec.dynamic.partition.mode", "nonstrict") \
-        .enableHiveSupport() \
-        .getOrCreate()
-
-    # 512 MBs per partition
-    sc._jsc.hadoopConfiguration().set("mapreduce.input.fileinputformat.split.minsize", "536870912")
-    sc._jsc.hadoopConfiguration().set("mapreduce.input.fileinputformat.split.maxsize", "536870912")
-    spark.conf.set("spark.kryoserializer.buffer.max", "4096m")
-    spark.conf.set("spark.serializer", "org.apache.spark.serializer.KryoSerializer")
-    spark.conf.set("spark.rdd.compress", "true")
-    spark.conf.set("spark.executor.memory", "10g")
-    spark.conf.set("spark.debug.maxToStringFields", "100")
-
-    # hive_database_analytics='hive_analytics'
-    # hive_table_analytics='tb_impressions_parquet'
-    # s3_object_raw='s3://koiker-bigdata-raw/hive-ads/tables/impressions/dt=2009-04-13-15-15/ec2-64-28-73-15.amazon.com-2009-04-13-15-15.log'
-    df = spark.sql("SELECT * FROM {}.{}".format(param['hive_database_raw'], param['hive_table_raw']))
-    #df = spark.sql("SELECT * FROM {}.{}".format(hive_database_raw, hive_table_raw))
-    # df = spark.sql("SELECT * FROM {}.{} LIMIT 1".format(hive_database_analytics, hive_table_analytics))
-    df.write.mode("append").insertInto(param['hive_database_analytics'] + "." + param['hive_table_analytics'])
+    logger.debug("partition: {}".format(partition))
+
+    # Settings applied when the SparkContext starts (job_runner.PROFILES)
+    spark = build_session("Spark and Hive", profile='medium')
+    sc = spark.sparkContext
+
+    # Replace only the partitions written by this run (reruns of the same partition are idempotent)
+    spark.conf.set("spark.sql.sources.partitionOverwriteMode", "dynamic")
+
+    source = "{}.{}".format(param['hive_database_raw'], param['hive_table_raw'])
+    destination = "{}.{}".format(param['hive_database_analytics'], param['hive_table_analytics'])
+    partition_columns = [column.name for column in spark.catalog.listColumns(
+        param['hive_table_analytics'], param['hive_database_analytics']) if column.isPartition]
+
+    df = spark.table(source)
+    if partition:
+        partition_name, partition_value = partition.split('=', 1)
+        if partition_columns != [partition_name]:
+            raise ValueError('The table {} is partitioned by {}, unable to overwrite the partition {}'.format(
+                destination, partition_columns, partition))
+        # The stage files of the partition were just copied, register the partition in the metastore
+        spark.sql("ALTER TABLE {} ADD IF NOT EXISTS PARTITION ({}='{}')".format(
+            source, partition_name, partition_value))
+        # Partition pruning: only the files of this partition are listed and read
+        df = df.where(col(partition_name) == partition_value)
+        logger.info('Processing the partition {} of {}'.format(partition, source))
+
+    if partition_columns:
+        layout_writer(df, partition_by=partition_columns).insertInto(destination, overwrite=True)
+    else:
+        logger.info('The table {} is not partitioned, appending the rows'.format(destination))
+        layout_writer(df).mode("append").insertInto(destination)
+
+    # Rollups of the job catalog (spark.datalake.rollups) updated with the partition loaded only
+    if partition_columns:
+        update_rollups(spark, destination, partition)
 
     sc.stop()
 
@@ -15,6 +15,11 @@ from pyspark.sql import SparkSession
 from pyspark.sql.functions import col, udf, to_timestamp, year, month, dayofmonth, concat, lit
 from pyspark.sql.types import *
 
+from job_runner import build_session
+from schema_registry import get_struct_type
+from transforms import parse_date
+from writer import layout_writer
+
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 logger.setLevel(getattr(logging, os.getenv('LOG_LEVEL', 'INFO')))
@@ -29,6 +34,8 @@ logger.info('Loading Job module.')
               help='Hive Analytics database name')
 @click.option('-hta', '--hive-table-analytics', envvar='HIVE_DATABASE_ANALYTICS', help='Hive Analytics table name')
 @click.option('-s3a', '--s3-object-analytics', envvar='S3_OBJECT_ANALYTICS', help='S3 path for Analytics objects')
+@click.option('-s3d', '--s3-data-source', envvar='S3_DATA_SOURCE',
+              help='Job catalog data source (schema registry key), optional')
 def run(**kwargs):
     # Sample parameter values
     # params['hive_database_raw'] ='db_sap_ge2_raw_dev'
@@ -40,6 +47,8 @@ def run(**kwargs):
 
     # Check for all options. This program need all of them to run.
     param = dict()
+    # The schema registry key is optional
+    s3_data_source = kwargs.pop('s3_data_source')
     params = kwargs
     path, filename = os.path.split(__file__)
     name, ext = os.path.splitext(filename)
@@ -53,6 +62,8 @@ def run(**kwargs):
         except ValueError:
             raise ValueError('Invalid JSON configuration file: {}'.format(config_file))
 
+    s3_data_source = s3_data_source or params.get('s3_data_source')
+
     for arg in kwargs:
         if kwargs.get(arg):
             logger.debug('Parsing parameter from command line {} : {}'.format(arg, kwargs.get(arg)))
@@ -71,32 +82,12 @@ def run(**kwargs):
     logger.debug("hive_table_analytics: {}".format(param['hive_table_analytics']))
     logger.debug("s3_object_analytics: {}".format(param['s3_object_analytics']))
 
-    sc = SparkContext()
-
-    spark = SparkSession.builder.appName("Spark and Hive")\
-                                .config("spark.hadoop.mapreduce.fileoutputcommitter.algorithm.version", "2")\
-                                .config("spark.speculation", "false")\
-                                .config("hive.exec.dynamic.partition", "true")\
-                                .config("hive.exec.dynamic.partition.mode", "nonstrict")\
-                                .enableHiveSupport()\
-                                .getOrCreate()
-
-    # 512 MBs per partition
-    sc._jsc.hadoopConfiguration().set("mapreduce.input.fileinputformat.split.minsize", "536870912")
-    sc._jsc.hadoopConfiguration().set("mapreduce.input.fileinputformat.split.maxsize", "536870912")
-    spark.conf.set("park.kryoserializer.buffer.max", "4096m")
-    spark.conf.set("spark.serializer", "org.apache.spark.serializer.KryoSerializer")
-    spark.conf.set("spark.rdd.compress", "true")
-    spark.conf.set("spark.executor.memory", "10g")
-    spark.conf.set("spark.debug.maxToStringFields", "100")
-
-    df = spark.sql("SELECT * FROM {}.{} LIMIT 1".format(param['hive_database_raw'], param['hive_table_raw']))
-
-    df.printSchema()
+    # Settings applied when the SparkContext starts (job_runner.PROFILES)
+    spark = build_session("Spark and Hive", profile='small')
+    sc = spark.sparkContext
 
-    df.show()
-
-    schema = df.schema
+    # Read the RAW table schema from the schema registry (no metastore query)
+    schema = get_struct_type(s3_data_source, param['hive_database_raw'], param['hive_table_raw'])
 
     df2 = spark.read.option("sep", ";").option("header", "true").schema(schema).csv(param['s3_object_raw'])
 
@@ -104,15 +95,7 @@ def run(**kwargs):
 
     df2.show()
 
-    def parse_date(argument, format_date='%Y-%m-%d'):
-        try:
-            return datetime.strptime(argument, format_date)
-        except ValueError:
-            return None
-
-    convert_date = udf(lambda x: parse_date(x, '%Y.%m.%d'), DateType())
-
-    df3 = df2.withColumn('year', year(convert_date(df2.date_time))).drop("month").drop("day")
+    df3 = df2.withColumn('year', year(parse_date(df2.date_time, '%Y.%m.%d'))).drop("month").drop("day")
     df3 = df3.repartition(1, df3['year'])
     df3.rdd.getNumPartitions()
 
@@ -120,7 +103,8 @@ def run(**kwargs):
 
     # df3.show()
 
-    df3.write.mode("append").insertInto(param['hive_database_analytics'] + "." + param['hive_table_analytics'])
+    destination = "{}.{}".format(param['hive_database_analytics'], param['hive_table_analytics'])
+    layout_writer(df3, partition_by=['year']).mode("append").insertInto(destination)
 
     sc.stop()
 
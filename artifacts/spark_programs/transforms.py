@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+#
+# Column transforms for the Spark programs
+#
+# parse_timestamp/parse_date replace the Python UDFs wrapping datetime.strptime. The formats use the same strptime
+# syntax of the old UDFs and are compiled to native Spark expressions (no rows serialized to Python workers):
+#
+#   from transforms import parse_timestamp
+#   df = df.withColumn('date_time', parse_timestamp(df.date_time, '%d.%m.%Y %H:%M:%S.%f'))
+#   df = df.withColumn('data_compra', parse_timestamp('data_compra', '%d/%m/%Y %H:%M:%S', '%d/%m/%Y'))
+#
+# - Several formats are tried in order (coalesce), the values that don't match any format are null (like the UDFs)
+# - %f (fraction of second, 1 to 6 digits) is supported as the last directive. Spark 2 to_timestamp drops the
+#   fraction so these formats are parsed with unix_timestamp (without the fraction) plus the fraction as a decimal
+# - The formats with directives Spark can't express like strptime does (%b, %y, %p, %z, ...) use a vectorized
+#   pandas_udf (Spark 2.3+ with pyarrow on the cluster)
+#
+# benchmark_transforms.py compares the rows/sec of the UDF and the native expressions
+
+from __future__ import print_function
+
+import re
+
+from pyspark.sql import Column
+from pyspark.sql.functions import coalesce, col, lit, regexp_extract, rpad, to_timestamp, unix_timestamp, when
+from pyspark.sql.types import TimestampType
+
+# strptime directive: (SimpleDateFormat pattern, regex of the accepted values)
+DIRECTIVES = {
+    'd': ('dd', r'\d{1,2}'),
+    'm': ('MM', r'\d{1,2}'),
+    'Y': ('yyyy', r'\d{4}'),
+    'H': ('HH', r'\d{1,2}'),
+    'M': ('mm', r'\d{1,2}'),
+    'S': ('ss', r'\d{1,2}'),
+    'j': ('DDD', r'\d{1,3}'),
+}
+
+FRACTION = r'(\d{1,6})'
+
+
+def _tokens(python_format):
+    tokens = []
+    position = 0
+    while position < len(python_format):
+        if python_format[position] == '%' and position + 1 < len(python_format):
+            directive = python_format[position + 1]
+            tokens.append(('literal', '%') if directive == '%' else ('directive', directive))
+            position += 2
+        else:
+            tokens.append(('literal', python_format[position]))
+            position += 1
+    return tokens
+
+
+def native_pattern(python_format):
+    """
+    SimpleDateFormat pattern and validation regex of the strptime format
+    :param python_format: string (ex: %d.%m.%Y %H:%M:%S.%f)
+    :return: tuple (pattern, regex, True if the format ends with %f) or None if Spark can't parse the format
+    """
+    tokens = _tokens(python_format)
+    fraction = bool(tokens) and tokens[-1] == ('directive', 'f')
+    if fraction:
+        tokens = tokens[:-1]
+    pattern = ''
+    regex = ''
+    for kind, value in tokens:
+        if kind == 'directive':
+            if value not in DIRECTIVES:
+                return None
+            pattern += DIRECTIVES[value][0]
+            regex += DIRECTIVES[value][1]
+        else:
+            # Letters and quotes are quoted in SimpleDateFormat
+            pattern += "'{}'".format(value.replace("'", "''")) if value.isalpha() or value == "'" else value
+            regex += re.escape(value)
+    if fraction:
+        return pattern, '^({}){}$'.format(regex, FRACTION), True
+    return pattern, '^{}$'.format(regex), False
+
+
+def _as_column(column):
+    return column if isinstance(column, Column) else col(column)
+
+
+def _native_timestamp(column, pattern, regex, fraction):
+    if not fraction:
+        return when(column.rlike(regex), to_timestamp(column, pattern))
+    # The decimal cast keeps the microseconds exact (a double would round them)
+    seconds = unix_timestamp(regexp_extract(column, regex, 1), pattern).cast('decimal(20,6)')
+    micros = rpad(regexp_extract(column, regex, 2), 6, '0').cast('decimal(20,6)') / lit(1000000)
+    return when(column.rlike(regex), (seconds + micros).cast('timestamp'))
+
+
+def _pandas_timestamp(column, python_formats):
+    try:
+        from pyspark.sql.functions import pandas_udf
+    except ImportError:
+        raise ValueError('The formats {} need pandas_udf (Spark 2.3+)'.format(python_formats))
+
+    @pandas_udf(TimestampType())
+    def parse(values):
+        import pandas as pd
+
+        result = pd.Series(pd.NaT, index=values.index)
+        for python_format in python_formats:
+            missing = result.isnull() & values.notnull()
+            if not missing.any():
+                break
+            result[missing] = pd.to_datetime(values[missing], format=python_format, errors='coerce')
+        return result
+
+    return parse(column)
+
+
+def parse_timestamp(column, *python_formats):
+    """
+    Timestamp column parsed with the first matching strptime format (null if no format matches)
+    :param column: Column or string column name
+    :param python_formats: strptime formats
+    :return: Column
+    """
+    if not python_formats:
+        raise ValueError('At least one format is required')
+    column = _as_column(column)
+    expressions = []
+    fallback = []
+    for python_format in python_formats:
+        native = native_pattern(python_format)
+        if native:
+            if fallback:
+                expressions.append(_pandas_timestamp(column, fallback))
+                fallback = []
+            expressions.append(_native_timestamp(column, *native))
+        else:
+            # Consecutive formats Spark can't parse share the same pandas_udf
+            fallback.append(python_format)
+    if fallback:
+        expressions.append(_pandas_timestamp(column, fallback))
+    return expressions[0] if len(expressions) == 1 else coalesce(*expressions)
+
+
+def parse_date(column, *python_formats):
+    """
+    Date column parsed with the first matching strptime format (null if no format matches)
+    :param column: Column or string column name
+    :param python_formats: strptime formats
+    :return: Column
+    """
+    return parse_timestamp(column, *python_formats).cast('date')
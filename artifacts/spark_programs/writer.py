@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+#
+# Layout of the analytics Parquet files
+#
+# Sorted (or Z-ordered) rows give narrow min/max statistics to the row groups and files, so the filters on these
+# columns skip most of the data (Spark predicate pushdown, Athena). The layout of a table is the "layout" attribute of
+# its job catalog item, odl_spark_submit sends it to the program as the Spark conf spark.datalake.layout:
+#
+#   {
+#     "sort_by": ["status", "customer"],        sort of the rows
+#     "zorder_by": ["customer", "date_time"],   or Z-order clustering of 2 to 4 columns (instead of sort_by)
+#     "files": 16,                              range partitioning in N files (disjoint ranges per file), optional
+#     "row_group_mb": 64,                       parquet.block.size
+#     "page_kb": 1024,                          parquet.page.size
+#     "dictionary": true,                       parquet.enable.dictionary
+#     "dictionary_page_kb": 1024,               parquet.dictionary.page.size
+#     "timestamp_micros": true                  INT64 timestamps (the default INT96 timestamps have no statistics)
+#   }
+#
+#   from writer import layout_writer
+#   layout_writer(df, partition_by=['dt']).mode('append').insertInto('db.table')
+#
+# The Parquet settings are set in the session conf (insertInto ignores the writer options) and apply to the next
+# writes of the session. benchmark_layout.py measures the bytes scanned by typical filters with each layout.
+
+from __future__ import division
+from __future__ import print_function
+
+import json
+import logging
+import os
+from functools import reduce
+
+from pyspark.ml.feature import Bucketizer
+from pyspark.sql.functions import coalesce, col, conv, datediff, hex, lit, rpad, shiftLeft, shiftRight, substring
+from pyspark.sql.types import BooleanType, DateType, NumericType, StringType, TimestampType
+
+logger = logging.getLogger(__name__)
+logger.setLevel(getattr(logging, os.getenv('LOG_LEVEL', 'INFO')))
+
+LAYOUT_CONF = 'spark.datalake.layout'
+
+LAYOUT_KEYS = ('sort_by', 'zorder_by', 'files', 'row_group_mb', 'page_kb', 'dictionary', 'dictionary_page_kb',
+               'timestamp_micros')
+
+ZORDER_COLUMN = '_zorder'
+
+# Quantiles per column of the Z-order (2 ** bits), the interleaved value must fit in a long
+ZORDER_MAX_BITS = 10
+
+# Bytes of the strings used by the Z-order (lexicographic order of the prefix)
+STRING_PREFIX = 6
+
+
+def get_layout(spark, layout=None):
+    """
+    Layout of the table: the argument or the spark.datalake.layout conf
+    :param spark: SparkSession
+    :param layout: dict or JSON string, optional
+    :return: dict
+    """
+    if layout is None:
+        layout = spark.conf.get(LAYOUT_CONF, None)
+    if not layout:
+        return {}
+    if not isinstance(layout, dict):
+        layout = json.loads(layout)
+    unknown = set(layout) - set(LAYOUT_KEYS)
+    if unknown:
+        raise ValueError('Unknown layout settings: {}'.format(', '.join(sorted(unknown))))
+    if layout.get('sort_by') and layout.get('zorder_by'):
+        raise ValueError('Use sort_by or zorder_by, not both')
+    if layout.get('zorder_by') and not 2 <= len(layout['zorder_by']) <= 4:
+        raise ValueError('zorder_by needs 2 to 4 columns')
+    return layout
+
+
+def parquet_conf(layout):
+    """
+    Session conf of the Parquet settings of the layout
+    :param layout: dict
+    :return: dict
+    """
+    conf = {}
+    if layout.get('row_group_mb'):
+        conf['parquet.block.size'] = str(int(layout['row_group_mb']) * 1024 * 1024)
+    if layout.get('page_kb'):
+        conf['parquet.page.size'] = str(int(layout['page_kb']) * 1024)
+    if layout.get('dictionary') is not None:
+        conf['parquet.enable.dictionary'] = 'true' if layout['dictionary'] else 'false'
+    if layout.get('dictionary_page_kb'):
+        conf['parquet.dictionary.page.size'] = str(int(layout['dictionary_page_kb']) * 1024)
+    if layout.get('timestamp_micros'):
+        conf['spark.sql.parquet.outputTimestampType'] = 'TIMESTAMP_MICROS'
+    return conf
+
+
+def _ordinal(df, column):
+    # Number with the same order of the values of the column
+    data_type = df.schema[column].dataType
+    if isinstance(data_type, (NumericType, BooleanType)):
+        return col(column).cast('double')
+    if isinstance(data_type, TimestampType):
+        return col(column).cast('long').cast('double')
+    if isinstance(data_type, DateType):
+        return datediff(col(column), lit('1970-01-01')).cast('double')
+    if isinstance(data_type, StringType):
+        # The hex digits of the UTF-8 prefix padded to the same length keep the lexicographic order
+        digits = STRING_PREFIX * 2
+        return conv(rpad(hex(substring(col(column), 1, STRING_PREFIX)), digits, '0'), 16, 10).cast('double')
+    raise ValueError('Z-order of the column {} ({}) is not supported'.format(column, data_type.simpleString()))
+
+
+def zorder(df, columns, relative_error=0.001):
+    """
+    Add the Z-order value of the columns: the quantile (approxQuantile) of each column with the bits interleaved,
+    rows close in all the columns get close values
+    :param df: DataFrame
+    :param columns: list of 2 to 4 column names
+    :param relative_error: float approxQuantile precision
+    :return: DataFrame with the _zorder column
+    """
+    bits = min(ZORDER_MAX_BITS, 62 // len(columns))
+    ordinals = ['_zorder_{}'.format(position) for position in range(len(columns))]
+    for name, column in zip(ordinals, columns):
+        df = df.withColumn(name, _ordinal(df, column))
+    probabilities = [step / 2 ** bits for step in range(1, 2 ** bits)]
+    quantiles = df.approxQuantile(ordinals, probabilities, relative_error)
+
+    buckets = []
+    for name, splits in zip(ordinals, quantiles):
+        # Bucketizer needs 3 splits (a column with only nulls has no quantiles)
+        splits = [float('-inf')] + (sorted(set(splits)) or [0.0]) + [float('inf')]
+        df = Bucketizer(splits=splits, inputCol=name, outputCol=name + '_bucket', handleInvalid='keep').transform(df)
+        # The nulls are the first values
+        buckets.append(coalesce(col(name + '_bucket').cast('long'), lit(0)))
+
+    terms = [shiftLeft(shiftRight(bucket, bit).bitwiseAND(1), bit * len(buckets) + position)
+             for bit in range(bits) for position, bucket in enumerate(buckets)]
+    df = df.withColumn(ZORDER_COLUMN, reduce(lambda left, right: left + right, terms))
+    return df.drop(*(ordinals + [name + '_bucket' for name in ordinals]))
+
+
+def apply_layout(df, layout, partition_by=None):
+    """
+    Rows of the DataFrame in the order of the layout (same columns)
+    :param df: DataFrame
+    :param layout: dict
+    :param partition_by: list of partition columns of the table, optional
+    :return: DataFrame
+    """
+    partition_by = list(partition_by or [])
+    columns = df.columns
+    if layout.get('zorder_by'):
+        df = zorder(df, layout['zorder_by'])
+        key = [ZORDER_COLUMN]
+    else:
+        key = list(layout.get('sort_by') or [])
+    order = partition_by + key
+    if layout.get('files') and order:
+        # Disjoint ranges per file (Spark 2.4+), hash partitioning in the older versions
+        repartition = getattr(df, 'repartitionByRange', df.repartition)
+        df = repartition(int(layout['files']), *order)
+    elif layout.get('files'):
+        df = df.repartition(int(layout['files']))
+    if order:
+        df = df.sortWithinPartitions(*order)
+    return df.select(*columns)
+
+
+def layout_writer(df, layout=None, partition_by=None):
+    """
+    DataFrameWriter of the DataFrame with the table layout applied
+    :param df: DataFrame
+    :param layout: dict or JSON string, default spark.datalake.layout conf
+    :param partition_by: list of partition columns of the table, optional
+    :return: DataFrameWriter
+    """
+    spark = df.sql_ctx.sparkSession
+    layout = get_layout(spark, layout)
+    if not layout:
+        return df.write
+    logger.info('Parquet layout: {}'.format(layout))
+    for key, value in parquet_conf(layout).items():
+        spark.conf.set(key, value)
+    return apply_layout(df, layout, partition_by).write
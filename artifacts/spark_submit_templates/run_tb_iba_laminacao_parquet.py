@@ -16,6 +16,9 @@ from pyspark.sql.functions import col, udf, to_timestamp, year, month, dayofmont
 from pyspark.sql.types import *
 import time
 
+from transforms import parse_timestamp
+from writer import layout_writer
+
 s3_object_raw = 's3://customer-stage-dev/br/iba/laminacao/dt=2018-06-07/pda000_2018-06-07_12.31.08.txt'
 # s3_object_raw = 's3://customer-stage-dev/br/iba/laminacao/dt=2018-06-07/'
 
@@ -35,7 +38,7 @@ spark = SparkSession.builder.appName("Spark and Hive") \
 # 512 MBs per partition
 # sc._jsc.hadoopConfiguration().set("mapreduce.input.fileinputformat.split.minsize", "536870912")
 # sc._jsc.hadoopConfiguration().set("mapreduce.input.fileinputformat.split.maxsize", "536870912")
-# spark.conf.set("park.kryoserializer.buffer.max", "4096m")
+# spark.conf.set("spark.kryoserializer.buffer.max", "1024m")
 # spark.conf.set("spark.serializer", "org.apache.spark.serializer.KryoSerializer")
 # spark.conf.set("spark.rdd.compress", "true")
 # spark.conf.set("spark.executor.memory", "10g")
@@ -57,16 +60,7 @@ df.show(1)
 
 df = df.drop("dt")
 
-def parse_date(argument, format_date='%d.%m.%Y %H:%M:%S.%f'):
-    try:
-        return datetime.strptime(argument, format_date)
-    except:
-        return None
-
-
-convert_date = udf(lambda x: parse_date(x, '%d.%m.%Y %H:%M:%S.%f'), TimestampType())
-
-df2 = df.withColumn('date_time', convert_date(df.date_time))
+df2 = df.withColumn('date_time', parse_timestamp(df.date_time, '%d.%m.%Y %H:%M:%S.%f'))
 
 df2.printSchema()
 
@@ -82,4 +76,4 @@ df3.show(1, False)
 
 # df3.write.saveAsTable(hive_database_analytics + "." + hive_table_analytics, format='parquet', mode='append', path=s3_target)
 
-df3.write.mode("append").insertInto(hive_database_analytics + "." + hive_table_analytics)
+layout_writer(df3, partition_by=['dt']).mode("append").insertInto(hive_database_analytics + "." + hive_table_analytics)
@@ -1,13 +1,14 @@
 from __future__ import print_function
 
 import sys
-from datetime import datetime
 
 from pyspark import SparkContext
 from pyspark.sql import SparkSession
-from pyspark.sql.functions import udf
 from pyspark.sql.types import *
 
+from transforms import parse_timestamp
+from writer import layout_writer
+
 dt = str(sys.argv[1])
 s3_object_name_stage = str(sys.argv[2])
 hive_database = str(sys.argv[3])
@@ -41,22 +42,12 @@ if __name__ == "__main__":
 
     df2 = df.selectExpr("_c0 as codigo1", "_c1 as codigo2", "_c2 as produto", "_c6 as data", "_c36 as data_compra")
 
-
-    def parse_date(argument, format_date='%d/%m/%Y %H:%M:%S'):
-        try:
-            return datetime.strptime(argument, format_date)
-        except:
-            return None
-
-
-    convert_date = udf(lambda x: parse_date(x, '%d/%m/%Y %H:%M:%S'), TimestampType())
-
-    df3 = df2.withColumn('data_compra', convert_date(df2.data_compra))
+    df3 = df2.withColumn('data_compra', parse_timestamp(df2.data_compra, '%d/%m/%Y %H:%M:%S'))
 
     df4 = df3.withColumn('dt', df3['data_compra'].cast('date'))
 
     # insert into usefull for production environment
-    df4.write.mode("append").insertInto(hive_database + "." + hive_table)
+    layout_writer(df4, partition_by=['dt']).mode("append").insertInto(hive_database + "." + hive_table)
 
     # Create table usefull for dev environment to infer the schema and show create table on hive or athena
     # df4.write.partitionBy('dt').saveAsTable(hive_database + "." + hive_table, format='parquet', mode='append', path=s3_target)
@@ -17,6 +17,13 @@ from pyspark.sql import SparkSession
 from pyspark.sql.functions import col, udf, to_timestamp, year, month, dayofmonth, concat, lit
 from pyspark.sql.types import *
 
+from job_runner import build_session
+from manifest import delete_files, manifest_files, plan_input, read_manifest
+from profiling import profiled
+from schema_registry import get_struct_type
+from transforms import parse_timestamp
+from writer import layout_writer
+
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 logger.setLevel(getattr(logging, os.getenv('LOG_LEVEL', 'INFO')))
@@ -31,6 +38,9 @@ logger.info('Loading Job module.')
               help='Hive Analytics database name')
 @click.option('-hta', '--hive-table-analytics', envvar='HIVE_DATABASE_ANALYTICS', help='Hive Analytics table name')
 @click.option('-s3a', '--s3-object-analytics', envvar='S3_OBJECT_ANALYTICS', help='S3 path for Analytics objects')
+@click.option('-s3d', '--s3-data-source', envvar='S3_DATA_SOURCE',
+              help='Job catalog data source (schema registry key), optional')
+@click.option('-m', '--manifest', envvar='MANIFEST', help='Manifest of the stage files (manifest.py), optional')
 def run(**kwargs):
     # Sample parameter values
     # params['hive_database_raw'] ='db_sap_ge2_raw_dev'
@@ -42,6 +52,9 @@ def run(**kwargs):
 
     # Check for all options. This program need all of them to run.
     param = dict()
+    # The schema registry key is optional
+    s3_data_source = kwargs.pop('s3_data_source')
+    manifest_path = kwargs.pop('manifest')
     params = kwargs
     path, filename = os.path.split(__file__)
     name, ext = os.path.splitext(filename)
@@ -54,6 +67,8 @@ def run(**kwargs):
         logger.info('Found a configuration file: {}, reading from them'.format(config_file))
         params = json.load(open(config_file))
 
+    s3_data_source = s3_data_source or params.get('s3_data_source')
+
     for arg in kwargs:
         if not params.get(arg):
             logger.info('Missing argument: {}'.format(arg))
@@ -69,16 +84,20 @@ def run(**kwargs):
     logger.debug("hive_table_analytics: {}".format(param['hive_table_analytics']))
     logger.debug("s3_object_analytics: {}".format(param['s3_object_analytics']))
 
-    regex = r"s3:\/\/([a-z0-9-_]+)"
-    bucket = re.search(regex, param['s3_object_raw']).group(1)
-    s3_bucket = boto3.resource('s3').Bucket(bucket)
-
-    # Check if there are files inside the bucket prefix
+    manifest = None
+    if manifest_path:
+        # The exact stage files of the job, without listing the prefix
+        manifest = read_manifest(manifest_path)
+        files = manifest_files(manifest)
+    else:
+        regex = r"s3:\/\/([a-z0-9-_]+)"
+        bucket = re.search(regex, param['s3_object_raw']).group(1)
+        s3_bucket = boto3.resource('s3').Bucket(bucket)
 
-    files = list()
-    s3_objects = s3_bucket.objects.filter(Prefix=prefix)
-    for obj in s3_objects:
-        files.append('s3://{}/{}'.format(obj.bucket_name, obj.key))
+        # Check if there are files inside the bucket prefix
+        files = list()
+        for obj in s3_bucket.objects.filter(Prefix=prefix):
+            files.append('s3://{}/{}'.format(obj.bucket_name, obj.key))
 
     if files:
         logger.info('The folder has {} objects'.format(len(files)))
@@ -86,31 +105,14 @@ def run(**kwargs):
         logger.info('The folder is empty and probably a previous job has already processed all objects')
         return
 
-    sc = SparkContext()
-
-    spark = SparkSession.builder.appName("Spark and Hive")\
-                                .config("spark.hadoop.mapreduce.fileoutputcommitter.algorithm.version", "2")\
-                                .config("spark.speculation", "false").config("hive.exec.dynamic.partition", "true")\
-                                .config("hive.exec.dynamic.partition.mode", "nonstrict")\
-                                .enableHiveSupport()\
-                                .getOrCreate()
-
-    # 512 MBs per partition
-    sc._jsc.hadoopConfiguration().set("mapreduce.input.fileinputformat.split.minsize", "536870912")
-    sc._jsc.hadoopConfiguration().set("mapreduce.input.fileinputformat.split.maxsize", "536870912")
-    spark.conf.set("park.kryoserializer.buffer.max", "4096m")
-    spark.conf.set("spark.serializer", "org.apache.spark.serializer.KryoSerializer")
-    spark.conf.set("spark.rdd.compress", "true")
-    spark.conf.set("spark.executor.memory", "10g")
-    spark.conf.set("spark.debug.maxToStringFields", "100")
-
-    df = spark.sql("SELECT * FROM {}.{} LIMIT 1".format(param['hive_database_raw'], param['hive_table_raw']))
+    # Settings applied when the SparkContext starts (job_runner.PROFILES)
+    spark = build_session("Spark and Hive", profile='medium')
+    sc = spark.sparkContext
+    if manifest:
+        plan_input(spark, manifest)
 
-    #df.printSchema()
-
-    #df.show()
-
-    schema = df.schema
+    # Read the RAW table schema from the schema registry (no metastore query)
+    schema = get_struct_type(s3_data_source, param['hive_database_raw'], param['hive_table_raw'])
 
     df2 = spark.read.option("sep", "\t").option("header", "true").schema(schema).csv(files)
 
@@ -120,15 +122,7 @@ def run(**kwargs):
 
     df2 = df2.drop("dt")
 
-    def parse_date(argument, format_date='%d.%m.%Y %H:%M:%S.%f'):
-        try:
-            return datetime.strptime(argument, format_date)
-        except:
-            return None
-
-    convert_date = udf(lambda x: parse_date(x, '%d.%m.%Y %H:%M:%S.%f'), TimestampType())
-
-    df3 = df2.withColumn('date_time', convert_date(df2.date_time))
+    df3 = df2.withColumn('date_time', parse_timestamp(df2.date_time, '%d.%m.%Y %H:%M:%S.%f'))
 
     #df3.printSchema()
 
@@ -138,7 +132,12 @@ def run(**kwargs):
 
     df3 = df3.withColumn('dt', (df3.date_time).cast('date'))
 
-    df3.write.mode("append").insertInto(param['hive_database_analytics'] + "." + param['hive_table_analytics'])
+    table_analytics = param['hive_database_analytics'] + "." + param['hive_table_analytics']
+
+    # Profile and quality rules of the job catalog (spark.datalake.profile), in the same job as the write
+    df3, profile = profiled(df3, table_analytics)
+
+    layout_writer(df3, partition_by=['dt']).mode("append").insertInto(table_analytics)
 
     #df3.printSchema()
 
@@ -146,9 +145,10 @@ def run(**kwargs):
 
     sc.stop()
 
-    # Delete the files from the stage bucket to avoid duplicated processing
+    # Delete the files read from the stage bucket to avoid duplicated processing (only these files, the files that
+    # arrived during the job are processed by the next one)
     logger.info('Finished processing files, deleting the stage files now...')
-    s3_objects.delete()
+    delete_files(files)
 
 
 if __name__ == '__main__':
@@ -1,58 +1,222 @@
+# -*- coding: utf-8 -*-
+#
+# Small files compaction of the partitions of a table (Glue Data Catalog)
+#
+# The append jobs (insertInto) leave the partitions with many small Parquet files and the query planning of Athena
+# and Spark is dominated by the file listing. For each partition of the table:
+#
+#   1. lists the files of the partition location and estimates the bytes per file
+#   2. if the partition has more than --max-files files, rewrites it with ceil(bytes / --target-size-mb) files in a new
+#      location ({table location}/_compacted/{partition}/{timestamp})
+#   3. checks the row count of the new files and lists the partition location again (files added during the rewrite
+#      abort the swap of the partition)
+#   4. points the partition to the new location with one update_partition call (atomic for the readers) and removes
+#      the old files
+#
+# spark-submit spark_repartition.py -hda db_analytics -hta tb_iba_laminacao --target-size-mb 256 --dry-run
+#
+# --dry-run prints the report of the partitions to compact without writing anything.
+
+from __future__ import division
 from __future__ import print_function
-import pyspark
 
-import json
 import logging
+import math
 import os
+from datetime import datetime
 
+import boto3
 import click
 
-from datetime import datetime
-
-from pyspark import SparkConf
 from pyspark import SparkContext
 from pyspark.sql import SparkSession
-from pyspark.sql.functions import col, udf, to_timestamp, year, month, dayofmonth, concat, lit
-from pyspark.sql.types import *
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 logger.setLevel(getattr(logging, os.getenv('LOG_LEVEL', 'INFO')))
 logger.info('Loading Job module.')
 
+# REGION NAME
+REGION = os.getenv('AWS_DEFAULT_REGION', 'us-east-1')
+
+# Directory (inside the table location) of the compacted partitions. Spark and Hive ignore the _ directories
+COMPACTED_DIR = '_compacted'
+
+MB = 1024 * 1024
+
+glue_client = boto3.client('glue', region_name=REGION)
+
+
+def hadoop_path(spark, path):
+    jvm = spark.sparkContext._jvm
+    path = jvm.org.apache.hadoop.fs.Path(path)
+    return path.getFileSystem(spark.sparkContext._jsc.hadoopConfiguration()), path
+
+
+def list_files(spark, location):
+    """
+    Data files of the partition location (the _ and . files are ignored like the readers do)
+    :param spark: SparkSession
+    :param location: string
+    :return: dict path: size
+    """
+    fs, path = hadoop_path(spark, location)
+    if not fs.exists(path):
+        return {}
+    files = {}
+    for status in fs.listStatus(path):
+        name = status.getPath().getName()
+        if status.isFile() and not name.startswith('_') and not name.startswith('.'):
+            files[status.getPath().toString()] = status.getLen()
+    return files
+
+
+def get_partitions(database, table, expression=None):
+    """
+    Partitions of the table in the Glue Data Catalog
+    :param database: string
+    :param table: string
+    :param expression: string Glue partition filter (ex: dt >= '2018-07-01')
+    :return: list of partitions
+    """
+    paginator = glue_client.get_paginator('get_partitions')
+    kwargs = {'DatabaseName': database, 'TableName': table}
+    if expression:
+        kwargs['Expression'] = expression
+    partitions = []
+    for page in paginator.paginate(**kwargs):
+        partitions.extend(page['Partitions'])
+    return partitions
+
+
+def plan(spark, table, partitions, max_files, target_size):
+    """
+    Partitions with more files than max_files and the number of files after the compaction
+    :param spark: SparkSession
+    :param table: dict Glue table
+    :param partitions: list of Glue partitions
+    :param max_files: integer
+    :param target_size: integer bytes per file
+    :return: list of dict (partition, name, files, bytes, target_files)
+    """
+    keys = [key['Name'] for key in table['PartitionKeys']]
+    compactions = []
+    for partition in partitions:
+        name = '/'.join('{}={}'.format(key, value) for key, value in zip(keys, partition['Values']))
+        files = list_files(spark, partition['StorageDescriptor']['Location'])
+        size = sum(files.values())
+        target_files = max(1, int(math.ceil(size / target_size)))
+        if len(files) > max_files and target_files < len(files):
+            compactions.append({
+                'partition': partition,
+                'name': name,
+                'files': files,
+                'bytes': size,
+                'target_files': target_files
+            })
+    return compactions
+
+
+def report(compactions, partitions, dry_run):
+    print('{:<50} {:>8} {:>12} {:>14} {:>8}'.format('partition', 'files', 'MB', 'MB per file', 'target'))
+    for compaction in compactions:
+        files = len(compaction['files'])
+        print('{:<50} {:>8} {:>12.1f} {:>14.2f} {:>8}'.format(
+            compaction['name'], files, compaction['bytes'] / MB, compaction['bytes'] / files / MB,
+            compaction['target_files']))
+    print('{} of {} partitions to compact: {} files to {} files{}'.format(
+        len(compactions), len(partitions), sum(len(compaction['files']) for compaction in compactions),
+        sum(compaction['target_files'] for compaction in compactions), ' (dry run)' if dry_run else ''))
+
+
+def swap_location(database, table, partition, location):
+    """
+    Point the partition to the new location
+    :param database: string
+    :param table: string
+    :param partition: dict Glue partition
+    :param location: string
+    :return: None
+    """
+    partition_input = dict((key, partition[key]) for key in ('Values', 'StorageDescriptor', 'Parameters')
+                           if key in partition)
+    partition_input['StorageDescriptor'] = dict(partition['StorageDescriptor'], Location=location)
+    glue_client.update_partition(
+        DatabaseName=database,
+        TableName=table,
+        PartitionValueList=partition['Values'],
+        PartitionInput=partition_input
+    )
+
+
+def compact(spark, database, table, compaction, keep_files):
+    """
+    Rewrite the partition with target_files files and swap the location
+    :param spark: SparkSession
+    :param database: string
+    :param table: dict Glue table
+    :param compaction: dict from plan
+    :param keep_files: boolean keep the old files after the swap
+    :return: string status
+    """
+    partition = compaction['partition']
+    files = compaction['files']
+    location = '{}/{}/{}/{}'.format(table['StorageDescriptor']['Location'].rstrip('/'), COMPACTED_DIR,
+                                    compaction['name'], datetime.utcnow().strftime('%Y%m%d%H%M%S'))
+    df = spark.read.parquet(*files.keys())
+    rows = df.count()
+    # coalesce: the small files are grouped in target_files tasks without a shuffle
+    df.coalesce(compaction['target_files']).write.mode('errorifexists').parquet(location)
+    fs, path = hadoop_path(spark, location)
+    written = spark.read.parquet(location).count()
+    if written != rows:
+        fs.delete(path, True)
+        return 'failed: {} rows written of {}'.format(written, rows)
+    if list_files(spark, partition['StorageDescriptor']['Location']) != files:
+        fs.delete(path, True)
+        return 'skipped: the partition changed during the compaction'
+
+    swap_location(database, table['Name'], partition, location)
+    if not keep_files:
+        for name in files:
+            old_fs, old_path = hadoop_path(spark, name)
+            old_fs.delete(old_path, False)
+    return 'compacted: {} files to {} files in {}'.format(len(files), compaction['target_files'], location)
+
 
 @click.command()
-@click.option('-hdr', '--hive-database-raw', envvar='HIVE_DATABASE_RAW', help='Hive RAW database name')
-@click.option('-htr', '--hive-table-raw', envvar='HIVE_TABLE_RAW', help='Hive RAW table name')
-@click.option('-s3r', '--s3-object-raw', envvar='S3_OBJECT_RAW', help='S3 path for RAW objects')
-@click.option('-hda', '--hive-database-analytics', envvar='HIVE_DATABASE_ANALYTICS',
+@click.option('-hda', '--hive-database-analytics', envvar='HIVE_DATABASE_ANALYTICS', required=True,
               help='Hive Analytics database name')
-@click.option('-hta', '--hive-table-analytics', envvar='HIVE_DATABASE_ANALYTICS', help='Hive Analytics table name')
-@click.option('-s3a', '--s3-object-analytics', envvar='S3_OBJECT_ANALYTICS', help='S3 path for Analytics objects')
-def run(**kwargs):
-    
+@click.option('-hta', '--hive-table-analytics', envvar='HIVE_TABLE_ANALYTICS', required=True,
+              help='Hive Analytics table name')
+@click.option('--partition-filter', envvar='PARTITION_FILTER', help="Glue partition filter (ex: dt >= '2018-07-01')")
+@click.option('--max-files', envvar='MAX_FILES', type=int, default=32,
+              help='Compact the partitions with more files than this')
+@click.option('--target-size-mb', envvar='TARGET_SIZE_MB', type=int, default=256, help='Size of the compacted files')
+@click.option('--keep-files', is_flag=True, default=False, help='Keep the old files after the swap')
+@click.option('--dry-run', is_flag=True, default=False, help='Only report the partitions to compact')
+def run(hive_database_analytics, hive_table_analytics, partition_filter, max_files, target_size_mb, keep_files,
+        dry_run):
     sc = SparkContext()
 
-    spark = SparkSession.builder.appName("Spark and Hive")\
+    spark = SparkSession.builder.appName("Compaction {}.{}".format(hive_database_analytics, hive_table_analytics))\
                                 .config("spark.hadoop.mapreduce.fileoutputcommitter.algorithm.version", "2")\
                                 .config("spark.speculation", "false")\
-                                .config("hive.exec.dynamic.partition", "true")\
-                                .config("hive.exec.dynamic.partition.mode", "nonstrict")\
                                 .enableHiveSupport()\
                                 .getOrCreate()
 
-    # 512 MBs per partition
-    sc._jsc.hadoopConfiguration().set("mapreduce.input.fileinputformat.split.minsize", "536870912")
-    sc._jsc.hadoopConfiguration().set("mapreduce.input.fileinputformat.split.maxsize", "536870912")
-    spark.conf.set("park.kryoserializer.buffer.max", "4096m")
-    spark.conf.set("spark.serializer", "org.apache.spark.serializer.KryoSerializer")
-    spark.conf.set("spark.rdd.compress", "true")
-    spark.conf.set("spark.executor.memory", "10g")
-    spark.conf.set("spark.debug.maxToStringFields", "100")
-
-    df = spark.read.parquet()
+    table = glue_client.get_table(DatabaseName=hive_database_analytics, Name=hive_table_analytics)['Table']
+    if not table.get('PartitionKeys'):
+        raise click.UsageError('The table {}.{} is not partitioned'.format(hive_database_analytics,
+                                                                           hive_table_analytics))
+    partitions = get_partitions(hive_database_analytics, hive_table_analytics, partition_filter)
+    compactions = plan(spark, table, partitions, max_files, target_size_mb * MB)
+    report(compactions, partitions, dry_run)
 
-    df.repartition()
+    if not dry_run:
+        for compaction in compactions:
+            status = compact(spark, hive_database_analytics, table, compaction, keep_files)
+            print('{}: {}'.format(compaction['name'], status))
 
     sc.stop()
 
@@ -17,13 +17,19 @@
 #
 #
 # Common functions to Data Lake Lambda functions
+import csv
 import datetime
+import decimal
 import hashlib
 import hmac
 import json
 import logging
 import os
+import re
 import string
+import sys
+import threading
+import time
 
 from urllib import quote
 # http://python-future.org/compatible_idioms.html
@@ -34,14 +40,32 @@ try:
 except ImportError:
     from urlparse import urlparse
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 from botocore.vendored import requests
 
 import boto3
+from boto3.dynamodb.conditions import Attr
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 logger.setLevel(getattr(logging, os.getenv('LOG_LEVEL', 'INFO')))
 
+# Name of the EMR step starting the resident Spark job server (job_server.py)
+JOB_SERVER_STEP_NAME = 'Start the Spark job server'
+
+# Elasticsearch write alias of the ingestion catalog. odl_es_index_manager rolls it over to new indices
+# (datalake-raw-YYYY.MM.DD-000001) and the searches use the read alias datalake-raw with all indices
+ES_RAW_WRITE_ALIAS = 'datalake-raw-write'
+ES_RAW_READ_ALIAS = 'datalake-raw'
+
+# Keys ingested again with the same name (ex: latest/ full dumps): after a rollover their previous document is in an
+# older index of the read alias and is deleted when the new one is written
+ES_RAW_REINGESTED_KEYS = re.compile(os.getenv('ES_RAW_REINGESTED_KEYS', r'(^|/)latest/'))
+
 
 class DatalakeStatus:
     INITIAL_LOAD = 'INITIAL_LOAD'
@@ -86,6 +110,50 @@ def cluster_is_running(label, s3_log_uri, sns_topic_arn, environment):
     return False
 
 
+def job_server_step(scripts_path, programs_path, queue_url, stage_table, control_table):
+    """
+    EMR step starting the resident Spark job server in background (start_job_server.sh does nothing if the server is
+    running, the step finishes when the server is started)
+    :param scripts_path: string EMR local home path of the bootstrap scripts
+    :param programs_path: string s3 path of the Spark programs
+    :param queue_url: string SQS queue of the job server
+    :param stage_table: string DynamoDB stage control table
+    :param control_table: string DynamoDB control table
+    :return: dict
+    """
+    return {
+        'Name': JOB_SERVER_STEP_NAME,
+        'ActionOnFailure': 'CONTINUE',
+        'HadoopJarStep': {
+            'Jar': 'command-runner.jar',
+            'Args': [
+                '{}/start_job_server.sh'.format(scripts_path),
+                programs_path,
+                queue_url,
+                stage_table,
+                control_table
+            ]
+        }
+    }
+
+
+def stage_has_emr_files(table_stage):
+    """
+    Check if the stage table has files to be processed by the EMR cluster (the files converted by the fast path
+    function odl_convert_parquet don't need it). The pages of a filtered scan can be empty before the last one.
+    :param table_stage: DynamoDB Table resource of the stage control table
+    :return: boolean
+    """
+    kwargs = {'FilterExpression': Attr('engine').not_exists() | Attr('engine').ne('lambda')}
+    while True:
+        response = table_stage.scan(**kwargs)
+        if response.get('Items'):
+            return True
+        if not response.get('LastEvaluatedKey'):
+            return False
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
 def send_notification(sns_arn, subject, message):
     client = boto3.client('sns')
     try:
@@ -125,11 +193,79 @@ def es_put(es_index, es_type, es_id, data):
     :param data: dict
     :return: object
     """
+    return es_request('PUT', '{}/{}/{}'.format(es_index, es_type, es_id), data)
+
+
+def es_delete(es_index, es_type, es_id):
+    """
+    Delete documents from Elasticsearch
+    the ES endpoint is get from Environment Variable ES_ENDPOINT
+    This code is supposed to run on Lambda function
+
+    :param es_index: string
+    :param es_type: string
+    :param es_id: string
+    :return: object
+    """
+    return es_request('DELETE', '{}/{}/{}'.format(es_index, es_type, es_id))
+
+
+def es_request(method, path, data=None, params=None):
+    """
+    Send any request to the Elasticsearch API (templates, aliases, reindex...)
+    the ES endpoint is get from Environment Variable ES_ENDPOINT
+    This code is supposed to run on Lambda function
+
+    :param method: string HTTP method
+    :param path: string API path without the endpoint (ex: _template/datalake-hive)
+    :param data: dict (optional) JSON body
+    :param params: dict (optional) query string
+    :return: object
+    """
+    endpoint, auth = _es_auth()
+    if not endpoint:
+        return None
+
+    url = '{}/{}'.format(endpoint, path)
+    logger.debug('URL: {}'.format(url))
+    response = requests.request(method, url, auth=auth, json=data, params=params)
+    return response
+
+
+def es_bulk(actions, default=None):
+    """
+    Send many index/delete actions to Elasticsearch in one _bulk request
+    the ES endpoint is get from Environment Variable ES_ENDPOINT
+    This code is supposed to run on Lambda function
+
+    :param actions: list of tuples (action, metadata, document) ex:
+                    ('index', {'_index': 'datalake-raw', '_type': '_doc', '_id': '1'}, {'data': 1}) /
+                    ('delete', {'_index': 'datalake-raw', '_type': '_doc', '_id': '1'}, None)
+    :param default: function (optional) to serialize the objects not supported by json (ex: datetime)
+    :return: object
+    """
+    endpoint, auth = _es_auth()
+    if not endpoint or not actions:
+        return None
+
+    lines = list()
+    for action, metadata, document in actions:
+        lines.append(json.dumps({action: metadata}))
+        if document is not None:
+            lines.append(json.dumps(document, default=default))
+    url = '{}/_bulk'.format(endpoint)
+    logger.debug('URL: {} ({} actions)'.format(url, len(actions)))
+    response = requests.post(url, auth=auth, data='\n'.join(lines) + '\n',
+                             headers={'Content-Type': 'application/x-ndjson'})
+    return response
+
+
+def _es_auth():
     region = os.getenv('AWS_DEFAULT_REGION', 'us-east-1')
     endpoint = os.getenv('ES_ENDPOINT')
     logger.setLevel(getattr(logging, os.getenv('LOG_LEVEL', 'INFO')))
     if not endpoint:
-        return None
+        return None, None
 
     if endpoint[-1:] == '/':
         endpoint = endpoint[:-1]
@@ -142,10 +278,7 @@ def es_put(es_index, es_type, es_id, data):
                            aws_host=host,
                            aws_region=region,
                            aws_service='es')
-    url = '{}/{}/{}/{}'.format(endpoint, es_index, es_type, es_id)
-    logger.debug('URL: {}'.format(url))
-    response = requests.put(url, auth=auth, json=data)
-    return response
+    return endpoint, auth
 
 
 class DatalakeIngestion(object):
@@ -293,11 +426,12 @@ class DatalakeIngestion(object):
         :return:
         """
         logger.debug("JSON to catalog on ES: {}".format(json.dumps(data)))
+        es_id = hashlib.md5(key).hexdigest()
         # Sent data to Catalog (ElasticSearch)
         try:
-            resp = es_put(es_index='datalake-raw',
+            resp = es_put(es_index=ES_RAW_WRITE_ALIAS,
                           es_type='_doc',
-                          es_id=hashlib.md5(key).hexdigest(),
+                          es_id=es_id,
                           data=data)
         except Exception as e:
             logger.error('Error executing Elastic Search Put')
@@ -311,10 +445,377 @@ class DatalakeIngestion(object):
             if not 200 <= resp.status_code <= 299:
                 logger.error('Error sending data to ES Catalog')
                 logger.debug('Error: {}'.format(resp.text))
+            elif ES_RAW_REINGESTED_KEYS.search(key):
+                self.delete_stale_catalog(key, es_id, resp.json().get('_index'))
         else:
             logger.debug('There is no ES_ENDPOINT configured')
         return resp
 
+    @staticmethod
+    def delete_stale_catalog(key, es_id, index):
+        """
+        Delete the copies of the document in the other indices of the read alias (written before a rollover), so the
+        searches (and the retention) only see the new one
+        :param key: filename
+        :param es_id: string
+        :param index: string index of the new document
+        :return: None
+        """
+        try:
+            resp = es_request('POST', '{}/_delete_by_query'.format(ES_RAW_READ_ALIAS), {'query': {'bool': {
+                'filter': [{'ids': {'values': [es_id]}}],
+                'must_not': [{'term': {'_index': index}}]
+            }}}, params={'conflicts': 'proceed'})
+        except Exception as e:
+            logger.error('Error deleting the previous ES Catalog documents of {}: {}'.format(key, e))
+            return
+        if resp is not None and not 200 <= resp.status_code <= 299:
+            logger.error('Error deleting the previous ES Catalog documents of {}: {}'.format(key, resp.text))
+
+
+def _athena_timestamp(value):
+    if '.' in value:
+        return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f')
+    return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+
+
+# Convert the Athena result values (always strings) to python types based on the ResultSetMetadata column type
+ATHENA_TYPE_CONVERTERS = {
+    'boolean': lambda value: value.lower() == 'true',
+    'tinyint': int,
+    'smallint': int,
+    'integer': int,
+    'bigint': int,
+    'float': float,
+    'real': float,
+    'double': float,
+    'decimal': decimal.Decimal,
+    'date': lambda value: datetime.datetime.strptime(value, '%Y-%m-%d').date(),
+    'timestamp': _athena_timestamp
+}
+
+
+class AthenaQueryExecutor(object):
+    FINAL_STATES = ['SUCCEEDED', 'FAILED', 'CANCELLED']
+
+    # Max rows returned by each GetQueryResults call (API limit)
+    PAGE_SIZE = 1000
+
+    # Bytes read by each ranged GetObject when streaming the result file from S3
+    STREAM_CHUNK_SIZE = 8 * 1024 * 1024
+
+    def __init__(self, output_location, max_concurrency=5, timeout=60, poll_interval=0.2, max_poll_interval=5,
+                 athena_client=None, s3_client=None):
+        """
+        AthenaQueryExecutor runs Athena queries with a bounded concurrency and poll the query state with
+        exponential backoff. The first poll waits for the expected runtime (moving average of the previous queries)
+        so long queries don't burn API calls and short queries are not delayed.
+
+        :param output_location: string s3://bucket/key for the query results
+        :param max_concurrency: integer max number of running queries (match the account Athena concurrency limit)
+        :param timeout: integer max seconds to wait for each query
+        :param poll_interval: float initial wait in seconds between the query state checks
+        :param max_poll_interval: float max wait in seconds between the query state checks
+        :param athena_client: object (optional) boto3 athena client
+        :param s3_client: object (optional) boto3 s3 client used to stream the result file
+        """
+        self._athena_client = athena_client or boto3.client('athena')
+        self._s3_client = s3_client
+        self._output_location = output_location
+        self._max_concurrency = max_concurrency
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._timeout = timeout
+        self._poll_interval = poll_interval
+        self._max_poll_interval = max_poll_interval
+        self._expected_runtime = None
+        self._lock = threading.Lock()
+
+    def start(self, query, database=None):
+        """
+        Start the query execution and return the execution id
+        :param query: string
+        :param database: string
+        :return: string
+        """
+        params = {
+            'QueryString': query,
+            'ResultConfiguration': {'OutputLocation': self._output_location}
+        }
+        if database:
+            params['QueryExecutionContext'] = {'Database': database}
+        return self._athena_client.start_query_execution(**params)['QueryExecutionId']
+
+    def wait(self, execution_id):
+        """
+        Poll the Athena API till you have a SUCCEEDED/FAILED/CANCELLED reply or the timeout is reached
+        The return is the string: SUCCEEDED/FAILED/CANCELLED/TIMEOUT
+
+        :param execution_id: string
+        :return: string
+        """
+        start = time.time()
+        interval = self._poll_interval
+        wait_time = max(self._poll_interval, self._expected_runtime or 0)
+        while True:
+            remaining = start + self._timeout - time.time()
+            if remaining <= 0:
+                logger.info('Athena query {} timed out after {} seconds'.format(execution_id, self._timeout))
+                try:
+                    self._athena_client.stop_query_execution(QueryExecutionId=execution_id)
+                except Exception as e:
+                    logger.debug('Unable to stop the Athena query {}: {}'.format(execution_id, e))
+                return 'TIMEOUT'
+            time.sleep(min(wait_time, remaining))
+            stats = self._athena_client.get_query_execution(QueryExecutionId=execution_id)
+            status = stats['QueryExecution']['Status']['State']
+            if status in self.FINAL_STATES:
+                if status == 'SUCCEEDED':
+                    self._update_expected_runtime(time.time() - start)
+                return status
+            interval = min(interval * 2, self._max_poll_interval)
+            wait_time = interval
+
+    def execute(self, query, database=None):
+        """
+        Run the query and block till it finishes. The number of queries running at the same time is limited by
+        max_concurrency even when this method is called from many threads.
+
+        :param query: string
+        :param database: string
+        :return: tuple (state, execution_id)
+        """
+        with self._semaphore:
+            execution_id = self.start(query, database)
+            return self.wait(execution_id), execution_id
+
+    def run(self, queries):
+        """
+        Run the queries concurrently and yield the result of each one as soon as it finishes
+
+        :param queries: iterable of tuples (key, query, database)
+        :return: generator of tuples (key, state, execution_id)
+        """
+        tasks = queue.Queue()
+        results = queue.Queue()
+        for task in queries:
+            tasks.put(task)
+        count = tasks.qsize()
+
+        def worker():
+            while True:
+                try:
+                    key, query, database = tasks.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    state, execution_id = self.execute(query, database)
+                except Exception as e:
+                    logger.error('Error executing the Athena query: {}'.format(query))
+                    logger.debug('Error: {}'.format(e))
+                    state, execution_id = 'FAILED', None
+                results.put((key, state, execution_id))
+
+        for _ in range(min(self._max_concurrency, count)):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+
+        for _ in range(count):
+            yield results.get()
+
+    def get_results(self, execution_id):
+        """
+        Return the GetQueryResults response of a finished query (only the first page, use iter_rows to read all rows)
+        :param execution_id: string
+        :return: dict
+        """
+        return self._athena_client.get_query_results(QueryExecutionId=execution_id)
+
+    def iter_pages(self, execution_id):
+        """
+        Lazily page through GetQueryResults following the NextToken, only one page is kept in memory
+
+        :param execution_id: string
+        :return: generator of GetQueryResults responses
+        """
+        params = {'QueryExecutionId': execution_id, 'MaxResults': self.PAGE_SIZE}
+        while True:
+            page = self._athena_client.get_query_results(**params)
+            yield page
+            next_token = page.get('NextToken')
+            if not next_token:
+                return
+            params['NextToken'] = next_token
+
+    def iter_rows(self, execution_id, skip_header=None):
+        """
+        Yield all rows of a finished query as tuples typed by the ResultSetMetadata (NULL values are None)
+        The results of SELECT queries (StatementType DML) have the column names as the first row, this row is skipped
+
+        :param execution_id: string
+        :param skip_header: boolean (optional) default is True for DML queries
+        :return: generator of tuples
+        """
+        if skip_header is None:
+            skip_header = self.statement_type(execution_id) == 'DML'
+        converters = None
+        for page in self.iter_pages(execution_id):
+            result_set = page.get('ResultSet', {})
+            if converters is None:
+                converters = self._converters(result_set.get('ResultSetMetadata', {}))
+            for row in result_set.get('Rows', []):
+                if skip_header:
+                    skip_header = False
+                    continue
+                yield self._convert_row([data.get('VarCharValue') for data in row['Data']], converters)
+
+    def iter_batches(self, execution_id, batch_size=PAGE_SIZE, stream=False):
+        """
+        Yield the typed rows in lists of batch_size rows
+
+        :param execution_id: string
+        :param batch_size: integer
+        :param stream: boolean read the result file from S3 instead of the GetQueryResults API (faster for large
+                       results of SELECT queries)
+        :return: generator of lists of tuples
+        """
+        rows = self.iter_csv_rows(execution_id) if stream else self.iter_rows(execution_id)
+        batch = list()
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = list()
+        if batch:
+            yield batch
+
+    def iter_csv_rows(self, execution_id):
+        """
+        Stream the CSV result file of a SELECT query from the S3 output location with ranged GetObject calls and
+        yield the rows typed by the ResultSetMetadata. Only one chunk of the file is kept in memory.
+
+        :param execution_id: string
+        :return: generator of tuples
+        """
+        output_location = self._athena_client.get_query_execution(
+            QueryExecutionId=execution_id)['QueryExecution']['ResultConfiguration']['OutputLocation']
+        metadata = self._athena_client.get_query_results(
+            QueryExecutionId=execution_id, MaxResults=1).get('ResultSet', {}).get('ResultSetMetadata', {})
+        converters = self._converters(metadata)
+        url = urlparse(output_location)
+        reader = csv.reader(self._iter_s3_lines(url.netloc, url.path.lstrip('/')))
+        # The first line of the CSV file is the header
+        next(reader, None)
+        for row in reader:
+            if sys.version_info[0] < 3:
+                row = [value.decode('utf-8') for value in row]
+            # The CSV file doesn't distinguish NULL from empty string, empty values of non string columns are NULL
+            yield self._convert_row([value if value or converter is None else None
+                                     for value, converter in zip(row, converters)], converters)
+
+    def columns(self, execution_id):
+        """
+        Return the column names and Athena types of a finished query
+        :param execution_id: string
+        :return: list of tuples (name, type)
+        """
+        metadata = self._athena_client.get_query_results(
+            QueryExecutionId=execution_id, MaxResults=1).get('ResultSet', {}).get('ResultSetMetadata', {})
+        return [(column['Name'], column['Type']) for column in metadata.get('ColumnInfo', [])]
+
+    def statement_type(self, execution_id):
+        """
+        Return the StatementType of the query: DDL/DML/UTILITY
+        :param execution_id: string
+        :return: string
+        """
+        stats = self._athena_client.get_query_execution(QueryExecutionId=execution_id)
+        return stats.get('QueryExecution', {}).get('StatementType')
+
+    def to_arrow(self, execution_id, batch_size=PAGE_SIZE, stream=False):
+        """
+        Build a pyarrow Table from the query results, one RecordBatch per batch of rows
+        pyarrow is not part of the Lambda runtime and is imported only when this method is called
+
+        :param execution_id: string
+        :param batch_size: integer
+        :param stream: boolean read the result file from S3 (see iter_batches)
+        :return: pyarrow.Table
+        """
+        import pyarrow as pa
+
+        columns = self.columns(execution_id)
+        names = [name for name, _ in columns]
+        batches = list()
+        for batch in self.iter_batches(execution_id, batch_size, stream):
+            arrays = [pa.array([row[index] for row in batch]) for index in range(len(names))]
+            batches.append(pa.RecordBatch.from_arrays(arrays, names))
+        if not batches:
+            return pa.Table.from_arrays([pa.array([]) for _ in names], names)
+        return pa.Table.from_batches(batches)
+
+    def to_pandas(self, execution_id, stream=False):
+        """
+        Build a pandas DataFrame from the query results
+        pandas is not part of the Lambda runtime and is imported only when this method is called
+
+        :param execution_id: string
+        :param stream: boolean read the result file from S3 (see iter_batches)
+        :return: pandas.DataFrame
+        """
+        import pandas as pd
+
+        names = [name for name, _ in self.columns(execution_id)]
+        rows = self.iter_csv_rows(execution_id) if stream else self.iter_rows(execution_id)
+        return pd.DataFrame.from_records(rows, columns=names)
+
+    def _iter_s3_lines(self, bucket, key):
+        if self._s3_client is None:
+            self._s3_client = boto3.client('s3')
+        size = self._s3_client.head_object(Bucket=bucket, Key=key)['ContentLength']
+        remainder = b''
+        for start in range(0, size, self.STREAM_CHUNK_SIZE):
+            end = min(start + self.STREAM_CHUNK_SIZE, size) - 1
+            chunk = self._s3_client.get_object(Bucket=bucket, Key=key,
+                                               Range='bytes={}-{}'.format(start, end))['Body'].read()
+            lines = (remainder + chunk).split(b'\n')
+            remainder = lines.pop()
+            for line in lines:
+                yield self._decode_line(line + b'\n')
+        if remainder:
+            yield self._decode_line(remainder)
+
+    @staticmethod
+    def _decode_line(line):
+        # csv.reader reads bytes on Python 2 and text on Python 3
+        if sys.version_info[0] < 3:
+            return line
+        return line.decode('utf-8')
+
+    @staticmethod
+    def _converters(metadata):
+        return [ATHENA_TYPE_CONVERTERS.get(column.get('Type', '').lower()) for column in metadata.get('ColumnInfo', [])]
+
+    @staticmethod
+    def _convert_row(values, converters):
+        row = list()
+        for index, value in enumerate(values):
+            converter = converters[index] if index < len(converters) else None
+            if value is not None and converter is not None:
+                try:
+                    value = converter(value)
+                except (ValueError, decimal.InvalidOperation):
+                    logger.debug('Unable to convert the Athena value: {}'.format(value))
+            row.append(value)
+        return tuple(row)
+
+    def _update_expected_runtime(self, runtime):
+        with self._lock:
+            if self._expected_runtime is None:
+                self._expected_runtime = runtime
+            else:
+                self._expected_runtime = 0.7 * self._expected_runtime + 0.3 * runtime
+
 
 # This part of the code is extracted from: https://github.com/DavidMuller/aws-requests-auth
 # MIT License
@@ -18,11 +18,14 @@
 
 from __future__ import print_function
 
+import hashlib
 import logging
 import os
 import boto3
 import time
-from common import es_put
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+from common import es_put, es_delete, send_notification, AthenaQueryExecutor
 import json
 
 # REGION NAME
@@ -40,19 +43,58 @@ BUCKET_ATHENA_QUERY_OUTPUT = os.environ['BUCKET_ATHENA_QUERY_OUTPUT']
 # S3 key athena query results
 KEY_ATHENA_QUERY_OUTPUT = os.environ['KEY_ATHENA_QUERY_OUTPUT']
 
-# Athena Query Results state
-STATE = ['RUNNING', 'QUEUED']
+# Max number of Athena queries running at the same time (match the account Athena concurrency limit)
+ATHENA_MAX_CONCURRENCY = int(os.getenv('ATHENA_MAX_CONCURRENCY', '5'))
+
+# Max seconds to wait for each Athena query
+ATHENA_QUERY_TIMEOUT = 60
+
+# Backend used to crawl the Hive metadata
+# glue   = Read databases, tables and columns directly from the Glue Data Catalog (recommended)
+# athena = Run SHOW DATABASES / SHOW TABLES / DESCRIBE queries on Athena
+CATALOG_BACKEND = os.getenv('CATALOG_BACKEND', 'glue')
+
+# Max number of tables returned by each Glue GetTables call (the API limit is 100)
+GLUE_PAGE_SIZE = 100
+
+# DynamoDB table with the fingerprint of each table sent to the ES catalog (Glue backend only)
+# Key schema: database (HASH) / table (RANGE)
+# When it is not configured every run reindexes all tables
+DYNAMO_DB_CATALOG = os.getenv('DYNAMO_DB_CATALOG')
+
+# Table parameters updated by statistics/crawlers that don't change the ES catalog document
+VOLATILE_PARAMETERS = ['transient_lastDdlTime', 'numFiles', 'numRows', 'rawDataSize', 'totalSize', 'recordCount',
+                       'averageRecordSize', 'objectCount', 'sizeKey', 'COLUMN_STATS_ACCURATE', 'UPDATED_BY_CRAWLER']
+
+# When the remaining time of the Lambda is lower than this (milliseconds) the crawl saves the cursor and hands off to
+# a new invocation of this function
+REMAINING_TIME_THRESHOLD = 60 * 1000
+
+# Number of tables described by Athena between each cursor checkpoint
+DESCRIBE_BATCH_SIZE = 50
+
+# S3 key prefix (in the BUCKET_ATHENA_QUERY_OUTPUT) with the cursor of the crawls in progress
+KEY_CRAWL_CURSOR = '{}/_crawl_cursor'.format(KEY_ATHENA_QUERY_OUTPUT)
 
 # level of recursion of this function.
-# 0 = No recursion (slowest process but the recommended way to run locally)
+# 0 = No recursion (the describe queries of each database run concurrently limited by ATHENA_MAX_CONCURRENCY)
 # 1 = Only databases will be invoked recursively
 # 2 = Databases and Tables will be invoked recursively
-RECURSION = 1
+# The recursive invocations are not limited by ATHENA_MAX_CONCURRENCY (each Lambda has its own executor) and still
+# need a wait time between the invocations to avoid Athena throttling
+RECURSION = 0
 
 sns_client = boto3.client('sns')
 dynamodb_client = boto3.resource('dynamodb', region_name=REGION)
 athena_client = boto3.client('athena')
+glue_client = boto3.client('glue')
 lambda_client = boto3.client('lambda')
+s3_client = boto3.client('s3')
+athena_executor = AthenaQueryExecutor(output_location='s3://{}/{}'.format(BUCKET_ATHENA_QUERY_OUTPUT,
+                                                                          KEY_ATHENA_QUERY_OUTPUT),
+                                      max_concurrency=ATHENA_MAX_CONCURRENCY,
+                                      timeout=ATHENA_QUERY_TIMEOUT,
+                                      athena_client=athena_client)
 # logging.basicConfig(level=getattr(logging, os.getenv('LOG_LEVEL', 'INFO')))
 logging.basicConfig()
 logger = logging.getLogger(__name__)
@@ -65,93 +107,122 @@ def lambda_handler(event, context):
     recursivity = event.get('Recursivity', RECURSION)
     database = event.get('Database')
     tablename = event.get('Table')
+    event = dict(event, Backend=event.get('Backend', CATALOG_BACKEND))
+    if event['Backend'] == 'glue':
+        return crawl_glue_catalog(database, tablename, event.get('FullSync', False), context, event)
+
     if database and tablename:
         send_table_to_es(database, tablename)
         return 'Recursive lambda function send_table_to_es() finished'
     elif database:
-        query_database(database, context, recursivity)
+        scope = cursor_scope(event) if is_resumable(context) else None
+        cursor = load_cursor(scope) if scope and recursivity <= 1 else {}
+        if query_database(database, context, recursivity, event, scope, cursor.get('table_index', 0)) and scope:
+            clear_cursor(scope)
         return 'Recursive lambda function query_database() finished'
 
-    query = 'show databases;'
-    query_id_databases = athena_client.start_query_execution(QueryString=query,
-                                                             ResultConfiguration={'OutputLocation': 's3://{}/{}'.format(
-                                                                BUCKET_ATHENA_QUERY_OUTPUT,
-                                                                KEY_ATHENA_QUERY_OUTPUT)
-                                                             })
-
-    logger.debug(query_id_databases)
-
-    resp = query_waiter(query_id_databases['QueryExecutionId'])
-    if resp in ['TIMEOUT', 'FAILED', 'CANCELLED']:
-        logger.debug('Query result: {}'.format(resp))
-        raise Exception('Unable to complete the Athena Query')
-
-    query_databases = resp.get('ResultSet', {}).get('Rows')
+    query_databases = list(athena_query('show databases;'))
     if query_databases:
         logger.info(query_databases)
     else:
         logger.error('GetQueryResults is empty!')
         raise Exception('Failed to execute the Hive Catalog')
+    databases = [row[0] for row in query_databases]
+
+    if not recursivity:
+        crawl_athena_databases(databases, context, event)
+        return
+
+    for database in databases:
+        # Invoke Lambda function with the database and table name
+        try:
+            response = lambda_client.invoke(
+                FunctionName=context.function_name,
+                InvocationType='Event',
+                Payload=json.dumps({'Database': database, 'Backend': event['Backend'], 'Recursivity': recursivity})
+            )
+            if response['StatusCode'] == 200:
+                logger.info('Invoked recursive lambda with Database: {}'.format(database))
+        except Exception as e:
+            logger.error('Error invoking recursive lambda - query_database()')
+            logger.debug('Error: {}'.format(e))
+        # This wait time is to avoid Throttling because Athena has a  soft limit of 5 concurrent queries
+        time.sleep(3)
+
+
+def crawl_athena_databases(databases, context, event):
+    """
+    Describe the tables of all databases in this invocation, resuming from the saved cursor and handing off to a new
+    invocation when the Lambda is close to the timeout
 
-    for column_properties in query_databases:
-        database = column_properties['Data'][0]['VarCharValue']
-        if recursivity:
-            # Invoke Lambda function with the database and table name
-            try:
-                response = lambda_client.invoke(
-                    FunctionName=context.function_name,
-                    InvocationType='Event',
-                    Payload=json.dumps({'Database': database})
-                )
-                if response['StatusCode'] == 200:
-                    logger.info('Invoked recursive lambda with Database: {}'.format(database))
-            except Exception as e:
-                logger.error('Error invoking recursive lambda - query_database()')
-                logger.debug('Error: {}'.format(e))
-            # This wait time is to avoid Throttling because Athena has a  soft limit of 5 concurrent queries
-            time.sleep(3)
-        else:
-            query_database(database, context, recursivity)
-
-
-def query_database(database, context, recursivity):
+    :param databases: list of strings
+    :param context: object Lambda context
+    :param event: dict
+    :return: boolean True when all databases were crawled
+    """
+    scope = cursor_scope(event) if is_resumable(context) else None
+    cursor = load_cursor(scope) if scope else {}
+    for index in range(cursor_database_index(databases, cursor), len(databases)):
+        database = databases[index]
+        table_index = cursor.get('table_index', 0) if cursor.get('database') == database else 0
+        if not query_database(database, context, 0, event, scope, table_index, index):
+            return False
+        if scope and index + 1 < len(databases):
+            next_cursor = {'database': databases[index + 1], 'database_index': index + 1, 'table_index': 0}
+            if checkpoint(context, event, scope, next_cursor):
+                return False
+    if scope:
+        clear_cursor(scope)
+    return True
+
+
+def query_database(database, context, recursivity, event=None, scope=None, table_index=0, database_index=0):
+    """
+    Send all tables of the database to the ES catalog
+    With scope the cursor is saved after each DESCRIBE_BATCH_SIZE tables and the crawl is handed off to a new
+    invocation when the Lambda is close to the timeout
+
+    :param database: string
+    :param context: object Lambda context
+    :param recursivity: integer
+    :param event: dict (optional) event to hand off
+    :param scope: string (optional) cursor scope, None disable the cursor
+    :param table_index: integer index of the first table to describe
+    :param database_index: integer index of the database (saved in the cursor)
+    :return: boolean True when all tables were sent
+    """
     logger.info(database)
     logger.debug("### Debug mode enabled ###")
     logger.debug("Database: {}".format(database))
-    query = 'show tables;'
-    query_id_tables = athena_client.start_query_execution(QueryString=query,
-                                                          QueryExecutionContext={'Database': database},
-                                                          ResultConfiguration={'OutputLocation': 's3://{}/{}'.format(
-                                                               BUCKET_ATHENA_QUERY_OUTPUT,
-                                                               KEY_ATHENA_QUERY_OUTPUT)
-                                                          })
-    resp = query_waiter(query_id_tables['QueryExecutionId'])
-    if resp in ['TIMEOUT', 'FAILED', 'CANCELLED']:
-        logger.debug('Query result: {}'.format(resp))
-        raise Exception('Unable to complete the Athena Query')
-
-    query_tables = resp.get('ResultSet', {}).get('Rows', [])
-
-    for column_data in query_tables:
-        tablename = column_data['Data'][0]['VarCharValue']
-        if recursivity > 1:
-            # Invoke Lambda function with the database and table name
-            try:
-                response = lambda_client.invoke(
-                    FunctionName=context.function_name,
-                    InvocationType='Event',
-                    Payload=json.dumps({'Database': database, 'Table': tablename})
-                )
-                if response['StatusCode'] == 200:
-                    logger.info('Invoked recursive lambda with Database: {} / Table: {}'.format(database, tablename))
-            except Exception as e:
-                logger.error('Error invoking recursive lambda - send_table_to_es()')
-                logger.debug('Error: {}'.format(e))
-
-            # This wait time is to avoid Throttling because Athena has a  soft limit of 5 concurrent queries
-            time.sleep(3)
-        else:
-            send_table_to_es(database, tablename)
+    tablenames = [row[0] for row in athena_query('show tables;', database)]
+
+    if recursivity <= 1:
+        for offset in range(table_index, len(tablenames), DESCRIBE_BATCH_SIZE):
+            describe_tables(database, tablenames[offset:offset + DESCRIBE_BATCH_SIZE])
+            if scope and offset + DESCRIBE_BATCH_SIZE < len(tablenames):
+                cursor = {'database': database, 'database_index': database_index,
+                          'table_index': offset + DESCRIBE_BATCH_SIZE}
+                if checkpoint(context, event, scope, cursor):
+                    return False
+        return True
+
+    for tablename in tablenames:
+        # Invoke Lambda function with the database and table name
+        try:
+            response = lambda_client.invoke(
+                FunctionName=context.function_name,
+                InvocationType='Event',
+                Payload=json.dumps({'Database': database, 'Table': tablename, 'Backend': event['Backend']})
+            )
+            if response['StatusCode'] == 200:
+                logger.info('Invoked recursive lambda with Database: {} / Table: {}'.format(database, tablename))
+        except Exception as e:
+            logger.error('Error invoking recursive lambda - send_table_to_es()')
+            logger.debug('Error: {}'.format(e))
+
+        # This wait time is to avoid Throttling because Athena has a  soft limit of 5 concurrent queries
+        time.sleep(3)
+    return True
 
 
 def send_table_to_es(database, tablename):
@@ -159,28 +230,280 @@ def send_table_to_es(database, tablename):
     logger.info(table)
     logger.debug("### Debug mode enabled ###")
     logger.debug("Table: {}".format(table))
-    query = 'describe ' + str(table) + ';'
-    query_id_table = athena_client.start_query_execution(QueryString=query,
-                                                         QueryExecutionContext={'Database': database},
-                                                         ResultConfiguration={
-                                                             'OutputLocation': 's3://{}/{}'.format(
-                                                                 BUCKET_ATHENA_QUERY_OUTPUT,
-                                                                 KEY_ATHENA_QUERY_OUTPUT)
-                                                         })
-
-    resp = query_waiter(query_id_table['QueryExecutionId'])
-    if resp in ['TIMEOUT', 'FAILED', 'CANCELLED']:
-        logger.debug('Query result: {}'.format(resp))
-        raise Exception('Unable to complete the Athena Query')
+    index_table(database, table, describe_columns(athena_query('describe ' + str(table) + ';', database)))
+
+
+def describe_tables(database, tablenames):
+    """
+    Run the describe query of all tables concurrently (limited by ATHENA_MAX_CONCURRENCY) and send each table to the
+    ES catalog as soon as its query finishes
+
+    :param database: string
+    :param tablenames: list of strings
+    :return: None
+    """
+    queries = [(tablename, 'describe ' + str(tablename) + ';', database) for tablename in tablenames]
+    for tablename, state, execution_id in athena_executor.run(queries):
+        if state != 'SUCCEEDED':
+            logger.error('Unable to describe the table {}.{}: {}'.format(database, tablename, state))
+            continue
+        logger.info(tablename)
+        index_table(database, tablename, describe_columns(athena_executor.iter_rows(execution_id)))
+
+
+def describe_columns(rows):
+    """
+    Parse the rows of an Athena describe query
+    :param rows: iterable of tuples
+    :return: list of tuples (column_name, column_type, column_comment)
+    """
+    columns = list()
+    for row in rows:
+        column = row[0]
+        if not column or not column.strip():
+            continue
+        column_name, column_type, column_comment = [x.strip() for x in column.split('\t')]
+        columns.append((column_name, column_type, column_comment))
+    return columns
+
+
+def crawl_glue_catalog(database=None, tablename=None, full_sync=False, context=None, event=None):
+    """
+    Crawl the Glue Data Catalog and send the tables to the ES catalog.
+    GetTables returns up to 100 tables per call with the columns included, so we don't need to run one Athena
+    query per database and per table.
+    With DYNAMO_DB_CATALOG configured only the added/changed tables are sent to ES and the dropped tables/columns
+    are deleted from ES.
+    Running on Lambda the cursor (database and GetTables NextToken) is saved after each page of tables and the crawl
+    is handed off to a new invocation when the Lambda is close to the timeout.
+
+    :param database: string (optional) crawl only this database
+    :param tablename: string (optional) crawl only this table (requires the database)
+    :param full_sync: boolean ignore the fingerprints and reindex all tables
+    :param context: object (optional) Lambda context
+    :param event: dict (optional) event to hand off
+    :return: string
+    """
+    if database and tablename:
+        table = glue_client.get_table(DatabaseName=database, Name=tablename)['Table']
+        fingerprints = {} if full_sync else load_fingerprints(database, tablename)
+        sync_table(database, table, fingerprints.get(tablename))
+        return 'Glue catalog table {}.{} finished'.format(database, tablename)
+
+    scope = cursor_scope(event) if event and is_resumable(context) else None
+    cursor = load_cursor(scope) if scope else {}
+    databases = [database] if database else list(glue_databases())
+    stats = cursor.get('stats', {'added': 0, 'changed': 0, 'unchanged': 0, 'dropped': 0})
+    for index in range(cursor_database_index(databases, cursor), len(databases)):
+        database_name = databases[index]
+        logger.info(database_name)
+        fingerprints = {} if full_sync else load_fingerprints(database_name)
+        resume = cursor.get('database') == database_name
+        seen = set(cursor.get('seen', [])) if resume else set()
+        next_token = cursor.get('next_token') if resume else None
+        while True:
+            params = {'DatabaseName': database_name, 'MaxResults': GLUE_PAGE_SIZE}
+            if next_token:
+                params['NextToken'] = next_token
+            page = glue_client.get_tables(**params)
+            for table in page.get('TableList', []):
+                seen.add(table['Name'])
+                stats[sync_table(database_name, table, fingerprints.get(table['Name']))] += 1
+            next_token = page.get('NextToken')
+            if not next_token:
+                break
+            if scope:
+                cursor = {'database': database_name, 'database_index': index, 'next_token': next_token,
+                          'seen': sorted(seen), 'stats': stats}
+                if checkpoint(context, event, scope, cursor):
+                    return 'Glue catalog crawl handed off'
+
+        # Tables with fingerprint that are not in the Glue Data Catalog anymore
+        for name, fingerprint in fingerprints.items():
+            if name not in seen:
+                drop_table(database_name, name, fingerprint.get('columns', []))
+                stats['dropped'] += 1
+
+        if scope and index + 1 < len(databases):
+            cursor = {'database': databases[index + 1], 'database_index': index + 1, 'stats': stats}
+            if checkpoint(context, event, scope, cursor):
+                return 'Glue catalog crawl handed off'
+
+    if not database and DYNAMO_DB_CATALOG and not full_sync:
+        # Databases with fingerprints that are not in the Glue Data Catalog anymore
+        for database_name in set(fingerprint_databases()) - set(databases):
+            for name, fingerprint in load_fingerprints(database_name).items():
+                drop_table(database_name, name, fingerprint.get('columns', []))
+                stats['dropped'] += 1
+
+    if scope:
+        clear_cursor(scope)
+    logger.info('Glue catalog crawl finished: {} databases / {}'.format(len(databases), stats))
+    return 'Glue catalog crawl finished'
+
+
+def sync_table(database, table, previous=None):
+    """
+    Send the table to the ES catalog when it is new or changed since the previous fingerprint
+    The return is the string: added/changed/unchanged
+
+    :param database: string
+    :param table: dict Glue table
+    :param previous: dict (optional) previous fingerprint
+    :return: string
+    """
+    columns = glue_table_columns(table)
+    fingerprint = table_fingerprint(database, table, columns)
+    if previous and previous.get('update_time') == fingerprint['update_time']:
+        return 'unchanged'
+    if previous and previous.get('columns_hash') == fingerprint['columns_hash'] \
+            and previous.get('parameters_hash') == fingerprint['parameters_hash']:
+        # Only the statistics were updated, keep the new update time to skip the hashes in the next run
+        save_fingerprint(fingerprint)
+        return 'unchanged'
+
+    index_table(database, table['Name'], columns)
+    if previous:
+        for column_name in set(previous.get('columns', [])) - set(fingerprint['columns']):
+            logger.debug('Deleting column_name: {} from ES datalake-tags'.format(column_name))
+            log_es_response(es_delete(es_index='datalake-tags',
+                                      es_type='_doc',
+                                      es_id='{}-{}-{}'.format(database, table['Name'], column_name)))
+    save_fingerprint(fingerprint)
+    return 'changed' if previous else 'added'
+
+
+def drop_table(database, tablename, column_names):
+    """
+    Delete the table and its columns from the ES catalog and the fingerprint table
+
+    :param database: string
+    :param tablename: string
+    :param column_names: list of strings
+    :return: None
+    """
+    logger.info('Deleting table {}.{} from ES catalog'.format(database, tablename))
+    for column_name in column_names:
+        log_es_response(es_delete(es_index='datalake-tags',
+                                  es_type='_doc',
+                                  es_id='{}-{}-{}'.format(database, tablename, column_name)))
+    log_es_response(es_delete(es_index='datalake-hive',
+                              es_type='_doc',
+                              es_id='{}-{}'.format(database, tablename)))
+    dynamodb_client.Table(DYNAMO_DB_CATALOG).delete_item(Key={'database': database, 'table': tablename})
+
+
+def table_fingerprint(database, table, columns):
+    """
+    Fingerprint of a Glue table: update time, hash of the columns and hash of the parameters
+
+    :param database: string
+    :param table: dict Glue table
+    :param columns: list of tuples (column_name, column_type, column_comment)
+    :return: dict
+    """
+    parameters = dict((key, value) for key, value in table.get('Parameters', {}).items()
+                      if key not in VOLATILE_PARAMETERS)
+    return {
+        'database': database,
+        'table': table['Name'],
+        'update_time': str(table.get('UpdateTime', table.get('CreateTime', ''))),
+        'columns_hash': hashlib.md5(json.dumps(columns).encode('utf-8')).hexdigest(),
+        'parameters_hash': hashlib.md5(json.dumps(parameters, sort_keys=True).encode('utf-8')).hexdigest(),
+        'columns': [column_name for column_name, _, _ in columns if column_name and '#' not in column_name]
+    }
+
+
+def load_fingerprints(database, tablename=None):
+    """
+    Load the fingerprints of the database tables from DYNAMO_DB_CATALOG
+
+    :param database: string
+    :param tablename: string (optional) load only this table
+    :return: dict table name -> fingerprint
+    """
+    if not DYNAMO_DB_CATALOG:
+        return {}
+    table_catalog = dynamodb_client.Table(DYNAMO_DB_CATALOG)
+    condition = Key('database').eq(database)
+    if tablename:
+        condition = condition & Key('table').eq(tablename)
+    params = {'KeyConditionExpression': condition}
+    fingerprints = dict()
+    while True:
+        response = table_catalog.query(**params)
+        for item in response.get('Items', []):
+            fingerprints[item['table']] = item
+        if not response.get('LastEvaluatedKey'):
+            return fingerprints
+        params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def fingerprint_databases():
+    """
+    Generator with the name of the databases that have fingerprints in DYNAMO_DB_CATALOG
+    :return: string
+    """
+    table_catalog = dynamodb_client.Table(DYNAMO_DB_CATALOG)
+    params = {'ProjectionExpression': '#db', 'ExpressionAttributeNames': {'#db': 'database'}}
+    databases = set()
+    while True:
+        response = table_catalog.scan(**params)
+        for item in response.get('Items', []):
+            if item['database'] not in databases:
+                databases.add(item['database'])
+                yield item['database']
+        if not response.get('LastEvaluatedKey'):
+            return
+        params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def save_fingerprint(fingerprint):
+    """
+    Save the table fingerprint in DYNAMO_DB_CATALOG
+    :param fingerprint: dict
+    :return: None
+    """
+    if DYNAMO_DB_CATALOG:
+        dynamodb_client.Table(DYNAMO_DB_CATALOG).put_item(Item=fingerprint)
 
-    query_columns = resp.get('ResultSet', {}).get('Rows', [])
 
-    dict_column_name = dict()
+def glue_databases():
+    """
+    Generator with the name of all databases in the Glue Data Catalog
+    :return: string
+    """
+    paginator = glue_client.get_paginator('get_databases')
+    for page in paginator.paginate():
+        for database in page.get('DatabaseList', []):
+            yield database['Name']
+
+
+def glue_table_columns(table):
+    """
+    Extract the columns and partition keys of a Glue table in the same order that Athena describe returns them
+    :param table: dict
+    :return: list of tuples (column_name, column_type, column_comment)
+    """
+    columns = table.get('StorageDescriptor', {}).get('Columns', []) + table.get('PartitionKeys', [])
+    return [(column['Name'], column.get('Type', ''), column.get('Comment', '')) for column in columns]
+
+
+def index_table(database, table, columns):
+    """
+    Send the table and its columns to the ES catalog (datalake-hive and datalake-tags indices)
+    The columns are sent as a list of {name, comment, type} documents (nested mapping in the datalake-hive template
+    of odl_es_index_manager) so new column names don't add fields to the index mapping
+
+    :param database: string
+    :param table: string
+    :param columns: list of tuples (column_name, column_type, column_comment)
+    :return: None
+    """
+    list_columns = list()
     dict_column_tags = list()
     dict_comment_tags = list()
-    for item in query_columns:
-        column = item['Data'][0]['VarCharValue']
-        column_name, _, column_comment = [x.strip() for x in column.split('\t')]
+    for column_name, column_type, column_comment in columns:
         if not column_comment:
             column_comment = "empty"
         logger.debug("column name    : {}".format(column_name))
@@ -192,19 +515,11 @@ def send_table_to_es(database, tablename):
             resp = es_put(es_index='datalake-tags',
                           es_type='_doc',
                           es_id='{}-{}-{}'.format(database, table, column_name),
-                          json={'tag': column_name})
-            logger.debug('ES PUT response: {}'.format(resp))
-            if resp is not None:
-                logger.debug('ES Put response code: {}'.format(resp.status_code))
-                logger.debug('ES Put response: {}'.format(resp.text))
-                if not 200 <= resp.status_code <= 299:
-                    logger.error('Error sending data to ES Catalog')
-                    logger.error('Error: {}'.format(resp.text))
-            else:
-                logger.debug('There is no ES_ENDPOINT configured')
+                          data={'tag': column_name})
+            log_es_response(resp)
             if column_comment:
                 dict_comment_tags.append(column_comment)
-                dict_column_name[column_name] = column_comment
+                list_columns.append({'name': column_name, 'comment': column_comment, 'type': column_type})
         else:
             logger.debug('Not adding this column_name/column_comment because one or both are missing')
 
@@ -213,53 +528,139 @@ def send_table_to_es(database, tablename):
         "table": table,
         "column_tags": " ".join(dict_column_tags),
         "comment_tags": " ".join(dict_comment_tags),
-        "columns": dict_column_name
+        "columns": list_columns
     }
     logger.info("JSON to catalog on ES: {}".format(json.dumps(json_data)))
     # Send data to Catalog (ElasticSearch)
+    resp = None
     try:
         resp = es_put(es_index='datalake-hive',
                       es_type='_doc',
                       es_id='{}-{}'.format(database, table),
-                      json=json_data)
+                      data=json_data)
     except Exception as e:
         logger.error('Error executing Elastic Search Put')
         logger.error('Error: {}'.format(e))
 
-    logger.info('ES PUT response: {}'.format(resp))
+    log_es_response(resp)
+
+
+def log_es_response(resp):
+    """
+    Log the response of an ES request (404 is expected when deleting documents that were never indexed)
+    :param resp: object
+    :return: None
+    """
+    logger.debug('ES response: {}'.format(resp))
     if resp is not None:
-        logger.debug('ES Put response code: {}'.format(resp.status_code))
-        logger.debug('ES Put response: {}'.format(resp.text))
-        if not 200 <= resp.status_code <= 299:
+        logger.debug('ES response code: {}'.format(resp.status_code))
+        logger.debug('ES response: {}'.format(resp.text))
+        if not 200 <= resp.status_code <= 299 and not (resp.request.method == 'DELETE' and resp.status_code == 404):
             logger.error('Error sending data to ES Catalog')
             logger.error('Error: {}'.format(resp.text))
     else:
         logger.debug('There is no ES_ENDPOINT configured')
 
 
-def query_waiter(execution_id, timeout=60):
+def is_resumable(context):
+    """
+    The crawl can only be handed off when running on Lambda (the local MockContext has no remaining time)
+    :param context: object
+    :return: boolean
     """
-    query_waiter receives an Athena execution id and pool the Athena API till you have a SUCCEEDED/FAILED/CANCELLED
-    reply or the timeout reached (default is 60 seconds)
-    The return is the string: SUCCEEDED/FAILED/CANCELLED/TIMEOUT
+    return hasattr(context, 'get_remaining_time_in_millis')
 
-    :param execution_id: string
-    :param timeout: integer
+
+def cursor_scope(event):
+    """
+    Name of the cursor of the crawl requested by the event (one cursor per backend and database)
+    :param event: dict
     :return: string
     """
-    start = time.time()
-    while True:
-        stats = athena_client.get_query_execution(QueryExecutionId=execution_id)
-        status = stats['QueryExecution']['Status']['State']
-        if status in ['SUCCEEDED', 'FAILED', 'CANCELLED']:
-            if status == 'SUCCEEDED':
-                status = athena_client.get_query_results(
-                    QueryExecutionId=execution_id)
-            return status
-        time.sleep(0.2)  # 200ms
-        # Exit if the time waiting exceed the timeout seconds
-        if time.time() > start + timeout:
-            return 'TIMEOUT'
+    return '{}-{}'.format(event.get('Backend', CATALOG_BACKEND), event.get('Database') or 'all')
+
+
+def cursor_database_index(databases, cursor):
+    """
+    Index of the database to resume the crawl, the databases can be created/dropped between the invocations
+    :param databases: list of strings
+    :param cursor: dict
+    :return: integer
+    """
+    if cursor.get('database') in databases:
+        return databases.index(cursor['database'])
+    return min(cursor.get('database_index', 0), len(databases))
+
+
+def load_cursor(scope):
+    """
+    Load the cursor saved by a previous invocation (empty when there is no crawl in progress)
+    :param scope: string
+    :return: dict
+    """
+    try:
+        response = s3_client.get_object(Bucket=BUCKET_ATHENA_QUERY_OUTPUT,
+                                        Key='{}/{}.json'.format(KEY_CRAWL_CURSOR, scope))
+    except ClientError as e:
+        if e.response['Error']['Code'] in ['NoSuchKey', '404']:
+            return {}
+        raise
+    cursor = json.loads(response['Body'].read())
+    logger.info('Resuming the crawl {} from cursor: {}'.format(scope, cursor))
+    return cursor
+
+
+def clear_cursor(scope):
+    """
+    Delete the cursor when the crawl finishes
+    :param scope: string
+    :return: None
+    """
+    s3_client.delete_object(Bucket=BUCKET_ATHENA_QUERY_OUTPUT, Key='{}/{}.json'.format(KEY_CRAWL_CURSOR, scope))
+
+
+def checkpoint(context, event, scope, cursor):
+    """
+    Save the cursor after each unit of work and, when the remaining time is lower than REMAINING_TIME_THRESHOLD,
+    invoke this function again to continue the crawl from the cursor
+
+    :param context: object Lambda context
+    :param event: dict event of the current invocation
+    :param scope: string
+    :param cursor: dict
+    :return: boolean True when the crawl was handed off and the current invocation must stop
+    """
+    s3_client.put_object(Bucket=BUCKET_ATHENA_QUERY_OUTPUT,
+                         Key='{}/{}.json'.format(KEY_CRAWL_CURSOR, scope),
+                         Body=json.dumps(cursor))
+    if context.get_remaining_time_in_millis() >= REMAINING_TIME_THRESHOLD:
+        return False
+
+    response = lambda_client.invoke(
+        FunctionName=context.function_name,
+        InvocationType='Event',
+        Payload=json.dumps(event)
+    )
+    if response['StatusCode'] not in [200, 202]:
+        send_notification(SNS_TOPIC_ARN, 'Hive catalog crawl interrupted',
+                          'Unable to hand off the crawl {} at cursor {}'.format(scope, cursor))
+    logger.info('Crawl {} handed off at cursor: {}'.format(scope, cursor))
+    return True
+
+
+def athena_query(query, database=None):
+    """
+    Run the Athena query and return all result rows (following the GetQueryResults NextToken)
+
+    :param query: string
+    :param database: string
+    :return: generator of tuples
+    """
+    state, execution_id = athena_executor.execute(query, database)
+    if state != 'SUCCEEDED':
+        logger.debug('Query result: {}'.format(state))
+        raise Exception('Unable to complete the Athena Query')
+    return athena_executor.iter_rows(execution_id)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,302 @@
+# Copyright 2018 Amazon.com, Inc. and its affiliates. All Rights Reserved.
+#
+# Licensed under the Amazon Software License (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#   http://aws.amazon.com/asl/
+#
+# or in the "license" file accompanying this file. This file is distributed
+# on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language governing
+# permissions and limitations under the License.
+#
+# Invoked asynchronously by odl_stage_control with {"s3_object_name_stage": "s3://..."}
+# Lambda Function to convert small stage files (CSV) to Parquet without an EMR cluster
+#
+# odl_stage_control routes the stage files smaller than FAST_PATH_MAX_SIZE whose job catalog item has
+# "fast_path": "True" to this function (the stage item is flagged with engine = lambda and ignored by
+# odl_create_emr_cluster and odl_spark_submit). The file is read with the columns and types of the analytics table
+# (job catalog hive_database_analytics.hive_table_analytics) and the delimiter/header of the raw table, written as a
+# Parquet file to the analytics partition and the partition is added to the Data Catalog. The control and stage tables
+# are updated as odl_validate_job_submit does for the EMR steps. If the conversion fails the engine flag is removed
+# and the file goes to EMR with the next cluster.
+#
+# pyarrow is not part of the Lambda runtime, deploy it with the function package or a Lambda layer
+
+from __future__ import print_function
+
+import io
+import logging
+import os
+import re
+import time
+
+import boto3
+from botocore.exceptions import ClientError
+
+from common import send_notification, DatalakeStatus
+
+# SNS topic to post email alerts to
+SNS_TOPIC_ARN = os.getenv('SNS_TOPIC_ARN')
+
+# DynamoDB table for Data Lake Control
+DYNAMO_DB_CONTROL = os.getenv('DYNAMO_DB_CONTROL')
+
+# DynamoDB table for Stage Control
+DYNAMO_DB_STAGE_TABLE = os.getenv('DYNAMO_DB_STAGE_TABLE')
+
+# DynamoDB table for Job Catalog
+DYNAMO_DB_JOB_CATALOG = os.getenv('DYNAMO_DB_JOB_CATALOG')
+
+# REGION NAME
+REGION = os.getenv('AWS_DEFAULT_REGION', 'us-east-1')
+
+# ENVIRONMENT
+ENVIRONMENT = os.getenv('ENVIRONMENT', 'DEV')
+
+# Parquet compression codec (same default of Spark)
+PARQUET_COMPRESSION = os.getenv('PARQUET_COMPRESSION', 'snappy')
+
+# Stage items converted by this function (see odl_stage_control)
+ENGINE_LAMBDA = 'lambda'
+
+DECIMAL_TYPE = re.compile(r'decimal\((\d+),\s*(\d+)\)')
+
+s3_client = boto3.client('s3')
+glue_client = boto3.client('glue')
+dynamodb_resource = boto3.resource('dynamodb', region_name=REGION)
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(getattr(logging, os.getenv('LOG_LEVEL', 'INFO')))
+logger.info('Loading Lambda Function {}'.format(__name__))
+
+
+def split_s3_path(s3_path):
+    """
+    Split a s3://bucket/key path
+    :param s3_path: string
+    :return: tuple (bucket, key)
+    """
+    bucket, _, key = s3_path.replace('s3://', '', 1).partition('/')
+    return bucket, key
+
+
+def arrow_type(hive_type):
+    """
+    Arrow type of a Hive column type (char/varchar are strings, complex types are not supported)
+    :param hive_type: string
+    :return: pyarrow.DataType
+    """
+    import pyarrow as pa
+
+    hive_type = hive_type.lower().strip()
+    decimal = DECIMAL_TYPE.match(hive_type)
+    if decimal:
+        return pa.decimal128(int(decimal.group(1)), int(decimal.group(2)))
+    base_type = hive_type.split('(')[0]
+    types = {
+        'string': pa.string(),
+        'varchar': pa.string(),
+        'char': pa.string(),
+        'tinyint': pa.int8(),
+        'smallint': pa.int16(),
+        'int': pa.int32(),
+        'integer': pa.int32(),
+        'bigint': pa.int64(),
+        'float': pa.float32(),
+        'double': pa.float64(),
+        'boolean': pa.bool_(),
+        'date': pa.date32(),
+        'timestamp': pa.timestamp('ms'),
+    }
+    if base_type not in types:
+        raise ValueError('Hive type {} is not supported by the fast path'.format(hive_type))
+    return types[base_type]
+
+
+def csv_options(raw_table):
+    """
+    Delimiter and header of the stage files from the SerDe of the raw table
+    :param raw_table: dict Glue Table
+    :return: tuple (delimiter, header lines)
+    """
+    serde_parameters = raw_table.get('StorageDescriptor', {}).get('SerdeInfo', {}).get('Parameters', {})
+    delimiter = serde_parameters.get('field.delim', serde_parameters.get('separatorChar', '\x01'))
+    header = int(raw_table.get('Parameters', {}).get('skip.header.line.count', 0))
+    return delimiter, header
+
+
+def convert_to_parquet(body, raw_table, analytics_table):
+    """
+    Convert the CSV file to a Parquet file with the schema of the analytics table. The columns are matched by
+    position, like insertInto does in the Spark programs
+    :param body: bytes content of the stage file
+    :param raw_table: dict Glue Table
+    :param analytics_table: dict Glue Table
+    :return: tuple (bytes of the Parquet file, number of rows)
+    """
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+
+    columns = analytics_table['StorageDescriptor']['Columns']
+    names = [column['Name'] for column in columns]
+    delimiter, header = csv_options(raw_table)
+    table = pa_csv.read_csv(
+        pa.BufferReader(body),
+        read_options=pa_csv.ReadOptions(column_names=names, skip_rows=header),
+        parse_options=pa_csv.ParseOptions(delimiter=delimiter),
+        convert_options=pa_csv.ConvertOptions(
+            column_types=dict((column['Name'], arrow_type(column['Type'])) for column in columns),
+            strings_can_be_null=True
+        )
+    )
+    output = io.BytesIO()
+    pq.write_table(table, output, compression=PARQUET_COMPRESSION)
+    return output.getvalue(), table.num_rows
+
+
+def partition_values(analytics_table, job, stage):
+    """
+    Values of the analytics partition of the stage file (same partition passed by odl_spark_submit to the programs)
+    :param analytics_table: dict Glue Table
+    :param job: dict Job Catalog item
+    :param stage: dict Stage item
+    :return: list of (name, value)
+    """
+    partition_keys = [key['Name'] for key in analytics_table.get('PartitionKeys', [])]
+    partition_name = job.get('partition_name_stage', 'false')
+    if not partition_keys:
+        return []
+    if partition_keys != [partition_name] or stage.get('partition', 'false') == 'false':
+        raise ValueError('The analytics table is partitioned by {} and the stage file has the partition {}={}'.format(
+            partition_keys, partition_name, stage.get('partition')))
+    return [(partition_name, stage['partition'])]
+
+
+def add_partition(analytics_table, values, location):
+    """
+    Add the partition to the Data Catalog with the storage of the table (skip if it already exists)
+    :param analytics_table: dict Glue Table
+    :param values: list of (name, value)
+    :param location: string S3 path of the partition
+    :return: None
+    """
+    storage = dict(analytics_table['StorageDescriptor'], Location=location)
+    try:
+        glue_client.create_partition(
+            DatabaseName=analytics_table['DatabaseName'],
+            TableName=analytics_table['Name'],
+            PartitionInput={
+                'Values': [value for _, value in values],
+                'StorageDescriptor': storage
+            }
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'AlreadyExistsException':
+            raise
+        logger.debug('Partition {} already exists'.format(location))
+
+
+def update_control(stage, job, timestamp):
+    table_control = dynamodb_resource.Table(DYNAMO_DB_CONTROL)
+    response = table_control.update_item(
+        TableName=DYNAMO_DB_CONTROL,
+        Key={
+            's3_object_name': str(stage['s3_object_name_raw'])
+        },
+        UpdateExpression="set file_status = :file_status, "
+                         "timestamp_step_finished = :timestamp_step_finished, "
+                         "hive_table_analytics = :hive_table_analytics, "
+                         "hive_database_analytics = :hive_database_analytics, "
+                         "s3_target = :s3_target",
+        ExpressionAttributeValues={
+            ':file_status': DatalakeStatus.LOADED,
+            ':timestamp_step_finished': str(timestamp),
+            ':hive_table_analytics': str(job['hive_table_analytics']),
+            ':hive_database_analytics': str(job['hive_database_analytics']),
+            ':s3_target': str(job['s3_target'])}
+    )
+    logger.debug('DDB update_item response: {}'.format(response))
+
+
+def fallback_to_emr(s3_object_name_stage):
+    """
+    Remove the engine flag of the stage item so the next EMR cluster processes the file
+    :param s3_object_name_stage: string
+    :return: None
+    """
+    table_stage = dynamodb_resource.Table(DYNAMO_DB_STAGE_TABLE)
+    table_stage.update_item(
+        TableName=DYNAMO_DB_STAGE_TABLE,
+        Key={
+            's3_object_name_stage': s3_object_name_stage
+        },
+        UpdateExpression="remove engine"
+    )
+
+
+def lambda_handler(event, context):
+    s3_object_name_stage = event['s3_object_name_stage']
+    logger.info('Converting stage file: {}'.format(s3_object_name_stage))
+
+    try:
+        table_stage = dynamodb_resource.Table(DYNAMO_DB_STAGE_TABLE)
+        stage = table_stage.get_item(Key={'s3_object_name_stage': s3_object_name_stage}).get('Item')
+        if not stage:
+            logger.info('There is no items returned from DynamoDB!')
+            return 'No items to process'
+        table_job = dynamodb_resource.Table(DYNAMO_DB_JOB_CATALOG)
+        job = table_job.get_item(Key={'s3_data_source': str(stage['s3_dir_stage'])}).get('Item')
+        if not job:
+            raise ValueError('There is no job catalog item for {}'.format(stage['s3_dir_stage']))
+        logger.debug("Stage item: {}".format(stage))
+        logger.debug("Job catalog item: {}".format(job))
+
+        raw_table = glue_client.get_table(DatabaseName=job['hive_database_raw'], Name=job['hive_table_raw'])['Table']
+        analytics_table = glue_client.get_table(DatabaseName=job['hive_database_analytics'],
+                                                Name=job['hive_table_analytics'])['Table']
+
+        bucket_stage, key_stage = split_s3_path(s3_object_name_stage)
+        body = s3_client.get_object(Bucket=bucket_stage, Key=key_stage)['Body'].read()
+        parquet, rows = convert_to_parquet(body, raw_table, analytics_table)
+
+        values = partition_values(analytics_table, job, stage)
+        location = analytics_table['StorageDescriptor']['Location'].rstrip('/')
+        for name, value in values:
+            location = '{}/{}={}'.format(location, name, value)
+        filename = os.path.splitext(key_stage.split('/')[-1])[0]
+        bucket_target, key_target = split_s3_path('{}/{}.parquet'.format(location, filename))
+        s3_client.put_object(Bucket=bucket_target, Key=key_target, Body=parquet)
+        logger.info('Wrote {} rows to s3://{}/{}'.format(rows, bucket_target, key_target))
+        if values:
+            add_partition(analytics_table, values, location)
+    except Exception as e:
+        msg_exception = "Fast path conversion Exception: {}".format(e)
+        logger.error(msg_exception)
+        send_notification(
+            SNS_TOPIC_ARN,
+            'Datalake:{} Lambda Error'.format(ENVIRONMENT),
+            "Lambda Function Name: {}\n{}\nThe file will be processed by EMR".format(context.function_name,
+                                                                                   msg_exception)
+        )
+        fallback_to_emr(s3_object_name_stage)
+        return 'Unable to convert the file'
+
+    timestamp_step_finished = time.strftime("%Y-%m-%dT%H:%M:%S-%Z")
+    try:
+        update_control(stage, job, timestamp_step_finished)
+        table_stage.delete_item(Key={'s3_object_name_stage': s3_object_name_stage})
+        s3_client.delete_object(Bucket=bucket_stage, Key=key_stage)
+    except Exception as e:
+        msg_exception = "DynamoDB/S3 Exception: {}".format(e)
+        logger.error(msg_exception)
+        send_notification(
+            SNS_TOPIC_ARN,
+            'Datalake:{} Lambda Error'.format(ENVIRONMENT),
+            "Lambda Function Name: {}\n{}".format(context.function_name, msg_exception)
+        )
+        return 'Unable to update the control tables'
+
+    return {'s3_target': 's3://{}/{}'.format(bucket_target, key_target), 'rows': rows}
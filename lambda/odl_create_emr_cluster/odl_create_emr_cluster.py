@@ -32,7 +32,7 @@ import json
 
 import boto3
 
-from common import send_notification, cluster_is_running
+from common import send_notification, cluster_is_running, job_server_step, stage_has_emr_files
 
 # label that will uniquely identify this cluster, also used as cluster name e.g. "daily-reporting-emr"
 label = os.getenv('CLUSTER_LABEL')
@@ -93,6 +93,16 @@ ENI_MASTER = os.getenv('ENI_MASTER')
 # EMR local home path
 EMR_HOME_SCRIPTS = os.getenv('EMR_HOME_SCRIPTS', '/home/hadoop')
 
+# SQS queue of the resident Spark job server (job_server.py), the server is started only if the queue is set
+JOB_SERVER_QUEUE_URL = os.getenv('JOB_SERVER_QUEUE_URL')
+
+# DynamoDB table for Data Lake Control (updated by the job server)
+DYNAMO_DB_CONTROL = os.getenv('DYNAMO_DB_CONTROL')
+
+# S3 location of the Spark programs copied to the cluster (same variables of odl_spark_submit)
+S3_BUCKET_PROGRAMS = os.getenv('S3_bucket_programs')
+S3_KEY_PROGRAMS = os.getenv('S3_key_programs')
+
 # Do not modify below this line, except for job_flow
 emr_client = boto3.client('emr')
 sns_client = boto3.client('sns')
@@ -105,12 +115,7 @@ logger.info('Loading Lambda Function {}'.format(__name__))
     
 def stage_is_empty():
     try:
-        table_stage = dynamodb_client.Table(DYNAMO_DB_STAGE_TABLE)
-        results_stage = table_stage.scan()
-        if results_stage.get('Items'):
-            return False
-        else:
-            return True
+        return not stage_has_emr_files(dynamodb_client.Table(DYNAMO_DB_STAGE_TABLE))
 
     except Exception as e:
         logger.error("Error Reading DynamoDB Table: {}".format(e))
@@ -276,6 +281,10 @@ def create_cluster():
         ]
     })
 
+    if JOB_SERVER_QUEUE_URL:
+        args['Steps'].append(job_server_step(EMR_HOME_SCRIPTS, 's3://{}/{}'.format(S3_BUCKET_PROGRAMS, S3_KEY_PROGRAMS),
+                                             JOB_SERVER_QUEUE_URL, DYNAMO_DB_STAGE_TABLE, DYNAMO_DB_CONTROL))
+
     # Create new EMR cluster
     emr_launch_message = 'Launching new EMR cluster: {}'.format(label)
     logger.info(emr_launch_message)
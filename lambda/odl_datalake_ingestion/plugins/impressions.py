@@ -87,6 +87,8 @@ def processor(**kwargs):
             's3_object_name_stage': "s3://{}/{}".format(bucket_target, key_target),
             'file_status': 'INITIAL_LOAD',
             's3_dir_stage': 's3://{}/{}'.format(bucket_target, s3_dir_stage),
+            # Value of the dt partition, odl_spark_submit sends it to the Spark program as dt=value
+            'partition': partition.split('=', 1)[1],
             'size': int(obj['ResponseMetadata']['HTTPHeaders']['content-length']),
             'type': obj['ResponseMetadata']['HTTPHeaders']['content-type'],
             'file_timestamp': obj['ResponseMetadata']['HTTPHeaders']['last-modified']
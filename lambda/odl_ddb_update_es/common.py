@@ -44,6 +44,19 @@ logger = logging.getLogger(__name__)
 logger.setLevel(getattr(logging, os.getenv('LOG_LEVEL', 'INFO')))
 
 
+def send_notification(sns_arn, subject, message):
+    client = boto3.client('sns')
+    try:
+        response = client.publish(
+            TargetArn=sns_arn,
+            Subject=subject,
+            Message=message
+        )
+        logger.info("Published the message to SNS topic. {}".format(response))
+    except Exception as ne:
+        logger.error("SNS Exception: {}".format(ne))
+
+
 # Key derivation functions. See:
 # http://docs.aws.amazon.com/general/latest/gr/signature-v4-examples.html#signature-v4-examples-python
 def sign(key, msg):
@@ -70,11 +83,79 @@ def es_put(es_index, es_type, es_id, data):
     :param data: dict
     :return: object
     """
+    return es_request('PUT', '{}/{}/{}'.format(es_index, es_type, es_id), data)
+
+
+def es_delete(es_index, es_type, es_id):
+    """
+    Delete documents from Elasticsearch
+    the ES endpoint is get from Environment Variable ES_ENDPOINT
+    This code is supposed to run on Lambda function
+
+    :param es_index: string
+    :param es_type: string
+    :param es_id: string
+    :return: object
+    """
+    return es_request('DELETE', '{}/{}/{}'.format(es_index, es_type, es_id))
+
+
+def es_request(method, path, data=None, params=None):
+    """
+    Send any request to the Elasticsearch API (templates, aliases, reindex...)
+    the ES endpoint is get from Environment Variable ES_ENDPOINT
+    This code is supposed to run on Lambda function
+
+    :param method: string HTTP method
+    :param path: string API path without the endpoint (ex: _template/datalake-hive)
+    :param data: dict (optional) JSON body
+    :param params: dict (optional) query string
+    :return: object
+    """
+    endpoint, auth = _es_auth()
+    if not endpoint:
+        return None
+
+    url = '{}/{}'.format(endpoint, path)
+    logger.debug('URL: {}'.format(url))
+    response = requests.request(method, url, auth=auth, json=data, params=params)
+    return response
+
+
+def es_bulk(actions, default=None):
+    """
+    Send many index/delete actions to Elasticsearch in one _bulk request
+    the ES endpoint is get from Environment Variable ES_ENDPOINT
+    This code is supposed to run on Lambda function
+
+    :param actions: list of tuples (action, metadata, document) ex:
+                    ('index', {'_index': 'datalake-raw', '_type': '_doc', '_id': '1'}, {'data': 1}) /
+                    ('delete', {'_index': 'datalake-raw', '_type': '_doc', '_id': '1'}, None)
+    :param default: function (optional) to serialize the objects not supported by json (ex: datetime)
+    :return: object
+    """
+    endpoint, auth = _es_auth()
+    if not endpoint or not actions:
+        return None
+
+    lines = list()
+    for action, metadata, document in actions:
+        lines.append(json.dumps({action: metadata}))
+        if document is not None:
+            lines.append(json.dumps(document, default=default))
+    url = '{}/_bulk'.format(endpoint)
+    logger.debug('URL: {} ({} actions)'.format(url, len(actions)))
+    response = requests.post(url, auth=auth, data='\n'.join(lines) + '\n',
+                             headers={'Content-Type': 'application/x-ndjson'})
+    return response
+
+
+def _es_auth():
     region = os.getenv('AWS_DEFAULT_REGION', 'us-east-1')
     endpoint = os.getenv('ES_ENDPOINT')
     logger.setLevel(getattr(logging, os.getenv('LOG_LEVEL', 'INFO')))
     if not endpoint:
-        return None
+        return None, None
 
     if endpoint[-1:] == '/':
         endpoint = endpoint[:-1]
@@ -87,11 +168,7 @@ def es_put(es_index, es_type, es_id, data):
                            aws_host=host,
                            aws_region=region,
                            aws_service='es')
-    url = '{}/{}/{}/{}'.format(endpoint, es_index, es_type, es_id)
-    logger.debug('URL: {}'.format(url))
-    response = requests.put(url, auth=auth, json=data)
-
-    return response
+    return endpoint, auth
 
 
 # This part of the code is extracted from: https://github.com/DavidMuller/aws-requests-auth
@@ -318,55 +395,6 @@ class AWSRequestsAuth(requests.auth.AuthBase):
         return canonical_querystring
 
 
-class ElasticSearchCatalog(object):
-    def __init__(self, context, sns_arn, header):
-        """
-        ElasticSearchCatalog core Object to send data to ElasticSearch
-        :param context: object
-        :param sns_arn: string
-        :param header: string
-        """
-        self._sns_client = boto3.client('sns')
-        self._s3_client = boto3.client('s3')
-        self._s3_resource = boto3.resource('s3')
-        self._context = context
-        self._sns_arn = sns_arn
-        self._header = header
-        self._first_line = 'no header'
-
-    def send_to_catalog(self, key, data, indice):
-        """
-        Send data to Elasticsearch and skip if there is no env var ES_ENDPOINT set
-        :param key: filename
-        :type key: string
-        :param data: dict object to be sent to Elasticsearch
-        :type data: dict
-        :return:
-        """
-        logger.debug("JSON to catalog on ES: {}".format(json.dumps(data)))
-        # Sent data to Catalog (ElasticSearch)
-        try:
-            resp = es_put(es_index=indice,
-                          es_type='_doc',
-                          es_id=hashlib.md5(key).hexdigest(),
-                          data=data)
-        except Exception as e:
-            logger.error('Error executing Elastic Search Put')
-            logger.debug('Error: {}'.format(e))
-            raise Exception('Error sending data to ES')
-
-        logger.debug('ES PUT response: {}'.format(resp))
-        if resp:
-            logger.debug('ES Put response code: {}'.format(resp.status_code))
-            logger.debug('ES Put response: {}'.format(resp.text))
-            if not 200 <= resp.status_code <= 299:
-                logger.error('Error sending data to ES Catalog')
-                logger.debug('Error: {}'.format(resp.text))
-        else:
-            logger.debug('There is no ES_ENDPOINT configured')
-        return resp
-
-
 if __name__ == '__main__':
     print('Testing common functions')
     for i in range(10):
@@ -1,13 +1,17 @@
 from __future__ import print_function
-from common import ElasticSearchCatalog
+from collections import OrderedDict
+from common import es_bulk, send_notification
 
+import hashlib
+import json
 import logging
 import os
-import json_util as json
+from json_util import from_dynamodb, json_serial
 
 SNS_TOPIC_ARN = os.getenv('SNS_TOPIC_ARN')
 
-HEADER = os.getenv('HEADER')
+# JSON with the type of the attributes that don't need to be detected: {"attribute": "string/datetime/int/float"}
+TYPE_HINTS = json.loads(os.getenv('TYPE_HINTS', '{}'))
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
@@ -16,40 +20,88 @@ logger.info('Loading Lambda Function {}'.format(__name__))
 
 
 def lambda_handler(event, context):
-
-    ingestion = ElasticSearchCatalog(context, SNS_TOPIC_ARN, HEADER)
-
+    """
+    Send the whole stream batch to the ES catalog in one _bulk request. The events of the same key are collapsed to
+    the last one (INSERT/MODIFY = index the NewImage, REMOVE = delete the document).
+    The records of the rejected documents are returned in batchItemFailures (ReportBatchItemFailures) to be retried.
+    """
     logger.info(event)
-
     logger.info("Invoked Lambda Function Name : " + context.function_name)
-    count = 0
-    for record in event['Records']:
 
+    # (index, es_id) -> (action, document, sequence numbers) in the order of the last event of each key
+    documents = OrderedDict()
+    for record in event['Records']:
         ddb_arn = record['eventSourceARN']
         ddb_table = ddb_arn.split(':')[5].split('/')[1].split('-')[3].lower()
 
         # Get the primary key for use as the Elasticsearch ID
         es_id = ""
         for item in record.get('dynamodb').get('Keys'):
-            es_id += record['dynamodb']['Keys'][item]['S']
+            es_id += next(iter(record['dynamodb']['Keys'][item].values()))
 
         logger.info('ElasticSearch id {}'.format(es_id))
-
-        logger.debug('Sending to Catalog (ElasticSearch)...')
-
-        if 'NewImage' not in record['dynamodb']:
-            document = record['dynamodb']
+        key = ('datalake-' + ddb_table, hashlib.md5(es_id.encode('utf-8')).hexdigest())
+        previous = documents.pop(key, (None, None, []))
+        sequence_numbers = previous[2] + [record['dynamodb'].get('SequenceNumber')]
+        if record.get('eventName') == 'REMOVE' or 'NewImage' not in record['dynamodb']:
+            documents[key] = ('delete', None, sequence_numbers)
         else:
-            document = record['dynamodb']['NewImage']
-
-        my_dict = json.loads(document)
-
-        ingestion.send_to_catalog(es_id, my_dict, 'datalake-' + ddb_table)
-        logger.info('Loading document {}'.format(my_dict))
-        logger.debug('Finished the Datalake Ingestion process successfully')
-
-        count += 1
-    return str(count) + ' records processed.'
+            documents[key] = ('index', from_dynamodb(record['dynamodb']['NewImage'], TYPE_HINTS), sequence_numbers)
+
+    actions = [(action, {'_index': index, '_type': '_doc', '_id': es_id}, document)
+               for (index, es_id), (action, document, _) in documents.items()]
+    logger.debug('Sending {} actions of {} records to Catalog (ElasticSearch)...'.format(len(actions),
+                                                                                         len(event['Records'])))
+    failures = list()
+    try:
+        resp = es_bulk(actions, default=json_serial)
+    except Exception as e:
+        logger.error('Error executing Elastic Search Bulk')
+        logger.error('Error: {}'.format(e))
+        resp = None
+        failures = list(documents.keys())
+
+    if resp is not None:
+        logger.debug('ES Bulk response code: {}'.format(resp.status_code))
+        if not 200 <= resp.status_code <= 299:
+            logger.error('Error sending data to ES Catalog')
+            logger.error('Error: {}'.format(resp.text))
+            failures = list(documents.keys())
+        elif resp.json().get('errors'):
+            for key, item in zip(documents.keys(), resp.json()['items']):
+                action, result = next(iter(item.items()))
+                if is_failed(action, result):
+                    logger.error('Error sending {} to ES Catalog: {}'.format(key, result.get('error')))
+                    failures.append(key)
+    elif not failures:
+        logger.debug('There is no ES_ENDPOINT configured')
+
+    if failures and len(failures) == len(documents):
+        send_notification(
+            SNS_TOPIC_ARN,
+            "Data Lake: Send to ES Catalog Exception",
+            "Lambda Function Name : {}\n{} actions of {} records failed, the records will be retried".format(
+                context.function_name, len(actions), len(event['Records']))
+        )
+
+    logger.info('{} records / {} actions processed / {} failed'.format(len(event['Records']), len(actions),
+                                                                      len(failures)))
+    return {
+        'batchItemFailures': [{'itemIdentifier': sequence_number}
+                              for key in failures for sequence_number in documents[key][2]]
+    }
+
+
+def is_failed(action, result):
+    """
+    Check the result of one action of the _bulk response (deleting a document that doesn't exist is not an error)
+    :param action: string
+    :param result: dict
+    :return: boolean
+    """
+    if action == 'delete' and result.get('status') == 404:
+        return False
+    return 'error' in result or not 200 <= result.get('status', 500) <= 299
 
 
 def clean_dict(document):
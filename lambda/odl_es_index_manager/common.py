@@ -0,0 +1,1050 @@
+# -*- coding: utf-8 -*-
+#
+# common.py
+#
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Amazon Software License (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    http://aws.amazon.com/asl/
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+#
+#
+# Common functions to Data Lake Lambda functions
+import csv
+import datetime
+import decimal
+import hashlib
+import hmac
+import json
+import logging
+import os
+import re
+import string
+import sys
+import threading
+import time
+
+from urllib import quote
+# http://python-future.org/compatible_idioms.html
+# Python 2 and 3: alternative 4
+try:
+    from urllib.parse import urlparse
+
+except ImportError:
+    from urlparse import urlparse
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from botocore.vendored import requests
+
+import boto3
+from boto3.dynamodb.conditions import Attr
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(getattr(logging, os.getenv('LOG_LEVEL', 'INFO')))
+
+# Name of the EMR step starting the resident Spark job server (job_server.py)
+JOB_SERVER_STEP_NAME = 'Start the Spark job server'
+
+# Elasticsearch write alias of the ingestion catalog. odl_es_index_manager rolls it over to new indices
+# (datalake-raw-YYYY.MM.DD-000001) and the searches use the read alias datalake-raw with all indices
+ES_RAW_WRITE_ALIAS = 'datalake-raw-write'
+ES_RAW_READ_ALIAS = 'datalake-raw'
+
+# Keys ingested again with the same name (ex: latest/ full dumps): after a rollover their previous document is in an
+# older index of the read alias and is deleted when the new one is written
+ES_RAW_REINGESTED_KEYS = re.compile(os.getenv('ES_RAW_REINGESTED_KEYS', r'(^|/)latest/'))
+
+
+class DatalakeStatus:
+    INITIAL_LOAD = 'INITIAL_LOAD'
+    STAGE = 'STAGE'
+    CANCELED = 'CANCELED'
+    PROCESSING = 'PROCESSING'
+    FAILED = 'FAILED'
+    LOADED = 'LOADED'
+
+    def __init__(self):
+        pass
+
+
+def cluster_is_running(label, s3_log_uri, sns_topic_arn, environment):
+    # Check if any previous EMR cluster is still running
+    emr_client = boto3.client('emr')
+    s3_client = boto3.client('s3')
+    clusters = list()
+    paginator = emr_client.get_paginator('list_clusters')
+    page_iterator = paginator.paginate(ClusterStates=['STARTING', 'BOOTSTRAPPING', 'RUNNING', 'WAITING'])
+    for page in page_iterator:
+        if page['Clusters']:
+            clusters.append(page['Clusters'])
+
+    for cluster in clusters:
+        if emr_client.describe_cluster(ClusterId=cluster[0]['Id']).get('Cluster', {}).get('Tags'):
+            for tag in emr_client.describe_cluster(ClusterId=cluster[0]['Id']).get('Cluster', {}).get('Tags'):
+                if tag['Key'] == 'Label' and tag['Value'] == label:
+                    # create lock file on S3 to notify the existing EMR cluster that Lambda did not create new
+                    # cluster and it should continue to run for another full time period
+                    s3_lock_key = "bootstrap/{}.lock".format(cluster[0]['Id'])
+                    s3_client.put_object(Bucket=s3_log_uri, Key=s3_lock_key)
+                    send_notification(
+                        sns_arn=sns_topic_arn,
+                        subject='Datalake:{} Create EMR Cluster message'.format(environment),
+                        message=('Data Lake Cluster is already running.\n'
+                                 'Skipping the creation of new one\n'
+                                 'Cluster Id  : {}\n'
+                                 'Cluster Name: {}'.format(cluster[0]['Id'], label))
+                    )
+                    return True
+    return False
+
+
+def job_server_step(scripts_path, programs_path, queue_url, stage_table, control_table):
+    """
+    EMR step starting the resident Spark job server in background (start_job_server.sh does nothing if the server is
+    running, the step finishes when the server is started)
+    :param scripts_path: string EMR local home path of the bootstrap scripts
+    :param programs_path: string s3 path of the Spark programs
+    :param queue_url: string SQS queue of the job server
+    :param stage_table: string DynamoDB stage control table
+    :param control_table: string DynamoDB control table
+    :return: dict
+    """
+    return {
+        'Name': JOB_SERVER_STEP_NAME,
+        'ActionOnFailure': 'CONTINUE',
+        'HadoopJarStep': {
+            'Jar': 'command-runner.jar',
+            'Args': [
+                '{}/start_job_server.sh'.format(scripts_path),
+                programs_path,
+                queue_url,
+                stage_table,
+                control_table
+            ]
+        }
+    }
+
+
+def stage_has_emr_files(table_stage):
+    """
+    Check if the stage table has files to be processed by the EMR cluster (the files converted by the fast path
+    function odl_convert_parquet don't need it). The pages of a filtered scan can be empty before the last one.
+    :param table_stage: DynamoDB Table resource of the stage control table
+    :return: boolean
+    """
+    kwargs = {'FilterExpression': Attr('engine').not_exists() | Attr('engine').ne('lambda')}
+    while True:
+        response = table_stage.scan(**kwargs)
+        if response.get('Items'):
+            return True
+        if not response.get('LastEvaluatedKey'):
+            return False
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def send_notification(sns_arn, subject, message):
+    client = boto3.client('sns')
+    try:
+        response = client.publish(
+            TargetArn=sns_arn,
+            Subject=subject,
+            Message=message
+        )
+        logger.info("Published the message to SNS topic. {}".format(response))
+    except Exception as ne:
+        logger.error("SNS Exception: {}".format(ne))
+
+
+# Key derivation functions. See:
+# http://docs.aws.amazon.com/general/latest/gr/signature-v4-examples.html#signature-v4-examples-python
+def sign(key, msg):
+    return hmac.new(key, msg.encode('utf-8'), hashlib.sha256).digest()
+
+
+def get_signature_key(key, datetime_stamp, region_name, service_name):
+    k_date = sign(('AWS4' + key).encode('utf-8'), datetime_stamp)
+    k_region = sign(k_date, region_name)
+    k_service = sign(k_region, service_name)
+    k_signing = sign(k_service, 'aws4_request')
+    return k_signing
+
+
+def es_put(es_index, es_type, es_id, data):
+    """
+    Send documents to Elasticsearch
+    the ES endpoint is get from Environment Variable ES_ENDPOINT
+    This code is supposed to run on Lambda function
+
+    :param es_index: string
+    :param es_type: string
+    :param es_id: string
+    :param data: dict
+    :return: object
+    """
+    return es_request('PUT', '{}/{}/{}'.format(es_index, es_type, es_id), data)
+
+
+def es_delete(es_index, es_type, es_id):
+    """
+    Delete documents from Elasticsearch
+    the ES endpoint is get from Environment Variable ES_ENDPOINT
+    This code is supposed to run on Lambda function
+
+    :param es_index: string
+    :param es_type: string
+    :param es_id: string
+    :return: object
+    """
+    return es_request('DELETE', '{}/{}/{}'.format(es_index, es_type, es_id))
+
+
+def es_request(method, path, data=None, params=None):
+    """
+    Send any request to the Elasticsearch API (templates, aliases, reindex...)
+    the ES endpoint is get from Environment Variable ES_ENDPOINT
+    This code is supposed to run on Lambda function
+
+    :param method: string HTTP method
+    :param path: string API path without the endpoint (ex: _template/datalake-hive)
+    :param data: dict (optional) JSON body
+    :param params: dict (optional) query string
+    :return: object
+    """
+    endpoint, auth = _es_auth()
+    if not endpoint:
+        return None
+
+    url = '{}/{}'.format(endpoint, path)
+    logger.debug('URL: {}'.format(url))
+    response = requests.request(method, url, auth=auth, json=data, params=params)
+    return response
+
+
+def es_bulk(actions, default=None):
+    """
+    Send many index/delete actions to Elasticsearch in one _bulk request
+    the ES endpoint is get from Environment Variable ES_ENDPOINT
+    This code is supposed to run on Lambda function
+
+    :param actions: list of tuples (action, metadata, document) ex:
+                    ('index', {'_index': 'datalake-raw', '_type': '_doc', '_id': '1'}, {'data': 1}) /
+                    ('delete', {'_index': 'datalake-raw', '_type': '_doc', '_id': '1'}, None)
+    :param default: function (optional) to serialize the objects not supported by json (ex: datetime)
+    :return: object
+    """
+    endpoint, auth = _es_auth()
+    if not endpoint or not actions:
+        return None
+
+    lines = list()
+    for action, metadata, document in actions:
+        lines.append(json.dumps({action: metadata}))
+        if document is not None:
+            lines.append(json.dumps(document, default=default))
+    url = '{}/_bulk'.format(endpoint)
+    logger.debug('URL: {} ({} actions)'.format(url, len(actions)))
+    response = requests.post(url, auth=auth, data='\n'.join(lines) + '\n',
+                             headers={'Content-Type': 'application/x-ndjson'})
+    return response
+
+
+def _es_auth():
+    region = os.getenv('AWS_DEFAULT_REGION', 'us-east-1')
+    endpoint = os.getenv('ES_ENDPOINT')
+    logger.setLevel(getattr(logging, os.getenv('LOG_LEVEL', 'INFO')))
+    if not endpoint:
+        return None, None
+
+    if endpoint[-1:] == '/':
+        endpoint = endpoint[:-1]
+    host = endpoint.replace('https://', '')
+    session = boto3.Session()
+    credentials = session.get_credentials()
+    auth = AWSRequestsAuth(aws_access_key=credentials.access_key,
+                           aws_secret_access_key=credentials.secret_key,
+                           aws_token=credentials.token,
+                           aws_host=host,
+                           aws_region=region,
+                           aws_service='es')
+    return endpoint, auth
+
+
+class DatalakeIngestion(object):
+    def __init__(self, context, sns_arn, header, dynamodb_table):
+        """
+        DatalakeIngestion core Object to process the files
+        :param context: object
+        :param sns_arn: string
+        :param header: string
+        """
+        self._sns_client = boto3.client('sns')
+        self._s3_client = boto3.client('s3')
+        self._s3_resource = boto3.resource('s3')
+        self._dynamodb_client = boto3.resource('dynamodb', region_name=os.getenv('AWS_DEFAULT_REGION', 'us-east-1'))
+        self._context = context
+        self._sns_arn = sns_arn
+        self._header = header
+        self._first_line = 'no header'
+        self._ddb_table = self._dynamodb_client.Table(dynamodb_table)
+
+    def copy_to_stage(self, bucket_source, key_source, bucket_target, key_target):
+        """
+        This function copies the object from S3 RAW bucket to S3 Stage bucket
+
+        :param bucket_source: Bucket source
+        :type bucket_source: string
+        :param key_source:  filename in the source
+        :type key_source: string
+        :param bucket_target: bucket destination
+        :type bucket_target: string
+        :param key_target: filename in the destination
+        :type key_target: string
+        :return: None
+        """
+        logger.debug('copy_to_stage source: s3://{}/{} destination: s3://{}/{}'.format(
+            bucket_source,
+            key_source,
+            bucket_target,
+            key_target
+        ))
+        try:
+            copy_source = {
+                'Bucket': bucket_source,
+                'Key': key_source
+            }
+            raw_source_object = "s3://{}/{}".format(bucket_source, key_source)
+            self._s3_client.copy(
+                copy_source,
+                bucket_target,
+                key_target,
+                ExtraArgs={
+                    "MetadataDirective": "REPLACE",
+                    "Metadata": {"s3-raw-object": raw_source_object}
+                }
+            )
+            self._s3_client.put_object_tagging(
+                Bucket=bucket_target,
+                Key=key_target,
+                Tagging={
+                    'TagSet': [
+                        {
+                            'Key': 's3_object_name_raw_tag',
+                            'Value': raw_source_object
+                        },
+                    ]
+                }
+            )
+
+        except Exception as e:
+            msg_exception = "S3 Exception: " + str(e)
+            logger.error(msg_exception)
+            send_notification(
+                self._sns_arn,
+                "Data Lake: Copy to Stage Exception",
+                "Lambda Function Name : {}\n{}".format(self._context.function_name, msg_exception)
+            )
+            return
+
+    def get_header(self, bucket, key):
+        """
+        This method download and open the file to get the first line if the HEADER env var is set to 'true'
+        :param bucket:
+        :type bucket: string
+        :param key:
+        :type key: string
+        :return: None
+        """
+        try:
+            # get the file headers
+            if self._header.lower() == "true":
+                self._s3_client.download_file(bucket, key, '/tmp/file.txt')
+                with open('/tmp/file.txt', 'r') as f:
+                    first_line_raw = f.readline()
+                    valid_chars = "-_ .&',$ %s%s" % (string.ascii_letters, string.digits)
+                    first_line = ''.join(c for c in first_line_raw if c in valid_chars)
+                    logger.info("Dataset header: {}".format(first_line))
+                    self._first_line = first_line
+            else:
+                self._first_line = 'no header'
+
+        except Exception as ne:
+            msg_exception = "S3 download_file Exception to get header: {}".format(ne)
+            logger.error(msg_exception)
+            send_notification(
+                self._sns_arn,
+                "Data Lake: Get HEADER Exception",
+                "Lambda Function Name : {}\n{}".format(self._context.function_name, msg_exception)
+            )
+            return
+
+    def send_to_dynamodb(self, data):
+        """
+        This method send the dict data to the DynamoDB Control Table
+        :param data:
+        :type data: dict
+        :return: None
+        """
+        logger.info("Put DynamoDB: {}".format(self._ddb_table))
+        try:
+
+            response = self._ddb_table.put_item(
+                Item=data
+            )
+            data['header'] = self._first_line
+            logger.debug('DynamoDB response: {}'.format(response))
+
+        except Exception as e:
+            msg_exception = "DynamoDB Exception: {}".format(e)
+            logger.info(msg_exception)
+            send_notification(
+                self._sns_arn,
+                "Data Lake: Send to DynamoDB Exception",
+                "Lambda Function Name : {}\n{}".format(self._context.function_name, msg_exception)
+            )
+            raise Exception('Unable to put item in DynamoDB')
+        return
+
+    def send_to_catalog(self, key, data):
+        """
+        Send data to Elasticsearch and skip if there is no env var ES_ENDPOINT set
+        :param key: filename
+        :type key: string
+        :param data: dict object to be sent to Elasticsearch
+        :type data: dict
+        :return:
+        """
+        logger.debug("JSON to catalog on ES: {}".format(json.dumps(data)))
+        es_id = hashlib.md5(key).hexdigest()
+        # Sent data to Catalog (ElasticSearch)
+        try:
+            resp = es_put(es_index=ES_RAW_WRITE_ALIAS,
+                          es_type='_doc',
+                          es_id=es_id,
+                          data=data)
+        except Exception as e:
+            logger.error('Error executing Elastic Search Put')
+            logger.debug('Error: {}'.format(e))
+            raise Exception('Error sending data to ES')
+
+        logger.debug('ES PUT response: {}'.format(resp))
+        if resp:
+            logger.debug('ES Put response code: {}'.format(resp.status_code))
+            logger.debug('ES Put response: {}'.format(resp.text))
+            if not 200 <= resp.status_code <= 299:
+                logger.error('Error sending data to ES Catalog')
+                logger.debug('Error: {}'.format(resp.text))
+            elif ES_RAW_REINGESTED_KEYS.search(key):
+                self.delete_stale_catalog(key, es_id, resp.json().get('_index'))
+        else:
+            logger.debug('There is no ES_ENDPOINT configured')
+        return resp
+
+    @staticmethod
+    def delete_stale_catalog(key, es_id, index):
+        """
+        Delete the copies of the document in the other indices of the read alias (written before a rollover), so the
+        searches (and the retention) only see the new one
+        :param key: filename
+        :param es_id: string
+        :param index: string index of the new document
+        :return: None
+        """
+        try:
+            resp = es_request('POST', '{}/_delete_by_query'.format(ES_RAW_READ_ALIAS), {'query': {'bool': {
+                'filter': [{'ids': {'values': [es_id]}}],
+                'must_not': [{'term': {'_index': index}}]
+            }}}, params={'conflicts': 'proceed'})
+        except Exception as e:
+            logger.error('Error deleting the previous ES Catalog documents of {}: {}'.format(key, e))
+            return
+        if resp is not None and not 200 <= resp.status_code <= 299:
+            logger.error('Error deleting the previous ES Catalog documents of {}: {}'.format(key, resp.text))
+
+
+def _athena_timestamp(value):
+    if '.' in value:
+        return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f')
+    return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+
+
+# Convert the Athena result values (always strings) to python types based on the ResultSetMetadata column type
+ATHENA_TYPE_CONVERTERS = {
+    'boolean': lambda value: value.lower() == 'true',
+    'tinyint': int,
+    'smallint': int,
+    'integer': int,
+    'bigint': int,
+    'float': float,
+    'real': float,
+    'double': float,
+    'decimal': decimal.Decimal,
+    'date': lambda value: datetime.datetime.strptime(value, '%Y-%m-%d').date(),
+    'timestamp': _athena_timestamp
+}
+
+
+class AthenaQueryExecutor(object):
+    FINAL_STATES = ['SUCCEEDED', 'FAILED', 'CANCELLED']
+
+    # Max rows returned by each GetQueryResults call (API limit)
+    PAGE_SIZE = 1000
+
+    # Bytes read by each ranged GetObject when streaming the result file from S3
+    STREAM_CHUNK_SIZE = 8 * 1024 * 1024
+
+    def __init__(self, output_location, max_concurrency=5, timeout=60, poll_interval=0.2, max_poll_interval=5,
+                 athena_client=None, s3_client=None):
+        """
+        AthenaQueryExecutor runs Athena queries with a bounded concurrency and poll the query state with
+        exponential backoff. The first poll waits for the expected runtime (moving average of the previous queries)
+        so long queries don't burn API calls and short queries are not delayed.
+
+        :param output_location: string s3://bucket/key for the query results
+        :param max_concurrency: integer max number of running queries (match the account Athena concurrency limit)
+        :param timeout: integer max seconds to wait for each query
+        :param poll_interval: float initial wait in seconds between the query state checks
+        :param max_poll_interval: float max wait in seconds between the query state checks
+        :param athena_client: object (optional) boto3 athena client
+        :param s3_client: object (optional) boto3 s3 client used to stream the result file
+        """
+        self._athena_client = athena_client or boto3.client('athena')
+        self._s3_client = s3_client
+        self._output_location = output_location
+        self._max_concurrency = max_concurrency
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._timeout = timeout
+        self._poll_interval = poll_interval
+        self._max_poll_interval = max_poll_interval
+        self._expected_runtime = None
+        self._lock = threading.Lock()
+
+    def start(self, query, database=None):
+        """
+        Start the query execution and return the execution id
+        :param query: string
+        :param database: string
+        :return: string
+        """
+        params = {
+            'QueryString': query,
+            'ResultConfiguration': {'OutputLocation': self._output_location}
+        }
+        if database:
+            params['QueryExecutionContext'] = {'Database': database}
+        return self._athena_client.start_query_execution(**params)['QueryExecutionId']
+
+    def wait(self, execution_id):
+        """
+        Poll the Athena API till you have a SUCCEEDED/FAILED/CANCELLED reply or the timeout is reached
+        The return is the string: SUCCEEDED/FAILED/CANCELLED/TIMEOUT
+
+        :param execution_id: string
+        :return: string
+        """
+        start = time.time()
+        interval = self._poll_interval
+        wait_time = max(self._poll_interval, self._expected_runtime or 0)
+        while True:
+            remaining = start + self._timeout - time.time()
+            if remaining <= 0:
+                logger.info('Athena query {} timed out after {} seconds'.format(execution_id, self._timeout))
+                try:
+                    self._athena_client.stop_query_execution(QueryExecutionId=execution_id)
+                except Exception as e:
+                    logger.debug('Unable to stop the Athena query {}: {}'.format(execution_id, e))
+                return 'TIMEOUT'
+            time.sleep(min(wait_time, remaining))
+            stats = self._athena_client.get_query_execution(QueryExecutionId=execution_id)
+            status = stats['QueryExecution']['Status']['State']
+            if status in self.FINAL_STATES:
+                if status == 'SUCCEEDED':
+                    self._update_expected_runtime(time.time() - start)
+                return status
+            interval = min(interval * 2, self._max_poll_interval)
+            wait_time = interval
+
+    def execute(self, query, database=None):
+        """
+        Run the query and block till it finishes. The number of queries running at the same time is limited by
+        max_concurrency even when this method is called from many threads.
+
+        :param query: string
+        :param database: string
+        :return: tuple (state, execution_id)
+        """
+        with self._semaphore:
+            execution_id = self.start(query, database)
+            return self.wait(execution_id), execution_id
+
+    def run(self, queries):
+        """
+        Run the queries concurrently and yield the result of each one as soon as it finishes
+
+        :param queries: iterable of tuples (key, query, database)
+        :return: generator of tuples (key, state, execution_id)
+        """
+        tasks = queue.Queue()
+        results = queue.Queue()
+        for task in queries:
+            tasks.put(task)
+        count = tasks.qsize()
+
+        def worker():
+            while True:
+                try:
+                    key, query, database = tasks.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    state, execution_id = self.execute(query, database)
+                except Exception as e:
+                    logger.error('Error executing the Athena query: {}'.format(query))
+                    logger.debug('Error: {}'.format(e))
+                    state, execution_id = 'FAILED', None
+                results.put((key, state, execution_id))
+
+        for _ in range(min(self._max_concurrency, count)):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+
+        for _ in range(count):
+            yield results.get()
+
+    def get_results(self, execution_id):
+        """
+        Return the GetQueryResults response of a finished query (only the first page, use iter_rows to read all rows)
+        :param execution_id: string
+        :return: dict
+        """
+        return self._athena_client.get_query_results(QueryExecutionId=execution_id)
+
+    def iter_pages(self, execution_id):
+        """
+        Lazily page through GetQueryResults following the NextToken, only one page is kept in memory
+
+        :param execution_id: string
+        :return: generator of GetQueryResults responses
+        """
+        params = {'QueryExecutionId': execution_id, 'MaxResults': self.PAGE_SIZE}
+        while True:
+            page = self._athena_client.get_query_results(**params)
+            yield page
+            next_token = page.get('NextToken')
+            if not next_token:
+                return
+            params['NextToken'] = next_token
+
+    def iter_rows(self, execution_id, skip_header=None):
+        """
+        Yield all rows of a finished query as tuples typed by the ResultSetMetadata (NULL values are None)
+        The results of SELECT queries (StatementType DML) have the column names as the first row, this row is skipped
+
+        :param execution_id: string
+        :param skip_header: boolean (optional) default is True for DML queries
+        :return: generator of tuples
+        """
+        if skip_header is None:
+            skip_header = self.statement_type(execution_id) == 'DML'
+        converters = None
+        for page in self.iter_pages(execution_id):
+            result_set = page.get('ResultSet', {})
+            if converters is None:
+                converters = self._converters(result_set.get('ResultSetMetadata', {}))
+            for row in result_set.get('Rows', []):
+                if skip_header:
+                    skip_header = False
+                    continue
+                yield self._convert_row([data.get('VarCharValue') for data in row['Data']], converters)
+
+    def iter_batches(self, execution_id, batch_size=PAGE_SIZE, stream=False):
+        """
+        Yield the typed rows in lists of batch_size rows
+
+        :param execution_id: string
+        :param batch_size: integer
+        :param stream: boolean read the result file from S3 instead of the GetQueryResults API (faster for large
+                       results of SELECT queries)
+        :return: generator of lists of tuples
+        """
+        rows = self.iter_csv_rows(execution_id) if stream else self.iter_rows(execution_id)
+        batch = list()
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = list()
+        if batch:
+            yield batch
+
+    def iter_csv_rows(self, execution_id):
+        """
+        Stream the CSV result file of a SELECT query from the S3 output location with ranged GetObject calls and
+        yield the rows typed by the ResultSetMetadata. Only one chunk of the file is kept in memory.
+
+        :param execution_id: string
+        :return: generator of tuples
+        """
+        output_location = self._athena_client.get_query_execution(
+            QueryExecutionId=execution_id)['QueryExecution']['ResultConfiguration']['OutputLocation']
+        metadata = self._athena_client.get_query_results(
+            QueryExecutionId=execution_id, MaxResults=1).get('ResultSet', {}).get('ResultSetMetadata', {})
+        converters = self._converters(metadata)
+        url = urlparse(output_location)
+        reader = csv.reader(self._iter_s3_lines(url.netloc, url.path.lstrip('/')))
+        # The first line of the CSV file is the header
+        next(reader, None)
+        for row in reader:
+            if sys.version_info[0] < 3:
+                row = [value.decode('utf-8') for value in row]
+            # The CSV file doesn't distinguish NULL from empty string, empty values of non string columns are NULL
+            yield self._convert_row([value if value or converter is None else None
+                                     for value, converter in zip(row, converters)], converters)
+
+    def columns(self, execution_id):
+        """
+        Return the column names and Athena types of a finished query
+        :param execution_id: string
+        :return: list of tuples (name, type)
+        """
+        metadata = self._athena_client.get_query_results(
+            QueryExecutionId=execution_id, MaxResults=1).get('ResultSet', {}).get('ResultSetMetadata', {})
+        return [(column['Name'], column['Type']) for column in metadata.get('ColumnInfo', [])]
+
+    def statement_type(self, execution_id):
+        """
+        Return the StatementType of the query: DDL/DML/UTILITY
+        :param execution_id: string
+        :return: string
+        """
+        stats = self._athena_client.get_query_execution(QueryExecutionId=execution_id)
+        return stats.get('QueryExecution', {}).get('StatementType')
+
+    def to_arrow(self, execution_id, batch_size=PAGE_SIZE, stream=False):
+        """
+        Build a pyarrow Table from the query results, one RecordBatch per batch of rows
+        pyarrow is not part of the Lambda runtime and is imported only when this method is called
+
+        :param execution_id: string
+        :param batch_size: integer
+        :param stream: boolean read the result file from S3 (see iter_batches)
+        :return: pyarrow.Table
+        """
+        import pyarrow as pa
+
+        columns = self.columns(execution_id)
+        names = [name for name, _ in columns]
+        batches = list()
+        for batch in self.iter_batches(execution_id, batch_size, stream):
+            arrays = [pa.array([row[index] for row in batch]) for index in range(len(names))]
+            batches.append(pa.RecordBatch.from_arrays(arrays, names))
+        if not batches:
+            return pa.Table.from_arrays([pa.array([]) for _ in names], names)
+        return pa.Table.from_batches(batches)
+
+    def to_pandas(self, execution_id, stream=False):
+        """
+        Build a pandas DataFrame from the query results
+        pandas is not part of the Lambda runtime and is imported only when this method is called
+
+        :param execution_id: string
+        :param stream: boolean read the result file from S3 (see iter_batches)
+        :return: pandas.DataFrame
+        """
+        import pandas as pd
+
+        names = [name for name, _ in self.columns(execution_id)]
+        rows = self.iter_csv_rows(execution_id) if stream else self.iter_rows(execution_id)
+        return pd.DataFrame.from_records(rows, columns=names)
+
+    def _iter_s3_lines(self, bucket, key):
+        if self._s3_client is None:
+            self._s3_client = boto3.client('s3')
+        size = self._s3_client.head_object(Bucket=bucket, Key=key)['ContentLength']
+        remainder = b''
+        for start in range(0, size, self.STREAM_CHUNK_SIZE):
+            end = min(start + self.STREAM_CHUNK_SIZE, size) - 1
+            chunk = self._s3_client.get_object(Bucket=bucket, Key=key,
+                                               Range='bytes={}-{}'.format(start, end))['Body'].read()
+            lines = (remainder + chunk).split(b'\n')
+            remainder = lines.pop()
+            for line in lines:
+                yield self._decode_line(line + b'\n')
+        if remainder:
+            yield self._decode_line(remainder)
+
+    @staticmethod
+    def _decode_line(line):
+        # csv.reader reads bytes on Python 2 and text on Python 3
+        if sys.version_info[0] < 3:
+            return line
+        return line.decode('utf-8')
+
+    @staticmethod
+    def _converters(metadata):
+        return [ATHENA_TYPE_CONVERTERS.get(column.get('Type', '').lower()) for column in metadata.get('ColumnInfo', [])]
+
+    @staticmethod
+    def _convert_row(values, converters):
+        row = list()
+        for index, value in enumerate(values):
+            converter = converters[index] if index < len(converters) else None
+            if value is not None and converter is not None:
+                try:
+                    value = converter(value)
+                except (ValueError, decimal.InvalidOperation):
+                    logger.debug('Unable to convert the Athena value: {}'.format(value))
+            row.append(value)
+        return tuple(row)
+
+    def _update_expected_runtime(self, runtime):
+        with self._lock:
+            if self._expected_runtime is None:
+                self._expected_runtime = runtime
+            else:
+                self._expected_runtime = 0.7 * self._expected_runtime + 0.3 * runtime
+
+
+# This part of the code is extracted from: https://github.com/DavidMuller/aws-requests-auth
+# MIT License
+# Copyright (c) David Muller.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+#     3. The names of its contributors may not be used to endorse or promote
+#        products derived from this software without specific prior written
+#        permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+class AWSRequestsAuth(requests.auth.AuthBase):
+    """
+    Auth class that allows us to connect to AWS services
+    via Amazon's signature version 4 signing process
+    Adapted from https://docs.aws.amazon.com/general/latest/gr/sigv4-signed-request-examples.html
+    """
+
+    def __init__(self,
+                 aws_access_key,
+                 aws_secret_access_key,
+                 aws_host,
+                 aws_region,
+                 aws_service,
+                 aws_token=None):
+        """
+        Example usage for talking to an AWS Elasticsearch Service:
+        AWSRequestsAuth(aws_access_key='YOURKEY',
+                        aws_secret_access_key='YOURSECRET',
+                        aws_host='search-service-foobar.us-east-1.es.amazonaws.com',
+                        aws_region='us-east-1',
+                        aws_service='es',
+                        aws_token='...')
+        The aws_token is optional and is used only if you are using STS
+        temporary credentials.
+        """
+        self.aws_access_key = aws_access_key
+        self.aws_secret_access_key = aws_secret_access_key
+        self.aws_host = aws_host
+        self.aws_region = aws_region
+        self.service = aws_service
+        self.aws_token = aws_token
+
+    def __call__(self, r):
+        """
+        Adds the authorization headers required by Amazon's signature
+        version 4 signing process to the request.
+        Adapted from https://docs.aws.amazon.com/general/latest/gr/sigv4-signed-request-examples.html
+        """
+        aws_headers = self.get_aws_request_headers_handler(r)
+        r.headers.update(aws_headers)
+        return r
+
+    def get_aws_request_headers_handler(self, r):
+        """
+        Override get_aws_request_headers_handler() if you have a
+        subclass that needs to call get_aws_request_headers() with
+        an arbitrary set of AWS credentials. The default implementation
+        calls get_aws_request_headers() with self.aws_access_key,
+        self.aws_secret_access_key, and self.aws_token
+        """
+        return self.get_aws_request_headers(r=r,
+                                            aws_access_key=self.aws_access_key,
+                                            aws_secret_access_key=self.aws_secret_access_key,
+                                            aws_token=self.aws_token)
+
+    def get_aws_request_headers(self, r, aws_access_key, aws_secret_access_key, aws_token):
+        """
+        Returns a dictionary containing the necessary headers for Amazon's
+        signature version 4 signing process. An example return value might
+        look like
+            {
+                'Authorization': 'AWS4-HMAC-SHA256 Credential=YOURKEY/20160618/us-east-1/es/aws4_request, '
+                                 'SignedHeaders=host;x-amz-date, '
+                                 'Signature=ca0a856286efce2a4bd96a978ca6c8966057e53184776c0685169d08abd74739',
+                'x-amz-date': '20160618T220405Z',
+            }
+        """
+        # Create a date for headers and the credential string
+        t = datetime.datetime.utcnow()
+        amzdate = t.strftime('%Y%m%dT%H%M%SZ')
+        datestamp = t.strftime('%Y%m%d')  # Date w/o time for credential_scope
+
+        canonical_uri = AWSRequestsAuth.get_canonical_path(r)
+
+        canonical_querystring = AWSRequestsAuth.get_canonical_querystring(r)
+
+        # Create the canonical headers and signed headers. Header names
+        # and value must be trimmed and lowercase, and sorted in ASCII order.
+        # Note that there is a trailing \n.
+        canonical_headers = ('host:' + self.aws_host + '\n' +
+                             'x-amz-date:' + amzdate + '\n')
+        if aws_token:
+            canonical_headers += 'x-amz-security-token:' + aws_token + '\n'
+
+        # Create the list of signed headers. This lists the headers
+        # in the canonical_headers list, delimited with ";" and in alpha order.
+        # Note: The request can include any headers; canonical_headers and
+        # signed_headers lists those that you want to be included in the
+        # hash of the request. "Host" and "x-amz-date" are always required.
+        signed_headers = 'host;x-amz-date'
+        if aws_token:
+            signed_headers += ';x-amz-security-token'
+
+        # Create payload hash (hash of the request body content). For GET
+        # requests, the payload is an empty string ('').
+        body = r.body if r.body else bytes()
+        try:
+            body = body.encode('utf-8')
+        except (AttributeError, UnicodeDecodeError):
+            # On py2, if unicode characters in present in `body`,
+            # encode() throws UnicodeDecodeError, but we can safely
+            # pass unencoded `body` to execute hexdigest().
+            #
+            # For py3, encode() will execute successfully regardless
+            # of the presence of unicode data
+            body = body
+
+        payload_hash = hashlib.sha256(body).hexdigest()
+
+        # Combine elements to create create canonical request
+        canonical_request = (r.method + '\n' + canonical_uri + '\n' +
+                             canonical_querystring + '\n' + canonical_headers +
+                             '\n' + signed_headers + '\n' + payload_hash)
+
+        # Match the algorithm to the hashing algorithm you use, either SHA-1 or
+        # SHA-256 (recommended)
+        algorithm = 'AWS4-HMAC-SHA256'
+        credential_scope = (datestamp + '/' + self.aws_region + '/' +
+                            self.service + '/' + 'aws4_request')
+        string_to_sign = (algorithm + '\n' + amzdate + '\n' + credential_scope +
+                          '\n' + hashlib.sha256(canonical_request.encode('utf-8')).hexdigest())
+
+        # Create the signing key using the function defined above.
+        signing_key = get_signature_key(aws_secret_access_key,
+                                        datestamp,
+                                        self.aws_region,
+                                        self.service)
+
+        # Sign the string_to_sign using the signing_key
+        string_to_sign_utf8 = string_to_sign.encode('utf-8')
+        signature = hmac.new(signing_key,
+                             string_to_sign_utf8,
+                             hashlib.sha256).hexdigest()
+
+        # The signing information can be either in a query string value or in
+        # a header named Authorization. This code shows how to use a header.
+        # Create authorization header and add to request headers
+        authorization_header = (algorithm + ' ' + 'Credential=' + aws_access_key +
+                                '/' + credential_scope + ', ' + 'SignedHeaders=' +
+                                signed_headers + ', ' + 'Signature=' + signature)
+
+        headers = {
+            'Authorization': authorization_header,
+            'x-amz-date': amzdate,
+        }
+        if aws_token:
+            headers['X-Amz-Security-Token'] = aws_token
+        return headers
+
+    @classmethod
+    def get_canonical_path(cls, r):
+        """
+        Create canonical URI--the part of the URI from domain to query
+        string (use '/' if no path)
+        """
+        parsedurl = urlparse(r.url)
+
+        # safe chars adapted from boto's use of urllib.parse.quote
+        # https://github.com/boto/boto/blob/d9e5cfe900e1a58717e393c76a6e3580305f217a/boto/auth.py#L393
+        return quote(parsedurl.path if parsedurl.path else '/', safe='/-_.~')
+
+    @classmethod
+    def get_canonical_querystring(cls, r):
+        """
+        Create the canonical query string. According to AWS, by the
+        end of this function our query string values must
+        be URL-encoded (space=%20) and the parameters must be sorted
+        by name.
+        This method assumes that the query params in `r` are *already*
+        url encoded.  If they are not url encoded by the time they make
+        it to this function, AWS may complain that the signature for your
+        request is incorrect.
+        """
+        canonical_querystring = ''
+
+        parsedurl = urlparse(r.url)
+        querystring_sorted = '&'.join(sorted(parsedurl.query.split('&')))
+
+        for query_param in querystring_sorted.split('&'):
+            key_val_split = query_param.split('=', 1)
+
+            key = key_val_split[0]
+            if len(key_val_split) > 1:
+                val = key_val_split[1]
+            else:
+                val = ''
+
+            if key:
+                if canonical_querystring:
+                    canonical_querystring += "&"
+                canonical_querystring += u'='.join([key, val])
+
+        return canonical_querystring
+
+
+if __name__ == '__main__':
+    print('Testing common functions')
+    for i in range(10):
+        mock_data = {"Name": "Robot{}".format(i),
+                     "Address": "Address{}".format(i)}
+        mock_resp = es_put(es_index='test', es_type='_doc', es_id=hashlib.md5(str(i)).hexdigest(), data=mock_data)
+        print(mock_resp.text)
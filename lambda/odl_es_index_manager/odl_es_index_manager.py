@@ -0,0 +1,465 @@
+# Copyright 2018 Amazon.com, Inc. and its affiliates. All Rights Reserved.
+#
+# Licensed under the Amazon Software License (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#   http://aws.amazon.com/asl/
+#
+# or in the "license" file accompanying this file. This file is distributed
+# on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language governing
+# permissions and limitations under the License.
+#
+# Invoked after the deploy (Action: install) or manually (Action: reindex / swap)
+# Lambda Function to manage the Elasticsearch index templates and aliases of the Data Lake catalog
+#
+# Each catalog index (datalake-hive, datalake-raw, datalake-tags and datalake-odlcontrol, the control table streamed by
+# odl_ddb_update_es) is an alias to a versioned index (ex: datalake-hive-v1) created from the template in
+# templates/<alias>.json. To change a mapping:
+# 1. Change the template and increase its "version"
+# 2. Invoke with {"Action": "install"} to update the template
+# 3. Invoke with {"Action": "reindex", "Index": "<alias>"} to copy the documents to the new version
+# 4. Invoke with {"Action": "swap", "Index": "<alias>"} to copy the documents written during the reindex and point
+#    the alias to the new version (the readers and writers never see a missing index)
+#
+# datalake-raw grows with the ingestion and uses rollover indices instead (see ROLLOVER): the writers use the write
+# alias datalake-raw-write and the searches the read alias datalake-raw (all indices). Schedule (ex: daily):
+# - {"Action": "rollover"} to start a new index when the write index is too old/big (new template versions apply to
+#   the next index)
+# - {"Action": "lifecycle"} to shrink to 1 shard and force-merge the old indices and delete them after the retention
+
+from __future__ import print_function
+
+import datetime
+import json
+import logging
+import os
+import re
+
+from common import es_request, ES_RAW_READ_ALIAS, ES_RAW_WRITE_ALIAS
+
+# Days to keep the datalake-raw indices (0 = keep forever)
+RAW_RETENTION_DAYS = int(os.getenv('RAW_RETENTION_DAYS', '0'))
+
+# Aliases backed by rollover indices named <alias>-YYYY.MM.DD-NNNNNN (the date is the index creation day)
+ROLLOVER = {
+    ES_RAW_READ_ALIAS: {
+        'write_alias': ES_RAW_WRITE_ALIAS,
+        # Start a new index when any of the conditions is met
+        'conditions': {
+            'max_age': os.getenv('RAW_ROLLOVER_MAX_AGE', '30d'),
+            'max_size': os.getenv('RAW_ROLLOVER_MAX_SIZE', '50gb')
+        },
+        # Shrink to 1 shard and force-merge the indices that are not written anymore after these days
+        'shrink_after_days': int(os.getenv('RAW_SHRINK_AFTER_DAYS', '7')),
+        'delete_after_days': RAW_RETENTION_DAYS
+    }
+}
+
+# Name of the rollover indices
+ROLLOVER_INDEX = re.compile(r'^(?P<alias>.+)-(?P<date>\d{4}\.\d{2}\.\d{2})-(?P<counter>\d+)(?P<shrink>-shrink)?$')
+
+# Suffix of the index with the shrunk copy of a rollover index
+SHRINK_SUFFIX = '-shrink'
+
+# Directory with the index templates (one file per alias)
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+
+# Painless scripts to convert the documents of the indices created before the templates (dynamic mapping)
+MIGRATION_SCRIPTS = {
+    # "columns": {name: comment} -> "columns": [{name, comment, type}]
+    'datalake-hive': "if (ctx._source.columns instanceof Map) {"
+                     " def columns = [];"
+                     " for (entry in ctx._source.columns.entrySet()) {"
+                     " columns.add(['name': entry.getKey(), 'comment': entry.getValue(), 'type': '']);"
+                     " }"
+                     " ctx._source.columns = columns;"
+                     " }"
+}
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(getattr(logging, os.getenv('LOG_LEVEL', 'INFO')))
+logger.info('Loading Lambda Function {}'.format(__name__))
+
+
+def lambda_handler(event, context):
+    logger.debug('Event: {}'.format(event))
+    action = event.get('Action', 'install')
+    if action == 'install':
+        return install(event.get('Indices'))
+    elif action == 'reindex':
+        return reindex(event['Index'])
+    elif action == 'swap':
+        return swap(event['Index'], event.get('Target'))
+    elif action == 'rollover':
+        return dict((alias, rollover(alias)) for alias in event.get('Indices', ROLLOVER.keys()))
+    elif action == 'lifecycle':
+        return dict((alias, lifecycle(alias)) for alias in event.get('Indices', ROLLOVER.keys()))
+    raise Exception('Unknown action: {}'.format(action))
+
+
+def load_templates(aliases=None):
+    """
+    Load the index templates from TEMPLATES_DIR
+    :param aliases: list of strings (optional) load only these templates
+    :return: dict alias -> template
+    """
+    templates = dict()
+    for filename in sorted(os.listdir(TEMPLATES_DIR)):
+        alias, extension = os.path.splitext(filename)
+        if extension != '.json' or (aliases and alias not in aliases):
+            continue
+        with open(os.path.join(TEMPLATES_DIR, filename)) as template_file:
+            templates[alias] = json.load(template_file)
+    return templates
+
+
+def versioned_index(alias, version):
+    """
+    Name of the index of the template version
+    :param alias: string
+    :param version: integer
+    :return: string
+    """
+    return '{}-v{}'.format(alias, version)
+
+
+def install(aliases=None):
+    """
+    Install the index templates and create the first versioned index of each alias.
+    Indices created by the dynamic mapping with the alias name are migrated to the versioned index.
+
+    :param aliases: list of strings (optional) install only these templates
+    :return: dict alias -> index
+    """
+    indices = dict()
+    for alias, template in load_templates(aliases).items():
+        logger.info('Installing the template {} version {}'.format(alias, template['version']))
+        check_response(es_request('PUT', '_template/{}'.format(alias), template))
+        if alias in ROLLOVER:
+            indices[alias] = ensure_rollover(alias)
+        else:
+            indices[alias] = ensure_alias(alias, template['version'])
+    return indices
+
+
+def ensure_alias(alias, version):
+    """
+    Create the versioned index and the alias when the alias doesn't exist yet
+
+    :param alias: string
+    :param version: integer
+    :return: string index behind the alias
+    """
+    current = alias_indices(alias)
+    if current:
+        logger.info('Alias {} already exists: {}'.format(alias, current))
+        return current[0]
+
+    index = versioned_index(alias, version)
+    actions = [{'add': {'index': index, 'alias': alias}}]
+    response = es_request('HEAD', alias)
+    if response is not None and response.status_code == 200:
+        # There is an index with the alias name, copy its documents and replace it by the alias in one operation
+        logger.info('Migrating the index {} to {}'.format(alias, index))
+        create_index(index)
+        copy_documents(alias, index, MIGRATION_SCRIPTS.get(alias))
+        actions.append({'remove_index': {'index': alias}})
+    elif not index_exists(index):
+        create_index(index)
+    check_response(es_request('POST', '_aliases', {'actions': actions}))
+    return index
+
+
+def reindex(alias):
+    """
+    Create the index of the current template version and copy the documents of the alias to it in background.
+    The alias keeps pointing to the old index till the swap.
+
+    :param alias: string
+    :return: dict with the ES task id and the new index
+    """
+    if alias in ROLLOVER:
+        raise Exception('The alias {} uses rollover indices, the new template version applies to the next rollover'
+                        .format(alias))
+    template = load_templates([alias])[alias]
+    index = versioned_index(alias, template['version'])
+    if index in alias_indices(alias):
+        raise Exception('The alias {} already points to {}, increase the template version'.format(alias, index))
+    if not index_exists(index):
+        create_index(index)
+    response = check_response(es_request('POST', '_reindex', reindex_body(alias, index, MIGRATION_SCRIPTS.get(alias)),
+                                         params={'wait_for_completion': 'false'}))
+    task = response.json().get('task') if response is not None else None
+    logger.info('Reindex of {} to {} started: {}'.format(alias, index, task))
+    return {'Index': alias, 'Target': index, 'Task': task}
+
+
+def swap(alias, target=None):
+    """
+    Copy the documents written to the old index during the reindex and point the alias to the new index
+    (the old index is kept to roll back, delete it when it is not needed anymore)
+
+    :param alias: string
+    :param target: string (optional) default is the index of the current template version
+    :return: dict
+    """
+    if not target:
+        target = versioned_index(alias, load_templates([alias])[alias]['version'])
+    current = alias_indices(alias)
+    if current == [target]:
+        return {'Index': alias, 'Target': target}
+    for index in current:
+        copy_documents(index, target, MIGRATION_SCRIPTS.get(alias))
+    actions = [{'remove': {'index': index, 'alias': alias}} for index in current]
+    actions.append({'add': {'index': target, 'alias': alias}})
+    check_response(es_request('POST', '_aliases', {'actions': actions}))
+    logger.info('Alias {} moved from {} to {}'.format(alias, current, target))
+    return {'Index': alias, 'Target': target, 'Previous': current}
+
+
+def ensure_rollover(alias):
+    """
+    Create the first rollover index with the write alias when the write alias doesn't exist yet.
+    An index created by the dynamic mapping with the alias name is copied to the first index and replaced by the
+    read alias, the same for an index with the write alias name (auto-created by a write before the install).
+    Versioned indices already behind the read alias are kept there (searchable) and are not written.
+
+    :param alias: string read alias
+    :return: string write index
+    """
+    config = ROLLOVER[alias]
+    current = alias_indices(config['write_alias'])
+    if current:
+        logger.info('Alias {} already exists: {}'.format(config['write_alias'], current))
+        return current[0]
+
+    # Indices with the alias names (there is no alias with the write alias name, checked above)
+    legacy = list()
+    if not alias_indices(alias) and index_exists(alias):
+        legacy.append(alias)
+    if index_exists(config['write_alias']):
+        legacy.append(config['write_alias'])
+    aliases = dict((name, {}) for name in (config['write_alias'], alias) if name not in legacy)
+    # Date math index name: <datalake-raw-{now/d}-000001> -> datalake-raw-2018.07.06-000001
+    response = check_response(es_request('PUT', quote_index('<{}-{{now/d}}-000001>'.format(alias)),
+                                         {'aliases': aliases}))
+    index = response.json().get('index') if response is not None else None
+    logger.info('Created the rollover index {} with the aliases {}'.format(index, aliases.keys()))
+    if legacy and index:
+        actions = list()
+        for name in legacy:
+            logger.info('Migrating the index {} to {}'.format(name, index))
+            copy_documents(name, index)
+            actions.extend([{'add': {'index': index, 'alias': name}}, {'remove_index': {'index': name}}])
+        check_response(es_request('POST', '_aliases', {'actions': actions}))
+    return index
+
+
+def rollover(alias):
+    """
+    Roll the write alias over to a new index when the write index meets the rollover conditions.
+    The new index is added to the read alias.
+
+    :param alias: string read alias
+    :return: dict rollover response
+    """
+    config = ROLLOVER[alias]
+    response = check_response(es_request('POST', '{}/_rollover'.format(config['write_alias']), {
+        'conditions': config['conditions'],
+        'aliases': {alias: {}}
+    }))
+    result = response.json() if response is not None else {}
+    if result.get('rolled_over'):
+        logger.info('Alias {} rolled over from {} to {}'.format(config['write_alias'], result.get('old_index'),
+                                                                result.get('new_index')))
+    return result
+
+
+def lifecycle(alias):
+    """
+    Apply the lifecycle to the rollover indices that are not written anymore:
+    - older than shrink_after_days: block the writes, shrink to 1 shard (the shrunk index replaces the original in the
+      read alias) and force-merge to 1 segment. Shrink needs all shards on one node, so it takes some runs: prepare
+      the allocation, wait the relocation, shrink, wait the shrunk index to be green and swap.
+    - older than delete_after_days: delete the index
+
+    :param alias: string read alias
+    :return: dict index -> lifecycle step executed
+    """
+    config = ROLLOVER[alias]
+    write_indices = alias_indices(config['write_alias'])
+    today = datetime.date.today()
+    steps = dict()
+    for index in alias_indices(alias):
+        match = ROLLOVER_INDEX.match(index)
+        if not match or index in write_indices:
+            continue
+        age = (today - datetime.datetime.strptime(match.group('date'), '%Y.%m.%d').date()).days
+        if config['delete_after_days'] and age >= config['delete_after_days']:
+            logger.info('Deleting the index {} ({} days)'.format(index, age))
+            check_response(es_request('DELETE', index))
+            steps[index] = 'deleted'
+        elif age >= config['shrink_after_days']:
+            steps[index] = shrink(index, alias)
+    return steps
+
+
+def shrink(index, alias):
+    """
+    Execute the next shrink step of the index
+    :param index: string
+    :param alias: string read alias
+    :return: string step executed
+    """
+    settings = index_settings(index)
+    blocked = settings.get('blocks', {}).get('write') == 'true'
+    if int(settings.get('number_of_shards', 1)) == 1:
+        if blocked:
+            return 'done'
+        force_merge(index)
+        return 'force-merged'
+
+    target = index + SHRINK_SUFFIX
+    if index_exists(target):
+        if cluster_health(target).get('status') != 'green':
+            return 'waiting shrink'
+        check_response(es_request('POST', '_aliases', {'actions': [
+            {'add': {'index': target, 'alias': alias}},
+            {'remove_index': {'index': index}}
+        ]}))
+        force_merge(target)
+        return 'shrunk'
+
+    node = settings.get('routing', {}).get('allocation', {}).get('require', {}).get('_name')
+    if not blocked or not node:
+        node = shrink_node()
+        check_response(es_request('PUT', '{}/_settings'.format(index), {
+            'index.routing.allocation.require._name': node,
+            'index.blocks.write': True
+        }))
+        return 'allocating to {}'.format(node)
+
+    health = cluster_health(index, wait_for_no_relocating_shards='true', timeout='1s')
+    if health.get('timed_out') or health.get('relocating_shards'):
+        return 'waiting relocation'
+    check_response(es_request('POST', '{}/_shrink/{}'.format(index, target), {
+        'settings': {
+            'index.number_of_shards': 1,
+            'index.codec': 'best_compression',
+            'index.routing.allocation.require._name': None,
+            'index.blocks.write': None
+        }
+    }))
+    return 'shrinking'
+
+
+def force_merge(index):
+    """
+    Merge the index to 1 segment and block the writes (the write block marks the index as merged)
+    :param index: string
+    :return: None
+    """
+    logger.info('Force-merging the index {}'.format(index))
+    check_response(es_request('POST', '{}/_forcemerge'.format(index), params={'max_num_segments': 1}))
+    check_response(es_request('PUT', '{}/_settings'.format(index), {'index.blocks.write': True}))
+
+
+def index_settings(index):
+    response = check_response(es_request('GET', '{}/_settings'.format(index)))
+    if response is None:
+        return {}
+    return response.json().get(index, {}).get('settings', {}).get('index', {})
+
+
+def cluster_health(index, **params):
+    response = check_response(es_request('GET', '_cluster/health/{}'.format(index), params=params or None))
+    return response.json() if response is not None else {}
+
+
+def shrink_node():
+    """
+    Data node that receives a copy of all shards of the index to shrink (the first data node by name)
+    :return: string
+    """
+    response = check_response(es_request('GET', '_cat/nodes', params={'format': 'json', 'h': 'name,node.role'}))
+    nodes = sorted(node['name'] for node in response.json() if 'd' in node.get('node.role', ''))
+    return nodes[0]
+
+
+def quote_index(name):
+    """
+    URL encode the date math index names
+    :param name: string
+    :return: string
+    """
+    for char, code in [('<', '%3C'), ('>', '%3E'), ('{', '%7B'), ('}', '%7D'), ('/', '%2F')]:
+        name = name.replace(char, code)
+    return name
+
+
+def alias_indices(alias):
+    """
+    Indices behind the alias
+    :param alias: string
+    :return: list of strings
+    """
+    response = es_request('GET', '_alias/{}'.format(alias))
+    if response is None or response.status_code != 200:
+        return []
+    return sorted(response.json().keys())
+
+
+def index_exists(index):
+    response = es_request('HEAD', index)
+    return response is not None and response.status_code == 200
+
+
+def create_index(index):
+    logger.info('Creating the index {}'.format(index))
+    check_response(es_request('PUT', index))
+
+
+def reindex_body(source, dest, script=None):
+    """
+    Body of the _reindex API. The external version copies only the documents that are new or were updated in the
+    source, so the same copy can run again to catch up the writes done during the first copy.
+
+    :param source: string
+    :param dest: string
+    :param script: string (optional) painless script to convert the documents
+    :return: dict
+    """
+    body = {
+        'conflicts': 'proceed',
+        'source': {'index': source},
+        'dest': {'index': dest, 'version_type': 'external'}
+    }
+    if script:
+        body['script'] = {'lang': 'painless', 'source': script}
+    return body
+
+
+def copy_documents(source, dest, script=None):
+    check_response(es_request('POST', '_reindex', reindex_body(source, dest, script),
+                              params={'wait_for_completion': 'true', 'refresh': 'true'}))
+
+
+def check_response(response):
+    """
+    Raise an exception when the ES request fails
+    :param response: object
+    :return: object
+    """
+    if response is None:
+        logger.debug('There is no ES_ENDPOINT configured')
+    elif not 200 <= response.status_code <= 299:
+        logger.error('Error: {}'.format(response.text))
+        raise Exception('Error executing the Elasticsearch request: {}'.format(response.status_code))
+    return response
+
+
+if __name__ == '__main__':
+    print(lambda_handler({'Action': 'install'}, None))
@@ -19,14 +19,17 @@
 
 from __future__ import print_function
 
+import hashlib
+import json
 import logging
 import os
 import time
+from decimal import Decimal
 
 import boto3
 from boto3.dynamodb.conditions import Attr
 from botocore.exceptions import ClientError
-from common import send_notification, DatalakeStatus
+from common import send_notification, job_server_step, DatalakeStatus, JOB_SERVER_STEP_NAME
 
 # SNS topic to post email alerts to
 SNS_TOPIC_ARN = os.getenv('SNS_TOPIC_ARN')
@@ -63,6 +66,42 @@ ENVIRONMENT = os.getenv('ENVIRONMENT', 'DEV')
 # Cloudwatch Event Rule (Used to continue the job submission when the number of jobs exceed the EMR limits
 EVENT_SPARK_SUBMIT = os.getenv('EVENT_SPARK_SUBMIT')
 
+# Prefix (in the programs bucket) of the manifests with the stage files of the manifest jobs
+MANIFEST_PREFIX = os.getenv('MANIFEST_PREFIX', 'manifests')
+
+# The manifests are the step names of their jobs, odl_validate_job_submit recognizes them by the suffix
+MANIFEST_SUFFIX = '.manifest.json'
+
+# params_type of the programs with the --manifest option
+MANIFEST_PARAMS_TYPES = ('json', 'cli', 'job_spec')
+
+# SQS queue of the resident Spark job server (job_server.py). If set, the job_spec items are sent to the queue instead
+# of adding EMR steps, and a step starts the job server if it stopped idle. The steps of the cluster run one at a time
+# (EMR 5, or StepConcurrencyLevel 1), so that step and the queued jobs wait for the running spark-submit steps: use a
+# StepConcurrencyLevel > 1 (EMR 5.28+) when the job_spec items share the cluster with other steps
+JOB_SERVER_QUEUE_URL = os.getenv('JOB_SERVER_QUEUE_URL')
+
+# EMR local home path (start_job_server.sh of the bootstrap)
+EMR_HOME_SCRIPTS = os.getenv('EMR_HOME_SCRIPTS', '/home/hadoop')
+
+# Spark conf with the Parquet layout of the job catalog item, read by the writer helper of the Spark programs
+# (writer.py)
+LAYOUT_CONF = 'spark.datalake.layout'
+
+# Spark confs of the data profile of the job catalog item (profiling.py of the Spark programs): the quality rules and
+# the location of the profile, read by odl_validate_job_submit
+PROFILE_CONF = 'spark.datalake.profile'
+PROFILE_PATH_CONF = 'spark.datalake.profile.path'
+
+# Prefix (in the programs bucket) of the data profiles
+PROFILES_PREFIX = os.getenv('PROFILES_PREFIX', 'profiles')
+
+# Spark conf with the rollups of the job catalog item, updated by the Spark programs after the load (rollup.py)
+ROLLUPS_CONF = 'spark.datalake.rollups'
+
+# Directory of the job specs of the generic Spark job runner (params_type job_spec), inside the code location
+JOB_SPECS_DIR = 'jobs/'
+
 STEPS_EXCEEDED = u"Maximum number of active steps(State = 'Running', 'Pending' or 'Cancel_Pending') for cluster " \
                  u"exceeded."
 
@@ -70,6 +109,7 @@ emr_client = boto3.client("emr")
 s3_client = boto3.client('s3')
 sns_client = boto3.client('sns')
 events_client = boto3.client('events')
+sqs_client = boto3.client('sqs')
 dynamodb_client = boto3.resource('dynamodb', region_name=REGION)
 
 logging.basicConfig()
@@ -78,6 +118,217 @@ logger.setLevel(getattr(logging, os.getenv('LOG_LEVEL', 'INFO')))
 logger.info('Loading Lambda Function {}'.format(__name__))
 
 
+def _json_number(value):
+    # DynamoDB numbers are Decimal
+    if isinstance(value, Decimal):
+        return int(value) if value % 1 == 0 else float(value)
+    raise TypeError('{} is not JSON serializable'.format(value))
+
+
+def layout_args(layout):
+    """
+    spark-submit arguments with the Parquet layout of the job
+    :param layout: JSON string or dict (DynamoDB map) from the job catalog item, optional
+    :return: list
+    """
+    if not layout:
+        return []
+    if isinstance(layout, dict):
+        layout = json.dumps(layout, default=_json_number)
+    return ['--conf', '{}={}'.format(LAYOUT_CONF, layout)]
+
+
+def profile_conf(profile, hive_database_analytics, hive_table_analytics, step_name):
+    """
+    Spark confs of the data profile of the job
+    :param profile: JSON string or dict (DynamoDB map) with the quality rules of the job catalog item, optional ({} to
+                    profile without rules)
+    :param hive_database_analytics: string
+    :param hive_table_analytics: string
+    :param step_name: string EMR step name (stage object or manifest)
+    :return: dict (empty if the job has no profile)
+    """
+    if profile is None:
+        return {}
+    if not isinstance(profile, dict):
+        profile = json.loads(profile or '{}')
+    path = 's3://{}/{}/{}/{}/{}.json'.format(S3_BUCKET_PROGRAMS, PROFILES_PREFIX, hive_database_analytics,
+                                             hive_table_analytics, hashlib.md5(step_name.encode('utf-8')).hexdigest())
+    return {PROFILE_CONF: json.dumps(profile, default=_json_number, sort_keys=True), PROFILE_PATH_CONF: path}
+
+
+def rollups_conf(rollups):
+    """
+    Spark conf with the rollups of the job
+    :param rollups: JSON string or list (DynamoDB list) from the job catalog item, optional
+    :return: dict (empty if the job has no rollups)
+    """
+    if not rollups:
+        return {}
+    if not isinstance(rollups, list):
+        rollups = json.loads(rollups)
+    return {ROLLUPS_CONF: json.dumps(rollups, default=_json_number, sort_keys=True)}
+
+
+def conf_args(conf):
+    """
+    spark-submit arguments with the Spark confs
+    :param conf: dict
+    :return: list
+    """
+    args = []
+    for name in sorted(conf):
+        args += ['--conf', '{}={}'.format(name, conf[name])]
+    return args
+
+
+def job_spec_args(code_path, spec, variables, partition=None):
+    """
+    Arguments of the generic Spark job runner (job_runner.py) for the job spec
+    :param code_path: string code location on the EMR master node
+    :param spec: string job spec file name (params of the job catalog item)
+    :param variables: dict variables of the job spec
+    :param partition: string name=value of the partition to process, optional
+    :return: list
+    """
+    args = ['--spec', code_path + JOB_SPECS_DIR + spec]
+    for name in sorted(variables):
+        args += ['--var', '{}={}'.format(name, variables[name])]
+    if partition:
+        args += ['--partition', partition]
+    return args
+
+
+def job_server_step_pending(cluster_id):
+    """
+    Check if the cluster has a step starting the job server that is not finished
+    :param cluster_id: string
+    :return: boolean
+    """
+    for page in emr_client.get_paginator('list_steps').paginate(ClusterId=cluster_id,
+                                                                StepStates=['PENDING', 'RUNNING']):
+        if any(step['Name'] == JOB_SERVER_STEP_NAME for step in page.get('Steps', [])):
+            return True
+    return False
+
+
+def send_to_job_server(s3_object_name_stage, spec, variables, partition=None, layout=None, conf=None):
+    """
+    Send the job spec to the queue of the resident Spark job server
+    :param s3_object_name_stage: string stage object (the step name of the EMR steps)
+    :param spec: string job spec file name
+    :param variables: dict variables of the job spec
+    :param partition: string name=value of the partition to process, optional
+    :param layout: JSON string or dict with the Parquet layout of the job catalog, optional
+    :param conf: dict Spark confs of the job (profile_conf), optional
+    :return: dict SQS response
+    """
+    message = {
+        's3_object_name_stage': s3_object_name_stage,
+        'spec': spec,
+        'variables': variables
+    }
+    if partition:
+        message['partition'] = partition
+    if layout:
+        message['layout'] = json.loads(layout) if not isinstance(layout, dict) else layout
+    if conf:
+        message['conf'] = conf
+    return sqs_client.send_message(QueueUrl=JOB_SERVER_QUEUE_URL,
+                                   MessageBody=json.dumps(message, default=_json_number))
+
+
+def write_manifest(s3_dir_stage, partition, items):
+    """
+    Write the manifest with the stage files of the job (read by the programs with --manifest, see manifest.py)
+    :param s3_dir_stage: string job catalog data source
+    :param partition: string partition of the stage files, optional
+    :param items: list of stage items
+    :return: string s3 path of the manifest
+    """
+    created = time.strftime("%Y-%m-%dT%H:%M:%S")
+    key = '{}/{}/{}{}{}'.format(MANIFEST_PREFIX, s3_dir_stage.split('://', 1)[-1].strip('/'),
+                                '{}-'.format(partition) if partition else '', time.strftime("%Y%m%d%H%M%S"),
+                                MANIFEST_SUFFIX)
+    manifest = {
+        's3_data_source': s3_dir_stage,
+        'partition': partition,
+        'created': created,
+        'files': [{'path': item['s3_object_name_stage'], 'size': int(item['size']) if item.get('size') else None}
+                  for item in items]
+    }
+    s3_client.put_object(Bucket=S3_BUCKET_PROGRAMS, Key=key, Body=json.dumps(manifest, indent=2).encode('utf-8'),
+                         ContentType='application/json')
+    return 's3://{}/{}'.format(S3_BUCKET_PROGRAMS, key)
+
+
+def submit_manifest(cluster_id, s3_dir_stage, partition, job, context):
+    """
+    Write the manifest of the stage items of the job and add one step with the manifest
+    :param cluster_id: string
+    :param s3_dir_stage: string job catalog data source
+    :param partition: string partition of the stage files, optional
+    :param job: dict with the step_args, the stage items and the analytics attributes of the job
+    :param context: Lambda context
+    :return: None or string error message
+    """
+    manifest = write_manifest(s3_dir_stage, partition, job['items'])
+    conf = profile_conf(job['profile'], job['hive_database_analytics'], job['hive_table_analytics'], manifest)
+    conf.update(rollups_conf(job['rollups']))
+    step = {"Name": manifest,
+            'ActionOnFailure': 'CONTINUE',
+            'HadoopJarStep': {
+                'Jar': 'command-runner.jar',
+                'Args': job['step_args'][:1] + conf_args(conf) + job['step_args'][1:] + ['--manifest', manifest]
+            }
+            }
+    timestamp_step_submitted = time.strftime("%Y-%m-%dT%H:%M:%S-%Z")
+    try:
+        action = emr_client.add_job_flow_steps(JobFlowId=cluster_id, Steps=[step])
+        logger.debug("Added step: {}".format(action))
+    except ClientError as e:
+        if e.operation_name == 'AddJobFlowSteps' and e.response['Error']['Message'] == STEPS_EXCEEDED:
+            # The stage items stay in the table, the next submission writes a new manifest
+            logger.info('The maximum number of steps for cluster exceeded')
+            if check_spark_submit_rule_enabled() == 'DISABLED':
+                set_spark_submit_rule_status('ENABLED')
+            return 'Finished sending step Jobs but with more on queue'
+        msg_exception = "EMR Add Steps Exception: {}".format(e)
+        logger.error(msg_exception)
+        send_notification(
+            SNS_TOPIC_ARN,
+            "Data Lake: Spark Submit Exception",
+            "Lambda Function Name: {}\n{}".format(context.function_name, msg_exception)
+        )
+        return 'Error Sending Job Flow Steps'
+
+    table_stage = dynamodb_client.Table(DYNAMO_DB_STAGE_TABLE)
+    for item in job['items']:
+        table_stage.update_item(
+            TableName=DYNAMO_DB_STAGE_TABLE,
+            Key={
+                's3_object_name_stage': item['s3_object_name_stage']
+            },
+            UpdateExpression="set hive_table_analytics = :hive_table_analytics,"
+                             "hive_database_analytics = :hive_database_analytics,"
+                             "s3_target = :s3_target,"
+                             "timestamp_step_submitted = :timestamp_step_submitted,"
+                             "manifest = :manifest,"
+                             "profile_path = :profile_path,"
+                             "file_status = :file_status",
+            ExpressionAttributeValues={
+                ':hive_table_analytics': job['hive_table_analytics'],
+                ':hive_database_analytics': job['hive_database_analytics'],
+                ':s3_target': job['s3_target'],
+                ':timestamp_step_submitted': timestamp_step_submitted,
+                ':manifest': manifest,
+                ':profile_path': conf.get(PROFILE_PATH_CONF),
+                ':file_status': DatalakeStatus.PROCESSING}
+        )
+    logger.info('Manifest {} submitted with {} files'.format(manifest, len(job['items'])))
+    return
+
+
 def check_spark_submit_rule_enabled():
     try:
         resp = events_client.describe_rule(Name=EVENT_SPARK_SUBMIT)
@@ -181,7 +432,9 @@ def lambda_handler(event, context):
     try:
         table_stage = dynamodb_client.Table(DYNAMO_DB_STAGE_TABLE)
         table_job = dynamodb_client.Table(DYNAMO_DB_JOB_CATALOG)
-        results = table_stage.scan(FilterExpression=Attr('file_status').ne(skip))
+        # The files converted by the fast path function (odl_convert_parquet) are not submitted to EMR
+        results = table_stage.scan(FilterExpression=Attr('file_status').ne(skip) & (
+            Attr('engine').not_exists() | Attr('engine').ne('lambda')))
 
     except Exception as e:
         msg_exception = "DynamoDB Scan Exception: {}".format(e)
@@ -193,6 +446,10 @@ def lambda_handler(event, context):
         )
         return
 
+    # Stage items of the manifest jobs by data source and partition, submitted after the scan
+    manifest_jobs = {}
+    # The job server step is added once, with the first message queued
+    job_server_started = False
     for item in results.get('Items'):
         s3_object_name_stage = item.get('s3_object_name_stage')
         partition_date = item.get('partition')
@@ -227,6 +484,9 @@ def lambda_handler(event, context):
             status_enabled = responses['Item']['Enabled']
             params_type = responses.get('Item', {}).get('params_type')
             params = responses.get('Item', {}).get('params')
+            layout = responses.get('Item', {}).get('layout')
+            profile = responses.get('Item', {}).get('profile')
+            rollups = responses.get('Item', {}).get('rollups')
 
             logger.debug("responses: {}".format(responses['Item']))
             logger.debug("spark_program_s3_path: {}".format(spark_program_s3_path))
@@ -249,13 +509,28 @@ def lambda_handler(event, context):
                 "/usr/bin/spark-submit",
                 "--conf",
                 "spark.yarn.appMasterEnv.PYTHONIOENCODING=utf8"
-            ]
+            ] + layout_args(layout)
             if params_type and params_type == 'json':
                 step_args.append(code_path + spark_program)
             elif params_type and params_type == 'cli':
                 step_args.append(code_path + spark_program)
                 for param in params.split(' '):
                     step_args.append(param)
+            elif params_type and params_type == 'job_spec':
+                # spark_program is the generic job runner and params the job spec of the table
+                job_variables = {
+                    's3_dir_stage': s3_dir_stage,
+                    's3_target': s3_target,
+                    'hive_database_raw': hive_database_raw,
+                    'hive_table_raw': hive_table_raw,
+                    'hive_database_analytics': hive_database_analytics,
+                    'hive_table_analytics': hive_table_analytics
+                }
+                job_partition = None
+                if partition_name_stage != 'false':
+                    job_partition = '{}={}'.format(partition_name_stage, partition_date)
+                step_args.append(code_path + spark_program)
+                step_args += job_spec_args(code_path, params, job_variables, job_partition)
             else:
                 step_args.append(code_path + spark_program)
                 step_args.append(hive_database_raw)
@@ -267,18 +542,47 @@ def lambda_handler(event, context):
                 if partition_name_stage != 'false':
                     step_args.append('{}={}'.format(partition_name_stage, partition_date))
 
+            # The data profile and quality rules (profiling.py) and the rollups (rollup.py) of the job catalog item
+            conf = profile_conf(profile, hive_database_analytics, hive_table_analytics, s3_object_name_stage)
+            conf.update(rollups_conf(rollups))
             step = {"Name": s3_object_name_stage,
                     'ActionOnFailure': 'CONTINUE',
                     'HadoopJarStep': {
                         'Jar': 'command-runner.jar',
-                        'Args': step_args
+                        'Args': step_args[:1] + conf_args(conf) + step_args[1:]
                     }
                     }
 
+            if status_enabled == "True" and responses['Item'].get('manifest') == 'True' and \
+                    params_type in MANIFEST_PARAMS_TYPES:
+                # One step with the manifest of all the stage files of the data source and partition
+                job = manifest_jobs.setdefault((s3_dir_stage, partition_date), {
+                    'step_args': step_args,
+                    'items': [],
+                    'profile': profile,
+                    'rollups': rollups,
+                    'hive_table_analytics': hive_table_analytics,
+                    'hive_database_analytics': hive_database_analytics,
+                    's3_target': s3_target
+                })
+                job['items'].append(item)
+                continue
+
             if status_enabled == "True":
                 timestamp_step_submitted = time.strftime("%Y-%m-%dT%H:%M:%S-%Z")
                 try:
-                    action = emr_client.add_job_flow_steps(JobFlowId=cluster_id, Steps=[step])
+                    if params_type == 'job_spec' and JOB_SERVER_QUEUE_URL:
+                        # The job server runs the job in its warm SparkSession, without a new spark-submit. It may
+                        # have stopped idle on the running cluster, start it again (the script skips a running one)
+                        if not job_server_started and not job_server_step_pending(cluster_id):
+                            emr_client.add_job_flow_steps(JobFlowId=cluster_id, Steps=[job_server_step(
+                                EMR_HOME_SCRIPTS, 's3://{}/{}'.format(S3_BUCKET_PROGRAMS, S3_KEY_PROGRAMS),
+                                JOB_SERVER_QUEUE_URL, DYNAMO_DB_STAGE_TABLE, DYNAMO_DB_CONTROL)])
+                        job_server_started = True
+                        action = send_to_job_server(s3_object_name_stage, params, job_variables, job_partition,
+                                                    layout, conf)
+                    else:
+                        action = emr_client.add_job_flow_steps(JobFlowId=cluster_id, Steps=[step])
 
                     logger.debug("### Debug mode enabled ###")
                     logger.debug("EMR Step: {}".format(step))
@@ -316,12 +620,14 @@ def lambda_handler(event, context):
                                          "hive_database_analytics = :hive_database_analytics,"
                                          "s3_target = :s3_target,"
                                          "timestamp_step_submitted = :timestamp_step_submitted,"
+                                         "profile_path = :profile_path,"
                                          "file_status = :file_status",
                         ExpressionAttributeValues={
                             ':hive_table_analytics': hive_table_analytics,
                             ':hive_database_analytics': hive_database_analytics,
                             ':s3_target': s3_target,
                             ':timestamp_step_submitted': timestamp_step_submitted,
+                            ':profile_path': conf.get(PROFILE_PATH_CONF),
                             ':file_status': DatalakeStatus.PROCESSING}
                        )
                     logger.info('DynamoDB update response: {}'.format(response))
@@ -340,6 +646,21 @@ def lambda_handler(event, context):
         else:
             logger.info('There is no items returned from DynamoDB')
 
+    for (s3_dir_stage, partition_date), job in manifest_jobs.items():
+        try:
+            error = submit_manifest(cluster_id, s3_dir_stage, partition_date, job, context)
+        except Exception as e:
+            msg_exception = "Manifest Submit Exception: {}".format(e)
+            logger.error(msg_exception)
+            send_notification(
+                SNS_TOPIC_ARN,
+                "Data Lake: Spark Submit Exception",
+                "Lambda Function Name: {}\n{}".format(context.function_name, msg_exception)
+            )
+            return
+        if error:
+            return error
+
     if skip:
         # We are running from a scheduled rule and there is no more jobs to submit
         # Let's disable the scheduled rule
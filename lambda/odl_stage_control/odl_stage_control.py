@@ -19,6 +19,7 @@
 from __future__ import print_function
 
 import datetime
+import json
 import logging
 import os
 
@@ -36,8 +37,21 @@ DYNAMO_DB_CONTROL = os.getenv('DYNAMO_DB_CONTROL')
 # DynamoDB table for Stage Control
 DYNAMO_DB_STAGE_TABLE = os.getenv('DYNAMO_DB_STAGE_TABLE')
 
+# DynamoDB table for Job Catalog
+DYNAMO_DB_JOB_CATALOG = os.getenv('DYNAMO_DB_JOB_CATALOG')
+
+# Lambda function to convert the small files without EMR (odl_convert_parquet). Fast path disabled if not set
+FAST_PATH_FUNCTION = os.getenv('FAST_PATH_FUNCTION')
+
+# Maximum size (bytes) of the stage files converted by the fast path
+FAST_PATH_MAX_SIZE = int(os.getenv('FAST_PATH_MAX_SIZE', 50 * 1024 * 1024))
+
+# Stage items converted by the fast path function, odl_create_emr_cluster and odl_spark_submit ignore them
+ENGINE_LAMBDA = 'lambda'
+
 sns_client = boto3.client('sns')
 s3_client = boto3.client('s3')
+lambda_client = boto3.client('lambda')
 dynamodb_resource = boto3.resource('dynamodb', region_name=REGION)
 logging.basicConfig()
 logger = logging.getLogger(__name__)
@@ -45,6 +59,48 @@ logger.setLevel(getattr(logging, os.getenv('LOG_LEVEL', 'INFO')))
 logger.info('Loading Lambda Function {}'.format(__name__))
 
 
+def use_fast_path(s3_dir_stage, size):
+    """
+    Check if the stage file can be converted by the fast path function: the function is configured, the file is small
+    and the job catalog item of the data source enables it ("fast_path": "True", only for the jobs that just convert
+    the file to the analytics table)
+    :param s3_dir_stage: string
+    :param size: integer file size (None if unknown)
+    :return: boolean
+    """
+    if not FAST_PATH_FUNCTION or size is None or size > FAST_PATH_MAX_SIZE:
+        return False
+    table_job = dynamodb_resource.Table(DYNAMO_DB_JOB_CATALOG)
+    job = table_job.get_item(Key={'s3_data_source': str(s3_dir_stage)}).get('Item') or {}
+    return job.get('Enabled') == 'True' and job.get('fast_path') == 'True'
+
+
+def invoke_fast_path(table_stage, s3_object_name_stage):
+    """
+    Invoke the fast path function asynchronously. If the invoke fails the engine flag is removed and the file is
+    processed by EMR
+    :param table_stage: DynamoDB Table
+    :param s3_object_name_stage: string
+    :return: None
+    """
+    try:
+        response = lambda_client.invoke(
+            FunctionName=FAST_PATH_FUNCTION,
+            InvocationType='Event',
+            Payload=json.dumps({'s3_object_name_stage': s3_object_name_stage})
+        )
+        logger.info("Fast path invoke: {}".format(response))
+    except Exception as e:
+        logger.error("Lambda Invoke Exception: {}, the file will be processed by EMR".format(e))
+        table_stage.update_item(
+            TableName=DYNAMO_DB_STAGE_TABLE,
+            Key={
+                's3_object_name_stage': s3_object_name_stage
+            },
+            UpdateExpression="remove engine"
+        )
+
+
 def lambda_handler(event, context):
     records = event['Records']
     logger.debug(records)
@@ -58,21 +114,29 @@ def lambda_handler(event, context):
             s3_dir_stage = record['dynamodb']['NewImage'].get('s3_dir_stage', {}).get('S')
             s3_object_name_stage = record['dynamodb']['NewImage'].get('s3_object_name_stage', {}).get('S')
             file_status = record['dynamodb']['NewImage'].get('file_status', {}).get('S')
+            size = record['dynamodb']['NewImage'].get('size', {}).get('N')
             if file_status == 'STAGE':
                 table_stage = dynamodb_resource.Table(DYNAMO_DB_STAGE_TABLE)
                 stage_timestamp = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S.000")
+                item = {
+                    's3_object_name_stage': s3_object_name_stage,
+                    'stage_timestamp': stage_timestamp,
+                    's3_object_name_raw': s3_object_name_raw,
+                    's3_dir_stage': s3_dir_stage,
+                    'partition': partition
+                }
+                if size is not None:
+                    size = int(size)
+                    item['size'] = size
 
                 try:
-                    response = table_stage.put_item(
-                        Item={
-                            's3_object_name_stage': s3_object_name_stage,
-                            'stage_timestamp': stage_timestamp,
-                            's3_object_name_raw': s3_object_name_raw,
-                            's3_dir_stage': s3_dir_stage,
-                            'partition': partition
-                        }
-                    )
+                    fast_path = use_fast_path(s3_dir_stage, size)
+                    if fast_path:
+                        item['engine'] = ENGINE_LAMBDA
+                    response = table_stage.put_item(Item=item)
                     logger.info("insert DynamoDB Stage: {}".format(response))
+                    if fast_path:
+                        invoke_fast_path(table_stage, s3_object_name_stage)
                 except Exception as e:
                     msg_exception = "DynamoDB Exception Table {}: {}".format(DYNAMO_DB_STAGE_TABLE, e)
                     logger.error(msg_exception)
@@ -24,10 +24,11 @@ import json
 import logging
 import os
 import time
+from decimal import Decimal
 
 import boto3
 
-from common import send_notification, DatalakeStatus
+from common import send_notification, stage_has_emr_files, DatalakeStatus
 
 # SNS topic to post email alerts to
 SNS_TOPIC_ARN = os.getenv('SNS_TOPIC_ARN')
@@ -44,6 +45,9 @@ REGION = os.getenv('AWS_DEFAULT_REGION', 'us-east-1')
 # ENVIRONMENT
 ENVIRONMENT = os.getenv('ENVIRONMENT', 'DEV')
 
+# Suffix of the manifests of the manifest jobs (odl_spark_submit), the step name of these jobs
+MANIFEST_SUFFIX = '.manifest.json'
+
 s3_client = boto3.client('s3')
 sns_client = boto3.client('sns')
 dynamodb_resource = boto3.resource('dynamodb', region_name=REGION)
@@ -57,8 +61,7 @@ logger.info('Loading Lambda Function {}'.format(__name__))
 def check_files_shutdown_emr(event_cluster_id, context):
     # check if there are files pending to be processed
     try:
-        table_stage = dynamodb_resource.Table(DYNAMO_DB_STAGE_TABLE)
-        results_stage = table_stage.scan()
+        pending = stage_has_emr_files(dynamodb_resource.Table(DYNAMO_DB_STAGE_TABLE))
     except Exception as e:
         logger.error("Error Reading DynamoDB Table: {}".format(e))
         send_notification(
@@ -72,7 +75,7 @@ def check_files_shutdown_emr(event_cluster_id, context):
         )
         return 'Unable to Scan table'
 
-    if not results_stage.get('Items'):
+    if not pending:
         msg = 'DynamoDB Stage Table {} is empty'.format(DYNAMO_DB_STAGE_TABLE)
         logger.info(msg)
         # EMR shutdown
@@ -84,6 +87,39 @@ def check_files_shutdown_emr(event_cluster_id, context):
         return response
 
 
+def is_manifest(step_name):
+    return step_name.endswith(MANIFEST_SUFFIX)
+
+
+def stage_objects(step_name):
+    """
+    Stage objects processed by the step: the step name or the files of the manifest (manifest jobs)
+    :param step_name: string
+    :return: list of strings
+    """
+    if not is_manifest(step_name):
+        return [step_name]
+    bucket, key = step_name.split('/', 3)[2:]
+    manifest = json.loads(s3_client.get_object(Bucket=bucket, Key=key)['Body'].read().decode('utf-8'))
+    return [item['path'] for item in manifest['files']]
+
+
+def get_profile(profile_path):
+    """
+    Data profile written by the Spark program (profiling.py)
+    :param profile_path: string s3 path of the profile (profile_path of the stage item)
+    :return: dict with DynamoDB numbers (Decimal) or None if there is no profile
+    """
+    try:
+        bucket, key = profile_path.split('/', 3)[2:]
+        body = s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+        return json.loads(body.decode('utf-8'), parse_float=Decimal)
+    except Exception as e:
+        # The data is loaded, the step is not failed by the profile
+        logger.error('Unable to read the data profile {}: {}'.format(profile_path, e))
+        return None
+
+
 def update_ddb_stage_control(item, file_status, timestamp):
     try:
         table_stage = dynamodb_resource.Table(DYNAMO_DB_STAGE_TABLE)
@@ -111,6 +147,135 @@ def update_ddb_stage_control(item, file_status, timestamp):
         return 'Unable to update Item from table'
 
 
+def load_stage_object(s3_object_name_stage, timestamp_step_finished, event_cluster_id, context, profiles=None,
+                      cleanup=True):
+    """
+    Update the control table with the loaded stage object, remove it from the stage table and bucket
+    :param s3_object_name_stage: string
+    :param timestamp_step_finished: string
+    :param event_cluster_id: string EMR cluster id
+    :param context: Lambda context
+    :param profiles: dict cache of the data profiles by path (the stage objects of a manifest share the profile)
+    :param cleanup: boolean delete the stage object from the bucket and check the cluster shutdown (the manifest jobs
+                    delete their files and the shutdown is checked once for the manifest)
+    :return: None or string error message
+    """
+    try:
+        table_stage = dynamodb_resource.Table(DYNAMO_DB_STAGE_TABLE)
+
+        response = table_stage.get_item(Key={'s3_object_name_stage': str(s3_object_name_stage)})
+        logger.info(response)
+
+    except Exception as e:
+        msg_exception = "DynamoDB Exception: {}".format(e)
+        logger.error(msg_exception)
+        logger.debug(traceback.print_exc())
+        send_notification(
+            SNS_TOPIC_ARN,
+            'AWS Lambda: {function_name}'
+            ' error: Unable to get DynamoDB Item.\nError: {error}'.format(
+                function_name=context.function_name,
+                error=e
+            ),
+            'Datalake:{} Lambda Error'.format(ENVIRONMENT)
+        )
+        return 'Unable to Get Item from table'
+
+    if response.get('Item'):
+        hive_database_analytics = response['Item']['hive_database_analytics']
+        hive_table_analytics = response['Item']['hive_table_analytics']
+        s3_target = response['Item']['s3_target']
+        s3_object_name_raw = response['Item']['s3_object_name_raw']
+        profile_path = response['Item'].get('profile_path')
+        profile = None
+        if profile_path:
+            profiles = {} if profiles is None else profiles
+            if profile_path not in profiles:
+                profiles[profile_path] = get_profile(profile_path)
+            profile = profiles[profile_path]
+        logger.debug("### Debug mode enabled ###")
+        logger.debug("Updating Table: {}".format(DYNAMO_DB_CONTROL))
+        logger.debug("s3_object_name_raw: {}".format(s3_object_name_raw))
+        try:
+            table_control = dynamodb_resource.Table(DYNAMO_DB_CONTROL)
+            response_control = table_control.update_item(
+                TableName=DYNAMO_DB_CONTROL,
+                Key={
+                    's3_object_name': str(s3_object_name_raw)
+                },
+                UpdateExpression="set file_status = :file_status, "
+                                 "timestamp_step_finished = :timestamp_step_finished, "
+                                 "hive_table_analytics = :hive_table_analytics, "
+                                 "hive_database_analytics = :hive_database_analytics, "
+                                 "s3_target = :s3_target, "
+                                 "data_profile = :data_profile",
+                ExpressionAttributeValues={
+                    ':file_status': DatalakeStatus.LOADED,
+                    ':timestamp_step_finished': str(timestamp_step_finished),
+                    ':hive_table_analytics': str(hive_table_analytics),
+                    ':hive_database_analytics': str(hive_database_analytics),
+                    ':s3_target': str(s3_target),
+                    ':data_profile': profile}
+            )
+            logger.debug('DDB update_item response: {}'.format(response_control))
+        except Exception as e:
+            msg_exception = "DynamoDB Exception: {}".format(e)
+            logger.error(msg_exception)
+            logger.debug(traceback.print_exc())
+            send_notification(
+                SNS_TOPIC_ARN,
+                'AWS Lambda: {function_name}'
+                ' error: Unable to update DynamoDB Item.\nError: {error}'.format(
+                    function_name=context.function_name,
+                    error=e
+                ),
+                'Datalake:{} Lambda Error'.format(ENVIRONMENT)
+            )
+            return 'Unable to Update Item from table'
+    else:
+        logger.info('There is no items returned from DynamoDB!')
+        return 'No items to process'
+
+    # TODO: Create a parameter to Delete or Keep the item in the DynamoDB StageControl
+    logger.info("Cleaning Table DynamoDB: {}; s3_object_name_stage: {}".format(DYNAMO_DB_STAGE_TABLE,
+                                                                               s3_object_name_stage))
+    try:
+        response_stage = table_stage.delete_item(Key={'s3_object_name_stage': s3_object_name_stage})
+        http_status_code_delete_stage = response_stage['ResponseMetadata']['HTTPStatusCode']
+        logger.debug("### Debug mode enabled ###")
+        logger.debug(response)
+        logger.debug("HTTPStatusCode: {}".format(http_status_code_delete_stage))
+    except Exception as e:
+        msg_exception = "DynamoDB Exception: {}".format(e)
+        logger.error(msg_exception)
+        send_notification(
+            SNS_TOPIC_ARN,
+            'AWS Lambda: {function_name}'
+            ' error: Unable to delete DynamoDB Item.\nError: {error}'.format(
+                function_name=context.function_name,
+                error=e
+            ),
+            'Datalake:{} Lambda Error'.format(ENVIRONMENT)
+        )
+        return 'Unable to delete Item from table'
+
+    if not cleanup:
+        return
+    logger.info("Cleaning s3 object stage: {}".format(s3_object_name_stage))
+    bucket_stage = s3_object_name_stage.split("/")[2]
+    logger.info("bucket: {}".format(bucket_stage))
+    key_stage = s3_object_name_stage.split('/', 3)[3]
+    logger.info("Key: {}".format(key_stage))
+    try:
+        s3_client.delete_object(Bucket=bucket_stage, Key=key_stage)
+        # check if there are files pending to be processed
+        # This step shutdown the cluster if there are no items in the StageControl Table
+        check_files_shutdown_emr(event_cluster_id, context)
+    except Exception as e:
+        logger.error("S3 Exception: {}".format(e))
+        return
+
+
 def lambda_handler(event, context):
     step_name = event.get('detail', {}).get('name')
     event_step_message = event.get('detail', {}).get('message')
@@ -140,118 +305,30 @@ def lambda_handler(event, context):
         message_step_completed = "job execution completed: Name: {}; ID: {}".format(step_name, event_step_id)
         logger.info(message_step_completed)
 
+        if not is_manifest(step_name):
+            return load_stage_object(step_name, timestamp_step_finished, event_cluster_id, context)
+        # Step of a manifest job: every stage object of the manifest was loaded
+        profiles = {}
+        for s3_object_name_stage in stage_objects(step_name):
+            load_stage_object(s3_object_name_stage, timestamp_step_finished, event_cluster_id, context, profiles,
+                              cleanup=False)
+        # The program deleted the stage files of the manifest (manifest.delete_files), only the shutdown is checked
         try:
-            table_stage = dynamodb_resource.Table(DYNAMO_DB_STAGE_TABLE)
-
-            response = table_stage.get_item(Key={'s3_object_name_stage': str(step_name)})
-            logger.info(response)
-
-        except Exception as e:
-            msg_exception = "DynamoDB Exception: {}".format(e)
-            logger.error(msg_exception)
-            logger.debug(traceback.print_exc())
-            send_notification(
-                SNS_TOPIC_ARN,
-                'AWS Lambda: {function_name}'
-                ' error: Unable to get DynamoDB Item.\nError: {error}'.format(
-                    function_name=context.function_name,
-                    error=e
-                ),
-                'Datalake:{} Lambda Error'.format(ENVIRONMENT)
-            )
-            return 'Unable to Get Item from table'
-
-        if response.get('Item'):
-            hive_database_analytics = response['Item']['hive_database_analytics']
-            hive_table_analytics = response['Item']['hive_table_analytics']
-            s3_target = response['Item']['s3_target']
-            s3_object_name_raw = response['Item']['s3_object_name_raw']
-            logger.debug("### Debug mode enabled ###")
-            logger.debug("Updating Table: {}".format(DYNAMO_DB_CONTROL))
-            logger.debug("s3_object_name_raw: {}".format(s3_object_name_raw))
-            try:
-                table_control = dynamodb_resource.Table(DYNAMO_DB_CONTROL)
-                response_control = table_control.update_item(
-                    TableName=DYNAMO_DB_CONTROL,
-                    Key={
-                        's3_object_name': str(s3_object_name_raw)
-                    },
-                    UpdateExpression="set file_status = :file_status, "
-                                     "timestamp_step_finished = :timestamp_step_finished, "
-                                     "hive_table_analytics = :hive_table_analytics, "
-                                     "hive_database_analytics = :hive_database_analytics, "
-                                     "s3_target = :s3_target",
-                    ExpressionAttributeValues={
-                        ':file_status': DatalakeStatus.LOADED,
-                        ':timestamp_step_finished': str(timestamp_step_finished),
-                        ':hive_table_analytics': str(hive_table_analytics),
-                        ':hive_database_analytics': str(hive_database_analytics),
-                        ':s3_target': str(s3_target)}
-                )
-                logger.debug('DDB update_item response: {}'.format(response_control))
-            except Exception as e:
-                msg_exception = "DynamoDB Exception: {}".format(e)
-                logger.error(msg_exception)
-                logger.debug(traceback.print_exc())
-                send_notification(
-                    SNS_TOPIC_ARN,
-                    'AWS Lambda: {function_name}'
-                    ' error: Unable to update DynamoDB Item.\nError: {error}'.format(
-                        function_name=context.function_name,
-                        error=e
-                    ),
-                    'Datalake:{} Lambda Error'.format(ENVIRONMENT)
-                )
-                return 'Unable to Update Item from table'
-        else:
-            logger.info('There is no items returned from DynamoDB!')
-            return 'No items to process'
-
-        # TODO: Create a parameter to Delete or Keep the item in the DynamoDB StageControl
-        logger.info("Cleaning Table DynamoDB: {}; s3_object_name_stage: {}".format(DYNAMO_DB_STAGE_TABLE, step_name))
-        try:
-            response_stage = table_stage.delete_item(Key={'s3_object_name_stage': step_name})
-            http_status_code_delete_stage = response_stage['ResponseMetadata']['HTTPStatusCode']
-            logger.debug("### Debug mode enabled ###")
-            logger.debug(response)
-            logger.debug("HTTPStatusCode: {}".format(http_status_code_delete_stage))
-        except Exception as e:
-            msg_exception = "DynamoDB Exception: {}".format(e)
-            logger.error(msg_exception)
-            send_notification(
-                SNS_TOPIC_ARN,
-                'AWS Lambda: {function_name}'
-                ' error: Unable to delete DynamoDB Item.\nError: {error}'.format(
-                    function_name=context.function_name,
-                    error=e
-                ),
-                'Datalake:{} Lambda Error'.format(ENVIRONMENT)
-            )
-            return 'Unable to delete Item from table'
-
-        logger.info("Cleaning s3 object stage: {}".format(step_name))
-        bucket_stage = step_name.split("/")[2]
-        logger.info("bucket: {}".format(bucket_stage))
-        key_stage = step_name.split('/', 3)[3]
-        logger.info("Key: {}".format(key_stage))
-        try:
-            s3_client.delete_object(Bucket=bucket_stage, Key=key_stage)
-            # check if there are files pending to be processed
-            # This step shutdown the cluster if there are no items in the StageControl Table
             check_files_shutdown_emr(event_cluster_id, context)
         except Exception as e:
-            logger.error("S3 Exception: {}".format(e))
-            return
+            logger.error("Shutdown check Exception: {}".format(e))
 
     elif 'FAILED' in event_step_state:
         message_step_failed = "job execution failed: Name: {}; ID: {}".format(step_name, event_step_id)
         logger.info(message_step_failed)
-        update_ddb_stage_control(step_name, DatalakeStatus.FAILED, timestamp_step_finished)
+        for s3_object_name_stage in stage_objects(step_name):
+            update_ddb_stage_control(s3_object_name_stage, DatalakeStatus.FAILED, timestamp_step_finished)
 
     elif 'CANCELLED' in event_step_state:
         message_step_cancelled = "job execution cancelled: Name: {}; ID: {}".format(step_name, event_step_id)
         logger.info(message_step_cancelled)
-        update_ddb_stage_control(step_name, DatalakeStatus.CANCELED, timestamp_step_finished)
+        for s3_object_name_stage in stage_objects(step_name):
+            update_ddb_stage_control(s3_object_name_stage, DatalakeStatus.CANCELED, timestamp_step_finished)
     else:
         return
 
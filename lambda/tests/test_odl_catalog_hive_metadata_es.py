@@ -42,6 +42,7 @@ mock_vars = {
     'DYNAMO_DB_CONTROL': 'mock-bigdata-OdlControl',
     'BUCKET_ATHENA_QUERY_OUTPUT': 'mock-bigdata-athena',
     'KEY_ATHENA_QUERY_OUTPUT': 'lambda_datalake_hive_catalog_es',
+    'CATALOG_BACKEND': 'athena',
     'CLUSTER_LABEL': 'mock_cluster',
     'SNS_TOPIC_ARN': 'arn:aws:sns:us-east-1:111111111111:mock-datalake',
     'S3_BOOTSTRAP_BUCKET': 'mock_artifacts',
@@ -77,7 +78,26 @@ with mock.patch.dict('os.environ', mock_vars):
                         }
                     }
                 }
+                mock_boto3_client.return_value.get_query_results.side_effect = [
+                    {
+                        'ResultSet': {
+                            'Rows': [{'Data': [{'VarCharValue': 'db_mdb_dev'}]}],
+                            'ResultSetMetadata': {'ColumnInfo': [{'Name': 'database_name', 'Type': 'string'}]}
+                        },
+                        'NextToken': 'mock-token'
+                    },
+                    {
+                        'ResultSet': {
+                            'Rows': [{'Data': [{'VarCharValue': 'db_mdb_raw_dev'}]}]
+                        }
+                    },
+                    {'ResultSet': {'Rows': []}},
+                    {'ResultSet': {'Rows': []}}
+                ]
                 lambda_handler(mock_event, mock_context)
+                # show databases (2 pages) + show tables on each database
+                assert mock_boto3_client.return_value.get_query_results.call_count == 4
+                mock_boto3_client.return_value.get_query_results.side_effect = None
                 mock_boto3_client.return_value.get_query_execution.return_value = None
                 mock_boto3_resource.reset_mock()
                 mock_boto3_client.reset_mock()
@@ -100,3 +120,143 @@ with mock.patch.dict('os.environ', mock_vars):
                     lambda_handler(mock_event, mock_context)
                 mock_boto3_resource.reset_mock()
                 mock_boto3_client.reset_mock()
+
+            def test_catalog_hive_metadata_es_glue_backend():
+                """
+                Test the odl_catalog_hive_metadata_es function reading the Glue Data Catalog
+                :return:
+                """
+                mock_context = MockContext()
+                mock_event = {'Backend': 'glue'}
+                mock_tables_page = {
+                    'TableList': [
+                        {
+                            'Name': 'tb_call_req',
+                            'StorageDescriptor': {
+                                'Columns': [
+                                    {'Name': 'id', 'Type': 'int', 'Comment': 'ticket id'},
+                                    {'Name': 'summary', 'Type': 'varchar(255)'}
+                                ]
+                            },
+                            'PartitionKeys': [{'Name': 'dt', 'Type': 'string'}]
+                        }
+                    ]
+                }
+                mock_paginator = mock_boto3_client.return_value.get_paginator.return_value
+                mock_paginator.paginate.side_effect = [
+                    [{'DatabaseList': [{'Name': 'db_mdb_raw_dev'}, {'Name': 'db_mdb_dev'}]}]
+                ]
+                mock_boto3_client.return_value.get_tables.side_effect = [mock_tables_page, mock_tables_page]
+                with mock.patch('odl_catalog_hive_metadata_es.index_table') as mock_index_table:
+                    lambda_handler(mock_event, mock_context)
+                    assert mock_index_table.call_count == 2
+                    mock_index_table.assert_called_with('db_mdb_dev', 'tb_call_req', [
+                        ('id', 'int', 'ticket id'), ('summary', 'varchar(255)', ''), ('dt', 'string', '')
+                    ])
+                mock_boto3_client.return_value.start_query_execution.assert_not_called()
+                mock_paginator.paginate.side_effect = None
+                mock_boto3_client.return_value.get_tables.side_effect = None
+                mock_boto3_resource.reset_mock()
+                mock_boto3_client.reset_mock()
+
+            def test_catalog_hive_metadata_es_describe_tables():
+                """
+                Test the odl_catalog_hive_metadata_es function running the describe queries with the Athena executor
+                :return:
+                """
+                mock_context = MockContext()
+                mock_event = {'Backend': 'athena', 'Database': 'db_mdb_dev', 'Recursivity': 0}
+                mock_boto3_client.return_value.get_query_execution.return_value = {
+                    'QueryExecution': {
+                        'Status': {
+                            'State': 'SUCCEEDED'
+                        }
+                    }
+                }
+                mock_describe = {'ResultSet': {'Rows': [{'Data': [{'VarCharValue': 'id  \tint  \tticket id'}]}]}}
+                mock_boto3_client.return_value.get_query_results.side_effect = [
+                    {'ResultSet': {'Rows': [{'Data': [{'VarCharValue': 'tb_a'}]}, {'Data': [{'VarCharValue': 'tb_b'}]}]}},
+                    mock_describe,
+                    mock_describe
+                ]
+                with mock.patch('odl_catalog_hive_metadata_es.index_table') as mock_index_table:
+                    lambda_handler(mock_event, mock_context)
+                    assert mock_index_table.call_count == 2
+                    assert sorted(call[0][1] for call in mock_index_table.call_args_list) == ['tb_a', 'tb_b']
+                    mock_index_table.assert_called_with('db_mdb_dev', mock.ANY, [('id', 'int', 'ticket id')])
+                assert mock_boto3_client.return_value.start_query_execution.call_count == 3
+                mock_boto3_client.return_value.get_query_results.side_effect = None
+                mock_boto3_client.return_value.get_query_execution.return_value = None
+                mock_boto3_resource.reset_mock()
+                mock_boto3_client.reset_mock()
+
+            def test_catalog_hive_metadata_es_glue_incremental():
+                """
+                Test the odl_catalog_hive_metadata_es function sending only the changed tables to ES
+                :return:
+                """
+                from odl_catalog_hive_metadata_es import table_fingerprint, glue_table_columns
+                mock_context = MockContext()
+                mock_event = {'Backend': 'glue', 'Database': 'db_mdb_dev'}
+                mock_unchanged = {'Name': 'tb_unchanged', 'UpdateTime': '2018-07-06 00:00:00',
+                                  'StorageDescriptor': {'Columns': [{'Name': 'id', 'Type': 'int'}]}}
+                mock_changed = {'Name': 'tb_changed', 'UpdateTime': '2018-07-07 00:00:00',
+                                'StorageDescriptor': {'Columns': [{'Name': 'id', 'Type': 'int'}]}}
+                mock_boto3_client.return_value.get_tables.side_effect = [{'TableList': [mock_unchanged, mock_changed]}]
+                previous_changed = table_fingerprint('db_mdb_dev', mock_changed, [('id', 'int', ''), ('old', 'int', '')])
+                previous_changed['update_time'] = '2018-07-06 00:00:00'
+                mock_table_catalog = mock_boto3_resource.return_value.Table.return_value
+                mock_table_catalog.query.return_value = {'Items': [
+                    table_fingerprint('db_mdb_dev', mock_unchanged, glue_table_columns(mock_unchanged)),
+                    previous_changed,
+                    {'database': 'db_mdb_dev', 'table': 'tb_dropped', 'columns': ['id']}
+                ]}
+                with mock.patch('odl_catalog_hive_metadata_es.DYNAMO_DB_CATALOG', 'mock-datalake-OdlCatalog'), \
+                        mock.patch('odl_catalog_hive_metadata_es.index_table') as mock_index_table, \
+                        mock.patch('odl_catalog_hive_metadata_es.es_delete') as mock_es_delete:
+                    lambda_handler(mock_event, mock_context)
+                    mock_index_table.assert_called_once_with('db_mdb_dev', 'tb_changed', [('id', 'int', '')])
+                    deleted = sorted(call[1]['es_id'] for call in mock_es_delete.call_args_list)
+                    assert deleted == ['db_mdb_dev-tb_changed-old', 'db_mdb_dev-tb_dropped', 'db_mdb_dev-tb_dropped-id']
+                mock_table_catalog.delete_item.assert_called_once_with(
+                    Key={'database': 'db_mdb_dev', 'table': 'tb_dropped'})
+                assert mock_table_catalog.put_item.call_count == 1
+                mock_boto3_client.return_value.get_tables.side_effect = None
+                mock_boto3_resource.reset_mock()
+                mock_boto3_client.reset_mock()
+
+            def test_catalog_hive_metadata_es_glue_hand_off():
+                """
+                Test the odl_catalog_hive_metadata_es function saving the cursor and invoking itself close to the
+                Lambda timeout, then resuming from the cursor
+                :return:
+                """
+                import json
+                from botocore.exceptions import ClientError
+                mock_context = MockContext()
+                mock_context.get_remaining_time_in_millis = mock.MagicMock(return_value=1000)
+                mock_event = {'Backend': 'glue', 'Database': 'db_mdb_dev'}
+                mock_client = mock_boto3_client.return_value
+                mock_client.get_object.side_effect = ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+                mock_client.get_tables.side_effect = [
+                    {'TableList': [{'Name': 'tb_a'}], 'NextToken': 'mock-token'},
+                    {'TableList': [{'Name': 'tb_b'}]}
+                ]
+                with mock.patch('odl_catalog_hive_metadata_es.index_table') as mock_index_table:
+                    assert lambda_handler(mock_event, mock_context) == 'Glue catalog crawl handed off'
+                    assert mock_index_table.call_count == 1
+                    cursor = json.loads(mock_client.put_object.call_args[1]['Body'])
+                    assert cursor['next_token'] == 'mock-token'
+                    assert cursor['seen'] == ['tb_a']
+                    assert json.loads(mock_client.invoke.call_args[1]['Payload']) == mock_event
+
+                    mock_client.get_object.side_effect = None
+                    mock_client.get_object.return_value = {'Body': mock.MagicMock(read=lambda: json.dumps(cursor))}
+                    mock_context.get_remaining_time_in_millis.return_value = 900000
+                    assert lambda_handler(mock_event, mock_context) == 'Glue catalog crawl finished'
+                    mock_index_table.assert_called_with('db_mdb_dev', 'tb_b', [])
+                    assert mock_client.get_tables.call_args[1]['NextToken'] == 'mock-token'
+                    mock_client.delete_object.assert_called_once()
+                mock_client.get_tables.side_effect = None
+                mock_boto3_resource.reset_mock()
+                mock_boto3_client.reset_mock()
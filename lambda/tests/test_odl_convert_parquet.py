@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+#
+# tests/test_odl_convert_parquet.py
+#
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import sys
+
+import mock
+# We need to add the parent directory to the path to find the module to test
+lambda_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '../odl_convert_parquet'))
+sys.path.insert(0, os.path.abspath(lambda_path))
+
+
+class MockContext(object):
+    def __init__(self):
+        self.function_name = 'mock'
+
+
+mock_stage = {
+    's3_object_name_stage': 's3://mock-stage/iba/br/laminacao/dt=2018-07-06/laminacao.csv',
+    's3_object_name_raw': 's3://mock-raw/iba/br/laminacao/2018/07/06/laminacao.csv',
+    's3_dir_stage': 's3://mock-stage/iba/br/laminacao',
+    'partition': '2018-07-06',
+    'size': 1024,
+    'engine': 'lambda'
+}
+mock_job = {
+    's3_data_source': 's3://mock-stage/iba/br/laminacao',
+    'hive_database_raw': 'db_raw',
+    'hive_table_raw': 'tb_laminacao',
+    'hive_database_analytics': 'db_analytics',
+    'hive_table_analytics': 'tb_laminacao',
+    's3_target': 's3://mock-analytics/iba/br/laminacao/',
+    'partition_name_stage': 'dt',
+    'Enabled': 'True',
+    'fast_path': 'True'
+}
+mock_raw_table = {
+    'Name': 'tb_laminacao',
+    'DatabaseName': 'db_raw',
+    'StorageDescriptor': {'SerdeInfo': {'Parameters': {'field.delim': '\t'}}},
+    'Parameters': {'skip.header.line.count': '1'}
+}
+mock_analytics_table = {
+    'Name': 'tb_laminacao',
+    'DatabaseName': 'db_analytics',
+    'StorageDescriptor': {
+        'Columns': [{'Name': 'id', 'Type': 'int'}, {'Name': 'value', 'Type': 'decimal(10,2)'}],
+        'Location': 's3://mock-analytics/iba/br/laminacao/'
+    },
+    'PartitionKeys': [{'Name': 'dt', 'Type': 'string'}]
+}
+
+mock_vars = {
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'SNS_TOPIC_ARN': 'arn:aws:sns:us-east-1:111111111111:mock-datalake',
+    'DYNAMO_DB_CONTROL': 'mock-datalake-OdlControl-FFFFFFFFFFF',
+    'DYNAMO_DB_STAGE_TABLE': 'mock-datalake-OdlStageControl-FFFFFFFFFFF',
+    'DYNAMO_DB_JOB_CATALOG': 'mock-datalake-OdlJobCatalog-FFFFFFFFFFF'
+}
+with mock.patch.dict('os.environ', mock_vars):
+    with mock.patch('boto3.client') as mock_boto3_client:
+        with mock.patch('boto3.resource') as mock_boto3_resource:
+            # We need to load the lambda function here to mock the boto3 objects that are initialized
+            # when the module is loaded import lambda_handler
+            from odl_convert_parquet import lambda_handler, csv_options
+
+            def mock_tables():
+                tables = {
+                    'mock-datalake-OdlStageControl-FFFFFFFFFFF': mock.MagicMock(),
+                    'mock-datalake-OdlJobCatalog-FFFFFFFFFFF': mock.MagicMock(),
+                    'mock-datalake-OdlControl-FFFFFFFFFFF': mock.MagicMock()
+                }
+                tables['mock-datalake-OdlStageControl-FFFFFFFFFFF'].get_item.return_value = {'Item': mock_stage}
+                tables['mock-datalake-OdlJobCatalog-FFFFFFFFFFF'].get_item.return_value = {'Item': mock_job}
+                return tables
+
+            def mock_get_table(DatabaseName, Name):
+                return {'Table': mock_raw_table if DatabaseName == 'db_raw' else mock_analytics_table}
+
+            def test_csv_options():
+                """
+                Test the delimiter and header read from the raw table
+                :return:
+                """
+                assert csv_options(mock_raw_table) == ('\t', 1)
+                assert csv_options({'StorageDescriptor': {}}) == ('\x01', 0)
+
+            def test_convert_parquet():
+                """
+                Test the odl_convert_parquet function converting a stage file
+                :return:
+                """
+                mock_context = MockContext()
+                tables = mock_tables()
+                with mock.patch('odl_convert_parquet.dynamodb_resource') as mock_dynamodb, \
+                        mock.patch('odl_convert_parquet.glue_client') as mock_glue, \
+                        mock.patch('odl_convert_parquet.s3_client') as mock_s3, \
+                        mock.patch('odl_convert_parquet.convert_to_parquet') as mock_convert:
+                    mock_dynamodb.Table.side_effect = tables.get
+                    mock_glue.get_table.side_effect = mock_get_table
+                    mock_s3.get_object.return_value = {'Body': mock.MagicMock()}
+                    mock_convert.return_value = (b'PAR1', 2)
+                    response = lambda_handler({'s3_object_name_stage': mock_stage['s3_object_name_stage']},
+                                              mock_context)
+                    assert response == {'s3_target': 's3://mock-analytics/iba/br/laminacao/dt=2018-07-06/'
+                                                      'laminacao.parquet', 'rows': 2}
+                    mock_s3.put_object.assert_called_once_with(Bucket='mock-analytics',
+                                                               Key='iba/br/laminacao/dt=2018-07-06/laminacao.parquet',
+                                                               Body=b'PAR1')
+                    partition = mock_glue.create_partition.call_args[1]['PartitionInput']
+                    assert partition['Values'] == ['2018-07-06']
+                    assert partition['StorageDescriptor']['Location'] == \
+                        's3://mock-analytics/iba/br/laminacao/dt=2018-07-06'
+                    control = tables['mock-datalake-OdlControl-FFFFFFFFFFF'].update_item.call_args[1]
+                    assert control['Key'] == {'s3_object_name': mock_stage['s3_object_name_raw']}
+                    assert control['ExpressionAttributeValues'][':file_status'] == 'LOADED'
+                    tables['mock-datalake-OdlStageControl-FFFFFFFFFFF'].delete_item.assert_called_once_with(
+                        Key={'s3_object_name_stage': mock_stage['s3_object_name_stage']})
+                    mock_s3.delete_object.assert_called_once_with(
+                        Bucket='mock-stage', Key='iba/br/laminacao/dt=2018-07-06/laminacao.csv')
+
+            def test_convert_parquet_fallback_to_emr():
+                """
+                Test the odl_convert_parquet function returning the file to EMR when the conversion fails
+                :return:
+                """
+                mock_context = MockContext()
+                tables = mock_tables()
+                with mock.patch('odl_convert_parquet.dynamodb_resource') as mock_dynamodb, \
+                        mock.patch('odl_convert_parquet.glue_client') as mock_glue, \
+                        mock.patch('odl_convert_parquet.s3_client') as mock_s3, \
+                        mock.patch('odl_convert_parquet.convert_to_parquet') as mock_convert:
+                    mock_dynamodb.Table.side_effect = tables.get
+                    mock_glue.get_table.side_effect = mock_get_table
+                    mock_convert.side_effect = ValueError('CSV parse error: Expected 2 columns, got 3')
+                    response = lambda_handler({'s3_object_name_stage': mock_stage['s3_object_name_stage']},
+                                              mock_context)
+                    assert response == 'Unable to convert the file'
+                    tables['mock-datalake-OdlStageControl-FFFFFFFFFFF'].update_item.assert_called_once_with(
+                        TableName='mock-datalake-OdlStageControl-FFFFFFFFFFF',
+                        Key={'s3_object_name_stage': mock_stage['s3_object_name_stage']},
+                        UpdateExpression='remove engine')
+                    assert not mock_s3.put_object.called
+                    assert not tables['mock-datalake-OdlControl-FFFFFFFFFFF'].update_item.called
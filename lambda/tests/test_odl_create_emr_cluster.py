@@ -57,7 +57,7 @@ with mock.patch.dict('os.environ', mock_vars):
         with mock.patch('boto3.resource') as mock_boto3_resource:
             # We need to load the lambda function here to mock the boto3 objects that are initialized
             # when the module is loaded
-            from odl_create_emr_cluster import lambda_handler
+            from odl_create_emr_cluster import lambda_handler, stage_is_empty
 
             def test_invoke_create_emr_cluster_with_ddb_exception():
                 """
@@ -97,6 +97,23 @@ with mock.patch.dict('os.environ', mock_vars):
                 mock_event = {}
                 lambda_handler(mock_event, mock_context)
 
+            def test_stage_is_empty_paginated_scan():
+                """
+                Test the filtered scan of the stage table following the empty pages
+                :return:
+                """
+                mock_scan = mock_boto3_resource.return_value.Table.return_value.scan
+                last_key = {'s3_object_name_stage': 's3://mock-stage/file1.csv'}
+                mock_scan.side_effect = [
+                    {'Items': [], 'LastEvaluatedKey': last_key},
+                    {'Items': [{'s3_object_name_stage': 's3://mock-stage/file2.csv'}]}
+                ]
+                assert not stage_is_empty()
+                assert mock_scan.call_args[1]['ExclusiveStartKey'] == last_key
+                mock_scan.side_effect = [{'Items': [], 'LastEvaluatedKey': last_key}, {'Items': []}]
+                assert stage_is_empty()
+                mock_scan.side_effect = None
+
             def test_invoke_create_emr_cluster_with_existing_cluster():
                 """
                 Test the odl_create_emr_cluster function with valid event invocation and the cluster is already running
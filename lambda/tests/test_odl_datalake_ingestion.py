@@ -252,3 +252,58 @@ def test_invoke_skip_plugin(mock_boto3_client, mock_boto3_resource):
         }
     }
     lambda_handler(mock_event, mock_context)
+
+
+@mock.patch('boto3.resource')
+@mock.patch('boto3.client')
+def test_invoke_impressions_plugin(mock_boto3_client, mock_boto3_resource):
+    """
+    Test the odl_datalake_ingestion function with impressions object, the dt partition is sent to the control table
+    :return:
+    """
+    from odl_datalake_ingestion import lambda_handler
+    mock_context = MockContext()
+    mock_event["Records"][0]["s3"]["object"]["key"] = "hive-ads/tables/impressions/dt=2009-04-14-13-00/" \
+                                                     "ec2-0-51-75-39.amazon.com-2009-04-14-13-00.log"
+    mock_boto3_client.return_value.head_object.return_value = {
+        "ResponseMetadata": {
+            "HTTPHeaders": {
+                "content-length": 1024,
+                "content-type": "text/plain",
+                "last-modified": "Sun, 1 Jan 2006 12:00:00 GMT"
+            }
+        }
+    }
+    lambda_handler(mock_event, mock_context)
+    item = mock_boto3_resource.return_value.Table.return_value.put_item.call_args[1]['Item']
+    assert item['partition'] == '2009-04-14-13-00'
+    assert item['s3_dir_stage'].endswith('/hive-ads/tables/impressions')
+
+
+@mock.patch('boto3.resource')
+@mock.patch('boto3.client')
+def test_send_to_catalog(mock_boto3_client, mock_boto3_resource):
+    """
+    Test the catalog document of an ingested object, the stale copies of the latest/ keys are deleted after the put
+    :return:
+    """
+    import common
+    from common import DatalakeIngestion
+    ingestion = DatalakeIngestion(MockContext(), 'arn:aws:sns:us-east-1:111111111111:mock-datalake', 'false',
+                                  'mock-datalake-OdlControl-FFFF')
+    with mock.patch.object(common, 'es_put') as mock_es_put, \
+            mock.patch.object(common, 'es_request') as mock_es_request:
+        mock_es_put.return_value.status_code = 201
+        mock_es_put.return_value.json.return_value = {'_index': 'datalake-raw-2018.08.05-000002'}
+        ingestion.send_to_catalog('hive-ads/tables/impressions/dt=2009-04-14-13-00/file.log', {'size': 1})
+        assert not mock_es_request.called
+
+        ingestion.send_to_catalog('servicedesk/customer/ca_sdm/tb_call_req/latest/call_req.csv', {'size': 1})
+        query = mock_es_request.call_args[0][2]['query']['bool']
+        assert mock_es_request.call_args[0][1] == 'datalake-raw/_delete_by_query'
+        assert query['must_not'] == [{'term': {'_index': 'datalake-raw-2018.08.05-000002'}}]
+
+        mock_es_request.reset_mock()
+        mock_es_put.return_value.status_code = 500
+        ingestion.send_to_catalog('servicedesk/customer/ca_sdm/tb_call_req/latest/call_req.csv', {'size': 1})
+        assert not mock_es_request.called
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+#
+# tests/test_odl_ddb_update_es.py
+#
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import datetime
+import hashlib
+import json
+import os
+import sys
+
+import mock
+# We need to add the parent directory to the path to find the module to test
+lambda_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '../odl_ddb_update_es'))
+sys.path.insert(0, os.path.abspath(lambda_path))
+
+
+class MockContext(object):
+    def __init__(self):
+        self.function_name = 'mock'
+
+
+mock_image = {
+    's3_object_name': {'S': 's3://mock-raw/sampledb/tb_call_req/tb_call_req.csv'},
+    'raw_timestamp': {'S': '2018-07-06T10:00:00.000'},
+    'file_timestamp': {'S': 'Fri, 06 Jul 2018 10:00:00 GMT'},
+    'size': {'N': '1024'},
+    'ratio': {'N': '0.5'},
+    'partition': {'NULL': True},
+    'skip': {'BOOL': False},
+    'tags': {'SS': ['sampledb']},
+    'header': {'L': [{'S': 'id'}, {'N': '1'}]},
+    'metadata': {'M': {'S': {'S': 'attribute named S'}, 'rows': {'N': '10'}}}
+}
+mock_key = 's3://mock-raw/sampledb/tb_call_req/tb_call_req.csv'
+
+
+def mock_record(event_name, sequence_number, image):
+    record = {
+        'eventName': event_name,
+        'eventSourceARN': 'arn:aws:dynamodb:us-east-1:111111111111:'
+                          'table/mock-bigdata-datalake-OdlControl-FFFF/stream/2018-07-06T00:00:00.000',
+        'dynamodb': {
+            'Keys': {'s3_object_name': {'S': mock_key}},
+            'SequenceNumber': sequence_number
+        }
+    }
+    if image:
+        record['dynamodb']['Keys'] = {'s3_object_name': image['s3_object_name']}
+        record['dynamodb']['NewImage'] = image
+    return record
+
+
+mock_vars = {
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'SNS_TOPIC_ARN': 'arn:aws:sns:us-east-1:111111111111:mock-datalake',
+    'TYPE_HINTS': '{"size": "string"}'
+}
+with mock.patch.dict('os.environ', mock_vars):
+    with mock.patch('boto3.client') as mock_boto3_client:
+        with mock.patch('boto3.resource') as mock_boto3_resource:
+            # This function has its own common.py (only the ES functions), the common module loaded by the other
+            # tests is restored after the import
+            previous_common = sys.modules.pop('common', None)
+            # We need to load the lambda function here to mock the boto3 objects that are initialized
+            # when the module is loaded import lambda_handler
+            from odl_ddb_update_es import lambda_handler
+            from json_util import from_dynamodb, loads
+            if previous_common:
+                sys.modules['common'] = previous_common
+
+            def test_from_dynamodb():
+                """
+                Test the single pass converter of DynamoDB images
+                :return:
+                """
+                document = from_dynamodb(mock_image)
+                assert document == {
+                    's3_object_name': 's3://mock-raw/sampledb/tb_call_req/tb_call_req.csv',
+                    'raw_timestamp': datetime.datetime(2018, 7, 6, 10, 0, 0),
+                    'file_timestamp': 'Fri, 06 Jul 2018 10:00:00 GMT',
+                    'size': 1024,
+                    'ratio': 0.5,
+                    'partition': None,
+                    'skip': False,
+                    'tags': ['sampledb'],
+                    'header': ['id', 1],
+                    'metadata': {'S': 'attribute named S', 'rows': 10}
+                }
+                # Same values as the json round trip (except the attribute named S that the object_hook can't handle)
+                image = dict((key, value) for key, value in mock_image.items() if key != 'metadata')
+                assert from_dynamodb(image) == loads(image)
+                hints = {'raw_timestamp': 'string', 'size': 'float'}
+                assert from_dynamodb(image, hints)['raw_timestamp'] == '2018-07-06T10:00:00.000'
+                assert from_dynamodb(image, hints)['size'] == 1024.0
+
+            def test_ddb_update_es():
+                """
+                Test the odl_ddb_update_es function
+                :return:
+                """
+                mock_context = MockContext()
+                mock_event = {'Records': [mock_record('INSERT', '1', mock_image)]}
+                with mock.patch('odl_ddb_update_es.es_bulk') as mock_es_bulk:
+                    mock_es_bulk.return_value.status_code = 200
+                    mock_es_bulk.return_value.json.return_value = {'errors': False, 'items': [{'index': {}}]}
+                    assert lambda_handler(mock_event, mock_context) == {'batchItemFailures': []}
+                    actions = mock_es_bulk.call_args[0][0]
+                    assert len(actions) == 1
+                    action, metadata, document = actions[0]
+                    assert action == 'index'
+                    assert metadata == {'_index': 'datalake-odlcontrol', '_type': '_doc',
+                                        '_id': hashlib.md5(mock_key).hexdigest()}
+                    assert document['size'] == '1024'
+                    assert document['raw_timestamp'] == datetime.datetime(2018, 7, 6, 10, 0, 0)
+                    assert json.loads(json.dumps(document, default=mock_es_bulk.call_args[1]['default']))[
+                        'raw_timestamp'] == '2018-07-06T10:00:00.000000'
+
+            def test_ddb_update_es_collapse_and_failures():
+                """
+                Test the odl_ddb_update_es function collapsing the events of the same key and reporting the failures
+                :return:
+                """
+                mock_context = MockContext()
+                mock_other = dict(mock_image, s3_object_name={'S': 's3://mock-raw/other.csv'})
+                mock_event = {'Records': [
+                    mock_record('INSERT', '1', mock_image),
+                    mock_record('INSERT', '2', mock_other),
+                    mock_record('MODIFY', '3', mock_image),
+                    mock_record('REMOVE', '4', None)
+                ]}
+                with mock.patch('odl_ddb_update_es.es_bulk') as mock_es_bulk:
+                    mock_es_bulk.return_value.status_code = 200
+                    mock_es_bulk.return_value.json.return_value = {'errors': True, 'items': [
+                        {'index': {'status': 429, 'error': {'type': 'es_rejected_execution_exception'}}},
+                        {'delete': {'status': 404, 'result': 'not_found'}}
+                    ]}
+                    with mock.patch('odl_ddb_update_es.send_notification') as mock_send_notification:
+                        response = lambda_handler(mock_event, mock_context)
+                        assert [action for action, _, _ in mock_es_bulk.call_args[0][0]] == ['index', 'delete']
+                        assert response == {'batchItemFailures': [{'itemIdentifier': '2'}]}
+                        assert not mock_send_notification.called
+
+                        mock_es_bulk.return_value.status_code = 503
+                        response = lambda_handler(mock_event, mock_context)
+                        assert sorted(item['itemIdentifier'] for item in response['batchItemFailures']) == [
+                            '1', '2', '3', '4']
+                        assert mock_send_notification.call_count == 1
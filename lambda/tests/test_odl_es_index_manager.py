@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+#
+# tests/test_odl_es_index_manager.py
+#
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import pytest
+import sys
+
+import mock
+# We need to add the parent directory to the path to find the module to test
+lambda_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '../odl_es_index_manager'))
+sys.path.insert(0, os.path.abspath(lambda_path))
+
+
+class MockContext(object):
+    def __init__(self):
+        self.function_name = 'mock'
+
+
+class MockResponse(object):
+    def __init__(self, status_code, data=None):
+        self.status_code = status_code
+        self.text = str(data)
+        self._data = data or {}
+
+    def json(self):
+        return self._data
+
+
+def mock_es(existing):
+    """
+    Fake ES API with the existing indices/aliases
+    :param existing: dict index -> list of aliases
+    :return: function
+    """
+    def es_request(method, path, data=None, params=None):
+        if method == 'HEAD':
+            return MockResponse(200 if path in existing else 404)
+        if method == 'GET' and path.startswith('_alias/'):
+            alias = path.split('/')[1]
+            indices = dict((index, {}) for index, aliases in existing.items() if alias in aliases)
+            return MockResponse(200 if indices else 404, indices)
+        if method == 'POST' and path == '_reindex':
+            return MockResponse(200, {'task': 'mock-task'})
+        if method == 'PUT' and path.startswith('%3Cdatalake-raw-'):
+            return MockResponse(200, {'acknowledged': True, 'index': 'datalake-raw-2018.07.06-000001'})
+        return MockResponse(200)
+    return es_request
+
+
+mock_vars = {
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'SNS_TOPIC_ARN': 'arn:aws:sns:us-east-1:111111111111:mock-datalake'
+}
+with mock.patch.dict('os.environ', mock_vars):
+    with mock.patch('boto3.client') as mock_boto3_client:
+        with mock.patch('boto3.resource') as mock_boto3_resource:
+            # We need to load the lambda function here to mock the boto3 objects that are initialized
+            # when the module is loaded import lambda_handler
+            from odl_es_index_manager import lambda_handler, ROLLOVER
+
+            def test_es_index_manager_install():
+                """
+                Test the odl_es_index_manager function installing the templates on an empty cluster
+                :return:
+                """
+                mock_context = MockContext()
+                mock_event = {'Action': 'install'}
+                with mock.patch('odl_es_index_manager.es_request', side_effect=mock_es({})) as mock_es_request:
+                    indices = lambda_handler(mock_event, mock_context)
+                    assert indices == {'datalake-hive': 'datalake-hive-v1',
+                                       'datalake-odlcontrol': 'datalake-odlcontrol-v1',
+                                       'datalake-raw': 'datalake-raw-2018.07.06-000001',
+                                       'datalake-tags': 'datalake-tags-v1'}
+                    mock_es_request.assert_any_call('PUT', 'datalake-hive-v1')
+                    mock_es_request.assert_any_call('POST', '_aliases', {'actions': [
+                        {'add': {'index': 'datalake-hive-v1', 'alias': 'datalake-hive'}}
+                    ]})
+                    template = [call[0][2] for call in mock_es_request.call_args_list
+                                if call[0][:2] == ('PUT', '_template/datalake-hive')][0]
+                    mapping = template['mappings']['_doc']
+                    assert mapping['dynamic'] == 'strict'
+                    assert mapping['properties']['columns']['type'] == 'nested'
+                    assert template['index_patterns'] == ['datalake-hive-v*']
+                    # The profile min/max strings are not detected as dates
+                    template = [call[0][2] for call in mock_es_request.call_args_list
+                                if call[0][:2] == ('PUT', '_template/datalake-odlcontrol')][0]
+                    columns = template['mappings']['_doc']['properties']['data_profile']['properties']['columns']
+                    assert columns['properties']['min']['type'] == 'keyword'
+                    mock_es_request.assert_any_call('PUT', '%3Cdatalake-raw-%7Bnow%2Fd%7D-000001%3E', {
+                        'aliases': {'datalake-raw-write': {}, 'datalake-raw': {}}
+                    })
+
+            def test_es_index_manager_install_migrate():
+                """
+                Test the odl_es_index_manager function replacing an index created by the dynamic mapping by the alias
+                :return:
+                """
+                mock_context = MockContext()
+                mock_event = {'Action': 'install', 'Indices': ['datalake-hive']}
+                existing = {'datalake-hive': [], 'datalake-tags-v1': ['datalake-tags']}
+                with mock.patch('odl_es_index_manager.es_request', side_effect=mock_es(existing)) as mock_es_request:
+                    assert lambda_handler(mock_event, mock_context) == {'datalake-hive': 'datalake-hive-v1'}
+                    reindex = [call for call in mock_es_request.call_args_list if call[0][1] == '_reindex'][0]
+                    assert reindex[0][2]['source'] == {'index': 'datalake-hive'}
+                    assert 'columns' in reindex[0][2]['script']['source']
+                    mock_es_request.assert_any_call('POST', '_aliases', {'actions': [
+                        {'add': {'index': 'datalake-hive-v1', 'alias': 'datalake-hive'}},
+                        {'remove_index': {'index': 'datalake-hive'}}
+                    ]})
+
+            def test_es_index_manager_install_migrate_write_index():
+                """
+                Test the odl_es_index_manager function replacing an index auto-created with the write alias name
+                :return:
+                """
+                mock_context = MockContext()
+                mock_event = {'Action': 'install', 'Indices': ['datalake-raw']}
+                existing = {'datalake-raw-write': []}
+                with mock.patch('odl_es_index_manager.es_request', side_effect=mock_es(existing)) as mock_es_request:
+                    indices = lambda_handler(mock_event, mock_context)
+                    assert indices == {'datalake-raw': 'datalake-raw-2018.07.06-000001'}
+                    mock_es_request.assert_any_call('PUT', '%3Cdatalake-raw-%7Bnow%2Fd%7D-000001%3E', {
+                        'aliases': {'datalake-raw': {}}
+                    })
+                    reindex = [call for call in mock_es_request.call_args_list if call[0][1] == '_reindex'][0]
+                    assert reindex[0][2]['source'] == {'index': 'datalake-raw-write'}
+                    mock_es_request.assert_any_call('POST', '_aliases', {'actions': [
+                        {'add': {'index': 'datalake-raw-2018.07.06-000001', 'alias': 'datalake-raw-write'}},
+                        {'remove_index': {'index': 'datalake-raw-write'}}
+                    ]})
+
+            def test_es_index_manager_reindex_and_swap():
+                """
+                Test the odl_es_index_manager function reindexing an alias to the new template version
+                :return:
+                """
+                mock_context = MockContext()
+                existing = {'datalake-tags-v0': ['datalake-tags']}
+                with mock.patch('odl_es_index_manager.es_request', side_effect=mock_es(existing)) as mock_es_request:
+                    response = lambda_handler({'Action': 'reindex', 'Index': 'datalake-tags'}, mock_context)
+                    assert response == {'Index': 'datalake-tags', 'Target': 'datalake-tags-v1', 'Task': 'mock-task'}
+                    response = lambda_handler({'Action': 'swap', 'Index': 'datalake-tags'}, mock_context)
+                    assert response['Previous'] == ['datalake-tags-v0']
+                    mock_es_request.assert_called_with('POST', '_aliases', {'actions': [
+                        {'remove': {'index': 'datalake-tags-v0', 'alias': 'datalake-tags'}},
+                        {'add': {'index': 'datalake-tags-v1', 'alias': 'datalake-tags'}}
+                    ]})
+
+                existing = {'datalake-tags-v1': ['datalake-tags']}
+                with mock.patch('odl_es_index_manager.es_request', side_effect=mock_es(existing)):
+                    with pytest.raises(Exception, match=r'.*(increase the template version).*'):
+                        lambda_handler({'Action': 'reindex', 'Index': 'datalake-tags'}, mock_context)
+
+            def test_es_index_manager_rollover():
+                """
+                Test the odl_es_index_manager function rolling over the datalake-raw write alias
+                :return:
+                """
+                mock_context = MockContext()
+                with mock.patch('odl_es_index_manager.es_request') as mock_es_request:
+                    mock_es_request.return_value = MockResponse(200, {'rolled_over': True,
+                                                                      'old_index': 'datalake-raw-2018.07.06-000001',
+                                                                      'new_index': 'datalake-raw-2018.08.05-000002'})
+                    response = lambda_handler({'Action': 'rollover'}, mock_context)
+                    assert response['datalake-raw']['rolled_over']
+                    mock_es_request.assert_called_once_with('POST', 'datalake-raw-write/_rollover', {
+                        'conditions': {'max_age': '30d', 'max_size': '50gb'},
+                        'aliases': {'datalake-raw': {}}
+                    })
+
+            def test_es_index_manager_lifecycle():
+                """
+                Test the odl_es_index_manager function applying the lifecycle steps to the datalake-raw indices
+                :return:
+                """
+                import datetime
+                mock_context = MockContext()
+                today = datetime.date.today()
+
+                def name(days, counter, suffix=''):
+                    date = (today - datetime.timedelta(days=days)).strftime('%Y.%m.%d')
+                    return 'datalake-raw-{}-{:06d}{}'.format(date, counter, suffix)
+
+                existing = {
+                    'datalake-raw-v1': ['datalake-raw'],
+                    name(400, 1): ['datalake-raw'],
+                    name(60, 2): ['datalake-raw'],
+                    name(40, 3, '-shrink'): ['datalake-raw'],
+                    name(30, 4): ['datalake-raw'],
+                    name(1, 5): ['datalake-raw', 'datalake-raw-write']
+                }
+                settings = {
+                    name(60, 2): {'number_of_shards': '2'},
+                    name(40, 3, '-shrink'): {'number_of_shards': '1', 'blocks': {'write': 'true'}},
+                    name(30, 4): {'number_of_shards': '2', 'blocks': {'write': 'true'},
+                                  'routing': {'allocation': {'require': {'_name': 'node-a'}}}}
+                }
+                fake_es = mock_es(existing)
+
+                def es_request(method, path, data=None, params=None):
+                    if method == 'GET' and path.endswith('/_settings'):
+                        index = path.split('/')[0]
+                        return MockResponse(200, {index: {'settings': {'index': settings[index]}}})
+                    if method == 'GET' and path == '_cat/nodes':
+                        return MockResponse(200, [{'name': 'node-b', 'node.role': 'mdi'},
+                                                  {'name': 'node-a', 'node.role': 'mdi'}])
+                    if method == 'GET' and path.startswith('_cluster/health/'):
+                        return MockResponse(200, {'status': 'green', 'timed_out': False, 'relocating_shards': 0})
+                    return fake_es(method, path, data, params)
+
+                with mock.patch('odl_es_index_manager.es_request', side_effect=es_request) as mock_es_request, \
+                        mock.patch.dict('odl_es_index_manager.ROLLOVER', {'datalake-raw': dict(
+                            ROLLOVER['datalake-raw'], delete_after_days=365)}):
+                    steps = lambda_handler({'Action': 'lifecycle'}, mock_context)['datalake-raw']
+                    assert steps == {
+                        name(400, 1): 'deleted',
+                        name(60, 2): 'allocating to node-a',
+                        name(40, 3, '-shrink'): 'done',
+                        name(30, 4): 'shrinking'
+                    }
+                    mock_es_request.assert_any_call('DELETE', name(400, 1))
+                    mock_es_request.assert_any_call('PUT', '{}/_settings'.format(name(60, 2)), {
+                        'index.routing.allocation.require._name': 'node-a',
+                        'index.blocks.write': True
+                    })
+                    shrink = [call for call in mock_es_request.call_args_list if '/_shrink/' in call[0][1]][0]
+                    assert shrink[0][1] == '{}/_shrink/{}-shrink'.format(name(30, 4), name(30, 4))
@@ -16,6 +16,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import hashlib
+import json
 import os
 import sys
 
@@ -52,7 +54,8 @@ with mock.patch.dict('os.environ', mock_vars):
         with mock.patch('boto3.resource') as mock_boto3_resource:
             # We need to load the lambda function here to mock the boto3 objects that are initialized
             # when the module is loaded
-            from odl_spark_submit import lambda_handler
+            from odl_spark_submit import conf_args, job_server_step, job_server_step_pending, job_spec_args, \
+                lambda_handler, layout_args, profile_conf, rollups_conf, send_to_job_server, write_manifest
 
             def test_invoke_spark_submit_with_no_valid_cluster():
                 """
@@ -71,3 +74,141 @@ with mock.patch.dict('os.environ', mock_vars):
                 mock_context = MockContext()
                 mock_event = {}
                 lambda_handler(mock_event, mock_context)
+
+            def test_layout_args():
+                """
+                Test the spark-submit arguments with the Parquet layout of the job catalog
+                :return:
+                """
+                from decimal import Decimal
+                assert layout_args(None) == []
+                assert layout_args('{"sort_by": ["status"]}') == ['--conf',
+                                                                  'spark.datalake.layout={"sort_by": ["status"]}']
+                args = layout_args({'zorder_by': ['customer', 'date_time'], 'row_group_mb': Decimal('64')})
+                assert args[0] == '--conf'
+                assert args[1].startswith('spark.datalake.layout=')
+                assert json.loads(args[1].split('=', 1)[1]) == {'zorder_by': ['customer', 'date_time'],
+                                                                'row_group_mb': 64}
+
+            def test_job_spec_args():
+                """
+                Test the arguments of the generic Spark job runner
+                :return:
+                """
+                variables = {'s3_dir_stage': 's3://mock-stage/tb_table1', 'hive_table_raw': 'tb_table1'}
+                assert job_spec_args('/home/hadoop/code/', 'tb_table1.json', variables) == [
+                    '--spec', '/home/hadoop/code/jobs/tb_table1.json',
+                    '--var', 'hive_table_raw=tb_table1',
+                    '--var', 's3_dir_stage=s3://mock-stage/tb_table1'
+                ]
+                args = job_spec_args('/home/hadoop/code/', 'tb_impressions.json', {}, 'dt=2018-07-06')
+                assert args == ['--spec', '/home/hadoop/code/jobs/tb_impressions.json', '--partition', 'dt=2018-07-06']
+
+            def test_send_to_job_server():
+                """
+                Test the message of the job spec sent to the job server queue
+                :return:
+                """
+                from decimal import Decimal
+                queue_url = 'https://sqs.us-east-1.amazonaws.com/111111111111/mock-jobs'
+                with mock.patch('odl_spark_submit.JOB_SERVER_QUEUE_URL', queue_url):
+                    send_to_job_server('s3://mock-stage/tb_impressions/dt=2018-07-06/file.json', 'tb_impressions.json',
+                                       {'hive_table_analytics': 'tb_impressions'}, 'dt=2018-07-06',
+                                       {'files': Decimal('8')})
+                kwargs = mock_boto3_client.return_value.send_message.call_args[1]
+                assert kwargs['QueueUrl'] == queue_url
+                assert json.loads(kwargs['MessageBody']) == {
+                    's3_object_name_stage': 's3://mock-stage/tb_impressions/dt=2018-07-06/file.json',
+                    'spec': 'tb_impressions.json',
+                    'variables': {'hive_table_analytics': 'tb_impressions'},
+                    'partition': 'dt=2018-07-06',
+                    'layout': {'files': 8}
+                }
+
+            def test_job_server_step():
+                """
+                Test the step starting the job server on the running cluster
+                :return:
+                """
+                queue_url = 'https://sqs.us-east-1.amazonaws.com/111111111111/mock-jobs'
+                step = job_server_step('/home/hadoop', 's3://mock-programs/spark_programs', queue_url,
+                                       'mock-datalake-OdlStageControl-FFFFFFFFFFF', 'mock-datalake-OdlControl')
+                args = step['HadoopJarStep']['Args']
+                assert step['Name'] == 'Start the Spark job server'
+                assert step['ActionOnFailure'] == 'CONTINUE'
+                assert args[0] == '/home/hadoop/start_job_server.sh'
+                assert args[2:4] == [queue_url, 'mock-datalake-OdlStageControl-FFFFFFFFFFF']
+
+            def test_job_server_step_pending():
+                """
+                Test the check of the step starting the job server on the running cluster
+                :return:
+                """
+                with mock.patch('odl_spark_submit.emr_client') as mock_emr_client:
+                    mock_emr_client.get_paginator.return_value.paginate.return_value = [
+                        {'Steps': [{'Name': 's3://mock-stage/tb_table1/file.csv'}]},
+                        {'Steps': [{'Name': 'Start the Spark job server'}]}
+                    ]
+                    assert job_server_step_pending('j-FFFFFFFFFFFFF')
+                    mock_emr_client.get_paginator.return_value.paginate.assert_called_with(
+                        ClusterId='j-FFFFFFFFFFFFF', StepStates=['PENDING', 'RUNNING'])
+                    mock_emr_client.get_paginator.return_value.paginate.return_value = [{'Steps': []}]
+                    assert not job_server_step_pending('j-FFFFFFFFFFFFF')
+
+            def test_profile_conf():
+                """
+                Test the Spark confs of the data profile of the job catalog item
+                :return:
+                """
+                from decimal import Decimal
+                assert profile_conf(None, 'db_analytics', 'tb_table1', 's3://mock-stage/file.csv') == {}
+                step_name = 's3://mock-stage/table1/file.csv'
+                with mock.patch('odl_spark_submit.S3_BUCKET_PROGRAMS', 'mock-programs'):
+                    conf = profile_conf({'min_rows': Decimal('1'), 'max_null_ratio': {'*': Decimal('0.5')}},
+                                        'db_analytics', 'tb_table1', step_name)
+                    assert profile_conf('', 'db_analytics', 'tb_table1', step_name)['spark.datalake.profile'] == '{}'
+                assert json.loads(conf['spark.datalake.profile']) == {'min_rows': 1, 'max_null_ratio': {'*': 0.5}}
+                assert conf['spark.datalake.profile.path'] == \
+                    's3://mock-programs/profiles/db_analytics/tb_table1/{}.json'.format(
+                        hashlib.md5(step_name.encode('utf-8')).hexdigest())
+                assert conf_args(conf) == [
+                    '--conf', 'spark.datalake.profile={}'.format(conf['spark.datalake.profile']),
+                    '--conf', 'spark.datalake.profile.path={}'.format(conf['spark.datalake.profile.path'])
+                ]
+
+            def test_rollups_conf():
+                """
+                Test the Spark conf of the rollups of the job catalog item
+                :return:
+                """
+                assert rollups_conf(None) == {}
+                rollups = [{'table': 'db_ads.tb_impressions_hourly', 'keys': ['adid'],
+                            'measures': [{'name': 'impressions', 'agg': 'count'}]}]
+                conf = rollups_conf(rollups)
+                assert json.loads(conf['spark.datalake.rollups']) == rollups
+                assert rollups_conf(json.dumps(rollups)) == conf
+
+            def test_write_manifest():
+                """
+                Test the manifest with the stage files of a manifest job
+                :return:
+                """
+                from decimal import Decimal
+                items = [
+                    {'s3_object_name_stage': 's3://mock-stage/iba/br/laminacao/dt=2018-07-06/file1.txt',
+                     'size': Decimal('1048576')},
+                    {'s3_object_name_stage': 's3://mock-stage/iba/br/laminacao/dt=2018-07-06/file2.txt'}
+                ]
+                with mock.patch('odl_spark_submit.S3_BUCKET_PROGRAMS', 'mock-programs'):
+                    path = write_manifest('s3://mock-stage/iba/br/laminacao', '2018-07-06', items)
+                assert path.startswith('s3://mock-programs/manifests/mock-stage/iba/br/laminacao/2018-07-06-')
+                assert path.endswith('.manifest.json')
+                kwargs = mock_boto3_client.return_value.put_object.call_args[1]
+                assert kwargs['Bucket'] == 'mock-programs'
+                assert 's3://{}/{}'.format(kwargs['Bucket'], kwargs['Key']) == path
+                manifest = json.loads(kwargs['Body'].decode('utf-8'))
+                assert manifest['s3_data_source'] == 's3://mock-stage/iba/br/laminacao'
+                assert manifest['files'] == [
+                    {'path': 's3://mock-stage/iba/br/laminacao/dt=2018-07-06/file1.txt', 'size': 1048576},
+                    {'path': 's3://mock-stage/iba/br/laminacao/dt=2018-07-06/file2.txt', 'size': None}
+                ]
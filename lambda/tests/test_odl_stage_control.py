@@ -339,3 +339,63 @@ with mock.patch.dict('os.environ', mock_vars):
                 lambda_handler(mock_event, mock_context)
                 mock_boto3_resource.return_value.Table.return_value.put_item.side_effect = None
                 mock_boto3_client.return_value.publish.side_effect = None
+
+            def test_invoke_stage_control_fast_path():
+                """
+                Test the odl_stage_control function sending a small file to the fast path function
+                :return:
+                """
+                mock_context = MockContext()
+                mock_event = {
+                    "Records": [
+                        {
+                            "dynamodb": {
+                                "Keys": {
+                                    "s3_object_name": {
+                                        "S": "s3://mock-bigdata-raw-dev/dummy/dummy-1.txt"
+                                    }
+                                },
+                                "NewImage": {
+                                    "file_status": {
+                                        "S": "STAGE"
+                                    },
+                                    "partition": {
+                                        "S": "false"
+                                    },
+                                    "s3_dir_stage": {
+                                        "S": "s3://mock-bigdata-stage-dev/dummy"
+                                    },
+                                    "s3_object_name_stage": {
+                                        "S": "s3://mock-bigdata-stage-dev/dummy/dummy-1.txt"
+                                    },
+                                    "size": {
+                                        "N": "1024"
+                                    }
+                                }
+                            },
+                            "eventName": "MODIFY"
+                        }
+                    ]
+                }
+                with mock.patch('odl_stage_control.FAST_PATH_FUNCTION', 'mock-convert-parquet'), \
+                        mock.patch('odl_stage_control.dynamodb_resource') as mock_dynamodb, \
+                        mock.patch('odl_stage_control.lambda_client') as mock_lambda:
+                    mock_table = mock_dynamodb.Table.return_value
+                    mock_table.get_item.return_value = {'Item': {'Enabled': 'True', 'fast_path': 'True'}}
+                    lambda_handler(mock_event, mock_context)
+                    item = mock_table.put_item.call_args[1]['Item']
+                    assert item['size'] == 1024
+                    assert item['engine'] == 'lambda'
+                    assert mock_lambda.invoke.call_args[1]['FunctionName'] == 'mock-convert-parquet'
+
+                    # Big files and the jobs without the fast path go to EMR
+                    mock_event['Records'][0]['dynamodb']['NewImage']['size']['N'] = str(100 * 1024 * 1024)
+                    mock_lambda.reset_mock()
+                    lambda_handler(mock_event, mock_context)
+                    assert 'engine' not in mock_table.put_item.call_args[1]['Item']
+                    assert not mock_lambda.invoke.called
+                    mock_event['Records'][0]['dynamodb']['NewImage']['size']['N'] = '1024'
+                    mock_table.get_item.return_value = {'Item': {'Enabled': 'True'}}
+                    lambda_handler(mock_event, mock_context)
+                    assert 'engine' not in mock_table.put_item.call_args[1]['Item']
+                    assert not mock_lambda.invoke.called
@@ -16,6 +16,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import json
 import os
 import sys
 
@@ -51,7 +52,7 @@ with mock.patch.dict('os.environ', mock_vars):
         with mock.patch('boto3.resource') as mock_boto3_resource:
             # We need to load the lambda function here to mock the boto3 objects that are initialized
             # when the module is loaded
-            from odl_validate_job_submit import lambda_handler
+            from odl_validate_job_submit import get_profile, lambda_handler, stage_objects
 
             def test_invoke_validate_job_submit():
                 """
@@ -80,3 +81,76 @@ with mock.patch.dict('os.environ', mock_vars):
                     "resources": []
                 }
                 lambda_handler(mock_event, mock_context)
+
+            def test_manifest_stage_objects():
+                """
+                Test the stage objects of the steps with and without manifest
+                :return:
+                """
+                step_name = 's3://datalake-stage/sap/ge2/global/financial/bkpf/dt=2018-03-08/ge2_bkpf_201803081134.csv'
+                assert stage_objects(step_name) == [step_name]
+                manifest = {
+                    'files': [
+                        {'path': 's3://mock-stage/iba/br/laminacao/dt=2018-07-06/file1.txt', 'size': 10},
+                        {'path': 's3://mock-stage/iba/br/laminacao/dt=2018-07-06/file2.txt', 'size': 20}
+                    ]
+                }
+                mock_boto3_client.return_value.get_object.return_value = {
+                    'Body': mock.Mock(read=mock.Mock(return_value=json.dumps(manifest).encode('utf-8')))
+                }
+                manifest_path = 's3://mock-programs/manifests/mock-stage/iba/br/laminacao/20180706100000.manifest.json'
+                assert stage_objects(manifest_path) == [
+                    's3://mock-stage/iba/br/laminacao/dt=2018-07-06/file1.txt',
+                    's3://mock-stage/iba/br/laminacao/dt=2018-07-06/file2.txt'
+                ]
+                mock_boto3_client.return_value.get_object.assert_called_with(
+                    Bucket='mock-programs', Key='manifests/mock-stage/iba/br/laminacao/20180706100000.manifest.json')
+
+            def test_validate_manifest_step():
+                """
+                Test the completed step of a manifest job: one shutdown check and no stage file deleted (the program
+                deleted them)
+                :return:
+                """
+                mock_context = MockContext()
+                mock_event = {
+                    "detail": {
+                        "stepId": "s-2PZOH669N5LUO",
+                        "clusterId": "j-PES1EPZ6LHJU",
+                        "state": "COMPLETED",
+                        "message": "Step s-2PZOH669N5LUO completed",
+                        "name": "s3://mock-programs/manifests/mock-stage/iba/br/laminacao/20180706100000.manifest.json"
+                    }
+                }
+                files = ['s3://mock-stage/iba/br/laminacao/dt=2018-07-06/file1.txt',
+                         's3://mock-stage/iba/br/laminacao/dt=2018-07-06/file2.txt']
+                with mock.patch('odl_validate_job_submit.stage_objects', return_value=files), \
+                        mock.patch('odl_validate_job_submit.check_files_shutdown_emr') as mock_check_shutdown, \
+                        mock.patch('odl_validate_job_submit.s3_client') as mock_s3_client:
+                    lambda_handler(mock_event, mock_context)
+                    mock_check_shutdown.assert_called_once_with('j-PES1EPZ6LHJU', mock_context)
+                    assert not mock_s3_client.delete_object.called
+
+            def test_get_profile():
+                """
+                Test the data profile read for the control table
+                :return:
+                """
+                from decimal import Decimal
+                from botocore.exceptions import ClientError
+                profile = {'rows': 10, 'status': 'OK', 'columns': [{'name': 'id', 'nulls': 0, 'null_ratio': 0.25}]}
+                mock_boto3_client.return_value.get_object.return_value = {
+                    'Body': mock.Mock(read=mock.Mock(return_value=json.dumps(profile).encode('utf-8')))
+                }
+                profile_path = 's3://mock-programs/profiles/db_analytics/tb_table1/0123456789abcdef.json'
+                assert get_profile(profile_path) == {
+                    'rows': 10, 'status': 'OK', 'columns': [{'name': 'id', 'nulls': 0, 'null_ratio': Decimal('0.25')}]
+                }
+                mock_boto3_client.return_value.get_object.assert_called_with(
+                    Bucket='mock-programs', Key='profiles/db_analytics/tb_table1/0123456789abcdef.json')
+                mock_boto3_client.return_value.get_object.side_effect = ClientError(
+                    {'Error': {'Code': 'NoSuchKey', 'Message': 'Not Found'}}, 'GetObject')
+                try:
+                    assert get_profile(profile_path) is None
+                finally:
+                    mock_boto3_client.return_value.get_object.side_effect = None